@@ -49,6 +49,7 @@ from aws_cdk import (
     aws_elasticloadbalancingv2 as elbv2,
     aws_elasticloadbalancingv2_targets as elbv2_targets,
     aws_events as events,
+    aws_events_targets as events_targets,
     aws_fsx as fsx,
     aws_lambda as aws_lambda,
     aws_logs as logs,
@@ -58,6 +59,7 @@ from aws_cdk import (
     aws_cloudwatch as cloudwatch,
     aws_cloudwatch_actions as cw_actions,
     aws_sns as sns,
+    aws_sqs as sqs,
     aws_route53resolver as route53resolver,
     aws_ssm as ssm,
     aws_kms as kms,
@@ -707,6 +709,7 @@ class SOCAInstall(Stack):
             "get_es_private_ip_lambda_role": None,
             "login_node_sg": None,
             "nat_gateway_ips": [],
+            "node_events_queue": None,
             "controller_eip": None,
             "controller_instance": None,
             "controller_role": None,
@@ -1195,6 +1198,40 @@ class SOCAInstall(Stack):
             )
         )
 
+        # EC2 state-change notifications consumed by nodes_manager.py --events
+        self.soca_resources["node_events_queue"] = sqs.Queue(
+            self,
+            f"{user_specified_variables.cluster_id}-NodeEventsQueue",
+            queue_name=f"{user_specified_variables.cluster_id}-NodeEvents",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            retention_period=Duration.hours(1),
+            visibility_timeout=Duration.seconds(60),
+        )
+
+        events.Rule(
+            self,
+            f"{user_specified_variables.cluster_id}-NodeEventsRule",
+            rule_name=f"{user_specified_variables.cluster_id}-NodeEvents",
+            description="Forward EC2 instance state changes to nodes_manager.py",
+            event_pattern=events.EventPattern(
+                source=["aws.ec2"],
+                detail_type=["EC2 Instance State-change Notification"],
+                detail={
+                    "state": [
+                        "running",
+                        "stopping",
+                        "stopped",
+                        "shutting-down",
+                        "terminated",
+                    ]
+                },
+            ),
+            targets=[
+                events_targets.SqsQueue(self.soca_resources["node_events_queue"])
+            ],
+        )
+
     def network(self):
         """
         Create a VPC with 3 public and 3 private subnets.
@@ -4584,6 +4621,7 @@ class SOCAInstall(Stack):
             "FileSystemData": _fs_data_mount,
             "FileSystemAppsProvider": _fs_apps_provider,
             "FileSystemApps": _fs_apps_mount,
+            "NodeEventsQueueUrl": self.soca_resources["node_events_queue"].queue_url,
             "SkipQuotas": get_config_key(
                 key_name="Config.skip_quotas", default=False, required=False
             ),
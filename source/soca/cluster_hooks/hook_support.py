@@ -0,0 +1,437 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Shared support module for the queuejob hooks (cluster_hooks/queuejob/*.py).
+This file is not a hook: it is imported by the hooks and must not be placed in cluster_hooks/queuejob.
+
+The hooks run on every qsub. Instead of parsing /etc/environment, queue_mapping.yml, licenses_mapping.yml and
+project_cost_manager.txt and querying SSM / Secrets Manager / LDAP each time, they read a precompiled snapshot:
+- kept in memory by the PBS server Python interpreter between two hook events
+- persisted in a pickle file (root only) so a restarted interpreter does not have to parse the YAML files again
+- invalidated when the mtime of one of the source files changes, LDAP group memberships expire after group_members_ttl seconds
+  (the last known membership is used for up to group_members_max_stale_age seconds when the directory can't be queried)
+
+Usage from a hook:
+    sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+    import hook_support
+    hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
+    queue_settings = hook_cache.get_queue_settings(job_queue)
+
+The snapshot can be rebuilt manually (e.g: after an update of queue_mapping.yml) with:
+    python3 hook_support.py --soca-home /opt/soca/<cluster_id>
+"""
+
+import json
+import os
+import pickle
+import re
+import time
+
+try:
+    import pbs
+except ImportError:
+    # Used outside of PBS to rebuild the snapshot
+    pbs = None
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE_NAME = ".queuejob_hooks_cache.pkl"
+GROUP_MEMBERS_TTL = 300
+GROUP_MEMBERS_MAX_STALE_AGE = 3600
+
+
+class HookSupportError(Exception):
+    """
+    Configuration error, the message can be returned to the user with e.reject()
+    """
+
+
+def _log(message):
+    if pbs is not None:
+        pbs.logmsg(pbs.LOG_DEBUG, f"hook_support: {message}")
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def parse_environment_file(filename="/etc/environment"):
+    """
+    Read /etc/environment and return a dict
+    """
+    _environment = {}
+    with open(filename, "r") as _file:
+        for _line in _file.read().split("\n"):
+            if _line.startswith("#") or "=" not in _line:
+                continue
+            _key, _, _value = _line.partition("=")
+            _environment[_key.replace("export ", "").strip()] = _value
+    return _environment
+
+
+def parse_project_cost_manager(filename):
+    """
+    Read project_cost_manager.txt and return {project: [users]}
+    """
+    from configparser import ConfigParser
+
+    _config = ConfigParser(allow_no_value=True)
+    with open(filename, "r") as _file:
+        _config.read_file(_file)
+    return {_section: _config.options(_section) for _section in _config.sections()}
+
+
+def compile_queue_mapping(queue_mapping):
+    """
+    Return {queue_name: [queue settings, ...]} from the parsed queue_mapping.yml, in the order of the file.
+    Entries with an invalid "queues" are kept under None so the hooks can report them.
+    """
+    _queues = {}
+    for _queue_type in (queue_mapping or {}).values():
+        for _queue_settings in _queue_type.values():
+            _queue_names = _queue_settings.get("queues", [])
+            if not isinstance(_queue_names, list):
+                _queues.setdefault(None, []).append(_queue_settings)
+                continue
+            for _queue_name in _queue_names:
+                _queues.setdefault(_queue_name, []).append(_queue_settings)
+    return _queues
+
+
+class QueueJobHookCache:
+    def __init__(
+        self,
+        soca_home,
+        environment_file="/etc/environment",
+        group_members_ttl=GROUP_MEMBERS_TTL,
+        group_members_max_stale_age=GROUP_MEMBERS_MAX_STALE_AGE,
+    ):
+        self.soca_home = soca_home
+        self.environment_file = environment_file
+        self.group_members_ttl = group_members_ttl
+        self.group_members_max_stale_age = group_members_max_stale_age
+        self.queue_settings_file = (
+            f"{soca_home}/cluster_manager/orchestrator/settings/queue_mapping.yml"
+        )
+        self.license_settings_file = (
+            f"{soca_home}/cluster_manager/orchestrator/settings/licenses_mapping.yml"
+        )
+        self.budget_config_file = f"{soca_home}/cluster_manager/orchestrator/settings/project_cost_manager.txt"
+        # Written by cluster_manager/orchestrator/project_budget_snapshot.py
+        self.budget_snapshot_file = (
+            f"{soca_home}/cluster_manager/orchestrator/project_budget_snapshot.json"
+        )
+        self.snapshot_file = f"{soca_home}/cluster_hooks/{SNAPSHOT_FILE_NAME}"
+        self._budget_snapshot = (None, None)
+        self._snapshot = None
+        self._snapshot_file_mtime = None
+        self._clients = {}
+        self._ad_bind_information = None
+
+    def _sources(self):
+        return {
+            "environment": self.environment_file,
+            "queue_mapping": self.queue_settings_file,
+            "licenses_mapping": self.license_settings_file,
+            "project_budgets": self.budget_config_file,
+        }
+
+    def _load_snapshot_file(self):
+        try:
+            _stat = os.stat(self.snapshot_file)
+        except OSError:
+            return None
+        if _stat.st_mtime == self._snapshot_file_mtime:
+            return self._snapshot
+        # Never unpickle a file which could have been written by a non-root user
+        if _stat.st_uid != 0 or _stat.st_mode & 0o022:
+            _log(
+                f"Ignoring {self.snapshot_file}, must be owned and writable by root only"
+            )
+            return None
+        try:
+            with open(self.snapshot_file, "rb") as _file:
+                _snapshot = pickle.load(_file)
+        except Exception as _err:
+            _log(f"Unable to read {self.snapshot_file}: {_err}")
+            return None
+        if _snapshot.get("version") != SNAPSHOT_VERSION:
+            return None
+        self._snapshot_file_mtime = _stat.st_mtime
+        return _snapshot
+
+    def _save_snapshot_file(self):
+        _tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        try:
+            _fd = os.open(_tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(_fd, "wb") as _file:
+                pickle.dump(self._snapshot, _file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(_tmp_file, self.snapshot_file)
+            self._snapshot_file_mtime = _get_mtime(self.snapshot_file)
+        except Exception as _err:
+            # The snapshot is still used in memory
+            _log(f"Unable to write {self.snapshot_file}: {_err}")
+            if os.path.exists(_tmp_file):
+                os.remove(_tmp_file)
+
+    def _build(self, name, path):
+        # Parsing errors are stored in the snapshot so they are reported to the user until the file is fixed
+        try:
+            if name == "environment":
+                return {"value": parse_environment_file(path), "error": None}
+            if name == "project_budgets":
+                return {"value": parse_project_cost_manager(path), "error": None}
+
+            import yaml
+
+            with open(path, "r") as _file:
+                _value = yaml.safe_load(_file)
+            if name == "queue_mapping":
+                _value = {
+                    "docs": _value,
+                    "queues": compile_queue_mapping(_value),
+                }
+            return {"value": _value, "error": None}
+        except Exception as _err:
+            return {"value": None, "error": str(_err)}
+
+    def refresh(self):
+        """
+        Make sure the snapshot matches the source files, only the modified files are parsed again.
+        This costs one stat() per source file when nothing has changed.
+        """
+        if self._snapshot is None or _get_mtime(self.snapshot_file) not in (
+            None,
+            self._snapshot_file_mtime,
+        ):
+            self._snapshot = self._load_snapshot_file() or {
+                "version": SNAPSHOT_VERSION,
+                "mtimes": {},
+                "data": {},
+                "group_members": {},
+                "user_directory_provider": None,
+            }
+
+        _modified = False
+        for _name, _path in self._sources().items():
+            _mtime = _get_mtime(_path)
+            if (
+                _name not in self._snapshot["data"]
+                or self._snapshot["mtimes"].get(_name) != _mtime
+            ):
+                _log(f"Loading {_path}")
+                self._snapshot["data"][_name] = self._build(_name, _path)
+                self._snapshot["mtimes"][_name] = _mtime
+                if _name == "environment":
+                    self._snapshot["user_directory_provider"] = None
+                    self._snapshot["group_members"] = {}
+                _modified = True
+
+        if _modified:
+            self._save_snapshot_file()
+        return self
+
+    def _get(self, name):
+        _data = self._snapshot["data"][name]
+        if _data["error"] is not None:
+            raise HookSupportError(_data["error"])
+        return _data["value"]
+
+    def get_environment(self):
+        """
+        Return /etc/environment as a dict, PBS does not pass the environment to the hooks
+        """
+        return self._get("environment")
+
+    def get_queue_mapping(self):
+        """
+        Return the parsed queue_mapping.yml
+        """
+        return self._get("queue_mapping")["docs"]
+
+    def get_queue_settings(self, queue_name):
+        """
+        Return the list of queue_mapping.yml entries (in file order) whose "queues" contains queue_name
+        """
+        return self._get("queue_mapping")["queues"].get(queue_name, [])
+
+    def get_invalid_queue_settings(self, queue_name):
+        """
+        Return the queue_mapping.yml entries whose "queues" is not a list but names queue_name (e.g: queues: "normal")
+        """
+        return [
+            _queue_settings
+            for _queue_settings in self._get("queue_mapping")["queues"].get(None, [])
+            if isinstance(_queue_settings.get("queues"), str)
+            and queue_name in re.split(r"[\s,]+", _queue_settings["queues"])
+        ]
+
+    def get_licenses_mapping(self):
+        """
+        Return the parsed licenses_mapping.yml
+        """
+        return self._get("licenses_mapping")
+
+    def get_project_budgets(self):
+        """
+        Return the users allowed to use each project as configured in project_cost_manager.txt
+        """
+        return self._get("project_budgets")
+
+    def get_budget_snapshot(self):
+        """
+        Return the project budgets written by project_budget_snapshot.py, or None if the file can't be read.
+        The file is only read again when it is replaced by the refresher.
+        """
+        _mtime = _get_mtime(self.budget_snapshot_file)
+        if _mtime is None:
+            return None
+        if _mtime != self._budget_snapshot[0]:
+            try:
+                with open(self.budget_snapshot_file, "r") as _file:
+                    self._budget_snapshot = (_mtime, json.load(_file))
+            except Exception as _err:
+                _log(f"Unable to read {self.budget_snapshot_file}: {_err}")
+                return None
+        return self._budget_snapshot[1]
+
+    def _get_client(self, service_name):
+        if service_name not in self._clients:
+            import boto3
+
+            self._clients[service_name] = boto3.client(
+                service_name,
+                region_name=self.get_environment().get("AWS_DEFAULT_REGION", ""),
+            )
+        return self._clients[service_name]
+
+    def _get_user_directory_provider(self, cluster_id):
+        if self._snapshot["user_directory_provider"] is None:
+            _ssm_result = self._get_client("ssm").get_parameter(
+                Name=f"/soca/{cluster_id}/UserDirectoryProvider"
+            )
+            self._snapshot["user_directory_provider"] = _ssm_result.get(
+                "Parameter", {}
+            ).get("Value", "")
+        return self._snapshot["user_directory_provider"]
+
+    def _get_ad_bind_information(self, cluster_id):
+        # Service account credentials are only kept in memory, never in the snapshot file
+        if self._ad_bind_information is None:
+            import ast
+
+            _response = self._get_client("secretsmanager").get_secret_value(
+                SecretId=f"/soca/{cluster_id}/UserDirectoryServiceAccount"
+            )
+            self._ad_bind_information = ast.literal_eval(
+                _response.get("SecretString", "")
+            )
+        return self._ad_bind_information
+
+    def _search_group_members(self, group_dn):
+        _cluster_id = self.get_environment().get("SOCA_CLUSTER_ID", "")
+        _user_directory_provider = self._get_user_directory_provider(_cluster_id)
+        if _user_directory_provider in [
+            "aws_ds_managed_activedirectory",
+            "existing_active_directory",
+        ]:
+            _ad_bind_information = self._get_ad_bind_information(_cluster_id)
+            _ad_user = _ad_bind_information.get("username", "")
+            _ad_password = _ad_bind_information.get("password", "")
+            _ad_domain_name = _ad_user.split("@")[1]
+            # Perform a nested AD group membership search
+            _ldapsearch = (
+                "ldapsearch -x -h "
+                + _ad_domain_name
+                + ' -D "'
+                + _ad_user
+                + '" -w "'
+                + _ad_password
+                + '" -b "'
+                + group_dn
+                + f"'(& (objectCategory=user)(memberOf:1.2.840.113556.1.4.1941:={group_dn}))'"
+                + " \"sAMAccountName\" | grep ^sAMAccountName | awk '{print $2}'"
+            )
+        else:
+            # OpenLdap
+            _ldapsearch = (
+                "ldapsearch -x -b "
+                + group_dn
+                + " -LLL | grep memberUid | awk '{print $2}'"
+            )
+
+        _users_in_group = os.popen(_ldapsearch).read()  # nosec
+        return list(filter(None, _users_in_group.split("\n")))
+
+    def get_group_members(self, group_dn):
+        """
+        Return the users of an LDAP / Active Directory group. Memberships are cached for group_members_ttl seconds.
+        The previous membership is returned if the directory can't be queried, as long as it is not older than
+        group_members_max_stale_age seconds.
+        """
+        _cached = self._snapshot["group_members"].get(group_dn)
+        if _cached is not None and time.time() - _cached[0] < self.group_members_ttl:
+            return _cached[1]
+
+        try:
+            _members = self._search_group_members(group_dn)
+        except Exception as _err:
+            _log(f"Unable to find users in {group_dn}: {_err}")
+            if (
+                _cached is not None
+                and time.time() - _cached[0] < self.group_members_max_stale_age
+            ):
+                return _cached[1]
+            raise HookSupportError(
+                "Unable to query the user directory. Please consult the HPC Administrator"
+            )
+
+        _log(f"Found users in {group_dn}: {_members}")
+        self._snapshot["group_members"][group_dn] = (time.time(), _members)
+        self._save_snapshot_file()
+        return _members
+
+
+_hook_caches = {}
+
+
+def get_hook_cache(soca_home):
+    """
+    Return the refreshed hook cache of soca_home. The cache is kept in memory by the PBS server between two hook events.
+    """
+    if soca_home not in _hook_caches:
+        _hook_caches[soca_home] = QueueJobHookCache(soca_home=soca_home)
+    return _hook_caches[soca_home].refresh()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s",
+        "--soca-home",
+        required=True,
+        help="SOCA home directory, e.g: /opt/soca/<cluster_id>",
+    )
+    arg = parser.parse_args()
+    # Force a full rebuild
+    _snapshot_file = f"{arg.soca_home}/cluster_hooks/{SNAPSHOT_FILE_NAME}"
+    if os.path.exists(_snapshot_file):
+        os.remove(_snapshot_file)
+    _hook_cache = get_hook_cache(soca_home=arg.soca_home)
+    for _name, _data in _hook_cache._snapshot["data"].items():
+        print(f"{_name}: {'OK' if _data['error'] is None else _data['error']}")
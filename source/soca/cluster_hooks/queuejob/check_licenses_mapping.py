@@ -32,7 +32,10 @@ if site_packages not in sys.path:
     sys.path.append(site_packages)
 
 import pbs
-import yaml
+
+# Shared hook support module (cached queue_mapping.yml and licenses_mapping.yml)
+sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+import hook_support
 
 e = pbs.event()
 j = e.job
@@ -41,8 +44,8 @@ j = e.job
 license_settings_file = "/opt/soca/%SOCA_CLUSTER_ID/cluster_manager/orchestrator/settings/licenses_mapping.yml"
 
 try:
-    with open(license_settings_file) as f:
-        lic_data = yaml.safe_load(f)
+    hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
+    lic_data = hook_cache.get_licenses_mapping()
 
     e.accept()
 
@@ -17,6 +17,9 @@ Doc: https://awslabs.github.io/scale-out-computing-on-aws/analytics/set-up-budge
 create hook check_project_budget event=queuejob
 import hook check_project_budget application/x-python default /opt/soca/%SOCA_CLUSTER_ID/cluster_hooks/queuejob/check_project_budget.py
 
+Budgets are not queried by this hook. They are read from the snapshot refreshed out-of-band by
+/opt/soca/%SOCA_CLUSTER_ID/cluster_manager/orchestrator/project_budget_snapshot.py (run it periodically via cron).
+
 Note: If you make any change to this file, you MUST re-execute the import command
 """
 
@@ -29,30 +32,11 @@ if site_packages not in sys.path:
     sys.path.append(site_packages)
 
 import pbs
-from configparser import (
-    ConfigParser,
-)
-
-import boto3
-
-
-def get_all_budgets():
-    config = ConfigParser(allow_no_value=True)
-    budget_per_project = {}
-    try:
-        config.read(budget_config_file)
-        # Get list of all budget
-        for section in config.sections():
-            budget_per_project[section] = []
-            for account in config.options(section):
-                budget_per_project[section].append(account)
-    except Exception as ex:
-        e.reject(f"Error. Budget file is incorrect: {ex}")
-
-    return budget_per_project
+import time
 
+sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+import hook_support
 
-budget_client = boto3.client("budgets")
 e = pbs.event()
 j = e.job
 job_owner = str(e.requestor)
@@ -62,7 +46,6 @@ job_project = (
 )  # <class 'pbs.v1._base_types.project'> to str
 
 # User Variables
-aws_account_id = "<YOUR_AWS_ACCOUNT_ID>"
 budget_config_file = "/opt/soca/%SOCA_CLUSTER_ID/cluster_manager/orchestrator/settings/project_cost_manager.txt"  # Link to example
 user_must_belong_to_project = (
     True  # Change if you don't want to restrict project to a list of users
@@ -73,6 +56,10 @@ allow_job_no_project = (
 allow_user_multiple_projects = (
     True  # Change if you want to restrict a user to one project
 )
+budget_snapshot_max_age = (
+    1800  # Budget snapshot older than this number of seconds is considered stale
+)
+budget_snapshot_fail_open = False  # Change to accept jobs when the budget snapshot is missing or stale instead of rejecting them
 
 if job_project is None and allow_job_no_project is False:
     e.reject(
@@ -82,8 +69,12 @@ if job_project is None and allow_job_no_project is False:
 else:
     try:
         pbs.logmsg(pbs.LOG_DEBUG, f"checking_budget: project: {job_project}")
+        hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
         # Get all budgets
-        projects_list = get_all_budgets()
+        try:
+            projects_list = hook_cache.get_project_budgets()
+        except Exception as ex:
+            e.reject(f"Error. Budget file is incorrect: {ex}")
 
         # Verify user is authorized to use this project
         user_to_project = [
@@ -107,17 +98,29 @@ else:
 
         # Project is valid and user is authorized. Calculating budget left for project
 
-        try:
-            budget_query = budget_client.describe_budget(
-                AccountId=aws_account_id, BudgetName=job_project
+        budget_snapshot = hook_cache.get_budget_snapshot()
+        if budget_snapshot is None:
+            budget_error = f"{hook_cache.budget_snapshot_file} is not available"
+        elif (
+            time.time() - budget_snapshot.get("refreshed_at", 0)
+            > budget_snapshot_max_age
+        ):
+            budget_error = f"{hook_cache.budget_snapshot_file} has not been refreshed for more than {budget_snapshot_max_age} seconds"
+        elif job_project not in budget_snapshot.get("budgets", {}):
+            budget_error = f"no AWS Budget found for {job_project}"
+        else:
+            budget_error = None
+
+        if budget_error is not None:
+            pbs.logmsg(pbs.LOG_DEBUG, f"checking_budget: {budget_error}")
+            if budget_snapshot_fail_open is True:
+                e.accept()
+            e.reject(
+                f"Error. Unable to verify the budget of {job_project}: {budget_error}. Please consult the HPC Administrator"
             )
-        except Exception as ex:
-            e.reject(f"Error. Unable to query AWS Budget API. ERROR: {ex}")
 
-        actual_spend = float(
-            budget_query["Budget"]["CalculatedSpend"]["ActualSpend"]["Amount"]
-        )
-        allocated_budget = float(budget_query["Budget"]["BudgetLimit"]["Amount"])
+        actual_spend = budget_snapshot["budgets"][job_project]["actual_spend"]
+        allocated_budget = budget_snapshot["budgets"][job_project]["budget_limit"]
 
         if actual_spend > allocated_budget:
             e.reject(
@@ -32,7 +32,10 @@ if site_packages not in sys.path:
     sys.path.append(site_packages)
 
 import pbs
-import yaml
+
+# Shared hook support module (cached queue_mapping.yml and licenses_mapping.yml)
+sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+import hook_support
 
 
 e = pbs.event()
@@ -46,8 +49,8 @@ pbs.logmsg(pbs.LOG_DEBUG, "check_queue_custom_sgs_roles: job_queue " + str(job_q
 queue_settings_file = "/opt/soca/%SOCA_CLUSTER_ID/cluster_manager/orchestrator/settings/queue_mapping.yml"
 
 try:
-    with open(queue_settings_file) as f:
-        docs = yaml.safe_load(f)
+    hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
+    queues_settings = hook_cache.get_queue_settings(job_queue)
 
 except Exception as err:
     message = (
@@ -71,39 +74,36 @@ if instance_profile is None and security_groups is None:
     e.accept()
 else:
     # Validate Queue IAM/SG permissions
-    for doc in docs.values():
-        for k, v in doc.items():
-            queues = v["queues"]
-            if job_queue in queues:
-                try:
-                    allowed_security_group_ids = list(v["allowed_security_group_ids"])
-                    allowed_instance_profiles = list(v["allowed_instance_profiles"])
-                except Exception as err:
+    for v in queues_settings:
+        try:
+            allowed_security_group_ids = list(v["allowed_security_group_ids"])
+            allowed_instance_profiles = list(v["allowed_instance_profiles"])
+        except Exception as err:
+            e.reject(
+                "allowed_security_group_ids or allowed_instance_profiles is missing on "
+                + queue_settings_file
+                + " or are not valid Python lists"
+            )
+
+        if security_groups is not None:
+            for sg_id in str(security_groups).split("+"):
+                if sg_id not in allowed_security_group_ids:
                     e.reject(
-                        "allowed_security_group_ids or allowed_instance_profiles is missing on "
+                        "Security group "
+                        + sg_id
+                        + " is not authorized for this queue. Please enable it on "
                         + queue_settings_file
-                        + " or are not valid Python lists"
+                        + ". List of valid SG for this queue: "
+                        + str(allowed_security_group_ids)
                     )
 
-                if security_groups is not None:
-                    for sg_id in str(security_groups).split("+"):
-                        if sg_id not in allowed_security_group_ids:
-                            e.reject(
-                                "Security group "
-                                + sg_id
-                                + " is not authorized for this queue. Please enable it on "
-                                + queue_settings_file
-                                + ". List of valid SG for this queue: "
-                                + str(allowed_security_group_ids)
-                            )
-
-                if instance_profile is not None:
-                    if str(instance_profile) not in allowed_instance_profiles:
-                        e.reject(
-                            "IAM instance profile "
-                            + instance_profile
-                            + " is not authorized for this queue. Please enable it on "
-                            + queue_settings_file
-                            + ". List of instance profiles for this queue: "
-                            + str(allowed_instance_profiles)
-                        )
+        if instance_profile is not None:
+            if str(instance_profile) not in allowed_instance_profiles:
+                e.reject(
+                    "IAM instance profile "
+                    + instance_profile
+                    + " is not authorized for this queue. Please enable it on "
+                    + queue_settings_file
+                    + ". List of instance profiles for this queue: "
+                    + str(allowed_instance_profiles)
+                )
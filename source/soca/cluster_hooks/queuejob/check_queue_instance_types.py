@@ -32,7 +32,10 @@ if site_packages not in sys.path:
     sys.path.append(site_packages)
 
 import pbs
-import yaml
+
+# Shared hook support module (cached queue_mapping.yml and licenses_mapping.yml)
+sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+import hook_support
 
 
 def is_allowed_instance_type(
@@ -84,8 +87,8 @@ else:
 # Validate queue_mapping YAML is not malformed
 try:
     queue_settings_file = "/opt/soca/%SOCA_CLUSTER_ID/cluster_manager/orchestrator/settings/queue_mapping.yml"
-    queue_reader = open(queue_settings_file, "r")
-    docs = yaml.safe_load(queue_reader)
+    hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
+    queues_settings = hook_cache.get_queue_settings(job_queue)
 except Exception as err:
     message = (
         "Job cannot be submitted. Unable to read "
@@ -96,60 +99,57 @@ except Exception as err:
     e.reject(message)
 
 # Validate Queue ACLs
-for doc in docs.values():
-    for k, v in doc.items():
-        queues = v["queues"]
-        if job_queue in queues:
-            if "allowed_instance_types" not in v.keys():
-                e.reject(
-                    "allowed_instance_types is not specified on "
-                    + queue_settings_file
-                    + ". See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-instance-types/ for examples"
-                )
-
-            if "excluded_instance_types" not in v.keys():
-                e.reject(
-                    "excluded_instance_types is not specified on "
-                    + queue_settings_file
-                    + ". See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-instance-types/ for examples"
-                )
-
-            # ensure expected keys are valid lists
-            if isinstance(v["allowed_instance_types"], list) is not True:
-                e.reject(
-                    "allowed_instance_types ("
-                    + queue_settings_file
-                    + ") must be a list. Detected: "
-                    + str(type(v["allowed_instance_types"]))
-                )
-            if isinstance(v["excluded_instance_types"], list) is not True:
-                e.reject(
-                    "excluded_instance_types ("
-                    + queue_settings_file
-                    + ") must be a list. Detected: "
-                    + str(type(v["excluded_instance_types"]))
-                )
-
-            allowed_instance_types = v["allowed_instance_types"]
-            excluded_instance_types = v["excluded_instance_types"]
-
-            if instance_type:
-                is_valid_instance = is_allowed_instance_type(
-                    instance_type, allowed_instance_types, excluded_instance_types
-                )
-            else:
-                # if no instance tpe in resource list default is used which is assumed to be valid.
-                is_valid_instance = True
-
-            # first, make sure the instance_type selection is valid (if any)
-            if not is_valid_instance:
-                message = (
-                    instance_type
-                    + " is not allowed for queue "
-                    + job_queue
-                    + ". Approved instance types/families are :"
-                    + ",".join(allowed_instance_types)
-                    + " .Contact your HPC admin and update "
-                    + queue_settings_file
-                )
-                e.reject(message)
+for v in queues_settings:
+    if "allowed_instance_types" not in v.keys():
+        e.reject(
+            "allowed_instance_types is not specified on "
+            + queue_settings_file
+            + ". See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-instance-types/ for examples"
+        )
+
+    if "excluded_instance_types" not in v.keys():
+        e.reject(
+            "excluded_instance_types is not specified on "
+            + queue_settings_file
+            + ". See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-instance-types/ for examples"
+        )
+
+    # ensure expected keys are valid lists
+    if isinstance(v["allowed_instance_types"], list) is not True:
+        e.reject(
+            "allowed_instance_types ("
+            + queue_settings_file
+            + ") must be a list. Detected: "
+            + str(type(v["allowed_instance_types"]))
+        )
+    if isinstance(v["excluded_instance_types"], list) is not True:
+        e.reject(
+            "excluded_instance_types ("
+            + queue_settings_file
+            + ") must be a list. Detected: "
+            + str(type(v["excluded_instance_types"]))
+        )
+
+    allowed_instance_types = v["allowed_instance_types"]
+    excluded_instance_types = v["excluded_instance_types"]
+
+    if instance_type:
+        is_valid_instance = is_allowed_instance_type(
+            instance_type, allowed_instance_types, excluded_instance_types
+        )
+    else:
+        # if no instance tpe in resource list default is used which is assumed to be valid.
+        is_valid_instance = True
+
+    # first, make sure the instance_type selection is valid (if any)
+    if not is_valid_instance:
+        message = (
+            instance_type
+            + " is not allowed for queue "
+            + job_queue
+            + ". Approved instance types/families are :"
+            + ",".join(allowed_instance_types)
+            + " .Contact your HPC admin and update "
+            + queue_settings_file
+        )
+        e.reject(message)
@@ -31,7 +31,10 @@ if site_packages not in sys.path:
     sys.path.append(site_packages)
 
 import pbs
-import yaml
+
+# Shared hook support module (cached queue_mapping.yml and licenses_mapping.yml)
+sys.path.append("/opt/soca/%SOCA_CLUSTER_ID/cluster_hooks")
+import hook_support
 
 e = pbs.event()
 j = e.job
@@ -45,31 +48,27 @@ queue_settings_file = (
 # Validate queue_mapping YAML is not malformed
 
 try:
-    with open(queue_settings_file) as f:
-        docs = yaml.safe_load(f)
+    hook_cache = hook_support.get_hook_cache(soca_home="/opt/soca/%SOCA_CLUSTER_ID")
 
     # Validate Queue ACLs
-    for doc in docs.values():
-        for k, v in doc.items():
-            queues = v["queues"]
-            if job_queue in queues:
-                if "restricted_parameters" not in v.keys():
-                    e.reject(
-                        f"restricted_parameters is not specified on {queue_settings_file}. See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-restricted-parameters/ for examples"
-                    )
+    for v in hook_cache.get_queue_settings(job_queue):
+        if "restricted_parameters" not in v.keys():
+            e.reject(
+                f"restricted_parameters is not specified on {queue_settings_file}. See https://awslabs.github.io/scale-out-computing-on-aws-documentation/documentation/security/manage-queue-restricted-parameters/ for examples"
+            )
 
-                if isinstance(v["restricted_parameters"], list) is not True:
-                    e.reject(
-                        f"restricted_parameters ({queue_settings_file}) must be a list. Detected: {str(type(v['restricted_parameters']))}"
-                    )
+        if isinstance(v["restricted_parameters"], list) is not True:
+            e.reject(
+                f"restricted_parameters ({queue_settings_file}) must be a list. Detected: {str(type(v['restricted_parameters']))}"
+            )
 
-                restricted_parameters = v["restricted_parameters"]
-                # Ensure restricted resources configure by cluster admins can't be replaced by users
-                for resource_requested in j.Resource_List.keys():
-                    if resource_requested in restricted_parameters:
-                        e.reject(
-                            f"{resource_requested} is a restricted parameter and can't be configured by the user. Contact your SOCA admin and update {queue_settings_file}"
-                        )
+        restricted_parameters = v["restricted_parameters"]
+        # Ensure restricted resources configure by cluster admins can't be replaced by users
+        for resource_requested in j.Resource_List.keys():
+            if resource_requested in restricted_parameters:
+                e.reject(
+                    f"{resource_requested} is a restricted parameter and can't be configured by the user. Contact your SOCA admin and update {queue_settings_file}"
+                )
 
 except Exception as err:
     e.reject(
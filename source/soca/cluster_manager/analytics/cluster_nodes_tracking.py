@@ -12,12 +12,11 @@
 #  and limitations under the License.                                                                                #
 ######################################################################################################################
 import sys
-import json
 import ast
 import datetime
 from utils.aws.ssm_parameter_store import SocaConfig
 from utils.analytics_client import SocaAnalyticsClient
-from utils.subprocess_client import SocaSubprocessClient
+from utils.pbs_nodes_snapshot import get_pbs_nodes_snapshot
 from utils.logger import SocaLogger
 
 
@@ -51,33 +50,28 @@ if __name__ == "__main__":
     # nodes in the pbsnodes list.
     # This is not a fatal problem for dynamic clusters that are cloud native
     # nodes come and go - and there may be times when there are simply no nodes yet.
-    _command = SocaSubprocessClient(
-        run_command="/opt/pbs/bin/pbsnodes -a -F json",
-    ).run(non_fatal_rcs=[1])
-    if _command.success is False:
-        # _message = ast.literal_eval(_command.message)
-        _message = _command.message
-        # False Positive
-        if "pbsnodes: server has no node list" in _message.get("stderr").lower():
-            _msg = "No nodes found, exiting"
-            logger.info(_msg)
-            sys.exit(0)
-        else:
-            logger.error(_command.message)
-            sys.exit(1)
+    # The snapshot taken by the dispatcher is re-used when it is recent enough
+    _nodes_snapshot = get_pbs_nodes_snapshot()
+    if _nodes_snapshot.refresh() is False:
+        logger.error(_nodes_snapshot.error)
+        sys.exit(1)
+
+    if not _nodes_snapshot.nodes:
+        _msg = "No nodes found, exiting"
+        logger.info(_msg)
+        sys.exit(0)
 
     else:
         # Compute Nodes detected
-        pbsnodes_output = json.loads(_command.message.get("stdout"))
-        for hostname, data in pbsnodes_output["nodes"].items():
+        for hostname, data in _nodes_snapshot.get_nodes().items():
 
             try:
                 data["timestamp"] = datetime.datetime.fromtimestamp(
-                    pbsnodes_output["timestamp"]
+                    _nodes_snapshot.timestamp
                 ).isoformat()
             except Exception as err:
                 logger.error(
-                    f"Unable to process record: {hostname=} / {data=} / {pbsnodes_output=}"
+                    f"Unable to process record: {hostname=} / {data=} / {_nodes_snapshot.timestamp=}"
                 )
 
             _index_data = _analytics_client.index(index=_index_name, body=data)
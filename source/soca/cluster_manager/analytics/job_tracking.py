@@ -12,7 +12,6 @@
 ######################################################################################################################
 
 from __future__ import division
-import ast
 import base64
 import datetime
 import json
@@ -26,6 +25,7 @@ from utils.logger import SocaLogger
 from utils.error import SocaError
 from utils.aws.boto3_wrapper import get_boto
 from utils.cast import SocaCastEngine
+from utils.aws.ec2_pricing_index import get_pricing_index
 
 # Update EBS rate for your region
 # EBS Formulas: https://aws.amazon.com/ebs/pricing/
@@ -50,49 +50,9 @@ def cast_wrapper(data: Any, cast_as: [str, list, float, int, dict]):
 
 
 def get_aws_pricing(ec2_instance_type):
-    pricing = {}
-    response = pricing_client.get_products(
-        ServiceCode="AmazonEC2",
-        Filters=[
-            {
-                "Type": "TERM_MATCH",
-                "Field": "usageType",
-                "Value": f"BoxUsage:{ec2_instance_type}",
-            },
-        ],
-    )
-    for data in response["PriceList"]:
-        data = ast.literal_eval(data)
-        for k, v in data["terms"].items():
-            if k == "OnDemand":
-                for skus in v.keys():
-                    for ratecode in v[skus]["priceDimensions"].keys():
-                        instance_data = v[skus]["priceDimensions"][ratecode]
-                        if (
-                            f"on demand linux {ec2_instance_type} instance hour"
-                            in instance_data["description"].lower()
-                        ):
-                            pricing["ondemand"] = float(
-                                instance_data["pricePerUnit"]["USD"]
-                            )
-            else:
-                for skus in v.keys():
-                    if (
-                        v[skus]["termAttributes"]["OfferingClass"] == "standard"
-                        and v[skus]["termAttributes"]["LeaseContractLength"] == "1yr"
-                        and v[skus]["termAttributes"]["PurchaseOption"] == "No Upfront"
-                    ):
-                        for ratecode in v[skus]["priceDimensions"].keys():
-                            instance_data = v[skus]["priceDimensions"][ratecode]
-                            if (
-                                "Linux/UNIX (Amazon VPC)"
-                                in instance_data["description"]
-                            ):
-                                pricing["reserved"] = float(
-                                    instance_data["pricePerUnit"]["USD"]
-                                )
-
-    return pricing
+    # Prices of the cluster region, served from the local EC2 pricing index or from the cached GetProducts lookups of
+    # the instance type while the index is downloaded
+    return get_pricing_index().get_price(ec2_instance_type, api_fallback=True)
 
 
 def job_already_indexed(job_uuid: str) -> bool:
@@ -162,7 +122,6 @@ if __name__ == "__main__":
     ]
 
     ec2_client = get_boto(service_name="ec2").message
-    pricing_client = get_boto(service_name="pricing", region_name="us-east-1").message
 
     _cluster_id = SocaConfig(key="/configuration/ClusterId").get_value().message
     _log_file_location = (
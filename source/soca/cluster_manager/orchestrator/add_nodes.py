@@ -18,33 +18,32 @@ import random
 import re
 import sys
 import uuid
-from math import ceil
-from botocore.exceptions import ClientError
 from botocore import exceptions
 
 sys.path.append(
     f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID', 'SOCA_CONFIGURATION_NOT_FOUND')}/cluster_manager"
 )
 import cloudformation_builder
+from capacity_validator import get_capacity_validator
+from quota_accountant import get_quota_accountant, instance_count_for_capacity
+from ri_coverage import get_ri_coverage
 from utils.aws.ssm_parameter_store import SocaConfig
 from utils.aws.boto3_wrapper import get_boto
+from utils.aws.ec2_instance_catalog import get_instance_catalog
 
 cloudformation = get_boto(service_name="cloudformation").message
 s3 = get_boto(service_name="s3").message
 ec2 = get_boto(service_name="ec2").message
 iam = get_boto(service_name="iam").message
-servicequotas = get_boto(service_name="service-quotas").message
 
 
 def is_placement_group_supported(
     instance_type: [str, list[str]], placement_group_type: str = "cluster"
 ) -> bool:
     """
-    Determine if a given instance type supports the given placement group type by sending a query to the AWS API.
+    Determine if a given instance type supports the given placement group type using the local EC2 instance catalog.
     """
     _query_instance_list: list = []
-    _pg_supported_list: list = []
-    _pg_unsupported_list: list = []
 
     if isinstance(instance_type, list):
         _query_instance_list = instance_type
@@ -60,212 +59,22 @@ def is_placement_group_supported(
         )
         return False
 
-    try:
-        # Paginator not needed since this should be an exact match query
-        _resp: dict = ec2.describe_instance_types(InstanceTypes=_query_instance_list)
-        for _instance_type in _resp.get("InstanceTypes", []):
-            _instance_type_name: str = _instance_type.get(
-                "InstanceType", "unknown-instance-name"
-            )
-            # If we see the proper supported PG type - append to our running list of supported
-            _supported_pgs: list = _instance_type.get("PlacementGroupInfo", {}).get(
-                "SupportedStrategies", []
-            )
-
-            if placement_group_type in _supported_pgs:
-                if _instance_type_name not in _pg_supported_list:
-                    _pg_supported_list.append(_instance_type_name)
-            else:
-                if _instance_type_name not in _pg_unsupported_list:
-                    _pg_unsupported_list.append(_instance_type_name)
-
-    except ClientError as err:
-        if err.response["Error"]["Code"] == "InvalidParameterValue":
-            return False
-        else:
-            raise err
-
     # Do we have any instances in the query list that are unsupported?
-    if _pg_unsupported_list:
-        return False
-    else:
-        return True
-
-
-def find_running_cpus_per_instance(instance_list) -> int:
-    # The term 'vcpu' is used for both vcpu and phycpu for quota
-    # calculation purposes.
-    # It comes down to what each instance counts torwards the quota
-    running_vcpus: int = 0
-    ec2_paginator = ec2.get_paginator("describe_instances")
-    ec2_iterator = ec2_paginator.paginate(
-        Filters=[
-            {"Name": "instance-type", "Values": instance_list},
-            {"Name": "instance-state-name", "Values": ["running", "pending"]},
-        ],
+    _catalog = get_instance_catalog()
+    return all(
+        _catalog.supports_placement_group(_instance_type, placement_group_type)
+        for _instance_type in _query_instance_list
     )
 
-    for page in ec2_iterator:
-        for reservation in page["Reservations"]:
-            for instance in reservation["Instances"]:
-                _core_count: int = instance.get("CpuOptions", {}).get("CoreCount", 1)
-                _threads_per_core: int = instance.get("CpuOptions", {}).get(
-                    "ThreadsPerCore", 1
-                )
-                running_vcpus += _core_count * _threads_per_core
-
-    return running_vcpus
-
-
-def verify_ri_saving_availabilities(instance_type, instance_type_info):
-    if instance_type not in instance_type_info.keys():
-        instance_type_info[instance_type] = {
-            "current_instance_in_use": 0,
-            "current_ri_purchased": 0,
-        }
-
-        # List all instances from this type currently running
-        ec2_paginator = ec2.get_paginator("describe_instances")
-        ec2_iterator = ec2_paginator.paginate(
-            Filters=[
-                {"Name": "instance-type", "Values": [instance_type]},
-                {"Name": "instance-state-name", "Values": ["running", "pending"]},
-            ],
-        )
-
-        for page in ec2_iterator:
-            for reservation in page["Reservations"]:
-                for instance in reservation["Instances"]:
-                    try:
-                        if instance["InstanceType"] == instance_type:
-                            instance_type_info[instance_type][
-                                "current_instance_in_use"
-                            ] += 1
-                    except Exception as _e:
-                        exc_type, exc_obj, exc_tb = sys.exc_info()
-                        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                        print(exc_type, fname, exc_tb.tb_lineno)
-
-        # Now list of many RI we have for this instance type
-        get_ri_count = ec2.describe_reserved_instances(
-            Filters=[
-                {"Name": "instance-type", "Values": [instance_type]},
-                {"Name": "state", "Values": ["active"]},
-            ]
-        )
-
-        if get_ri_count["ReservedInstances"]:
-            for reservation in get_ri_count["ReservedInstances"]:
-                instance_type_info[instance_type][
-                    "current_ri_purchased"
-                ] += reservation["InstanceCount"]
-
-    # print(f"Detected {instance_type_info[instance_type]["current_instance_in_use"]} running {instance_type} instance ")
-    # print(f"Detected {instance_type_info[instance_type]['current_ri_purchased']} RI for {instance_type} instance")
-    return instance_type_info
-
-
-def verify_vcpus_limit(instance_type, desired_capacity, quota_info):
-    cpus_count_pattern = re.search(r"[.](\d+)", instance_type)
-    find_instance_family = re.search(r"(.*)\d", instance_type.split(".")[0])
-    if find_instance_family:
-        instance_family = find_instance_family.group(1)
-    else:
-        return {
-            "message": f"Unable to detect instance type for {instance_type}",
-            "quota_info": "",
-        }
-
-    if cpus_count_pattern:
-        vcpus_per_instance = int(cpus_count_pattern.group(1)) * 4
-    else:
-        if "xlarge" in instance_type:
-            vcpus_per_instance = 4
-        else:
-            vcpus_per_instance = 2
-
-    total_vcpus_requested = vcpus_per_instance * int(desired_capacity)
-    running_vcpus = 0
-
-    max_vcpus_allowed = False
-    quota_name = False
-
-    if not quota_info or instance_type not in quota_info.keys():
-        servicequotas_paginator = servicequotas.get_paginator("list_service_quotas")
-        servicequotas_iterator = servicequotas_paginator.paginate(ServiceCode="ec2")
-
-        for page in servicequotas_iterator:
-            for quota in page["Quotas"]:
-                if "running on-demand" in quota["QuotaName"].lower() and re.search(
-                    f"(\s|\(){instance_family}(\s|\)|,)", quota["QuotaName"].lower()
-                ):
-                    max_vcpus_allowed = quota["Value"]
-                    quota_name = quota["QuotaName"]
-                    # print(f"Instance Type {instance_type}. Quota {quota_name}, Max CPUs {max_vcpus_allowed}")
-    else:
-        max_vcpus_allowed = quota_info[instance_type]["max_vcpus_allowed"]
-        quota_name = quota_info[instance_type]["quota_name"]
-
-    if max_vcpus_allowed is False:
-        return {
-            "message": f"Unable to find ServiceQuota for {instance_type}",
-            "quota_info": quota_info,
-        }
-
-    # list all ec2 instances
-    if "standard" in quota_name.lower():
-        instances_family_allowed_in_quota = (
-            re.search(
-                r"running on-demand standard \((.*)\) instances", quota_name.lower()
-            )
-            .group(1)
-            .split(",")
-        )
-    else:
-        instances_family_allowed_in_quota = list(
-            re.search(r"running on-demand (.*) instances", quota_name.lower()).group(1)
-        )
-
-    if not quota_info or instance_type not in quota_info.keys():
-        all_instances_available = []
-        paginator = ec2.get_paginator("describe_instance_types")
-        for page in paginator.paginate():
-            for instance in page["InstanceTypes"]:
-                all_instances_available.append(instance["InstanceType"])
-
-        all_instances_for_quota = [
-            instance_family
-            for x in instances_family_allowed_in_quota
-            for instance_family in all_instances_available
-            if instance_family.startswith(x.rstrip().lstrip())
-        ]
-        required_api_calls = ceil(len(all_instances_for_quota) / 190)
-        for i in range(0, required_api_calls):
-            # DescribeInstances has a limit of 200 attributes per filter
-            instances_to_check = all_instances_for_quota[i * 190 : (i + 1) * 190]
-            if instances_to_check:
-                running_vcpus += find_running_cpus_per_instance(instances_to_check)
-
-    else:
-        running_vcpus = quota_info[instance_type]["vcpus_provisioned"]
-
-    quota_info[instance_type] = {
-        "max_vcpus_allowed": max_vcpus_allowed,
-        "vcpus_provisioned": running_vcpus + total_vcpus_requested,
-        "quota_name": quota_name,
-    }
-
-    if max_vcpus_allowed >= (running_vcpus + total_vcpus_requested):
-        return {"message": True, "quota_info": quota_info}
-    else:
-        return {
-            "message": f"Job cannot start due to AWS Service limit. Max Vcpus allowed {max_vcpus_allowed}. Detected running Vcpus {running_vcpus}. Requested Vcpus for this job {total_vcpus_requested}. Quota Name {quota_name}",
-            "quota_info": quota_info,
-        }
-
 
 def can_launch_capacity(
-    instance_type, desired_capacity, image_id, subnet_id, security_group
+    instance_type,
+    desired_capacity,
+    image_id,
+    subnet_id,
+    security_group,
+    reservation_id=None,
+    weighted_capacity=None,
 ):
     # Allow skipping DryRun and Quotas - default to False if they are not set in the config
     skip_dryrun: bool = (
@@ -283,51 +92,54 @@ def can_launch_capacity(
         # No need to even send the API calls if we have both knobs set to Skip
         return True
 
-    for instance in instance_type:
-        try:
-            ec2.run_instances(
-                ImageId=image_id,
-                InstanceType=instance,
-                SubnetId=subnet_id,
-                SecurityGroupIds=[security_group],
-                MaxCount=int(desired_capacity),
-                MinCount=int(desired_capacity),
-                MetadataOptions={
-                    "HttpTokens": SocaConfig(key="/configuration/MetadataHttpTokens")
-                    .get_value(default="required")
-                    .get("message")
-                },
-                DryRun=True,
-            )
-
-        except ClientError as e:
-            if e.response["Error"].get("Code") == "DryRunOperation":
-                # Dry Run Succeed.
-                if skip_quota:
-                    return True
-                else:
-                    try:
-                        quota_info
-                    except NameError:
-                        quota_info = {}
-
-                    vcpus_check = verify_vcpus_limit(
-                        instance, desired_capacity, quota_info
-                    )
-                    quota_info = vcpus_check["quota_info"]
-                    if vcpus_check["message"] is True:
-                        return True
-                    else:
-                        return vcpus_check["message"]
-            else:
+    if not skip_dryrun:
+        # DryRun all instance types concurrently, identical checks across jobs are served from the validator cache
+        _http_tokens = (
+            SocaConfig(key="/configuration/MetadataHttpTokens")
+            .get_value(default="required")
+            .get("message")
+        )
+        _dry_runs = get_capacity_validator().check_many(
+            [
+                {
+                    "image_id": image_id,
+                    "instance_type": instance,
+                    "subnet_id": subnet_id,
+                    "security_group": security_group,
+                    "count": int(desired_capacity),
+                    "http_tokens": _http_tokens,
+                }
+                for instance in instance_type
+            ]
+        )
+        for instance, _dry_run in zip(instance_type, _dry_runs):
+            if _dry_run["success"] is False:
                 print(
                     "Dry Run Failed, capacity "
                     + instance
                     + " can not be added: "
-                    + str(e),
+                    + _dry_run["message"],
                     "error",
                 )
-                return str(instance + " can not be added: " + str(e))
+                return str(instance + " can not be added: " + _dry_run["message"])
+
+    if skip_quota:
+        return True
+
+    # Book the vCPUs in the quota ledger, reservation is released once the instances are running
+    vcpus_check = get_quota_accountant().reserve(
+        reservation_id=(
+            reservation_id
+            if reservation_id is not None
+            else f"{instance_type[0]}-{uuid.uuid4()}"
+        ),
+        instance_type=instance_type[0],
+        instance_count=instance_count_for_capacity(desired_capacity, weighted_capacity),
+    )
+    if vcpus_check["success"] is True:
+        return True
+    else:
+        return vcpus_check["message"]
 
 
 def check_config(**kwargs):
@@ -345,24 +157,23 @@ def check_config(**kwargs):
         kwargs["instance_type"] = kwargs["instance_type"].split("+")
 
         # Get Instance information
-        try:
-            instance_attributes = ec2.describe_instance_types(
-                InstanceTypes=[kwargs["instance_type"][0]]
-            )
-            if len(instance_attributes["InstanceTypes"]) == 0:
-                skip = True
-                error.append(f"No instance returned from DescribeInstanceTypes")
-        except ClientError as e:
+        _describe_instance = get_instance_catalog().describe(
+            [kwargs["instance_type"][0]]
+        )
+        if _describe_instance.get("success") is False:
             skip = True
-            if e.response["Error"].get("Code") == "InvalidInstanceType":
-                error.append(
-                    f"Instance type does not seem to be valid. Update boto3 to refresh the list if needed"
-                )
-            else:
-                error.append(f"Unable to get instance information due to {e}")
-        except Exception as e:
+            error.append(
+                f"Unable to get instance information due to {_describe_instance.get('message')}"
+            )
+        elif not _describe_instance.get("message"):
             skip = True
-            error.append(f"Unable to run describe_instance_types API due to {e}")
+            error.append(
+                f"Instance type does not seem to be valid. Update boto3 to refresh the list if needed"
+            )
+        else:
+            instance_attributes = {
+                "InstanceTypes": list(_describe_instance.get("message").values())
+            }
 
         if not skip:
             # Transform weighted_capacity as a list in case multiple instance types are specified
@@ -413,30 +224,15 @@ def check_config(**kwargs):
 
             if kwargs["force_ri"] is True and kwargs["spot_price"] is False:
                 # Job can only run on Reserved Instance. We ignore if SpotFleet is enabled
-                try:
-                    instance_type_info
-                except NameError:
-                    instance_type_info = {}
-
+                # RI coverage is booked for the job and released once its instances are running
                 for instance_type in kwargs["instance_type"]:
-                    check_ri = verify_ri_saving_availabilities(
-                        instance_type, instance_type_info
+                    check_ri = get_ri_coverage().book(
+                        booking_id=str(kwargs["job_id"]),
+                        instance_type=instance_type,
+                        instance_count=kwargs["desired_capacity"],
                     )
-                    if (
-                        check_ri[instance_type]["current_instance_in_use"]
-                        + int(kwargs["desired_capacity"])
-                    ) > check_ri[instance_type]["current_ri_purchased"]:
-                        error.append(
-                            f"Not enough RI to cover for this job. Instance type: {instance_type}, number of running instances: {check_ri[instance_type]['current_instance_in_use']}, number of purchased RIs: {check_ri[instance_type]['current_ri_purchased']}, capacity requested: {kwargs['desired_capacity']}. Either purchase more RI or allow usage of On Demand"
-                        )
-                    else:
-                        # Update the number of current_instance_in_use with the number of new instance that this job will launch
-                        instance_type_info[instance_type] = {
-                            "current_instance_in_use": check_ri[instance_type][
-                                "current_instance_in_use"
-                            ]
-                            + int(kwargs["desired_capacity"])
-                        }
+                    if check_ri["success"] is False:
+                        error.append(check_ri["message"])
 
             # Default System metrics to False unless explicitly set to True
             if kwargs["system_metrics"] is not True:
@@ -939,7 +735,23 @@ def return_message(message, success=False):
     return {"success": success, "message": message}
 
 
-def main(**kwargs):
+def build_stack(**kwargs):
+    """
+    Build stage: validate the job parameters, build the CloudFormation template, render the bootstrap scripts and run the capacity checks.
+    Return return_message() on error, otherwise {"success": True, "stack": {...}} to be passed to upload_stack_bootstrap() and submit_stack()
+    """
+    _build = return_message("Build stage interrupted")
+    try:
+        _build = _build_stack(**kwargs)
+        return _build
+    finally:
+        # RI coverage is booked by check_config(), release it on every failure so it does not leak until booking_ttl
+        _force_ri = str(kwargs.get("force_ri")).lower() in ["true", "yes", "y", "on"]
+        if _build["success"] is False and _force_ri:
+            get_ri_coverage().release(str(kwargs.get("job_id")))
+
+
+def _build_stack(**kwargs):
     try:
         # Create default value for optional parameters if needed
         optional_job_parameters = {
@@ -972,6 +784,7 @@ def main(**kwargs):
             "scratch_iops": 0,
             "stack_uuid": str(uuid.uuid4()),
             "weighted_capacity": False,
+            "prioritized_instance_types": False,
         }
 
         for k, v in optional_job_parameters.items():
@@ -1194,6 +1007,12 @@ def main(**kwargs):
             },
             "VolumeTypeIops": {"Key": "scratch_iops", "Default": 0},
             "WeightedCapacity": {"Key": "weighted_capacity", "Default": False},
+            "PrioritizedInstanceTypes": {
+                "Key": "prioritized_instance_types",
+                "Default": False,
+            },
+            # Job specific bootstrap scripts are stored per stack, see cloudformation_builder.prune_bootstrap_scripts()
+            "StackName": {"Key": None, "Default": cfn_stack_name},
         }
         cfn_stack_parameters = {}
         for k, v in parameters_list.items():
@@ -1223,41 +1042,92 @@ def main(**kwargs):
             cfn_stack_parameters["ImageId"],
             cfn_stack_parameters["SubnetId"][0],
             cfn_stack_parameters["SecurityGroupId"],
+            reservation_id=cfn_stack_name,
+            weighted_capacity=cfn_stack_parameters["WeightedCapacity"],
         )
 
-        if can_launch is True:
-            try:
-                cloudformation.create_stack(
-                    StackName=cfn_stack_name,
-                    TemplateBody=cfn_stack_body["output"],
-                    Tags=cfn_stack_tags,
-                )
+        stack = {
+            "stack_name": cfn_stack_name,
+            "compute_node": "job" + str(params["job_id"]),
+            "job_id": str(params["job_id"]),
+            "force_ri": params["force_ri"],
+            "template_body": cfn_stack_body["output"],
+            "bootstrap_scripts": cfn_stack_body.get("bootstrap_scripts", []),
+            "tags": cfn_stack_tags,
+        }
+        if can_launch is not True:
+            # RI coverage is released by build_stack()
+            get_quota_accountant().release(cfn_stack_name)
+            return return_message("Dry Run failed: " + str(can_launch))
 
-                return {
-                    "success": True,
-                    "stack_name": cfn_stack_name,
-                    "compute_node": "job" + str(params["job_id"]),
-                }
+        return {"success": True, "stack": stack}
 
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                return return_message(
-                    str(e)
-                    + ": error:"
-                    + str(exc_type)
-                    + " "
-                    + str(fname)
-                    + " "
-                    + str(exc_tb.tb_lineno)
-                    + " "
-                    + str(kwargs)
-                )
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        return return_message(
+            str(e)
+            + ": error:"
+            + str(exc_type)
+            + " "
+            + str(fname)
+            + " "
+            + str(exc_tb.tb_lineno)
+            + " "
+            + str(kwargs)
+        )
+
+
+def release_capacity_reservations(stack):
+    """
+    Release the vCPU quota and RI coverage booked by build_stack() when the stack won't be created
+    """
+    get_quota_accountant().release(stack["stack_name"])
+    if stack["force_ri"] is True:
+        get_ri_coverage().release(stack["job_id"])
+
+
+def upload_stack_bootstrap(stack, api_call=None):
+    """
+    Upload stage: upload the bootstrap scripts rendered by build_stack() to S3
+    """
+    _upload = cloudformation_builder.upload_bootstrap_scripts(
+        stack["bootstrap_scripts"], api_call=api_call
+    )
+    if _upload["success"] is False:
+        release_capacity_reservations(stack)
+        return return_message(_upload["output"])
+    return {"success": True, "stack": stack}
 
+
+def submit_stack(stack, api_call=None):
+    """
+    Submit stage: create the CloudFormation stack.
+    api_call(function, **kwargs) can be specified to wrap the create_stack call (e.g. to retry when CloudFormation throttles the requests)
+    """
+    try:
+        if api_call is None:
+            cloudformation.create_stack(
+                StackName=stack["stack_name"],
+                TemplateBody=stack["template_body"],
+                Tags=stack["tags"],
+            )
         else:
-            return return_message("Dry Run failed: " + str(can_launch))
+            api_call(
+                cloudformation.create_stack,
+                StackName=stack["stack_name"],
+                TemplateBody=stack["template_body"],
+                Tags=stack["tags"],
+            )
+
+        return {
+            "success": True,
+            "stack_name": stack["stack_name"],
+            "compute_node": stack["compute_node"],
+        }
 
     except Exception as e:
+        release_capacity_reservations(stack)
         exc_type, exc_obj, exc_tb = sys.exc_info()
         fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
         return return_message(
@@ -1269,10 +1139,25 @@ def main(**kwargs):
             + " "
             + str(exc_tb.tb_lineno)
             + " "
-            + str(kwargs)
+            + str(stack["stack_name"])
         )
 
 
+def main(**kwargs):
+    """
+    Provision capacity synchronously. The dispatcher uses stack_submission.StackSubmissionPipeline to run the same stages on worker pools.
+    """
+    _build = build_stack(**kwargs)
+    if _build["success"] is False:
+        return _build
+
+    _upload = upload_stack_bootstrap(_build["stack"])
+    if _upload["success"] is False:
+        return _upload
+
+    return submit_stack(_build["stack"])
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -0,0 +1,213 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Weighted capacity planning for the multiple_jobs scaling mode: all queued jobs of a job hash are packed at once
+on the free nodes of the hash and on the cheapest mix of new instances.
+"""
+
+import logging
+import math
+
+from utils.aws.ec2_pricing_index import get_pricing_index
+
+logger = logging.getLogger("soca_logger")
+
+
+class _Bin:
+    __slots__ = ("instance_type", "ncpus", "mem", "used_ncpus", "used_mem", "jobs")
+
+    def __init__(self, instance_type, ncpus, mem):
+        # instance_type is None for existing (free) nodes
+        self.instance_type = instance_type
+        self.ncpus = ncpus
+        self.mem = mem
+        self.used_ncpus = 0
+        self.used_mem = 0
+        self.jobs = set()
+
+    def fits(self, job_id, ncpus, mem):
+        return (
+            job_id not in self.jobs
+            and self.used_ncpus + ncpus <= self.ncpus
+            and self.used_mem + mem <= self.mem
+        )
+
+    def add(self, job_id, ncpus, mem):
+        self.used_ncpus += ncpus
+        self.used_mem += mem
+        self.jobs.add(job_id)
+
+
+class CapacityPlanner:
+    """
+    Bin-pack the chunks of all queued jobs of a job hash:
+    - chunks are sorted by decreasing size and placed first on the free nodes of the hash (best fit), then on new instances
+    - a new instance uses the instance type with the lowest price per unit of weighted capacity able to host the chunk
+    - once all chunks are placed, each new instance is right-sized to the cheapest instance type able to host its chunks
+    Chunks of the same job are never placed on the same node. Prices come from the EC2 pricing index,
+    when a price is not available the weighted capacity is used as cost so the planner minimizes the provisioned capacity.
+
+    example:
+        planner = CapacityPlanner(
+            instance_types=["c6i.large", "c6i.2xlarge"], weighted_capacity=[2, 8], memory=[4096, 16384], pricing_model="ondemand"
+        )
+        planner.plan(jobs=[{"job_id": "1", "ncpus": 6, "nodect": 1, "mem": 2048}, ...], free_nodes=[{"ncpus": 2, "mem": 4096}])
+        -> {"capacity": 8, "instances": {"c6i.2xlarge": 1}, "jobs": ["1", ...], "jobs_on_free_nodes": [], "unschedulable_jobs": [], "estimated_hourly_cost": 0.34}
+    """
+
+    def __init__(
+        self, instance_types, weighted_capacity, memory, pricing_model="ondemand"
+    ):
+        self.instance_types = {}
+        for _instance_type, _weight, _memory in zip(
+            instance_types, weighted_capacity, memory
+        ):
+            _price = get_pricing_index().get_price(_instance_type).get(pricing_model)
+            self.instance_types[_instance_type] = {
+                "ncpus": int(_weight),
+                "mem": float(_memory),
+                "price": _price,
+            }
+        self._priced = all(
+            _spec["price"] is not None for _spec in self.instance_types.values()
+        )
+
+    def _cost(self, instance_type):
+        _spec = self.instance_types[instance_type]
+        return _spec["price"] if self._priced else _spec["ncpus"]
+
+    def _new_bin(self, job_id, ncpus, mem):
+        _candidates = [
+            _instance_type
+            for _instance_type, _spec in self.instance_types.items()
+            if _spec["ncpus"] >= ncpus and _spec["mem"] >= mem
+        ]
+        # Lowest price per unit of capacity, prefer larger instances on ties so the next chunks can share them
+        _instance_type = min(
+            _candidates,
+            key=lambda _i: (
+                self._cost(_i) / self.instance_types[_i]["ncpus"],
+                -self.instance_types[_i]["ncpus"],
+            ),
+        )
+        return _Bin(
+            _instance_type,
+            self.instance_types[_instance_type]["ncpus"],
+            self.instance_types[_instance_type]["mem"],
+        )
+
+    def _right_size(self, instance_bin):
+        _candidates = [
+            _instance_type
+            for _instance_type, _spec in self.instance_types.items()
+            if _spec["ncpus"] >= instance_bin.used_ncpus
+            and _spec["mem"] >= instance_bin.used_mem
+        ]
+        return min(
+            _candidates,
+            key=lambda _i: (self._cost(_i), self.instance_types[_i]["ncpus"]),
+        )
+
+    def plan(self, jobs, free_nodes=None, committed_jobs=None):
+        """
+        jobs: queued jobs to provision, list of {"job_id", "ncpus" (total), "nodect", "mem" (total MiB)}
+        free_nodes: free capacity of the hash (see SocaPBSNodesSnapshot.get_free_capacity)
+        committed_jobs: queued jobs of the hash whose capacity has already been requested, they are placed on
+        the free nodes first so the same free capacity is not accounted twice
+        Return the weighted capacity to request and the instance mix, jobs which can't fit on any instance type are
+        returned in unschedulable_jobs and not counted.
+        """
+        _free_bins = [
+            _Bin(None, int(_node["ncpus"]), float(_node["mem"]))
+            for _node in free_nodes or []
+        ]
+        _new_bins = []
+
+        def _chunks(job_list):
+            _result = []
+            for _job in job_list:
+                _nodect = max(int(_job.get("nodect", 1)), 1)
+                _ncpus = math.ceil(int(_job["ncpus"]) / _nodect)
+                _mem = float(_job.get("mem") or 0) / _nodect
+                _result.extend(
+                    (str(_job["job_id"]), _ncpus, _mem) for _ in range(_nodect)
+                )
+            return sorted(_result, key=lambda _c: (_c[1], _c[2]), reverse=True)
+
+        def _best_fit(bins, job_id, ncpus, mem):
+            _fitting = [_b for _b in bins if _b.fits(job_id, ncpus, mem)]
+            if not _fitting:
+                return None
+            return min(_fitting, key=lambda _b: (_b.ncpus - _b.used_ncpus - ncpus))
+
+        for _job_id, _ncpus, _mem in _chunks(committed_jobs or []):
+            _bin = _best_fit(_free_bins, _job_id, _ncpus, _mem)
+            if _bin is not None:
+                _bin.add(_job_id, _ncpus, _mem)
+
+        # A job is unschedulable when its chunks don't fit on any instance type of the hash
+        _unschedulable_jobs = [
+            str(_job["job_id"])
+            for _job in jobs
+            if not any(
+                _ncpus <= _spec["ncpus"] and _mem <= _spec["mem"]
+                for _, _ncpus, _mem in _chunks([_job])[:1]
+                for _spec in self.instance_types.values()
+            )
+        ]
+
+        _unschedulable_job_ids = set(_unschedulable_jobs)
+        _jobs_on_new_instances = set()
+        for _job_id, _ncpus, _mem in _chunks(
+            [_job for _job in jobs if str(_job["job_id"]) not in _unschedulable_job_ids]
+        ):
+            _bin = _best_fit(_free_bins, _job_id, _ncpus, _mem) or _best_fit(
+                _new_bins, _job_id, _ncpus, _mem
+            )
+            if _bin is None:
+                _bin = self._new_bin(_job_id, _ncpus, _mem)
+                _new_bins.append(_bin)
+            _bin.add(_job_id, _ncpus, _mem)
+            if _bin.instance_type is not None:
+                _jobs_on_new_instances.add(_job_id)
+
+        _instances = {}
+        _capacity = 0
+        _estimated_hourly_cost = 0
+        for _bin in _new_bins:
+            _instance_type = self._right_size(_bin)
+            _instances[_instance_type] = _instances.get(_instance_type, 0) + 1
+            _capacity += self.instance_types[_instance_type]["ncpus"]
+            if self._priced:
+                _estimated_hourly_cost += self.instance_types[_instance_type]["price"]
+
+        _planned_jobs = [
+            str(_job["job_id"])
+            for _job in jobs
+            if str(_job["job_id"]) not in _unschedulable_job_ids
+        ]
+        return {
+            "capacity": _capacity,
+            "instances": _instances,
+            "jobs": _planned_jobs,
+            "jobs_on_free_nodes": [
+                _job_id
+                for _job_id in _planned_jobs
+                if _job_id not in _jobs_on_new_instances
+            ],
+            "unschedulable_jobs": _unschedulable_jobs,
+            "estimated_hourly_cost": (
+                round(_estimated_hourly_cost, 4) if self._priced else None
+            ),
+        }
@@ -0,0 +1,214 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Deduplicated, cached and concurrent RunInstances DryRun validation used by add_nodes before creating capacity.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from utils.aws.boto3_wrapper import get_boto
+
+logger = logging.getLogger("soca_logger")
+
+THROTTLING_ERROR_CODES = (
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+)
+
+
+class CapacityValidator:
+    """
+    Run ec2.run_instances(DryRun=True) checks:
+    - identical checks (AMI, instance type, subnet, security group, metadata options, count) are run only once,
+      concurrent callers wait for the check already in flight
+    - successful checks are cached for positive_ttl seconds and also answer any check with a smaller count,
+      failures are never cached
+    - check_many() runs the checks through a pool of max_workers threads
+    - when EC2 throttles the requests, all workers pause with an exponential backoff (shared across threads) before retrying
+
+    example:
+        validator = get_capacity_validator()
+        validator.check(image_id="ami-123", instance_type="c6i.large", subnet_id="subnet-123", security_group="sg-123", count=10)
+        -> {"success": True, "message": "DryRunOperation"}
+    """
+
+    def __init__(
+        self,
+        max_workers=8,
+        positive_ttl=300,
+        max_attempts=5,
+        base_backoff=0.5,
+        max_backoff=20,
+    ):
+        self.max_workers = max_workers
+        self.positive_ttl = positive_ttl
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._inflight = {}
+        self._throttled_until = 0
+        self._metrics = {"cache_hit": 0, "inflight_hit": 0, "dryrun": 0, "throttled": 0}
+
+    def _wait_if_throttled(self):
+        _delay = self._throttled_until - time.time()
+        if _delay > 0:
+            time.sleep(_delay)
+
+    def _dry_run(self, key, count):
+        _image_id, _instance_type, _subnet_id, _security_group, _http_tokens = key
+        _ec2 = get_boto(service_name="ec2").message
+        for _attempt in range(1, self.max_attempts + 1):
+            self._wait_if_throttled()
+            with self._lock:
+                self._metrics["dryrun"] += 1
+            try:
+                _ec2.run_instances(
+                    ImageId=_image_id,
+                    InstanceType=_instance_type,
+                    SubnetId=_subnet_id,
+                    SecurityGroupIds=[_security_group],
+                    MaxCount=count,
+                    MinCount=count,
+                    MetadataOptions={"HttpTokens": _http_tokens},
+                    DryRun=True,
+                )
+            except ClientError as err:
+                _code = err.response["Error"].get("Code")
+                if _code == "DryRunOperation":
+                    return {"success": True, "message": _code}
+                if _code in THROTTLING_ERROR_CODES and _attempt < self.max_attempts:
+                    _backoff = min(
+                        self.max_backoff, self.base_backoff * 2 ** (_attempt - 1)
+                    ) * random.uniform(0.5, 1)
+                    with self._lock:
+                        self._metrics["throttled"] += 1
+                        self._throttled_until = max(
+                            self._throttled_until, time.time() + _backoff
+                        )
+                    logger.warning(
+                        f"DryRun for {_instance_type} throttled ({_code}), retrying in {_backoff:.2f}s"
+                    )
+                    continue
+                return {"success": False, "message": str(err)}
+            except Exception as err:
+                return {"success": False, "message": str(err)}
+
+            # DryRun=True never succeeds, it raises DryRunOperation or another error
+            return {
+                "success": False,
+                "message": f"Unexpected response from DryRun for {_instance_type}",
+            }
+
+        return {
+            "success": False,
+            "message": f"DryRun for {_instance_type} still throttled after {self.max_attempts} attempts",
+        }
+
+    def check(
+        self,
+        image_id,
+        instance_type,
+        subnet_id,
+        security_group,
+        count,
+        http_tokens="required",
+    ):
+        """
+        Return {"success": True/False, "message": ...} for a RunInstances DryRun of count instance_type
+        """
+        _key = (image_id, instance_type, subnet_id, security_group, http_tokens)
+        _count = max(1, int(count))
+        with self._lock:
+            # Cache stores the highest count validated for _key
+            _cached = self._cache.get(_key)
+            if (
+                _cached is not None
+                and _cached[0] > time.time()
+                and _cached[1] >= _count
+            ):
+                self._metrics["cache_hit"] += 1
+                return {"success": True, "message": "DryRunOperation"}
+
+            _future = self._inflight.get((_key, _count))
+            if _future is not None:
+                self._metrics["inflight_hit"] += 1
+                _owner = False
+            else:
+                _future = Future()
+                self._inflight[(_key, _count)] = _future
+                _owner = True
+
+        if not _owner:
+            return _future.result()
+
+        try:
+            _result = self._dry_run(_key, _count)
+        except Exception as err:
+            _result = {"success": False, "message": str(err)}
+
+        with self._lock:
+            if _result["success"] is True:
+                _now = time.time()
+                _cached = self._cache.get(_key)
+                self._cache[_key] = (
+                    _now + self.positive_ttl,
+                    max(
+                        _count,
+                        _cached[1] if _cached is not None and _cached[0] > _now else 0,
+                    ),
+                )
+                # Remove expired entries
+                if len(self._cache) > 1000:
+                    self._cache = {
+                        _k: _v for _k, _v in self._cache.items() if _v[0] > _now
+                    }
+            self._inflight.pop((_key, _count), None)
+        _future.set_result(_result)
+        return _result
+
+    def check_many(self, checks):
+        """
+        Run a list of checks (dict of check() parameters) concurrently, return the results in the same order
+        """
+        if len(checks) <= 1:
+            return [self.check(**_check) for _check in checks]
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(checks))
+        ) as _pool:
+            return list(_pool.map(lambda _check: self.check(**_check), checks))
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+
+_capacity_validator = None
+
+
+def get_capacity_validator():
+    """
+    Return the CapacityValidator shared by the current process (the dispatcher keeps it across scheduling cycles)
+    """
+    global _capacity_validator
+    if _capacity_validator is None:
+        _capacity_validator = CapacityValidator()
+    return _capacity_validator
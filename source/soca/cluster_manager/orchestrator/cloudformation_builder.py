@@ -48,17 +48,23 @@ import troposphere.ec2 as ec2
 
 import pathlib
 
-from utils.aws.ssm_parameter_store import SocaConfig
+from utils.aws.ssm_parameter_store import SocaConfigSnapshot
+from utils.aws.ec2_instance_catalog import get_instance_catalog
+from utils.aws.boto3_wrapper import get_boto
 from utils.jinjanizer import SocaJinja2Generator
 
+import datetime
+import hashlib
+import json
 import logging
-import boto3
 import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
 from utils.response import SocaResponse
 
-# FIXME TODO - ExtraConfig / API / versioning?
-ec2_client = boto3.client("ec2")
 logger = logging.getLogger("soca_logger")
 
 
@@ -110,10 +116,12 @@ def is_cpu_options_supported(instance_type: str) -> bool:
     # it's not explicitly called out in AWS docs, but this page does not list metal instances for CpuOptions:
     # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/cpu-options-supported-instances-values.html
 
-    # TODO - clean this up a bit , try/except
-    _instance_details = ec2_client.describe_instance_types(
-        InstanceTypes=[instance_type]
-    ).get("InstanceTypes", {})[0]
+    _describe_instance = get_instance_catalog().describe([instance_type])
+    _instance_details = (
+        _describe_instance.message.get(instance_type, {})
+        if _describe_instance.success
+        else {}
+    )
 
     # If we are bare metal - no CpuOptions
     if _instance_details.get("BareMetal", False):
@@ -139,49 +147,753 @@ def is_ebs_optimized(instance_type: str) -> bool:
     """
     Determine if a given instance_type supports EBS Optimization.
     """
-    # TODO - try/except
-    _instance_details = ec2_client.describe_instance_types(
-        InstanceTypes=[instance_type]
-    ).get("InstanceTypes", {})[0]
-
-    _ebs_opt = (
-        _instance_details.get("EbsInfo", {})
-        .get("EbsOptimizedSupport", "unsupported")
-        .lower()
+    return get_instance_catalog().is_ebs_optimized(instance_type)
+
+
+# (bucket, key) of the content-addressed bootstrap scripts already uploaded by this process
+_uploaded_bootstrap_scripts = set()
+_uploaded_bootstrap_scripts_lock = threading.Lock()
+
+# Bootstrap scripts which don't embed any job specific value (JobId, BootstrapPath ...), they are content-addressed and
+# shared by all the jobs rendering the same script
+JOB_INDEPENDENT_BOOTSTRAP_TEMPLATES = (
+    "templates/linux/system_packages/install_required_packages",
+    "templates/linux/filesystems_automount",
+    "compute_node/04_setup_user_customization",
+)
+
+
+def get_bootstrap_s3_folder(cluster_id: str) -> str:
+    """
+    S3 folder of the compute node bootstrap scripts:
+    - content/<sha256>/<script>: content-addressed job independent scripts
+    - <stack_name>/<uuid>/<script>: job specific scripts, pruned by prune_bootstrap_scripts() once the stack is deleted
+    """
+    return f"{cluster_id}/config/do_not_delete/bootstrap/compute_node"
+
+
+def _direct_call(function, **kwargs):
+    return function(**kwargs)
+
+
+def upload_bootstrap_scripts(bootstrap_scripts: list, api_call=None) -> dict:
+    """
+    Upload the bootstrap scripts rendered by main() to S3, scripts are uploaded concurrently.
+    Content-addressed scripts already uploaded by this process or already present on S3 are not uploaded again,
+    job specific scripts are always uploaded with a single PutObject.
+    api_call(function, **kwargs) can be specified to wrap each S3 call (e.g. to retry when S3 throttles the requests)
+    """
+    if not bootstrap_scripts:
+        return {"success": True, "output": "No bootstrap script to upload"}
+
+    _s3_client = get_boto(service_name="s3").message
+    _call = api_call or _direct_call
+
+    def _put(script):
+        _call(
+            _s3_client.put_object,
+            Bucket=script["bucket"],
+            Key=script["key"],
+            Body=script["body"],
+        )
+
+    def _upload(script):
+        try:
+            if not script.get("content_addressed"):
+                _put(script)
+                return None
+
+            _object = (script["bucket"], script["key"])
+            with _uploaded_bootstrap_scripts_lock:
+                if _object in _uploaded_bootstrap_scripts:
+                    return None
+            try:
+                _call(
+                    _s3_client.head_object, Bucket=script["bucket"], Key=script["key"]
+                )
+            except ClientError as err:
+                if err.response["Error"].get("Code") not in (
+                    "404",
+                    "NoSuchKey",
+                    "NotFound",
+                ):
+                    raise
+                _put(script)
+            with _uploaded_bootstrap_scripts_lock:
+                _uploaded_bootstrap_scripts.add(_object)
+            return None
+        except Exception as err:
+            return f"Unable to write rendered template to s3://{script['bucket']}/{script['key']} because of {err}"
+
+    with ThreadPoolExecutor(max_workers=len(bootstrap_scripts)) as _pool:
+        _errors = [_e for _e in _pool.map(_upload, bootstrap_scripts) if _e]
+
+    if _errors:
+        return {"success": False, "output": ", ".join(_errors)}
+    return {
+        "success": True,
+        "output": f"{len(bootstrap_scripts)} bootstrap scripts available on S3",
+    }
+
+
+def prune_bootstrap_scripts(
+    bucket: str, cluster_id: str, active_stacks: set, min_age: int = 86400
+) -> dict:
+    """
+    Delete the job specific bootstrap scripts of the compute node stacks which are not in active_stacks anymore.
+    Scripts uploaded less than min_age seconds ago are kept as their stack may not be created yet.
+    Content-addressed scripts are shared by all jobs and are never pruned.
+    """
+    _s3_client = get_boto(service_name="s3").message
+    _prefix = f"{get_bootstrap_s3_folder(cluster_id)}/"
+    _expired_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        seconds=min_age
     )
+    _keys = []
+    for _page in _s3_client.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=_prefix
+    ):
+        for _object in _page.get("Contents", []):
+            _stack_name = _object["Key"][len(_prefix) :].split("/")[0]
+            # Folders of the stacks of another layout (e.g. content/) are not job specific
+            if (
+                not _stack_name.startswith(f"{cluster_id}-")
+                or _stack_name in active_stacks
+                or _object["LastModified"] > _expired_before
+            ):
+                continue
+            _keys.append(_object["Key"])
+
+    _errors = []
+    # DeleteObjects accepts up to 1000 keys per call
+    for _i in range(0, len(_keys), 1000):
+        _response = _s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [{"Key": _key} for _key in _keys[_i : _i + 1000]],
+                "Quiet": True,
+            },
+        )
+        _errors.extend(_response.get("Errors", []))
+
+    if _errors:
+        return {
+            "success": False,
+            "output": f"Unable to delete {len(_errors)} bootstrap scripts: {_errors[:10]}",
+        }
+    return {
+        "success": True,
+        "output": f"Deleted {len(_keys)} bootstrap scripts of deleted stacks",
+    }
+
+
+def _build_template(params: dict, user_data: str) -> Template:
+    """
+    Build the troposphere template of the compute node stack. user_data must be base64 encoded
+    """
+    # Metadata
+    t = Template()
+    t.set_version("2010-09-09")
+    t.set_description("(SOCA) - Base template to deploy compute nodes. Version 25.5.0")
+
+    mip_usage = False
+    # list of instance type. Use + to specify more than one type
+    # ex: c5.xlarge+c6.xlarge
+    instances_list = params["InstanceType"]
+
+    asg_lt = asg_LaunchTemplate()
+    ltd = LaunchTemplateData("NodeLaunchTemplateData")
+    mip = MixedInstancesPolicy()
+    stack_name = Ref("AWS::StackName")
+
+    # Begin LaunchTemplateData
+
+    # Specify the security groups to assign to the compute nodes. Max 5 per instance
+    # TODO - the length vs. maxlength should be checked
+    security_groups = [params["SecurityGroupId"]]
+    if params["AdditionalSecurityGroupIds"]:
+        for sg_id in params["AdditionalSecurityGroupIds"]:
+            security_groups.append(sg_id)
+
+    # Specify the IAM instance profile to use
+    instance_profile = (
+        params["ComputeNodeInstanceProfileArn"]
+        if params["CustomIamInstanceProfile"] is False
+        else params["CustomIamInstanceProfile"]
+    )
+
+    SpotFleet = (
+        True
+        if (
+            (params["SpotPrice"] is not False)
+            and (params["SpotAllocationCount"] is False)
+            and (int(params["DesiredCapacity"]) > 1 or len(instances_list) > 1)
+        )
+        else False
+    )
+    ltd.EbsOptimized = True
+    for instance in instances_list:
+        ltd.EbsOptimized = is_ebs_optimized(instance_type=instance)
+
+        if is_cpu_options_supported(instance_type=instance) and (
+            SpotFleet is False or len(instances_list) == 1
+        ):
+            # Spotfleet with multiple instance types doesn't support CpuOptions
+            # So we can't add CpuOptions if SpotPrice is specified and when multiple instances are specified
+            ltd.CpuOptions = CpuOptions(
+                CoreCount=int(params["CoreCount"]),
+                ThreadsPerCore=1 if params["ThreadsPerCore"] is False else 2,
+            )
+
+    ltd.IamInstanceProfile = IamInstanceProfile(Arn=instance_profile)
+    ltd.KeyName = params["SSHKeyPair"]
+    ltd.ImageId = params["ImageId"]
+
+    if params["SpotPrice"] is not False and params["SpotAllocationCount"] is False:
+        if params["SpotPrice"] == "auto":
+            # auto -> cap at OD price
+            ltd.InstanceMarketOptions = InstanceMarketOptions(MarketType="spot")
+        else:
+            ltd.InstanceMarketOptions = InstanceMarketOptions(
+                MarketType="spot",
+                SpotOptions=SpotOptions(MaxPrice=str(params["SpotPrice"])),
+            )
+    ltd.InstanceType = instances_list[0]
+
+    #
+    # EFA Interface deployments
+    #
+    ltd.NetworkInterfaces = [
+        NetworkInterfaces(
+            InterfaceType=(
+                "efa" if params["Efa"] is not False else Ref("AWS::NoValue")
+            ),
+            DeleteOnTermination=True,
+            DeviceIndex=0,
+            Groups=security_groups,
+        )
+    ]
+    if params.get("Efa", False) is not False:
+        _max_efa_interfaces: int = params.get("MaxEfaInterfaces", 0)
+
+        for _i in range(1, _max_efa_interfaces):
+            ltd.NetworkInterfaces.append(
+                NetworkInterfaces(
+                    InterfaceType="efa",
+                    DeleteOnTermination=True,
+                    DeviceIndex=1 if (_i > 0) else 0,
+                    NetworkCardIndex=_i,
+                    Groups=security_groups,
+                )
+            )
+
+    ltd.UserData = user_data
 
-    if _ebs_opt in {"default", "supported"}:
-        return True
+    if params["BaseOS"] in {"amazonlinux2", "amazonlinux2023"}:
+        _ebs_device_name = "/dev/xvda"
     else:
-        return False
+        _ebs_device_name = "/dev/sda1"
+    _ebs_scratch_device_name = "/dev/xvdbx"
+
+    # What is our default root volume_type?
+    _volume_type: str = params.get("VolumeType", "gp2")
+
+    ltd.BlockDeviceMappings = [
+        LaunchTemplateBlockDeviceMapping(
+            DeviceName=_ebs_device_name,
+            Ebs=EBSBlockDevice(
+                VolumeSize=params["RootSize"],
+                VolumeType=_volume_type,
+                DeleteOnTermination=("false" if params["KeepEbs"] is True else "true"),
+                Encrypted=True,
+            ),
+        )
+    ]
 
+    if int(params["ScratchSize"]) > 0:
+        ltd.BlockDeviceMappings.append(
+            BlockDeviceMapping(
+                DeviceName=_ebs_scratch_device_name,
+                Ebs=EBSBlockDevice(
+                    VolumeSize=params["ScratchSize"],
+                    VolumeType=(
+                        "io2" if int(params["VolumeTypeIops"]) > 0 else _volume_type
+                    ),
+                    Iops=(
+                        params["VolumeTypeIops"]
+                        if int(params["VolumeTypeIops"]) > 0
+                        else Ref("AWS::NoValue")
+                    ),
+                    DeleteOnTermination=(
+                        "false" if params["KeepEbs"] is True else "true"
+                    ),
+                    Encrypted=True,
+                ),
+            )
+        )
+    ltd.TagSpecifications = [
+        ec2.TagSpecifications(
+            ResourceType="instance",
+            Tags=base_Tags(
+                Name=str(params["ClusterId"]) + "-compute-job-" + str(params["JobId"]),
+                _soca_JobId=str(params["JobId"]),
+                _soca_JobName=str(params["JobName"]),
+                _soca_JobQueue=str(params["JobQueue"]),
+                _soca_StackId=stack_name,
+                _soca_JobOwner=str(params["JobOwner"]),
+                _soca_JobProject=str(params["JobProject"]),
+                _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
+                _soca_KeepForever=str(params["KeepForever"]).lower(),
+                _soca_ClusterId=str(params["ClusterId"]),
+                _soca_NodeType="compute_node",
+            ),
+        )
+    ]
+    ltd.MetadataOptions = MetadataOptions(
+        HttpEndpoint="enabled", HttpTokens=params["MetadataHttpTokens"]
+    )
 
-def main(**params):
-    try:
-        # Metadata
-        t = Template()
-        t.set_version("2010-09-09")
-        t.set_description(
-            "(SOCA) - Base template to deploy compute nodes. Version 25.5.0"
+    if params["PlacementGroup"] is True:
+        pg = PlacementGroup("ComputeNodePlacementGroup")
+        pg.Strategy = "cluster"
+        t.add_resource(pg)
+        ltd.Placement = ec2.Placement(GroupName=Ref(pg))
+
+    # End LaunchTemplateData
+
+    # Begin Launch Template Resource
+    lt = LaunchTemplate("NodeLaunchTemplate")
+    lt.LaunchTemplateName = params["ClusterId"] + "-" + str(params["JobId"])
+    lt.LaunchTemplateData = ltd
+
+    t.add_resource(lt)
+    # End Launch Template Resource
+
+    if SpotFleet is True:
+        # SpotPrice is defined and DesiredCapacity > 1 or need to try more than 1 instance_type
+        # Create SpotFleet
+
+        # Begin SpotFleetRequestConfigData Resource
+        sfrcd = ec2.SpotFleetRequestConfigData()
+        sfrcd.AllocationStrategy = params["SpotAllocationStrategy"]
+        sfrcd.ExcessCapacityTerminationPolicy = "noTermination"
+        sfrcd.IamFleetRole = params["SpotFleetIAMRoleArn"]
+        sfrcd.InstanceInterruptionBehavior = "terminate"
+        if params["SpotPrice"] != "auto":
+            sfrcd.SpotPrice = str(params["SpotPrice"])
+        sfrcd.SpotMaintenanceStrategies = ec2.SpotMaintenanceStrategies(
+            CapacityRebalance=ec2.SpotCapacityRebalance(ReplacementStrategy="launch")
+        )
+        sfrcd.TargetCapacity = params["DesiredCapacity"]
+        sfrcd.Type = "maintain"
+        sfltc = ec2.LaunchTemplateConfigs()
+        sflts = ec2.FleetLaunchTemplateSpecification(
+            LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
         )
+        sfltc.LaunchTemplateSpecification = sflts
+        sfltc.Overrides = []
+        for subnet in params["SubnetId"]:
+            for index, instance in enumerate(instances_list):
+                if params["WeightedCapacity"] is not False:
+                    sfltc.Overrides.append(
+                        ec2.LaunchTemplateOverrides(
+                            InstanceType=instance,
+                            SubnetId=subnet,
+                            WeightedCapacity=params["WeightedCapacity"][index],
+                        )
+                    )
+                else:
+                    sfltc.Overrides.append(
+                        ec2.LaunchTemplateOverrides(
+                            InstanceType=instance, SubnetId=subnet
+                        )
+                    )
+        sfrcd.LaunchTemplateConfigs = [sfltc]
+        TagSpecifications = ec2.SpotFleetTagSpecification(
+            ResourceType="spot-fleet-request",
+            Tags=base_Tags(
+                Name=str(params["ClusterId"]) + "-compute-job-" + str(params["JobId"]),
+                _soca_JobId=str(params["JobId"]),
+                _soca_JobName=str(params["JobName"]),
+                _soca_JobQueue=str(params["JobQueue"]),
+                _soca_StackId=stack_name,
+                _soca_JobOwner=str(params["JobOwner"]),
+                _soca_JobProject=str(params["JobProject"]),
+                _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
+                _soca_KeepForever=str(params["KeepForever"]).lower(),
+                _soca_ClusterId=str(params["ClusterId"]),
+                _soca_NodeType="compute_node",
+            ),
+        )
+        # End SpotFleetRequestConfigData Resource
+
+        # Begin SpotFleet Resource
+        spotfleet = ec2.SpotFleet("SpotFleet")
+        spotfleet.SpotFleetRequestConfigData = sfrcd
+        t.add_resource(spotfleet)
+        # End SpotFleet Resource
+    else:
+        asg_lt.LaunchTemplateSpecification = LaunchTemplateSpecification(
+            LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
+        )
+
+        asg_lt.Overrides = []
+        for index, instance in enumerate(instances_list):
+            if params["WeightedCapacity"] is not False:
+                mip_usage = True
+                asg_lt.Overrides.append(
+                    LaunchTemplateOverrides(
+                        InstanceType=instance,
+                        WeightedCapacity=str(params["WeightedCapacity"][index]),
+                    )
+                )
+            else:
+                asg_lt.Overrides.append(LaunchTemplateOverrides(InstanceType=instance))
+
+        # Begin InstancesDistribution
+        if (
+            params["SpotPrice"] is not False
+            and params["SpotAllocationCount"] is not False
+            and (int(params["DesiredCapacity"]) - int(params["SpotAllocationCount"]))
+            > 0
+        ):
+            mip_usage = True
+            idistribution = InstancesDistribution()
+            idistribution.OnDemandAllocationStrategy = (
+                "prioritized"  # only supported value
+            )
+            idistribution.OnDemandBaseCapacity = (
+                params["DesiredCapacity"] - params["SpotAllocationCount"]
+            )
+            idistribution.OnDemandPercentageAboveBaseCapacity = (
+                "0"  # force the other instances to be SPOT
+            )
+            idistribution.SpotMaxPrice = (
+                Ref("AWS::NoValue")
+                if params["SpotPrice"] == "auto"
+                else str(params["SpotPrice"])
+            )
+            idistribution.SpotAllocationStrategy = params["SpotAllocationStrategy"]
+            mip.InstancesDistribution = idistribution
+
+        # End MixedPolicyInstance
+
+        # HPCJobDeploymentMethod selection
+
+        # _soca_cluster_configuration: dict = get_soca_configuration(clusterid=)
+
+        # Begin AutoScalingGroup Resource
+        asg = AutoScalingGroup("AutoScalingComputeGroup")
+        asg.DependsOn = "NodeLaunchTemplate"
+        if mip_usage is True or len(instances_list) > 1:
+            mip.LaunchTemplate = asg_lt
+            asg.MixedInstancesPolicy = mip
+
+        else:
+            asg.LaunchTemplate = LaunchTemplateSpecification(
+                LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
+            )
+
+        asg.MinSize = int(params["DesiredCapacity"])
+        asg.MaxSize = int(params["DesiredCapacity"])
+        asg.VPCZoneIdentifier = params["SubnetId"]
+        asg.CapacityRebalance = False
+        asg.Tags = Tags(
+            Name=str(params["ClusterId"]) + "-compute-job-" + str(params["JobId"]),
+            _soca_JobId=str(params["JobId"]),
+            _soca_JobName=str(params["JobName"]),
+            _soca_JobQueue=str(params["JobQueue"]),
+            _soca_StackId=stack_name,
+            _soca_JobOwner=str(params["JobOwner"]),
+            _soca_JobProject=str(params["JobProject"]),
+            _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
+            _soca_KeepForever=str(params["KeepForever"]).lower(),
+            _soca_ClusterId=str(params["ClusterId"]),
+            _soca_NodeType="compute_node",
+        )
+
+        # t.add_resource(asg)
+
+        # HPC Fleet
+
+        # On-Demand capacity is launched with the instance types in the order of InstanceType (e.g: capacity planned by
+        # the dispatcher) instead of the lowest price
+        _prioritized = (
+            params.get("PrioritizedInstanceTypes", False) is True
+            and len(instances_list) > 1
+            and not (
+                params["SpotPrice"] is not False
+                and params["SpotAllocationCount"] is False
+            )
+        )
+        _fleet_overrides: list = []
+        for _subnet in params["SubnetId"]:
+            for _index, _instance in enumerate(instances_list):
+                _override = ec2.FleetLaunchTemplateOverridesRequest(
+                    SubnetId=_subnet,
+                    InstanceType=_instance,
+                )
+                if params["WeightedCapacity"] is not False:
+                    _override.WeightedCapacity = str(params["WeightedCapacity"][_index])
+                if _prioritized:
+                    # Lowest number is launched first
+                    _override.Priority = float(_index)
+                _fleet_overrides.append(_override)
+
+        # XXX FIXME TODO
+        # Need to make sure the instance type is available in the AZ/subnet
+        # As the Override generation with incompatible deployment would cause the entire API
+        # to reject even if it could be fulfilled by another AZ.
+        # This resolution takes place with the EC2 API for describe-offerings
+        #
+
+        _ec2_fleet = ec2.EC2Fleet(title="Ec2Fleet", Type="instant")
+        _ec2_fleet.LaunchTemplateConfigs = [
+            ec2.FleetLaunchTemplateConfigRequest(
+                LaunchTemplateSpecification=ec2.FleetLaunchTemplateSpecificationRequest(
+                    LaunchTemplateId=Ref(lt),
+                    Version=GetAtt(lt, "LatestVersionNumber"),
+                ),
+                Overrides=_fleet_overrides,
+            )
+        ]
+
+        # Spot support for EC2 Fleet
+        if params["SpotPrice"] is not False and params["SpotAllocationCount"] is False:
+            _spot_options_request = ec2.SpotOptionsRequest()
+            _spot_options_request.InstanceInterruptionBehavior = "terminate"
+            _spot_options_request.AllocationStrategy = params["SpotAllocationStrategy"]
+            _ec2_fleet.SpotOptions = _spot_options_request
+            _ec2_fleet.TargetCapacitySpecification = (
+                ec2.TargetCapacitySpecificationRequest(
+                    TotalTargetCapacity=int(params["DesiredCapacity"]),
+                    DefaultTargetCapacityType="spot",
+                )
+            )
+
+        else:
+            _ec2_fleet.TargetCapacitySpecification = (
+                ec2.TargetCapacitySpecificationRequest(
+                    TotalTargetCapacity=int(params["DesiredCapacity"]),
+                    DefaultTargetCapacityType="on-demand",
+                    OnDemandTargetCapacity=int(params["DesiredCapacity"]),
+                )
+            )
+            if _prioritized:
+                _ec2_fleet.OnDemandOptions = ec2.OnDemandOptionsRequest(
+                    AllocationStrategy="prioritized"
+                )
+
+        t.add_resource(_ec2_fleet)
+
+        # End AutoScalingGroup Resource
+
+    # Begin FSx for Lustre
+    if params["FSxLustreConfiguration"]["fsx_lustre"] is not False:
+        if params["FSxLustreConfiguration"]["existing_fsx"] is False:
+            fsx_lustre = FileSystem("FSxForLustre")
+            fsx_lustre.FileSystemType = "LUSTRE"
+            fsx_lustre.FileSystemTypeVersion = "2.15"
+            fsx_lustre.StorageCapacity = params["FSxLustreConfiguration"]["capacity"]
+            fsx_lustre.SecurityGroupIds = security_groups
+            fsx_lustre.SubnetIds = params["SubnetId"]
+            fsx_lustre_configuration = LustreConfiguration()
+            fsx_lustre_configuration.DeploymentType = params["FSxLustreConfiguration"][
+                "deployment_type"
+            ].upper()
+            if params["FSxLustreConfiguration"]["deployment_type"].upper() in {
+                "PERSISTENT_1",
+                "PERSISTENT_2",
+            }:
+                fsx_lustre_configuration.PerUnitStorageThroughput = params[
+                    "FSxLustreConfiguration"
+                ]["per_unit_throughput"]
+
+            if params["FSxLustreConfiguration"]["s3_backend"] is not False:
+                fsx_lustre_configuration.ImportPath = (
+                    params["FSxLustreConfiguration"]["import_path"]
+                    if params["FSxLustreConfiguration"]["import_path"] is not False
+                    else params["FSxLustreConfiguration"]["s3_backend"]
+                )
+                fsx_lustre_configuration.ExportPath = (
+                    params["FSxLustreConfiguration"]["import_path"]
+                    if params["FSxLustreConfiguration"]["import_path"] is not False
+                    else params["FSxLustreConfiguration"]["s3_backend"]
+                    + "/"
+                    + params["ClusterId"]
+                    + "-fsxoutput/job-"
+                    + params["JobId"]
+                    + "/"
+                )
+
+            fsx_lustre.LustreConfiguration = fsx_lustre_configuration
+            fsx_lustre.Tags = base_Tags(
+                # False disable PropagateAtLaunch
+                Name=str(params["ClusterId"] + "-compute-job-" + params["JobId"]),
+                _soca_JobId=str(params["JobId"]),
+                _soca_JobName=str(params["JobName"]),
+                _soca_JobQueue=str(params["JobQueue"]),
+                _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
+                _soca_StackId=stack_name,
+                _soca_JobOwner=str(params["JobOwner"]),
+                _soca_JobProject=str(params["JobProject"]),
+                _soca_KeepForever=str(params["KeepForever"]).lower(),
+                _soca_NodeType="compute_node",
+                _soca_FSx="true",
+                _soca_ClusterId=str(params["ClusterId"]),
+            )
+            t.add_resource(fsx_lustre)
+    # End FSx For Lustre
+
+    # Begin Custom Resource
+    # Change Mapping to No if you want to disable this
+    if params.get("MetricCollectionAnonymous", False) is True:
+        metrics = CustomResourceSendAnonymousMetrics("SendAnonymousData")
+        metrics.ServiceToken = params["SolutionMetricsLambda"]
+        metrics.DesiredCapacity = str(params["DesiredCapacity"])
+        metrics.InstanceType = str(params["InstanceType"])
+        metrics.Efa = str(params["Efa"])
+        metrics.ScratchSize = str(params["ScratchSize"])
+        metrics.RootSize = str(params["RootSize"])
+        metrics.SpotPrice = str(params["SpotPrice"])
+        metrics.BaseOS = str(params["BaseOS"])
+        metrics.StackUUID = str(params["StackUUID"])
+        metrics.KeepForever = str(params["KeepForever"])
+        # remove potentially sensitive information
+        fsx_l_metric = {}
+        fsx_l_config = params.get("FSxLustreConfiguration", {})
+        if fsx_l_config.get("fsx_lustre", False):
+            fsx_l_metric["fsx_lustre"] = True
+            fsx_l_metric["deployment_type"] = fsx_l_config.get(
+                "deployment_type", "SCRATCH_2"
+            ).upper()
+            fsx_l_metric["capacity"] = fsx_l_config.get("capacity", 1200)
+            fsx_l_metric["per_unit_throughput"] = fsx_l_config.get(
+                "per_unit_throughput", 200
+            )
+            # Replace these with simple True/False - not the actual user values
+            for item in {
+                "existing_fsx",
+                "s3_backend",
+                "import_path",
+                "export_path",
+            }:
+                fsx_l_metric[item] = True if fsx_l_config.get(item) else False
+        else:
+            fsx_l_metric["fsx_lustre"] = False
+        metrics.FsxLustre = str(fsx_l_metric)
+        metrics.TerminateWhenIdle = str(params["TerminateWhenIdle"])
+        metrics.Dcv = "false"
+        metrics.Region = params.get("Region", "")
+        metrics.Version = params.get("Version", "")
+        metrics.Misc = params.get("Misc", "")
+        t.add_resource(metrics)
+    # End Custom Resource
+
+    return t
+
+
+# Fields specific to each job, patched into the template skeleton shared by all jobs with the same shape
+SKELETON_FIELDS = (
+    "JobId",
+    "JobName",
+    "JobOwner",
+    "JobProject",
+    "JobQueue",
+    "TerminateWhenIdle",
+    "StackUUID",
+)
+# Integer placeholder used for DesiredCapacity, troposphere validates integer properties
+SKELETON_DESIRED_CAPACITY = 987654319
+SKELETON_CACHE_MAXSIZE = 128
+
+_skeleton_lock = threading.Lock()
+_skeleton_cache = OrderedDict()
+_skeleton_metrics = {"hit": 0, "miss": 0}
+
+
+def _skeleton_placeholder(field: str) -> str:
+    return f"@@skeleton:{field}@@"
+
+
+def _serialize_template(t: Template) -> str:
+    # Tags must use "soca:<Key>" syntax
+    return t.to_json(indent=None, separators=(",", ":")).replace("_soca_", "soca:")
+
 
-        _cluster_id: str = params.get("ClusterId", "unknown-cluster")
+def build_template(params: dict, user_data: str, use_skeleton: bool = True) -> str:
+    """
+    Return the JSON CloudFormation template of the compute node stack. user_data must be base64 encoded.
+    With use_skeleton, the troposphere template is built and serialized once per job shape (all parameters but SKELETON_FIELDS,
+    user data and DesiredCapacity), the job specific values are then patched into the serialized skeleton.
+    """
+    if not use_skeleton:
+        return _serialize_template(_build_template(params=params, user_data=user_data))
+
+    # DesiredCapacity changes the template layout when it's 1 or when part of the capacity is Spot, it's part of the shape in that case
+    _patch_desired_capacity = (
+        int(params["DesiredCapacity"]) > 1 and params["SpotAllocationCount"] is False
+    )
+    _shape = {
+        _k: _v
+        for _k, _v in params.items()
+        if _k not in SKELETON_FIELDS
+        and not (_k == "DesiredCapacity" and _patch_desired_capacity)
+    }
+    _shape_json = json.dumps(_shape, sort_keys=True, default=str)
+    if str(SKELETON_DESIRED_CAPACITY) in _shape_json:
+        return _serialize_template(_build_template(params=params, user_data=user_data))
+
+    _shape_key = hashlib.sha256(_shape_json.encode()).hexdigest()
+    with _skeleton_lock:
+        _skeleton = _skeleton_cache.get(_shape_key)
+        if _skeleton is not None:
+            _skeleton_cache.move_to_end(_shape_key)
+            _skeleton_metrics["hit"] += 1
+        else:
+            _skeleton_metrics["miss"] += 1
+
+    if _skeleton is None:
+        _skeleton_params = dict(params)
+        for _field in SKELETON_FIELDS:
+            _skeleton_params[_field] = _skeleton_placeholder(_field)
+        if _patch_desired_capacity:
+            _skeleton_params["DesiredCapacity"] = SKELETON_DESIRED_CAPACITY
+        _skeleton = _serialize_template(
+            _build_template(
+                params=_skeleton_params,
+                user_data=_skeleton_placeholder("UserData"),
+            )
+        )
+        with _skeleton_lock:
+            _skeleton_cache[_shape_key] = _skeleton
+            while len(_skeleton_cache) > SKELETON_CACHE_MAXSIZE:
+                _skeleton_cache.popitem(last=False)
+
+    _template = _skeleton
+    if _patch_desired_capacity:
+        _template = _template.replace(
+            str(SKELETON_DESIRED_CAPACITY), str(int(params["DesiredCapacity"]))
+        )
+    _values = {
+        _field: json.dumps(str(params[_field]))[1:-1] for _field in SKELETON_FIELDS
+    }
+    _values["UserData"] = user_data
+    _template = re.sub(
+        r"@@skeleton:(\w+)@@", lambda _m: _values[_m.group(1)], _template
+    )
+    return _template
 
-        debug = False
-        mip_usage = False
-        # list of instance type. Use + to specify more than one type
-        # ex: c5.xlarge+c6.xlarge
-        instances_list = params["InstanceType"]
 
-        asg_lt = asg_LaunchTemplate()
-        ltd = LaunchTemplateData("NodeLaunchTemplateData")
-        mip = MixedInstancesPolicy()
-        stack_name = Ref("AWS::StackName")
+def get_skeleton_cache_metrics() -> dict:
+    with _skeleton_lock:
+        return {**_skeleton_metrics, "size": len(_skeleton_cache)}
 
-        # Begin LaunchTemplateData
 
+def main(**params):
+    try:
         # Retrieve SOCA specific variable from AWS Parameter Store
-        soca_parameters = SocaConfig(key="/").get_value(return_as=dict).get("message")
+        soca_parameters = SocaConfigSnapshot.get_snapshot().get("message")
         if not soca_parameters:
             return {
                 "success": False,
@@ -198,7 +910,13 @@ def main(**params):
         _bootstrap_uuid = str(uuid.uuid4())
 
         # Location of Boostrap scripts on S3
-        _bootstrap_s3_location_folder = f"{soca_parameters.get('/configuration/ClusterId')}/config/do_not_delete/bootstrap/compute_node/{_bootstrap_uuid}"
+        _bootstrap_s3_folder = get_bootstrap_s3_folder(
+            soca_parameters.get("/configuration/ClusterId")
+        )
+        _bootstrap_s3_location_folder = (
+            f"{_bootstrap_s3_folder}/{params['StackName']}/{_bootstrap_uuid}"
+        )
+        _bootstrap_s3_content_folder = f"{_bootstrap_s3_folder}/content"
 
         # Add custom bootstrap path specific to current job id
         soca_parameters["/job/BootstrapPath"] = (
@@ -215,29 +933,6 @@ def main(**params):
             f"s3://{soca_parameters.get('/configuration/S3Bucket')}/{_bootstrap_s3_location_folder}/"
         )
 
-        # Create User Data
-        _render_user_data = SocaJinja2Generator(
-            get_template=f"compute_node/01_user_data.sh.j2",
-            template_dirs=[
-                f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_node_bootstrap/"
-            ],
-            variables=soca_parameters,
-        ).to_stdout(autocast_values=True)
-
-        if _render_user_data.get("success") is False:
-            return SocaResponse(
-                success=False,
-                message=f"Unable to generate compute_node/01_user_data.sh.j2 Jinja2 template because of {_render_user_data.get('message')}",
-            )
-        else:
-            _user_data = clean_user_data(
-                text_to_remove=[
-                    "# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.",
-                    "# SPDX-License-Identifier: Apache-2.0",
-                ],
-                data=_render_user_data.get("message"),
-            )
-
         # Create bootstrap setup invoked by user data
         # Create directory structure
         pathlib.Path(soca_parameters.get("/job/BootstrapPath")).mkdir(
@@ -253,6 +948,9 @@ def main(**params):
             "compute_node/04_setup_user_customization",
         ]
 
+        # Job independent scripts are content-addressed: jobs rendering the same script share the same S3 object, which is
+        # uploaded only once by upload_bootstrap_scripts() once the template is built
+        _bootstrap_scripts = []
         for _t in _templates_to_render:
             # Render Template
             _render_bootstrap_setup_template = SocaJinja2Generator(
@@ -261,518 +959,68 @@ def main(**params):
                     f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_node_bootstrap/"
                 ],
                 variables=soca_parameters,
-            ).to_s3(
-                bucket_name=soca_parameters.get("/configuration/S3Bucket"),
-                key=f"{_bootstrap_s3_location_folder}/{_t.split('/')[-1]}.sh",
-                autocast_values=True,
-            )
+            ).to_stdout(autocast_values=True, use_cache=True)
 
             if _render_bootstrap_setup_template.get("success") is False:
                 return SocaResponse(
                     success=False,
                     message=f"Unable to generate {_t}.sh.j2 Jinja2 template because of {_render_bootstrap_setup_template.get('message')}",
                 )
-
-        # Specify the security groups to assign to the compute nodes. Max 5 per instance
-        # TODO - the length vs. maxlength should be checked
-        security_groups = [params["SecurityGroupId"]]
-        if params["AdditionalSecurityGroupIds"]:
-            for sg_id in params["AdditionalSecurityGroupIds"]:
-                security_groups.append(sg_id)
-
-        # Specify the IAM instance profile to use
-        instance_profile = (
-            params["ComputeNodeInstanceProfileArn"]
-            if params["CustomIamInstanceProfile"] is False
-            else params["CustomIamInstanceProfile"]
-        )
-
-        SpotFleet = (
-            True
-            if (
-                (params["SpotPrice"] is not False)
-                and (params["SpotAllocationCount"] is False)
-                and (int(params["DesiredCapacity"]) > 1 or len(instances_list) > 1)
-            )
-            else False
-        )
-        ltd.EbsOptimized = True
-        for instance in instances_list:
-            ltd.EbsOptimized = is_ebs_optimized(instance_type=instance)
-
-            if is_cpu_options_supported(instance_type=instance) and (
-                SpotFleet is False or len(instances_list) == 1
-            ):
-                # Spotfleet with multiple instance types doesn't support CpuOptions
-                # So we can't add CpuOptions if SpotPrice is specified and when multiple instances are specified
-                ltd.CpuOptions = CpuOptions(
-                    CoreCount=int(params["CoreCount"]),
-                    ThreadsPerCore=1 if params["ThreadsPerCore"] is False else 2,
-                )
-
-        ltd.IamInstanceProfile = IamInstanceProfile(Arn=instance_profile)
-        ltd.KeyName = params["SSHKeyPair"]
-        ltd.ImageId = params["ImageId"]
-
-        if params["SpotPrice"] is not False and params["SpotAllocationCount"] is False:
-            if params["SpotPrice"] == "auto":
-                # auto -> cap at OD price
-                ltd.InstanceMarketOptions = InstanceMarketOptions(MarketType="spot")
-            else:
-                ltd.InstanceMarketOptions = InstanceMarketOptions(
-                    MarketType="spot",
-                    SpotOptions=SpotOptions(MaxPrice=str(params["SpotPrice"])),
-                )
-        ltd.InstanceType = instances_list[0]
-
-        #
-        # EFA Interface deployments
-        #
-        ltd.NetworkInterfaces = [
-            NetworkInterfaces(
-                InterfaceType=(
-                    "efa" if params["Efa"] is not False else Ref("AWS::NoValue")
-                ),
-                DeleteOnTermination=True,
-                DeviceIndex=0,
-                Groups=security_groups,
+            _body = _render_bootstrap_setup_template.get("message")
+            _content_addressed = _t in JOB_INDEPENDENT_BOOTSTRAP_TEMPLATES
+            _folder = (
+                f"{_bootstrap_s3_content_folder}/{hashlib.sha256(_body.encode()).hexdigest()}"
+                if _content_addressed
+                else _bootstrap_s3_location_folder
             )
-        ]
-        if params.get("Efa", False) is not False:
-            _max_efa_interfaces: int = params.get("MaxEfaInterfaces", 0)
-
-            for _i in range(1, _max_efa_interfaces):
-                ltd.NetworkInterfaces.append(
-                    NetworkInterfaces(
-                        InterfaceType="efa",
-                        DeleteOnTermination=True,
-                        DeviceIndex=1 if (_i > 0) else 0,
-                        NetworkCardIndex=_i,
-                        Groups=security_groups,
-                    )
-                )
-
-        ltd.UserData = base64.b64encode(_user_data.encode("utf-8")).decode("utf-8")
-
-        if params["BaseOS"] in {"amazonlinux2", "amazonlinux2023"}:
-            _ebs_device_name = "/dev/xvda"
-        else:
-            _ebs_device_name = "/dev/sda1"
-        _ebs_scratch_device_name = "/dev/xvdbx"
-
-        # What is our default root volume_type?
-        _volume_type: str = params.get("VolumeType", "gp2")
-
-        ltd.BlockDeviceMappings = [
-            LaunchTemplateBlockDeviceMapping(
-                DeviceName=_ebs_device_name,
-                Ebs=EBSBlockDevice(
-                    VolumeSize=params["RootSize"],
-                    VolumeType=_volume_type,
-                    DeleteOnTermination=(
-                        "false" if params["KeepEbs"] is True else "true"
-                    ),
-                    Encrypted=True,
-                ),
+            _bootstrap_scripts.append(
+                {
+                    "name": f"{_t.split('/')[-1]}.sh",
+                    "bucket": soca_parameters.get("/configuration/S3Bucket"),
+                    "key": f"{_folder}/{_t.split('/')[-1]}.sh",
+                    "body": _body,
+                    "content_addressed": _content_addressed,
+                }
             )
-        ]
 
-        if int(params["ScratchSize"]) > 0:
-            ltd.BlockDeviceMappings.append(
-                BlockDeviceMapping(
-                    DeviceName=_ebs_scratch_device_name,
-                    Ebs=EBSBlockDevice(
-                        VolumeSize=params["ScratchSize"],
-                        VolumeType=(
-                            "io2" if int(params["VolumeTypeIops"]) > 0 else _volume_type
-                        ),
-                        Iops=(
-                            params["VolumeTypeIops"]
-                            if int(params["VolumeTypeIops"]) > 0
-                            else Ref("AWS::NoValue")
-                        ),
-                        DeleteOnTermination=(
-                            "false" if params["KeepEbs"] is True else "true"
-                        ),
-                        Encrypted=True,
-                    ),
-                )
-            )
-        ltd.TagSpecifications = [
-            ec2.TagSpecifications(
-                ResourceType="instance",
-                Tags=base_Tags(
-                    Name=str(params["ClusterId"])
-                    + "-compute-job-"
-                    + str(params["JobId"]),
-                    _soca_JobId=str(params["JobId"]),
-                    _soca_JobName=str(params["JobName"]),
-                    _soca_JobQueue=str(params["JobQueue"]),
-                    _soca_StackId=stack_name,
-                    _soca_JobOwner=str(params["JobOwner"]),
-                    _soca_JobProject=str(params["JobProject"]),
-                    _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
-                    _soca_KeepForever=str(params["KeepForever"]).lower(),
-                    _soca_ClusterId=str(params["ClusterId"]),
-                    _soca_NodeType="compute_node",
-                ),
-            )
-        ]
-        ltd.MetadataOptions = MetadataOptions(
-            HttpEndpoint="enabled", HttpTokens=params["MetadataHttpTokens"]
+        # Objects downloaded by the user data, format: <script_name>=<s3_uri> <script_name>=<s3_uri> ...
+        soca_parameters["/job/BootstrapScriptsS3Objects"] = " ".join(
+            f"{_script['name']}=s3://{_script['bucket']}/{_script['key']}"
+            for _script in _bootstrap_scripts
         )
 
-        if params["PlacementGroup"] is True:
-            pg = PlacementGroup("ComputeNodePlacementGroup")
-            pg.Strategy = "cluster"
-            t.add_resource(pg)
-            ltd.Placement = ec2.Placement(GroupName=Ref(pg))
-
-        # End LaunchTemplateData
-
-        # Begin Launch Template Resource
-        lt = LaunchTemplate("NodeLaunchTemplate")
-        lt.LaunchTemplateName = params["ClusterId"] + "-" + str(params["JobId"])
-        lt.LaunchTemplateData = ltd
-
-        t.add_resource(lt)
-        # End Launch Template Resource
-
-        if SpotFleet is True:
-            # SpotPrice is defined and DesiredCapacity > 1 or need to try more than 1 instance_type
-            # Create SpotFleet
-
-            # Begin SpotFleetRequestConfigData Resource
-            sfrcd = ec2.SpotFleetRequestConfigData()
-            sfrcd.AllocationStrategy = params["SpotAllocationStrategy"]
-            sfrcd.ExcessCapacityTerminationPolicy = "noTermination"
-            sfrcd.IamFleetRole = params["SpotFleetIAMRoleArn"]
-            sfrcd.InstanceInterruptionBehavior = "terminate"
-            if params["SpotPrice"] != "auto":
-                sfrcd.SpotPrice = str(params["SpotPrice"])
-            sfrcd.SpotMaintenanceStrategies = ec2.SpotMaintenanceStrategies(
-                CapacityRebalance=ec2.SpotCapacityRebalance(
-                    ReplacementStrategy="launch"
-                )
-            )
-            sfrcd.TargetCapacity = params["DesiredCapacity"]
-            sfrcd.Type = "maintain"
-            sfltc = ec2.LaunchTemplateConfigs()
-            sflts = ec2.FleetLaunchTemplateSpecification(
-                LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
-            )
-            sfltc.LaunchTemplateSpecification = sflts
-            sfltc.Overrides = []
-            for subnet in params["SubnetId"]:
-                for index, instance in enumerate(instances_list):
-                    if params["WeightedCapacity"] is not False:
-                        sfltc.Overrides.append(
-                            ec2.LaunchTemplateOverrides(
-                                InstanceType=instance,
-                                SubnetId=subnet,
-                                WeightedCapacity=params["WeightedCapacity"][index],
-                            )
-                        )
-                    else:
-                        sfltc.Overrides.append(
-                            ec2.LaunchTemplateOverrides(
-                                InstanceType=instance, SubnetId=subnet
-                            )
-                        )
-            sfrcd.LaunchTemplateConfigs = [sfltc]
-            TagSpecifications = ec2.SpotFleetTagSpecification(
-                ResourceType="spot-fleet-request",
-                Tags=base_Tags(
-                    Name=str(params["ClusterId"])
-                    + "-compute-job-"
-                    + str(params["JobId"]),
-                    _soca_JobId=str(params["JobId"]),
-                    _soca_JobName=str(params["JobName"]),
-                    _soca_JobQueue=str(params["JobQueue"]),
-                    _soca_StackId=stack_name,
-                    _soca_JobOwner=str(params["JobOwner"]),
-                    _soca_JobProject=str(params["JobProject"]),
-                    _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
-                    _soca_KeepForever=str(params["KeepForever"]).lower(),
-                    _soca_ClusterId=str(params["ClusterId"]),
-                    _soca_NodeType="compute_node",
-                ),
-            )
-            # End SpotFleetRequestConfigData Resource
+        # Create User Data
+        _render_user_data = SocaJinja2Generator(
+            get_template=f"compute_node/01_user_data.sh.j2",
+            template_dirs=[
+                f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_node_bootstrap/"
+            ],
+            variables=soca_parameters,
+        ).to_stdout(autocast_values=True)
 
-            # Begin SpotFleet Resource
-            spotfleet = ec2.SpotFleet("SpotFleet")
-            spotfleet.SpotFleetRequestConfigData = sfrcd
-            t.add_resource(spotfleet)
-            # End SpotFleet Resource
-        else:
-            asg_lt.LaunchTemplateSpecification = LaunchTemplateSpecification(
-                LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
+        if _render_user_data.get("success") is False:
+            return SocaResponse(
+                success=False,
+                message=f"Unable to generate compute_node/01_user_data.sh.j2 Jinja2 template because of {_render_user_data.get('message')}",
             )
-
-            asg_lt.Overrides = []
-            for index, instance in enumerate(instances_list):
-                if params["WeightedCapacity"] is not False:
-                    mip_usage = True
-                    asg_lt.Overrides.append(
-                        LaunchTemplateOverrides(
-                            InstanceType=instance,
-                            WeightedCapacity=str(params["WeightedCapacity"][index]),
-                        )
-                    )
-                else:
-                    asg_lt.Overrides.append(
-                        LaunchTemplateOverrides(InstanceType=instance)
-                    )
-
-            # Begin InstancesDistribution
-            if (
-                params["SpotPrice"] is not False
-                and params["SpotAllocationCount"] is not False
-                and (
-                    int(params["DesiredCapacity"]) - int(params["SpotAllocationCount"])
-                )
-                > 0
-            ):
-                mip_usage = True
-                idistribution = InstancesDistribution()
-                idistribution.OnDemandAllocationStrategy = (
-                    "prioritized"  # only supported value
-                )
-                idistribution.OnDemandBaseCapacity = (
-                    params["DesiredCapacity"] - params["SpotAllocationCount"]
-                )
-                idistribution.OnDemandPercentageAboveBaseCapacity = (
-                    "0"  # force the other instances to be SPOT
-                )
-                idistribution.SpotMaxPrice = (
-                    Ref("AWS::NoValue")
-                    if params["SpotPrice"] == "auto"
-                    else str(params["SpotPrice"])
-                )
-                idistribution.SpotAllocationStrategy = params["SpotAllocationStrategy"]
-                mip.InstancesDistribution = idistribution
-
-            # End MixedPolicyInstance
-
-            # HPCJobDeploymentMethod selection
-
-            # _soca_cluster_configuration: dict = get_soca_configuration(clusterid=)
-
-            # Begin AutoScalingGroup Resource
-            asg = AutoScalingGroup("AutoScalingComputeGroup")
-            asg.DependsOn = "NodeLaunchTemplate"
-            if mip_usage is True or len(instances_list) > 1:
-                mip.LaunchTemplate = asg_lt
-                asg.MixedInstancesPolicy = mip
-
-            else:
-                asg.LaunchTemplate = LaunchTemplateSpecification(
-                    LaunchTemplateId=Ref(lt), Version=GetAtt(lt, "LatestVersionNumber")
-                )
-
-            asg.MinSize = int(params["DesiredCapacity"])
-            asg.MaxSize = int(params["DesiredCapacity"])
-            asg.VPCZoneIdentifier = params["SubnetId"]
-            asg.CapacityRebalance = False
-            asg.Tags = Tags(
-                Name=str(params["ClusterId"]) + "-compute-job-" + str(params["JobId"]),
-                _soca_JobId=str(params["JobId"]),
-                _soca_JobName=str(params["JobName"]),
-                _soca_JobQueue=str(params["JobQueue"]),
-                _soca_StackId=stack_name,
-                _soca_JobOwner=str(params["JobOwner"]),
-                _soca_JobProject=str(params["JobProject"]),
-                _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
-                _soca_KeepForever=str(params["KeepForever"]).lower(),
-                _soca_ClusterId=str(params["ClusterId"]),
-                _soca_NodeType="compute_node",
+        else:
+            _user_data = clean_user_data(
+                text_to_remove=[
+                    "# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.",
+                    "# SPDX-License-Identifier: Apache-2.0",
+                ],
+                data=_render_user_data.get("message"),
             )
 
-            # t.add_resource(asg)
-
-            # HPC Fleet
-
-            _fleet_overrides: list = []
-            for _subnet in params["SubnetId"]:
-                for _index, _instance in enumerate(instances_list):
-                    if params["WeightedCapacity"] is not False:
-                        _fleet_overrides.append(
-                            ec2.FleetLaunchTemplateOverridesRequest(
-                                SubnetId=_subnet,
-                                InstanceType=_instance,
-                                WeightedCapacity=str(
-                                    params["WeightedCapacity"][_index]
-                                ),
-                            )
-                        )
-                    else:
-                        _fleet_overrides.append(
-                            ec2.FleetLaunchTemplateOverridesRequest(
-                                SubnetId=_subnet,
-                                InstanceType=_instance,
-                            )
-                        )
-
-            # XXX FIXME TODO
-            # Need to make sure the instance type is available in the AZ/subnet
-            # As the Override generation with incompatible deployment would cause the entire API
-            # to reject even if it could be fulfilled by another AZ.
-            # This resolution takes place with the EC2 API for describe-offerings
-            #
-
-            _ec2_fleet = ec2.EC2Fleet(title="Ec2Fleet", Type="instant")
-            _ec2_fleet.LaunchTemplateConfigs = [
-                ec2.FleetLaunchTemplateConfigRequest(
-                    LaunchTemplateSpecification=ec2.FleetLaunchTemplateSpecificationRequest(
-                        LaunchTemplateId=Ref(lt),
-                        Version=GetAtt(lt, "LatestVersionNumber"),
-                    ),
-                    Overrides=_fleet_overrides,
-                )
-            ]
-
-            # Spot support for EC2 Fleet
-            if (
-                params["SpotPrice"] is not False
-                and params["SpotAllocationCount"] is False
-            ):
-                _spot_options_request = ec2.SpotOptionsRequest()
-                _spot_options_request.InstanceInterruptionBehavior = "terminate"
-                _spot_options_request.AllocationStrategy = params[
-                    "SpotAllocationStrategy"
-                ]
-                _ec2_fleet.SpotOptions = _spot_options_request
-                _ec2_fleet.TargetCapacitySpecification = (
-                    ec2.TargetCapacitySpecificationRequest(
-                        TotalTargetCapacity=int(params["DesiredCapacity"]),
-                        DefaultTargetCapacityType="spot",
-                    )
-                )
-
-            else:
-                _ec2_fleet.TargetCapacitySpecification = (
-                    ec2.TargetCapacitySpecificationRequest(
-                        TotalTargetCapacity=int(params["DesiredCapacity"]),
-                        DefaultTargetCapacityType="on-demand",
-                        OnDemandTargetCapacity=int(params["DesiredCapacity"]),
-                    )
-                )
-
-            t.add_resource(_ec2_fleet)
-
-            # End AutoScalingGroup Resource
-
-        # Begin FSx for Lustre
-        if params["FSxLustreConfiguration"]["fsx_lustre"] is not False:
-            if params["FSxLustreConfiguration"]["existing_fsx"] is False:
-                fsx_lustre = FileSystem("FSxForLustre")
-                fsx_lustre.FileSystemType = "LUSTRE"
-                fsx_lustre.FileSystemTypeVersion = "2.15"
-                fsx_lustre.StorageCapacity = params["FSxLustreConfiguration"][
-                    "capacity"
-                ]
-                fsx_lustre.SecurityGroupIds = security_groups
-                fsx_lustre.SubnetIds = params["SubnetId"]
-                fsx_lustre_configuration = LustreConfiguration()
-                fsx_lustre_configuration.DeploymentType = params[
-                    "FSxLustreConfiguration"
-                ]["deployment_type"].upper()
-                if params["FSxLustreConfiguration"]["deployment_type"].upper() in {
-                    "PERSISTENT_1",
-                    "PERSISTENT_2",
-                }:
-                    fsx_lustre_configuration.PerUnitStorageThroughput = params[
-                        "FSxLustreConfiguration"
-                    ]["per_unit_throughput"]
-
-                if params["FSxLustreConfiguration"]["s3_backend"] is not False:
-                    fsx_lustre_configuration.ImportPath = (
-                        params["FSxLustreConfiguration"]["import_path"]
-                        if params["FSxLustreConfiguration"]["import_path"] is not False
-                        else params["FSxLustreConfiguration"]["s3_backend"]
-                    )
-                    fsx_lustre_configuration.ExportPath = (
-                        params["FSxLustreConfiguration"]["import_path"]
-                        if params["FSxLustreConfiguration"]["import_path"] is not False
-                        else params["FSxLustreConfiguration"]["s3_backend"]
-                        + "/"
-                        + params["ClusterId"]
-                        + "-fsxoutput/job-"
-                        + params["JobId"]
-                        + "/"
-                    )
-
-                fsx_lustre.LustreConfiguration = fsx_lustre_configuration
-                fsx_lustre.Tags = base_Tags(
-                    # False disable PropagateAtLaunch
-                    Name=str(params["ClusterId"] + "-compute-job-" + params["JobId"]),
-                    _soca_JobId=str(params["JobId"]),
-                    _soca_JobName=str(params["JobName"]),
-                    _soca_JobQueue=str(params["JobQueue"]),
-                    _soca_TerminateWhenIdle=str(params["TerminateWhenIdle"]),
-                    _soca_StackId=stack_name,
-                    _soca_JobOwner=str(params["JobOwner"]),
-                    _soca_JobProject=str(params["JobProject"]),
-                    _soca_KeepForever=str(params["KeepForever"]).lower(),
-                    _soca_NodeType="compute_node",
-                    _soca_FSx="true",
-                    _soca_ClusterId=str(params["ClusterId"]),
-                )
-                t.add_resource(fsx_lustre)
-        # End FSx For Lustre
-
-        # Begin Custom Resource
-        # Change Mapping to No if you want to disable this
-        if params.get("MetricCollectionAnonymous", False) is True:
-            metrics = CustomResourceSendAnonymousMetrics("SendAnonymousData")
-            metrics.ServiceToken = params["SolutionMetricsLambda"]
-            metrics.DesiredCapacity = str(params["DesiredCapacity"])
-            metrics.InstanceType = str(params["InstanceType"])
-            metrics.Efa = str(params["Efa"])
-            metrics.ScratchSize = str(params["ScratchSize"])
-            metrics.RootSize = str(params["RootSize"])
-            metrics.SpotPrice = str(params["SpotPrice"])
-            metrics.BaseOS = str(params["BaseOS"])
-            metrics.StackUUID = str(params["StackUUID"])
-            metrics.KeepForever = str(params["KeepForever"])
-            # remove potentially sensitive information
-            fsx_l_metric = {}
-            fsx_l_config = params.get("FSxLustreConfiguration", {})
-            if fsx_l_config.get("fsx_lustre", False):
-                fsx_l_metric["fsx_lustre"] = True
-                fsx_l_metric["deployment_type"] = fsx_l_config.get(
-                    "deployment_type", "SCRATCH_2"
-                ).upper()
-                fsx_l_metric["capacity"] = fsx_l_config.get("capacity", 1200)
-                fsx_l_metric["per_unit_throughput"] = fsx_l_config.get(
-                    "per_unit_throughput", 200
-                )
-                # Replace these with simple True/False - not the actual user values
-                for item in {
-                    "existing_fsx",
-                    "s3_backend",
-                    "import_path",
-                    "export_path",
-                }:
-                    fsx_l_metric[item] = True if fsx_l_config.get(item) else False
-            else:
-                fsx_l_metric["fsx_lustre"] = False
-            metrics.FsxLustre = str(fsx_l_metric)
-            metrics.TerminateWhenIdle = str(params["TerminateWhenIdle"])
-            metrics.Dcv = "false"
-            metrics.Region = params.get("Region", "")
-            metrics.Version = params.get("Version", "")
-            metrics.Misc = params.get("Misc", "")
-            t.add_resource(metrics)
-        # End Custom Resource
-
-        if debug is True:
-            print(t.to_json())
-
-        # Tags must use "soca:<Key>" syntax
-        template_output = t.to_yaml().replace("_soca_", "soca:")
-        return {"success": True, "output": template_output}
+        template_output = build_template(
+            params=params,
+            user_data=base64.b64encode(_user_data.encode("utf-8")).decode("utf-8"),
+        )
+        return {
+            "success": True,
+            "output": template_output,
+            "bootstrap_scripts": _bootstrap_scripts,
+        }
 
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
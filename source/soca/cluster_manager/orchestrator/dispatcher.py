@@ -17,15 +17,16 @@ This script retrieve all queued jobs, calculate PBS resources required to launch
 and provision EC2 capacity if all resources conditions are met.
 """
 import argparse
+from concurrent.futures import wait as futures_wait
 from datetime import datetime, timezone, timedelta
 import fnmatch
-import json
 import logging
 import os
 import re
 import subprocess
 import sys
 import socket
+import time
 import pytz
 import yaml
 from botocore.exceptions import ClientError
@@ -33,8 +34,26 @@ from botocore.exceptions import ClientError
 sys.path.append(
     f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID', 'SOCA_CONFIGURATION_NOT_FOUND')}/cluster_manager"
 )
-from utils.aws.boto3_wrapper import get_boto
-import add_nodes
+from utils.aws.boto3_wrapper import get_boto, get_boto_metrics
+from utils.aws.ec2_instance_catalog import get_instance_catalog
+from utils.pbs_nodes_snapshot import get_pbs_nodes_snapshot, parse_pbs_size
+import fair_share
+import socaqstat
+from pbs_batch import PBSBatchExecutor
+from capacity_planner import CapacityPlanner
+from stack_submission import get_submission_pipeline
+from license_availability import get_license_availability
+
+logger = logging.getLogger("tcpserver")
+queue_log_handlers = {}
+# Incremental job tracker, only used in daemon mode
+jobs_tracker = None
+# Fair share usage history per half life, kept in memory between passes in daemon mode
+fair_share_usages = {}
+# Max time to wait for the capacity requests submitted to the StackSubmissionPipeline during a queue evaluation
+capacity_submission_timeout = 600
+# Capacity requests still running after capacity_submission_timeout, their jobs are updated by the next passes
+pending_capacity_submissions = []
 
 
 def run_command(cmd, cmd_type: str):
@@ -43,6 +62,9 @@ def run_command(cmd, cmd_type: str):
             command = subprocess.check_output(cmd)
         elif cmd_type == "call":
             command = subprocess.call(cmd)
+            if jobs_tracker is not None and cmd[0] == system_cmds["qalter"]:
+                # Job id is always the last argument, fetch it again during the next cycle
+                jobs_tracker.invalidate(cmd[-1])
         else:
             print("Command not Defined")
             exit(1)
@@ -52,10 +74,14 @@ def run_command(cmd, cmd_type: str):
 
 
 def get_lock(process_name):
-    get_lock._lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # Keep a reference to each lock socket, a daemon can hold one lock per queue type
+    if not hasattr(get_lock, "_lock_sockets"):
+        get_lock._lock_sockets = {}
+    _lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
     pid = os.getpid()
     try:
-        get_lock._lock_socket.bind("\0" + process_name)
+        _lock_socket.bind("\0" + process_name)
+        get_lock._lock_sockets[process_name] = _lock_socket
         # print(f'Obtained the lock {process_name} - PID {pid}')
         return True
     except socket.error:
@@ -63,179 +89,194 @@ def get_lock(process_name):
         return str(pid)
 
 
-def fair_share_job_id_order(sorted_queued_job, user_fair_share):
-    """
-        Generate the job order to provision based on fair share score
-
-        example:
-        sorted_queued_job = [
-            {'get_job_id': 1, 'get_job_owner': 'mcrozes'},
-            {'get_job_id': 2, 'get_job_owner': 'mcrozes'},
-            {'get_job_id': 3, 'get_job_owner': 'mcrozes'},
-            {'get_job_id': 4, 'get_job_owner': 'test'},
-            {'get_job_id': 5, 'get_job_owner': 'test'},
-        ]
-        user_fair_share = {'mcrozes': 100,
-                           'test': 50}
-
-        Result:
-        Next User is mcrozes
-    Next User is test
-    Next User is mcrozes
-    Next User is test
-    Next User is mcrozes
-    Next User is test
-    [1, 4, 2, 5, 3]
+def logpush(message, status="info"):
+    if status == "error":
+        logger.error(message)
+    else:
+        logger.info(message)
 
-    """
 
-    job_ids_to_start = []
-    order = 0
-    while order <= sorted_queued_job.__len__():
-        sorted_user_fair_share = sorted(
-            user_fair_share.items(), key=lambda kv: kv[1], reverse=True
+def set_queue_logger(log_name):
+    """
+    Route logpush() messages to orchestrator/logs/<log_name>.log.
+    Handlers are created once and re-used across scheduling passes when running as a daemon.
+    """
+    if log_name not in queue_log_handlers.keys():
+        log_file = logging.FileHandler(
+            "/opt/soca/"
+            + os.environ["SOCA_CLUSTER_ID"]
+            + "/cluster_manager/orchestrator/logs/"
+            + log_name
+            + ".log",
+            "a",
         )
-        logpush("Fair Share Score: " + str(sorted_user_fair_share))
-
-        next_user = sorted_user_fair_share[0][0]
-        logpush("Next User is " + next_user)
-
-        next_user_jobs = [
-            i["get_job_id"]
-            for i in sorted_queued_job
-            if i["get_job_owner"] == next_user
-        ]
-        logpush("Next Job for user is " + str(next_user_jobs))
-        for job_id in next_user_jobs:
-            if job_id in job_ids_to_start:
-                if next_user_jobs.__len__() == 1:
-                    # User don't have any more queued jobs
-                    del user_fair_share[next_user]
-            else:
-                job_ids_to_start.append(job_id)
-                user_fair_share[next_user] = (
-                    user_fair_share[next_user] + fair_share_running_job_malus
-                )
-                break
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(lineno)d] [%(levelname)s] [%(message)s]"
+        )
+        log_file.setFormatter(formatter)
+        queue_log_handlers[log_name] = log_file
 
-        order += 1
+    for hdlr in logger.handlers[:]:  # remove all old handlers
+        logger.removeHandler(hdlr)
 
-    logpush("jobs id re-order based on fairshare: " + str(job_ids_to_start))
-    return job_ids_to_start
+    logger.addHandler(queue_log_handlers[log_name])  # set the new handler
+    logger.setLevel(logging.DEBUG)
 
 
-def fair_share_score(queued_jobs, running_jobs, queue):
-    user_score = {}
-    now = int((datetime.now()).strftime("%s"))
+def get_jobs_infos(queue, queue_parameter_values, jobs_snapshot):
+    """
+    Return all jobs for a given queue, served from the qstat snapshot of the current scheduling pass
+    """
+    try:
+        jobs = jobs_snapshot.get_jobs_infos(
+            queue=queue, queue_parameter_values=queue_parameter_values, user="all"
+        )
+    except Exception as _e:
+        # no job
+        return {}
 
-    # First, apply malus for users who already have running job
-    for r_job_data in running_jobs:
-        if r_job_data["get_job_owner"] not in user_score.keys():
-            user_score[r_job_data["get_job_owner"]] = (
-                fair_share_start_score + fair_share_running_job_malus
-            )
-        else:
-            user_score[r_job_data["get_job_owner"]] = (
-                user_score[r_job_data["get_job_owner"]] + fair_share_running_job_malus
-            )
+    if queue_parameter_values.get("scaling_mode", "single_job") == "multiple_jobs":
+        all_jobs = [job for job_hash in jobs.values() for job in job_hash.values()]
+    else:
+        all_jobs = jobs.values()
 
-    for q_job_data in queued_jobs:
-        if "stack_id" in q_job_data["get_job_resource_list"].keys():
-            # If job is queued and in the process of start (provision capacity), we apply the running job malus
-            job_bonus_score = fair_share_running_job_malus
+    for job in all_jobs:
+        # Clear case where project starts with digits to prevent leading zero errors
+        job["get_job_project"] = str(job["get_job_project"])
 
-        else:
-            # Begin FairShare Formula
-            timestamp_submission = q_job_data["get_job_queue_time_epoch"]
-            resource_name = q_job_data["get_job_resource_list"].keys()
-            license = 0
+    return jobs
 
-            for license_name in fnmatch.filter(resource_name, "*_lic*"):
-                logpush(
-                    "Job use the following licenses:"
-                    + str(license_name)
-                    + " - "
-                    + str(q_job_data["get_job_resource_list"][license_name])
-                )
-                license += int(q_job_data["get_job_resource_list"][license_name])
 
-            required_resource = int(q_job_data["get_job_nodect"]) + license
-            logpush("Job Required Resource Bonus " + str(required_resource))
+def revert_jobs_compute_node(job_ids, jobs_data):
+    """
+    Rollback stack_id and compute_node of queued jobs so they can be reconsidered in the next dispatcher iteration.
+    Jobs sharing the same select are updated with a single qalter.
+    """
+    pbs_batch = PBSBatchExecutor(qalter_bin=system_cmds["qalter"], logger=logger)
+    for job_id in job_ids:
+        job_select_resource = jobs_data[job_id]["get_job_resource_list"]["select"]
+        new_job_select = (
+            job_select_resource.split(":compute_node")[0] + ":compute_node=tbd"
+        )
+        pbs_batch.qalter(
+            job_id=job_id, args=["-l", "stack_id=", "-l", "select=" + new_job_select]
+        )
+        if jobs_tracker is not None:
+            jobs_tracker.invalidate(str(job_id))
 
-            # Example dynamic bonus score
-            # c1 = 0.5
-            # c2 = 1.7
-            # job_bonus_score = required_resource * (c1 * ((int(now) - int(timestamp_submission))/3600/24) ** c2)
+    for result in pbs_batch.run().values():
+        if result["returncode"] != 0:
+            logpush(f"Unable to revert {result['cmd']}: {result['output']}", "error")
 
-            # Linear
-            c1: float = 1
-            c2: float = 0
-            job_bonus_score: float = 1
 
+def process_capacity_submissions(capacity_submissions):
+    """
+    Wait for the capacity requests submitted to the StackSubmissionPipeline and update the jobs.
+    All requests share a single capacity_submission_timeout deadline. Submissions are removed from capacity_submissions
+    once processed, requests still running after the deadline are moved to pending_capacity_submissions.
+    Jobs are always updated from the dispatcher thread, never from a StackSubmissionPipeline worker.
+    """
+    apply_pending_capacity_submissions()
+    if not capacity_submissions:
+        return
+
+    submissions = capacity_submissions[:]
+    del capacity_submissions[:]
+    _, not_done = futures_wait(
+        [submission["future"] for submission in submissions],
+        timeout=capacity_submission_timeout,
+    )
+    for submission in submissions:
+        if submission["future"] in not_done:
             logpush(
-                "Job "
-                + str(q_job_data["get_job_id"])
-                + " queued for "
-                + str((int(now) - int(timestamp_submission)) / 60)
-                + " minutes: bonus %.2f" % job_bonus_score
+                f"Capacity request for {submission['job_id']} still running after {capacity_submission_timeout}s, job will be updated by the next pass once the request completes",
+                "error",
             )
-
-            # END
-        if q_job_data["get_job_owner"] not in user_score.keys():
-            user_score[q_job_data["get_job_owner"]] = (
-                fair_share_start_score + job_bonus_score
-            )
-        else:
-            user_score[q_job_data["get_job_owner"]] = (
-                user_score[q_job_data["get_job_owner"]] + job_bonus_score
-            )
-
-    # Remove user with no queued job
-    for user, score in list(
-        user_score.items()
-    ):  # cast to list as we change the size of the dict on the fly w/ py3
-        if [i["get_job_owner"] for i in queued_jobs if i["get_job_owner"] == user]:
-            pass
+            pending_capacity_submissions.append(submission)
         else:
-            del user_score[user]
+            apply_capacity_submission(submission, submission["future"])
 
-    return user_score
 
+def apply_pending_capacity_submissions(timeout=0):
+    """
+    Update the jobs of the capacity requests left running by the previous passes which completed within timeout seconds.
+    Use timeout=None to wait for all of them
+    """
+    if not pending_capacity_submissions:
+        return
 
-def logpush(message, status="info"):
-    if status == "error":
-        logger.error(message)
-    else:
-        logger.info(message)
+    futures_wait(
+        [submission["future"] for submission in pending_capacity_submissions],
+        timeout=timeout,
+    )
+    for submission in pending_capacity_submissions[:]:
+        if submission["future"].done():
+            pending_capacity_submissions.remove(submission)
+            apply_capacity_submission(submission, submission["future"])
 
 
-def get_jobs_infos(queue):
-    command = [
-        system_cmds["python"],
-        system_cmds["socaqstat"],
-        "-f",
-        "json",
-        "-u",
-        "all",
-        "-q",
-        queue,
-    ]
-    output = run_command(command, "check_output")
+def apply_capacity_submission(submission, future):
+    """
+    Update the job of a completed capacity request:
+    - on success, flush the job error_message (and set select/stack_id for single_job scaling mode)
+    - on failure, set the job error_message and return the licenses booked for the request
+    """
+    job_id = submission["job_id"]
     try:
-        sanitize_input = output.decode("utf-8")
-        for match in re.findall(r'"project":(\d+),', sanitize_input, re.MULTILINE):
-            # Clear case where project starts with digits to prevent leading zero errors
-            print(
-                f'Detected "project":{match}, > Will be replaced to prevent int leading zero error'
+        create_new_asg = future.result()
+    except Exception as e:
+        create_new_asg = {"success": False, "message": str(e)}
+
+    if create_new_asg["success"] is True:
+        compute_unit = create_new_asg["compute_node"]
+        stack_id = create_new_asg["stack_name"]
+        logpush(
+            str(job_id)
+            + " : compute_node="
+            + str(compute_unit)
+            + " | stack_id="
+            + str(stack_id)
+        )
+        if submission["select"] is not None:
+            # Add new PBS resource to the job
+            # stack_id=xxx -> CloudFormation Stack Name
+            # compute_node=xxx -> Unique ID that will be assigned to all EC2 hosts for this job
+            select = submission["select"] + ":compute_node=" + str(compute_unit)
+            logpush(f"select variable: {select}")
+            run_command(
+                [system_cmds["qalter"], "-l", "select=" + select, str(job_id)],
+                "call",
             )
-            sanitize_input = sanitize_input.replace(
-                f'"project":{match},', f'"project":"{match}",'
+            run_command(
+                [system_cmds["qalter"], "-l", "stack_id=" + stack_id, str(job_id)],
+                "call",
             )
 
-        return json.loads(sanitize_input)
-    except Exception as _e:
-        # no job
-        return {}
+        # flush error if any
+        run_command(
+            [system_cmds["qalter"], "-l", "error_message=", str(job_id)],
+            "call",
+        )
+    else:
+        sanitized_error = (
+            create_new_asg["message"]
+            .replace("'", "_")
+            .replace("!", "_")
+            .replace(" ", "_")
+        )
+        run_command(
+            [
+                system_cmds["qalter"],
+                "-l",
+                "error_message='" + sanitized_error + "'",
+                str(job_id),
+            ],
+            "call",
+        )
+        logpush(f"Error while trying to create ASG: {create_new_asg}")
+        # Licenses booked when the request was submitted can be used by the next jobs
+        for resource, count in submission.get("licenses", {}).items():
+            get_license_availability().release(resource, count)
 
 
 def check_if_queue_started(queue_name):
@@ -255,23 +296,16 @@ def check_if_queue_started(queue_name):
 
 # BEGIN FLEXLM FUNCTIONS
 def check_available_licenses(commands, license_to_check):
-    output = {}
+    """
+    Return the available licenses for license_to_check (minus the licenses promised to the jobs provisioned during this cycle).
+    Commands are run concurrently and their result is cached for a few seconds, see LicenseAvailability.
+    """
     if commands.__len__() == 0:
         return {}
 
-    for pbs_resource, flexlm_cmd in commands.items():
-        if pbs_resource in license_to_check:
-            try:
-                available_licenses = run_command(flexlm_cmd.split(), "check_output")
-                output[pbs_resource] = int(available_licenses.rstrip())
-            except subprocess.CalledProcessError as e:
-                logpush(
-                    message=f"command '{e.cmd}' return with error (code {e.returncode}): {e.output}",
-                    status="error",
-                )
-                exit(1)
-
-    return output
+    license_service = get_license_availability()
+    license_service.set_commands(commands)
+    return license_service.get_available(license_to_check)
 
 
 # END FLEXLM FUNCTIONS
@@ -465,215 +499,126 @@ def capacity_being_provisioned(stack_id, job_id, job_select_resource, scaling_mo
     return False
 
 
-def available_capacity(job_hash):
-    free_cpus = 0
-    pbsnodes_args = " -a -F json"
-    pbsnodes_output = {}
-    try:
-        pbsnodes_output = json.loads(
-            (
-                run_command(
-                    (system_cmds["pbsnodes"] + pbsnodes_args).split(), "check_output"
-                )
-            ).decode("utf-8")
-        )
-        if "nodes" in pbsnodes_output.keys():
-            for hostname, host_data in pbsnodes_output["nodes"].items():
-                if (
-                    (host_data["state"] == "free")
-                    and (
-                        host_data["resources_available"]["compute_node"]
-                        == "job" + job_hash
-                    )
-                    and (
-                        datetime.now().timestamp()
-                        > host_data["last_state_change_time"] + 60
-                    )
-                ):
-                    if "ncpus" in host_data["resources_assigned"].keys():
-                        free_cpus += int(
-                            host_data["resources_available"]["ncpus"]
-                        ) - int(host_data["resources_assigned"]["ncpus"])
-                    else:
-                        free_cpus += int(host_data["resources_available"]["ncpus"])
-            return free_cpus
-    except AttributeError:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        if (
-            len(pbsnodes_output) == 0
-        ):  # pbsnodes_output could return an empty string when there are no nodes in the cluster
-            pass
-        else:
-            logpush(
-                "Error occurred: {}, {}, {}".format(exc_type, fname, exc_tb.tb_lineno)
-            )
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        logpush(
-            "Error occurred: {}, {}, {}, error: {}".format(
-                exc_type, fname, exc_tb.tb_lineno, e
-            )
-        )
-
-    return 0
-
-
 # END EC2 FUNCTIONS
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-c", "--config", nargs="?", required=True, help="Path to a configuration file"
-    )
-    parser.add_argument(
-        "-t",
-        "--type",
-        nargs="?",
-        required=True,
-        help="queue type - ex: graphics, compute .. Open YML file for more info",
-    )
-    arg = parser.parse_args()
-    queue_type = arg.type
-
-    # Try to get a lock; if another dispatcher for the same queue is running, this instance will exit
-    process_lock = get_lock("{} {}".format(__file__, queue_type))
-    if process_lock is not True:
-        print(
-            "Dispatcher.py for this queue is already is already running with process id "
-            + process_lock
-            + ". Stop it first"
-        )
-        sys.exit(1)
-
-    if "SOCA_CLUSTER_ID" not in os.environ:
-        print("SOCA_CLUSTER_ID not found, make sure to source /etc/environment first")
-        sys.exit(1)
-
-    # Begin Pre-requisite
-    system_cmds = {
-        "qstat": "/opt/pbs/bin/qstat",
-        "qmgr": "/opt/pbs/bin/qmgr",
-        "qalter": "/opt/pbs/bin/qalter",
-        "qdel": "/opt/pbs/bin/qdel",
-        "pbsnodes": "/opt/pbs/bin/pbsnodes",
-        "socaqstat": "/opt/soca/"
-        + os.environ["SOCA_CLUSTER_ID"]
-        + "/cluster_manager/orchestrator/socaqstat.py",
-        "python": "/opt/soca/"
-        + os.environ["SOCA_CLUSTER_ID"]
-        + "/python/latest/bin/python3",
-    }
-    # AWS Clients
-    ses = get_boto(service_name="ses").message
-    ec2 = get_boto(service_name="ec2").message
-    cloudformation = get_boto(service_name="cloudformation").message
-    autoscaling = get_boto(service_name="autoscaling").message
-
-    # Variables
-    queue_parameter_values = {}
-    queues = False
-    queues_only_parameters = [
-        "allowed_users",
-        "excluded_users",
-        "excluded_instance_types",
-        "allowed_instance_types",
-        "restricted_parameters",
-        "allowed_security_group_ids",
-        "allowed_instance_profiles",
-    ]
-    restricted_job_resources = [
-        "select",
-        "ncpus",
-        "ngpus",
-        "place",
-        "nodect",
-        "queues",
-        "compute_node",
-        "stack_id",
-        "max_running_jobs",
-        "max_provisioned_instances",
-        "scaling_mode",
-    ]  # dispatcher cannot edit these job values
-    asg_name = None
-    fair_share_running_job_malus = -60
-    fair_share_start_score = 100
-
-    # Retrieve Default Queue parameters
-    queue_settings_file = (
-        "/opt/soca/"
-        + os.environ["SOCA_CLUSTER_ID"]
-        + "/cluster_manager/orchestrator/settings/queue_mapping.yml"
-    )
+def get_fair_share_usage(half_life):
+    """
+    Return the decayed usage history for a given half life (in hours), updated with the jobs completed since the last run.
+    Return None if the usage cannot be computed, fair share is then calculated without usage history.
+    """
     try:
-        stream_resource_mapping = open(queue_settings_file, "r")
-        docs = yaml.safe_load_all(stream_resource_mapping)
-        for doc in docs:
-            for items in doc.values():
-                for _type, info in items.items():
-                    if _type == queue_type:
-                        queues = info["queues"]
-                        for parameter_key, parameter_value in info.items():
-                            if parameter_key in queues_only_parameters:
-                                # specific queue resources which are not job resources
-                                pass
-                            else:
-                                queue_parameter_values[parameter_key] = parameter_value
-            stream_resource_mapping.close()
+        if half_life not in fair_share_usages.keys():
+            fair_share_usages[half_life] = fair_share.FairShareUsage(
+                state_file=f"{fair_share_usage_directory}/usage_{half_life}h.json",
+                half_life=half_life,
+            )
+        fair_share_usages[half_life].update()
+        return fair_share_usages[half_life]
     except Exception as err:
-        print(
-            f"Unable to read queue settings file ({queue_settings_file}) with error: {err}"
-        )
-        sys.exit(1)
+        logpush(f"Unable to update fair share usage history: {err}", "error")
+        return None
 
-    # Generate FlexLM mapping
-    license_mapping_file = (
-        "/opt/soca/"
-        + os.environ["SOCA_CLUSTER_ID"]
-        + "/cluster_manager/orchestrator/settings/licenses_mapping.yml"
+
+def get_fair_share_job_list(
+    queued_jobs, running_jobs, fair_share_settings, fair_share_usage
+):
+    """
+    Return the queued job ids sorted by fair share, using the formula and weights configured in queue_mapping.yml
+    """
+    running_job_malus = fair_share_settings.get(
+        "fair_share_running_job_malus", fair_share_running_job_malus
     )
-    try:
-        stream_flexlm_mapping = open(license_mapping_file, "r")
-        docs = yaml.safe_load_all(stream_flexlm_mapping)
-        custom_flexlm_resources = {}
-        for doc in docs:
-            for k, v in doc.items():
-                for license_name, license_output in v.items():
-                    custom_flexlm_resources[license_name] = license_output
-        stream_flexlm_mapping.close()
-    except Exception as err:
-        print(f"Unable to read license file ({license_mapping_file}) with error: {err}")
-        sys.exit(1)
-    # End Pre-requisite
+    user_fair_share = fair_share.fair_share_score(
+        queued_jobs,
+        running_jobs,
+        start_score=fair_share_start_score,
+        running_job_malus=running_job_malus,
+        formula=fair_share_settings.get("fair_share_formula", "linear"),
+        formula_parameters=fair_share_settings.get("fair_share_formula_parameters"),
+        usage=fair_share_usage,
+        usage_weight=fair_share_settings.get("fair_share_usage_weight", 0),
+        project_usage_weight=fair_share_settings.get(
+            "fair_share_project_usage_weight", 0
+        ),
+    )
+    logpush(f"User Fair Share: {user_fair_share}")
+    job_id_order_based_on_fairshare = fair_share.fair_share_job_id_order(
+        sorted(queued_jobs, key=lambda k: k["get_job_order_in_queue"]),
+        user_fair_share,
+        running_job_malus=running_job_malus,
+    )
+    logpush(f"Job_id_order_based_on_fairshare: {job_id_order_based_on_fairshare}")
+    return job_id_order_based_on_fairshare
 
-    if queues is False:
-        print("No queues detected in the queue_mapping.yml. Exiting ...")
-        exit(1)
 
-    for queue_name in queues:
-        log_file = logging.FileHandler(
-            "/opt/soca/"
-            + os.environ["SOCA_CLUSTER_ID"]
-            + "/cluster_manager/orchestrator/logs/"
-            + queue_name
-            + ".log",
-            "a",
+def dispatch_queues(
+    queues,
+    queue_parameter_values,
+    custom_flexlm_resources,
+    jobs_snapshot=None,
+    fair_share_settings=None,
+):
+    """
+    Evaluate all queued jobs for the queues of a given queue type and provision capacity when needed.
+    This is a single scheduling pass, called once by the cron mode or every cycle by the daemon mode.
+    qstat is only queried once per pass, unless a jobs_snapshot already created for this cycle is provided.
+    """
+    # Jobs of the capacity requests completed since the previous pass must be updated before being evaluated again
+    apply_pending_capacity_submissions()
+    capacity_submissions = []
+    try:
+        _dispatch_queues(
+            queues,
+            queue_parameter_values,
+            custom_flexlm_resources,
+            capacity_submissions,
+            jobs_snapshot=jobs_snapshot,
+            fair_share_settings=fair_share_settings,
         )
-        formatter = logging.Formatter(
-            "[%(asctime)s] [%(lineno)d] [%(levelname)s] [%(message)s]"
+    finally:
+        # Stacks already submitted must be reported to their jobs even when the pass exits early (e.g: sys.exit on invalid
+        # queue settings), otherwise the jobs stay untagged and the next pass provisions them again
+        process_capacity_submissions(capacity_submissions)
+
+
+def _dispatch_queues(
+    queues,
+    queue_parameter_values,
+    custom_flexlm_resources,
+    capacity_submissions,
+    jobs_snapshot=None,
+    fair_share_settings=None,
+):
+    if jobs_snapshot is None:
+        jobs_snapshot = socaqstat.QstatSnapshot(qstat_bin=system_cmds["qstat"])
+
+    if jobs_snapshot.error is not None:
+        logpush(jobs_snapshot.error, "error")
+
+    if fair_share_settings is None:
+        fair_share_settings = {}
+
+    fair_share_usage = None
+    if queue_parameter_values.get("queue_mode") == "fairshare" and (
+        fair_share_settings.get("fair_share_usage_weight", 0)
+        or fair_share_settings.get("fair_share_project_usage_weight", 0)
+    ):
+        # Usage history is shared by all queues of this queue type
+        fair_share_usage = get_fair_share_usage(
+            fair_share_settings.get("fair_share_usage_half_life", 24)
         )
-        log_file.setFormatter(formatter)
-        logger = logging.getLogger("tcpserver")
-        for hdlr in logger.handlers[:]:  # remove all old handlers
-            logger.removeHandler(hdlr)
 
-        logger.addHandler(log_file)  # set the new handler
-        logger.setLevel(logging.DEBUG)
+    submission_pipeline = get_submission_pipeline()
+    for queue_name in queues:
+        set_queue_logger(queue_name)
         skip_queue = False
         limit_running_jobs = False
-        get_jobs = get_jobs_infos(queue_name)
+        get_jobs = get_jobs_infos(
+            queue=queue_name,
+            queue_parameter_values=queue_parameter_values,
+            jobs_snapshot=jobs_snapshot,
+        )
         if "queue_mode" in queue_parameter_values.keys():
             queue_mode = queue_parameter_values["queue_mode"]
         else:
@@ -729,21 +674,22 @@ if __name__ == "__main__":
                     f"Detected Default Parameters for this queue: {queue_parameter_values}"
                 )
 
+                # Probe all the licenses required by the queued jobs at once, jobs are then validated from the cache
+                licenses_required = []
+                for job_data in queued_jobs:
+                    resource_name = job_data["get_job_resource_list"].keys()
+                    for license_name in fnmatch.filter(resource_name, "*_lic*"):
+                        if license_name not in licenses_required:
+                            licenses_required.append(license_name)
+                if licenses_required:
+                    check_available_licenses(custom_flexlm_resources, licenses_required)
+
                 job_list = []
                 # Validate queue_mode
                 if queue_mode == "fairshare":
-                    user_fair_share = fair_share_score(
-                        queued_jobs, running_jobs, queue_name
-                    )
-                    logpush(f"User Fair Share: {user_fair_share}")
-                    job_id_order_based_on_fairshare = fair_share_job_id_order(
-                        sorted(queued_jobs, key=lambda k: k["get_job_order_in_queue"]),
-                        user_fair_share,
-                    )
-                    logpush(
-                        f"Job_id_order_based_on_fairshare: {job_id_order_based_on_fairshare}"
+                    job_list = get_fair_share_job_list(
+                        queued_jobs, running_jobs, fair_share_settings, fair_share_usage
                     )
-                    job_list = job_id_order_based_on_fairshare
 
                 elif queue_mode == "fifo":
                     for job in sorted(
@@ -761,6 +707,9 @@ if __name__ == "__main__":
                 stack_id = ""
                 for job_hash, hash_data in get_jobs.items():
                     logpush(f"Iterating for job_hash: {job_hash}")
+                    # Jobs to provision during this cycle and jobs of the hash with capacity already requested
+                    planned_jobs = []
+                    committed_jobs = []
                     # Identify job ids that belong to the current job_hash
                     jobs_in_hash = []
                     for job_id in job_list:
@@ -812,12 +761,20 @@ if __name__ == "__main__":
                     vcpus_required_instances = []
                     cores_required_instances = []
                     weighted_capacity = []
-                    instances_attributes = ec2.describe_instance_types(
-                        InstanceTypes=user_instance_types
+                    instances_attributes = get_instance_catalog().describe(
+                        user_instance_types
                     )
-                    # Note: describe_instance_types doesn't maintain order for user_instance_types
+                    if (
+                        instances_attributes.get("success") is False
+                        or not instances_attributes.get("message")
+                    ):
+                        logpush(
+                            f"Unable to retrieve instance attributes for {user_instance_types}: {instances_attributes.get('message')}",
+                            "error",
+                        )
+                        continue
                     # Extract InstanceType and corresponding DefaultVCpus/DefaultCores to have consistent weighted_capacity
-                    for item in instances_attributes["InstanceTypes"]:
+                    for item in instances_attributes.get("message").values():
                         instance_types.append(item["InstanceType"])
                         memory_required_instances.append(
                             item["MemoryInfo"]["SizeInMiB"]
@@ -871,12 +828,25 @@ if __name__ == "__main__":
                                             + " as this job already has a valid compute node"
                                         )
                                         skip_job = True
+                                        committed_jobs.append(
+                                            {
+                                                "job_id": job_id,
+                                                "ncpus": job_data["get_job_ncpus"],
+                                                "nodect": job_data["get_job_nodect"],
+                                                "mem": parse_pbs_size(
+                                                    job_data[
+                                                        "get_job_resource_list"
+                                                    ].get("mem", 0)
+                                                ),
+                                            }
+                                        )
                                 except KeyError:
                                     # in certain very rare case, stack_id is not present, in this case we just ignore as the stack will automatically be generated
                                     pass
 
                             job_required_resource = job_data["get_job_resource_list"]
                             license_requirement = {}
+                            job_required_mem = 0
 
                             licenses_required = []
                             resource_name = job_required_resource.keys()
@@ -1102,14 +1072,10 @@ if __name__ == "__main__":
                                             job_required_resource[res]
                                         )
 
-                                hash_cpu_ct += int(job_data["get_job_ncpus"]) * int(
-                                    job_data["get_job_nodect"]
-                                )
                                 compute_unit = "job" + job_hash
                                 stack_id = (
                                     os.environ["SOCA_CLUSTER_ID"] + "-job-" + job_hash
                                 )
-                                # logpush(str(job_id) + " : compute_node=" + str(compute_unit) + " | stack_id=" +str(stack_id))
                                 select = (
                                     job_required_resource["select"].split(
                                         ":compute_node"
@@ -1117,42 +1083,30 @@ if __name__ == "__main__":
                                     + ":compute_node="
                                     + str(compute_unit)
                                 )
-                                logpush(
-                                    "Setting job: "
-                                    + str(job_id)
-                                    + " select variable: "
-                                    + str(select)
-                                )
-
-                                run_command(
-                                    [
-                                        system_cmds["qalter"],
-                                        "-l",
-                                        "select=" + select,
-                                        str(job_id),
-                                    ],
-                                    "call",
-                                )
-                                run_command(
-                                    [
-                                        system_cmds["qalter"],
-                                        "-l",
-                                        "stack_id=" + stack_id,
-                                        str(job_id),
-                                    ],
-                                    "call",
+                                # select/stack_id are only set once the job is part of the capacity plan of the hash
+                                planned_jobs.append(
+                                    {
+                                        "job_id": job_id,
+                                        "ncpus": job_data["get_job_ncpus"],
+                                        "nodect": job_data["get_job_nodect"],
+                                        "mem": job_required_mem,
+                                        "select": select,
+                                        "licenses": dict(license_requirement),
+                                    }
                                 )
+                                # Licenses are booked as soon as the job is planned so the next jobs of the hash can't use them,
+                                # they are released if the job is not part of the capacity provisioned for the hash
+                                for (
+                                    resource,
+                                    count_to_substract,
+                                ) in license_requirement.items():
+                                    get_license_availability().promise(
+                                        resource, count_to_substract
+                                    )
 
                     # We've completed a full iteration on all queued jobs that belong to a certain job_hash
-                    # Now, the script will provision the required resources for these jobs
-                    logpush(
-                        "Completed full iteration for job_hash: "
-                        + str(job_hash)
-                        + ". Total required capacity is: "
-                        + str(hash_cpu_ct)
-                    )
-
-                    if hash_cpu_ct > 0:
+                    # Now, the script will plan and provision the required resources for all these jobs at once
+                    if planned_jobs:
                         # Limit number of running jobs if "max_running_jobs" is set for this queue
                         try:
                             if "max_running_jobs" in queue_parameter_values.keys():
@@ -1177,16 +1131,20 @@ if __name__ == "__main__":
                                         queue_parameter_values["max_running_jobs"]
                                     )
                                 )
-                                if (
-                                    hash_cpu_ct + all_running_jobs
-                                    > queue_parameter_values["max_running_jobs"]
-                                ):
-                                    hash_cpu_ct = (
-                                        queue_parameter_values["max_running_jobs"]
-                                        - all_running_jobs
-                                    )
-                            else:
-                                pass
+                                # planned_jobs follows the queue order (fifo/fairshare), keep the first ones
+                                max_planned_jobs = max(
+                                    queue_parameter_values["max_running_jobs"]
+                                    - all_running_jobs,
+                                    0,
+                                )
+                                for planned_job in planned_jobs[max_planned_jobs:]:
+                                    for resource, count in planned_job[
+                                        "licenses"
+                                    ].items():
+                                        get_license_availability().release(
+                                            resource, count
+                                        )
+                                planned_jobs = planned_jobs[:max_planned_jobs]
 
                         except Exception as err:
                             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -1196,14 +1154,85 @@ if __name__ == "__main__":
                             )
                             sys.exit(1)
 
-                        # Check available resources and reduce hash_cpu_ct accordingly
-                        # Uncomment if you want to reduce capacity to be requested
-                        # Note available_capacity method considers vCPUs/cores available
-                        # However, it doesn't look at job memory requirements and memory available on instances
-                        # free_cpus = available_capacity(job_hash)
-                        # if free_cpus > 0:
-                        #    logpush('Found ' + str(free_cpus) + ' available capacity for job_hash: ' + str(job_hash)+ '. Reducing required capacity accordingly')
-                        #    hash_cpu_ct -= free_cpus
+                    if planned_jobs:
+                        # Pack all jobs of the hash on the free nodes of the hash and on the cheapest mix of new instances
+                        # pbsnodes is only queried once per cycle, the snapshot is shared by all hashes and queues
+                        nodes_snapshot = get_pbs_nodes_snapshot(
+                            pbsnodes_bin=system_cmds["pbsnodes"]
+                        )
+                        nodes_snapshot.refresh()
+                        capacity_plan = CapacityPlanner(
+                            instance_types=instance_types,
+                            weighted_capacity=weighted_capacity,
+                            memory=memory_required_instances,
+                            pricing_model=(
+                                "ondemand"
+                                if str(
+                                    job_parameter_values.get("spot_price", False)
+                                ).lower()
+                                in ("false", "none", "")
+                                else "spot"
+                            ),
+                        ).plan(
+                            jobs=planned_jobs,
+                            free_nodes=nodes_snapshot.get_free_capacity(
+                                "job" + job_hash
+                            ),
+                            committed_jobs=committed_jobs,
+                        )
+                        logpush(
+                            f"Capacity plan for job_hash {job_hash}: {capacity_plan}"
+                        )
+                        for unschedulable_job_id in capacity_plan["unschedulable_jobs"]:
+                            logpush(
+                                f"Skipping job: {unschedulable_job_id}, it does not fit on any instance type of the job_hash: {instance_types}",
+                                "error",
+                            )
+
+                        pbs_batch = PBSBatchExecutor(
+                            qalter_bin=system_cmds["qalter"], logger=logger
+                        )
+                        # Licenses of the jobs provisioned for the hash, returned if the capacity can't be provisioned
+                        planned_licenses = {}
+                        for planned_job in planned_jobs:
+                            if str(planned_job["job_id"]) not in capacity_plan["jobs"]:
+                                for resource, count in planned_job["licenses"].items():
+                                    get_license_availability().release(resource, count)
+                                continue
+                            for resource, count in planned_job["licenses"].items():
+                                planned_licenses[resource] = (
+                                    planned_licenses.get(resource, 0) + count
+                                )
+                            logpush(
+                                "Setting job: "
+                                + str(planned_job["job_id"])
+                                + " select variable: "
+                                + str(planned_job["select"])
+                            )
+                            pbs_batch.qalter(
+                                job_id=planned_job["job_id"],
+                                args=["-l", "select=" + planned_job["select"]],
+                            )
+                            pbs_batch.qalter(
+                                job_id=planned_job["job_id"],
+                                args=["-l", "stack_id=" + stack_id],
+                            )
+                            if jobs_tracker is not None:
+                                jobs_tracker.invalidate(str(planned_job["job_id"]))
+                        for result in pbs_batch.run().values():
+                            if result["returncode"] != 0:
+                                logpush(
+                                    f"Unable to run {result['cmd']}: {result['output']}",
+                                    "error",
+                                )
+
+                        hash_cpu_ct = capacity_plan["capacity"]
+                        logpush(
+                            "Completed full iteration for job_hash: "
+                            + str(job_hash)
+                            + ". Total required capacity is: "
+                            + str(hash_cpu_ct)
+                        )
 
                         if hash_cpu_ct > 0:
                             try:
@@ -1283,7 +1312,7 @@ if __name__ == "__main__":
                                                     + " to: "
                                                     + str(new_target_capacity)
                                                 )
-                                                resp = ec2.modify_spot_fleet_request(
+                                                ec2.modify_spot_fleet_request(
                                                     SpotFleetRequestId=spotfleet,
                                                     TargetCapacity=new_target_capacity,
                                                 )
@@ -1293,26 +1322,15 @@ if __name__ == "__main__":
                                                     "Spot Fleet can't be modified at this time... reverting stack_id and select for job_ids:  "
                                                     + str(jobs_to_revert)
                                                 )
-                                                for job_id in jobs_to_revert:
-                                                    job_select_resource = hash_data[
-                                                        job_id
-                                                    ]["get_job_resource_list"]["select"]
-                                                    new_job_select = (
-                                                        job_select_resource.split(
-                                                            ":compute_node"
-                                                        )[0]
-                                                        + ":compute_node=tbd"
-                                                    )
-                                                    run_command(
-                                                        [
-                                                            system_cmds["qalter"],
-                                                            "-l",
-                                                            "stack_id=",
-                                                            "-l",
-                                                            "select=" + new_job_select,
-                                                            str(job_id),
-                                                        ],
-                                                        "call",
+                                                revert_jobs_compute_node(
+                                                    jobs_to_revert, hash_data
+                                                )
+                                                for (
+                                                    resource,
+                                                    count,
+                                                ) in planned_licenses.items():
+                                                    get_license_availability().release(
+                                                        resource, count
                                                     )
                                             break
                                         if (
@@ -1338,13 +1356,11 @@ if __name__ == "__main__":
                                                 + " to: "
                                                 + str(new_target_capacity)
                                             )
-                                            resp = (
-                                                autoscaling.update_auto_scaling_group(
-                                                    AutoScalingGroupName=asg,
-                                                    MinSize=new_target_capacity,
-                                                    MaxSize=new_target_capacity,
-                                                    DesiredCapacity=new_target_capacity,
-                                                )
+                                            autoscaling.update_auto_scaling_group(
+                                                AutoScalingGroupName=asg,
+                                                MinSize=new_target_capacity,
+                                                MaxSize=new_target_capacity,
+                                                DesiredCapacity=new_target_capacity,
                                             )
                                             break
                                 elif (
@@ -1356,26 +1372,10 @@ if __name__ == "__main__":
                                         "CFN status is CREATE_IN_PROGRESS... reverting stack_id and select for job_ids:  "
                                         + str(jobs_to_revert)
                                     )
-                                    for job_id in jobs_to_revert:
-                                        job_select_resource = hash_data[job_id][
-                                            "get_job_resource_list"
-                                        ]["select"]
-                                        new_job_select = (
-                                            job_select_resource.split(":compute_node")[
-                                                0
-                                            ]
-                                            + ":compute_node=tbd"
-                                        )
-                                        run_command(
-                                            [
-                                                system_cmds["qalter"],
-                                                "-l",
-                                                "stack_id=",
-                                                "-l",
-                                                "select=" + new_job_select,
-                                                str(job_id),
-                                            ],
-                                            "call",
+                                    revert_jobs_compute_node(jobs_to_revert, hash_data)
+                                    for resource, count in planned_licenses.items():
+                                        get_license_availability().release(
+                                            resource, count
                                         )
 
                             except ClientError as e:
@@ -1406,81 +1406,47 @@ if __name__ == "__main__":
                                     job_parameter_values["terminate_when_idle"] = (
                                         job_data["get_job_terminate_when_idle"]
                                     )
+                                    # The fleet launches the instance types in this order (On-Demand "prioritized" allocation):
+                                    # planned types first, largest first so the capacity can always run the largest planned job,
+                                    # then the other types of the hash as fallback
+                                    instance_weights = dict(
+                                        zip(instance_types, weighted_capacity)
+                                    )
+                                    planned_instance_types = sorted(
+                                        instance_types,
+                                        key=lambda item: (
+                                            capacity_plan["instances"].get(item, 0)
+                                            == 0,
+                                            -int(instance_weights[item]),
+                                        ),
+                                    )
+                                    job_parameter_values[
+                                        "prioritized_instance_types"
+                                    ] = True
                                     job_parameter_values["instance_type"] = "+".join(
-                                        instance_types
+                                        planned_instance_types
                                     )
                                     job_parameter_values["ht_support"] = job_data[
                                         "get_job_ht_support"
                                     ]
                                     job_parameter_values["weighted_capacity"] = (
                                         "+".join(
-                                            str(item) for item in weighted_capacity
+                                            str(instance_weights[item])
+                                            for item in planned_instance_types
                                         )
                                     )
 
-                                    # create capacity
-                                    create_new_asg = add_nodes.main(
-                                        **job_parameter_values
+                                    # create capacity, the result is processed by process_capacity_submissions() at the end of the queue evaluation
+                                    capacity_submissions.append(
+                                        {
+                                            "job_id": job_id,
+                                            "select": None,
+                                            "licenses": planned_licenses,
+                                            "future": submission_pipeline.submit(
+                                                **job_parameter_values
+                                            ),
+                                        }
                                     )
-                                    if create_new_asg["success"] is True:
-                                        compute_unit = create_new_asg["compute_node"]
-                                        stack_id = create_new_asg["stack_name"]
-                                        logpush(
-                                            str(job_id)
-                                            + " : compute_node="
-                                            + str(compute_unit)
-                                            + " | stack_id="
-                                            + str(stack_id)
-                                        )
-
-                                        # flush error if any
-                                        run_command(
-                                            [
-                                                system_cmds["qalter"],
-                                                "-l",
-                                                "error_message=",
-                                                str(job_id),
-                                            ],
-                                            "call",
-                                        )
-
-                                        for (
-                                            resource,
-                                            count_to_substract,
-                                        ) in license_requirement.items():
-                                            license_available[resource] = (
-                                                license_available[resource]
-                                                - count_to_substract
-                                            )
-                                            logpush(
-                                                "License available: "
-                                                + str(license_available[resource])
-                                            )
-
-                                    else:
-                                        sanitized_error = re.sub(
-                                            r"\W+", "_", create_new_asg["message"]
-                                        )
-                                        sanitized_error = (
-                                            create_new_asg["message"]
-                                            .replace("'", "_")
-                                            .replace("!", "_")
-                                            .replace(" ", "_")
-                                        )
-                                        run_command(
-                                            [
-                                                system_cmds["qalter"],
-                                                "-l",
-                                                "error_message='"
-                                                + sanitized_error
-                                                + "'",
-                                                str(job_id),
-                                            ],
-                                            "call",
-                                        )
-                                        logpush(
-                                            f"Error while trying to create ASG: {create_new_asg}"
-                                        )
 
                                 else:
                                     logpush(
@@ -1591,18 +1557,9 @@ if __name__ == "__main__":
                 job_list = []
                 # Validate queue_mode
                 if queue_mode == "fairshare":
-                    user_fair_share = fair_share_score(
-                        queued_jobs, running_jobs, queue_name
+                    job_list = get_fair_share_job_list(
+                        queued_jobs, running_jobs, fair_share_settings, fair_share_usage
                     )
-                    logpush(f"User Fair Share: {user_fair_share}")
-                    job_id_order_based_on_fairshare = fair_share_job_id_order(
-                        sorted(queued_jobs, key=lambda k: k["get_job_order_in_queue"]),
-                        user_fair_share,
-                    )
-                    logpush(
-                        f"Job_id_order_based_on_fairshare: {job_id_order_based_on_fairshare}"
-                    )
-                    job_list = job_id_order_based_on_fairshare
 
                 elif queue_mode == "fifo":
                     for job in sorted(
@@ -1858,7 +1815,6 @@ if __name__ == "__main__":
                     job_parameter_values = {}
                     job = get_jobs[job_id]
 
-                    job_owner = str(job["get_job_owner"])
                     job_id = str(job["get_job_id"])
 
                     if job["get_job_resource_list"]["compute_node"] != "tbd":
@@ -2063,94 +2019,34 @@ if __name__ == "__main__":
                                 ]
                                 job_parameter_values["keep_forever"] = False
 
-                                # create capacity for the job
-                                create_new_asg = add_nodes.main(**job_parameter_values)
-                                if create_new_asg["success"] is True:
-                                    compute_unit = create_new_asg["compute_node"]
-                                    stack_id = create_new_asg["stack_name"]
-                                    logpush(
-                                        str(job_id)
-                                        + " : compute_node="
-                                        + str(compute_unit)
-                                        + " | stack_id="
-                                        + str(stack_id)
-                                    )
-                                    # Add new PBS resource to the job
-                                    # stack_id=xxx -> CloudFormation Stack Name
-                                    # compute_node=xxx -> Unique ID that will be assigned to all EC2 hosts for this job
-
-                                    select = (
-                                        job_required_resource["select"].split(
-                                            ":compute_node"
-                                        )[0]
-                                        + ":compute_node="
-                                        + str(compute_unit)
-                                    )
-                                    logpush(f"select variable: {select}")
-
-                                    run_command(
-                                        [
-                                            system_cmds["qalter"],
-                                            "-l",
-                                            "select=" + select,
-                                            str(job_id),
-                                        ],
-                                        "call",
-                                    )
-                                    run_command(
-                                        [
-                                            system_cmds["qalter"],
-                                            "-l",
-                                            "stack_id=" + stack_id,
-                                            str(job_id),
-                                        ],
-                                        "call",
-                                    )
-
-                                    # flush error if any
-                                    run_command(
-                                        [
-                                            system_cmds["qalter"],
-                                            "-l",
-                                            "error_message=",
-                                            str(job_id),
-                                        ],
-                                        "call",
-                                    )
-
-                                    for (
-                                        resource,
-                                        count_to_substract,
-                                    ) in license_requirement.items():
-                                        license_available[resource] = (
-                                            license_available[resource]
-                                            - count_to_substract
-                                        )
-                                        logpush(
-                                            f"License available: {license_available[resource]}"
-                                        )
+                                # create capacity for the job, the result is processed by process_capacity_submissions() at the end of the queue evaluation
+                                capacity_submissions.append(
+                                    {
+                                        "job_id": job_id,
+                                        "select": job_required_resource[
+                                            "select"
+                                        ].split(":compute_node")[0],
+                                        "licenses": dict(license_requirement),
+                                        "future": submission_pipeline.submit(
+                                            **job_parameter_values
+                                        ),
+                                    }
+                                )
 
-                                else:
-                                    sanitized_error = re.sub(
-                                        r"\W+", "_", create_new_asg["message"]
+                                # Licenses are booked when the request is submitted so the next jobs evaluated during this cycle can't use them
+                                for (
+                                    resource,
+                                    count_to_substract,
+                                ) in license_requirement.items():
+                                    get_license_availability().promise(
+                                        resource, count_to_substract
                                     )
-                                    sanitized_error = (
-                                        create_new_asg["message"]
-                                        .replace("'", "_")
-                                        .replace("!", "_")
-                                        .replace(" ", "_")
-                                    )
-                                    run_command(
-                                        [
-                                            system_cmds["qalter"],
-                                            "-l",
-                                            "error_message='" + sanitized_error + "'",
-                                            str(job_id),
-                                        ],
-                                        "call",
+                                    license_available[resource] = (
+                                        license_available[resource]
+                                        - count_to_substract
                                     )
                                     logpush(
-                                        f"Error while trying to create ASG: {create_new_asg}"
+                                        f"License available: {license_available[resource]}"
                                     )
 
                             except Exception as e:
@@ -2175,3 +2071,326 @@ if __name__ == "__main__":
                             logpush(f"can_run is False for {job_id}")
                     else:
                         logpush(f"Skip {job_id}")
+
+        # Wait for the stacks submitted for this queue and update the jobs accordingly
+        process_capacity_submissions(capacity_submissions)
+
+
+def load_queue_settings(queue_type):
+    """
+    Parse queue_mapping.yml and return the queues, default job parameters, dispatcher interval and fair share settings for a given queue type.
+    queues is False if the queue type does not exist.
+    """
+    queue_settings = {
+        "queues": False,
+        "queue_parameter_values": {},
+        "dispatcher_interval": None,
+        "fair_share_settings": {},
+    }
+    with open(queue_settings_file, "r") as stream_resource_mapping:
+        docs = yaml.safe_load_all(stream_resource_mapping)
+        for doc in docs:
+            for items in doc.values():
+                for _type, info in items.items():
+                    if _type == queue_type:
+                        queue_settings["queues"] = info["queues"]
+                        if "dispatcher_interval" in info.keys():
+                            queue_settings["dispatcher_interval"] = int(
+                                info["dispatcher_interval"]
+                            )
+                        for parameter_key, parameter_value in info.items():
+                            if parameter_key in fair_share_parameters:
+                                queue_settings["fair_share_settings"][
+                                    parameter_key
+                                ] = parameter_value
+                            elif parameter_key in queues_only_parameters:
+                                # specific queue resources which are not job resources
+                                pass
+                            else:
+                                queue_settings["queue_parameter_values"][
+                                    parameter_key
+                                ] = parameter_value
+
+    return queue_settings
+
+
+def load_licenses_mapping():
+    """
+    Parse licenses_mapping.yml and return the PBS resource -> FlexLM command mapping
+    """
+    custom_flexlm_resources = {}
+    with open(license_mapping_file, "r") as stream_flexlm_mapping:
+        docs = yaml.safe_load_all(stream_flexlm_mapping)
+        for doc in docs:
+            for k, v in doc.items():
+                for license_name, license_output in v.items():
+                    custom_flexlm_resources[license_name] = license_output
+
+    return custom_flexlm_resources
+
+
+def run_daemon(queue_types, default_interval, qstat_resync_interval):
+    """
+    Long-running dispatcher (--daemon).
+    AWS clients, parsed settings and log handlers stay in memory between scheduling passes.
+    Each queue type is evaluated on its own cadence (dispatcher_interval in queue_mapping.yml, default to --interval seconds)
+    and settings files are only parsed again when they are modified on disk.
+    Job states are tracked from the PBS accounting logs, a full qstat is only done every qstat_resync_interval seconds.
+    """
+    global jobs_tracker
+    jobs_tracker = socaqstat.QstatJobTracker(
+        qstat_bin=system_cmds["qstat"], resync_interval=qstat_resync_interval
+    )
+    settings_mtime = None
+    queue_types_settings = {}
+    custom_flexlm_resources = {}
+    next_run = {queue_type: 0 for queue_type in queue_types}
+
+    while True:
+        set_queue_logger("dispatcher_daemon")
+        try:
+            current_settings_mtime = (
+                os.path.getmtime(queue_settings_file),
+                os.path.getmtime(license_mapping_file),
+            )
+        except OSError as err:
+            logpush(
+                f"Unable to check settings files, keeping previous settings: {err}",
+                "error",
+            )
+            current_settings_mtime = settings_mtime
+
+        if current_settings_mtime != settings_mtime:
+            try:
+                new_queue_types_settings = {
+                    queue_type: load_queue_settings(queue_type)
+                    for queue_type in queue_types
+                }
+                custom_flexlm_resources = load_licenses_mapping()
+                queue_types_settings = new_queue_types_settings
+                settings_mtime = current_settings_mtime
+                logpush(f"Loaded settings for queue types: {queue_types_settings}")
+            except Exception as err:
+                logpush(
+                    f"Unable to read settings files, keeping previous settings: {err}",
+                    "error",
+                )
+
+        # Job tracker is only refreshed once per cycle and shared by all queue types evaluated during this cycle
+        jobs_snapshot = None
+        get_license_availability().new_cycle()
+        for queue_type in queue_types:
+            if time.time() < next_run[queue_type]:
+                continue
+
+            queue_settings = queue_types_settings.get(queue_type, {})
+            interval = queue_settings.get("dispatcher_interval") or default_interval
+            if queue_settings.get("queues", False) is False:
+                set_queue_logger("dispatcher_daemon")
+                logpush(
+                    f"No queues detected for {queue_type} in the queue_mapping.yml",
+                    "error",
+                )
+            else:
+                try:
+                    if jobs_snapshot is None:
+                        jobs_tracker.refresh()
+                        jobs_snapshot = jobs_tracker
+                    dispatch_queues(
+                        queue_settings["queues"],
+                        queue_settings["queue_parameter_values"],
+                        custom_flexlm_resources,
+                        jobs_snapshot=jobs_snapshot,
+                        fair_share_settings=queue_settings["fair_share_settings"],
+                    )
+                except SystemExit:
+                    # dispatch_queues exits on invalid queue configuration, only skip this pass in daemon mode
+                    logpush(f"Dispatcher pass for {queue_type} exited early", "error")
+                except Exception as err:
+                    exc_type, exc_obj, exc_tb = sys.exc_info()
+                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                    logpush(
+                        f"Dispatcher pass for {queue_type} failed: {exc_type}, {fname}, {exc_tb.tb_lineno}, error: {err}",
+                        "error",
+                    )
+
+            next_run[queue_type] = time.time() + interval
+
+        if jobs_snapshot is not None:
+            set_queue_logger("dispatcher_daemon")
+            logpush(f"AWS API usage since startup: {get_boto_metrics().message}")
+
+        time.sleep(max(1, min(next_run.values()) - time.time()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c", "--config", nargs="?", required=True, help="Path to a configuration file"
+    )
+    parser.add_argument(
+        "-t",
+        "--type",
+        nargs="?",
+        required=True,
+        help="queue type - ex: graphics, compute .. Open YML file for more info. Use a comma separated list with --daemon",
+    )
+    parser.add_argument(
+        "-d",
+        "--daemon",
+        action="store_const",
+        const=True,
+        default=False,
+        help="Keep the dispatcher running and evaluate queues on a regular interval instead of exiting after one pass",
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        type=int,
+        default=60,
+        help="Default interval in seconds between two passes in daemon mode. Can be overridden per queue type with dispatcher_interval",
+    )
+    parser.add_argument(
+        "--qstat-resync-interval",
+        type=int,
+        default=300,
+        help="Interval in seconds between two full qstat in daemon mode. Job states are tracked from the PBS accounting logs in between",
+    )
+    parser.add_argument(
+        "--license-cache-ttl",
+        type=int,
+        default=5,
+        help="Number of seconds the result of a license command is re-used before querying the license server again",
+    )
+    arg = parser.parse_args()
+    if arg.daemon:
+        queue_types = [_type.strip() for _type in arg.type.split(",") if _type.strip()]
+    else:
+        queue_types = [arg.type]
+
+    # Try to get a lock; if another dispatcher for the same queue is running, this instance will exit
+    for queue_type in queue_types:
+        process_lock = get_lock("{} {}".format(__file__, queue_type))
+        if process_lock is not True:
+            print(
+                "Dispatcher.py for this queue is already is already running with process id "
+                + process_lock
+                + ". Stop it first"
+            )
+            sys.exit(1)
+
+    if "SOCA_CLUSTER_ID" not in os.environ:
+        print("SOCA_CLUSTER_ID not found, make sure to source /etc/environment first")
+        sys.exit(1)
+
+    # Begin Pre-requisite
+    system_cmds = {
+        "qstat": "/opt/pbs/bin/qstat",
+        "qmgr": "/opt/pbs/bin/qmgr",
+        "qalter": "/opt/pbs/bin/qalter",
+        "qdel": "/opt/pbs/bin/qdel",
+        "pbsnodes": "/opt/pbs/bin/pbsnodes",
+        "python": "/opt/soca/"
+        + os.environ["SOCA_CLUSTER_ID"]
+        + "/python/latest/bin/python3",
+    }
+    # AWS Clients
+    ses = get_boto(service_name="ses").message
+    ec2 = get_boto(service_name="ec2").message
+    cloudformation = get_boto(service_name="cloudformation").message
+    autoscaling = get_boto(service_name="autoscaling").message
+
+    # Variables
+    queues_only_parameters = [
+        "allowed_users",
+        "excluded_users",
+        "excluded_instance_types",
+        "allowed_instance_types",
+        "restricted_parameters",
+        "allowed_security_group_ids",
+        "allowed_instance_profiles",
+        "dispatcher_interval",
+    ]
+    restricted_job_resources = [
+        "select",
+        "ncpus",
+        "ngpus",
+        "place",
+        "nodect",
+        "queues",
+        "compute_node",
+        "stack_id",
+        "max_running_jobs",
+        "max_provisioned_instances",
+        "scaling_mode",
+    ]  # dispatcher cannot edit these job values
+    asg_name = None
+    fair_share_running_job_malus = -60
+    fair_share_start_score = 100
+    # Fair share settings which can be configured per queue type in queue_mapping.yml
+    fair_share_parameters = [
+        "fair_share_formula",
+        "fair_share_formula_parameters",
+        "fair_share_running_job_malus",
+        "fair_share_usage_weight",
+        "fair_share_project_usage_weight",
+        "fair_share_usage_half_life",
+    ]
+    fair_share_usage_directory = (
+        "/opt/soca/"
+        + os.environ["SOCA_CLUSTER_ID"]
+        + "/cluster_manager/orchestrator/fair_share"
+    )
+
+    queue_settings_file = (
+        "/opt/soca/"
+        + os.environ["SOCA_CLUSTER_ID"]
+        + "/cluster_manager/orchestrator/settings/queue_mapping.yml"
+    )
+    license_mapping_file = (
+        "/opt/soca/"
+        + os.environ["SOCA_CLUSTER_ID"]
+        + "/cluster_manager/orchestrator/settings/licenses_mapping.yml"
+    )
+
+    get_license_availability(cache_ttl=arg.license_cache_ttl)
+
+    if arg.daemon:
+        run_daemon(
+            queue_types=queue_types,
+            default_interval=arg.interval,
+            qstat_resync_interval=arg.qstat_resync_interval,
+        )
+
+    # Retrieve Default Queue parameters
+    try:
+        queue_settings = load_queue_settings(arg.type)
+        queues = queue_settings["queues"]
+        queue_parameter_values = queue_settings["queue_parameter_values"]
+        fair_share_settings = queue_settings["fair_share_settings"]
+    except Exception as err:
+        print(
+            f"Unable to read queue settings file ({queue_settings_file}) with error: {err}"
+        )
+        sys.exit(1)
+
+    # Generate FlexLM mapping
+    try:
+        custom_flexlm_resources = load_licenses_mapping()
+    except Exception as err:
+        print(f"Unable to read license file ({license_mapping_file}) with error: {err}")
+        sys.exit(1)
+    # End Pre-requisite
+
+    if queues is False:
+        print("No queues detected in the queue_mapping.yml. Exiting ...")
+        exit(1)
+
+    dispatch_queues(
+        queues,
+        queue_parameter_values,
+        custom_flexlm_resources,
+        fair_share_settings=fair_share_settings,
+    )
+    # The cron mode exits after a single pass, wait for the capacity requests still running
+    apply_pending_capacity_submissions(timeout=None)
@@ -0,0 +1,382 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Fair share scoring and job ordering used by dispatcher.py when queue_mode is set to fairshare.
+"""
+
+import fnmatch
+import heapq
+import inspect
+import json
+import logging
+import os
+import re
+from collections import deque
+from datetime import datetime, timedelta
+
+# Same logger as dispatcher.py logpush(), messages are routed to the log file of the current queue
+logger = logging.getLogger("tcpserver")
+
+
+def linear_bonus(required_resource, queued_seconds, c1=1):
+    # Same bonus for every queued job
+    return c1
+
+
+def required_resource_bonus(required_resource, queued_seconds, c1=1):
+    # Bonus proportional to the number of nodes and licenses requested by the job
+    return c1 * required_resource
+
+
+def queue_time_bonus(required_resource, queued_seconds, c1=0.5, c2=1.7):
+    # Bonus growing with the time spent in queue (in days).
+    # queued_seconds can be negative when the clocks of the PBS server and of this host drift, a negative base
+    # would return a complex number
+    return required_resource * (c1 * (max(queued_seconds, 0) / 3600 / 24) ** c2)
+
+
+# Formulas selectable with fair_share_formula in queue_mapping.yml.
+# A formula receives the job required resources (nodect + licenses), the time spent in queue in seconds
+# and fair_share_formula_parameters as keyword arguments
+FAIR_SHARE_FORMULAS = {
+    "linear": linear_bonus,
+    "required_resource": required_resource_bonus,
+    "queue_time": queue_time_bonus,
+}
+
+
+def job_bonus_score(q_job_data, now, formula="linear", formula_parameters=None):
+    """
+    Return the fair share bonus of a queued job
+    """
+    timestamp_submission = q_job_data["get_job_queue_time_epoch"]
+    license = 0
+    for license_name in fnmatch.filter(
+        q_job_data["get_job_resource_list"].keys(), "*_lic*"
+    ):
+        logger.info(
+            f"Job use the following licenses: {license_name} - {q_job_data['get_job_resource_list'][license_name]}"
+        )
+        license += int(q_job_data["get_job_resource_list"][license_name])
+
+    required_resource = int(q_job_data["get_job_nodect"]) + license
+    logger.info(f"Job Required Resource Bonus {required_resource}")
+
+    queued_seconds = int(now) - int(timestamp_submission)
+    bonus_score: float = FAIR_SHARE_FORMULAS[formula](
+        required_resource=required_resource,
+        queued_seconds=queued_seconds,
+        **(formula_parameters or {}),
+    )
+
+    logger.info(
+        f"Job {q_job_data['get_job_id']} queued for {queued_seconds / 60} minutes: {formula} bonus %.2f"
+        % bonus_score
+    )
+    return bonus_score
+
+
+def fair_share_score(
+    queued_jobs,
+    running_jobs,
+    start_score,
+    running_job_malus,
+    formula="linear",
+    formula_parameters=None,
+    usage=None,
+    usage_weight=0,
+    project_usage_weight=0,
+):
+    """
+    Return the fair share score of all users with at least one queued job.
+    Every user starts with start_score, running_job_malus is applied for each running job (or queued job with capacity
+    being provisioned) and the bonus returned by formula is added for each queued job.
+    When a FairShareUsage is provided, usage_weight is removed for each decayed core-hour consumed by the user
+    (including running jobs) and project_usage_weight for each decayed core-hour consumed by the project of a queued job.
+    """
+    user_score = {}
+    users_with_queued_jobs = set()
+    now = int((datetime.now()).strftime("%s"))
+    if formula not in FAIR_SHARE_FORMULAS.keys():
+        logger.error(
+            f"Fair share formula {formula} is invalid, must be one of {list(FAIR_SHARE_FORMULAS.keys())}. Defaulting to linear"
+        )
+        formula = "linear"
+        formula_parameters = None
+
+    formula_parameters = formula_parameters or {}
+    _valid_parameters = [
+        _parameter
+        for _parameter in inspect.signature(FAIR_SHARE_FORMULAS[formula]).parameters
+        if _parameter not in ("required_resource", "queued_seconds")
+    ]
+    if not isinstance(formula_parameters, dict) or any(
+        _parameter not in _valid_parameters or not isinstance(_value, (int, float))
+        for _parameter, _value in formula_parameters.items()
+    ):
+        logger.error(
+            f"Fair share formula parameters {formula_parameters} are invalid for {formula}, must be numbers with keys in {_valid_parameters}. Defaulting to the {formula} default parameters"
+        )
+        formula_parameters = None
+
+    running_core_hours = {}
+    # First, apply malus for users who already have running job
+    for r_job_data in running_jobs:
+        _owner = r_job_data["get_job_owner"]
+        user_score[_owner] = user_score.get(_owner, start_score) + running_job_malus
+        if usage is not None and r_job_data["get_job_start_time_epoch"] != "-":
+            running_core_hours[_owner] = running_core_hours.get(_owner, 0) + (
+                int(r_job_data["get_job_ncpus"])
+                * (now - int(r_job_data["get_job_start_time_epoch"]))
+                / 3600
+            )
+
+    for q_job_data in queued_jobs:
+        _owner = q_job_data["get_job_owner"]
+        users_with_queued_jobs.add(_owner)
+        if "stack_id" in q_job_data["get_job_resource_list"].keys():
+            # If job is queued and in the process of start (provision capacity), we apply the running job malus
+            bonus_score = running_job_malus
+        else:
+            bonus_score = job_bonus_score(
+                q_job_data=q_job_data,
+                now=now,
+                formula=formula,
+                formula_parameters=formula_parameters,
+            )
+
+        if usage is not None and project_usage_weight:
+            bonus_score -= project_usage_weight * usage.get_project_usage(
+                q_job_data["get_job_project"]
+            )
+
+        user_score[_owner] = user_score.get(_owner, start_score) + bonus_score
+
+    if usage is not None and usage_weight:
+        for _owner in user_score.keys():
+            _core_hours = usage.get_user_usage(_owner) + running_core_hours.get(
+                _owner, 0
+            )
+            logger.info(f"{_owner} consumed {_core_hours:.2f} decayed core-hours")
+            user_score[_owner] -= usage_weight * _core_hours
+
+    # Remove user with no queued job
+    return {
+        user: score
+        for user, score in user_score.items()
+        if user in users_with_queued_jobs
+    }
+
+
+class FairShareUsage:
+    """
+    Decayed core-hours consumed per user and per project by completed jobs.
+    Usage is read incrementally from the E (ended) records of the PBS accounting logs and persisted in state_file,
+    so each dispatcher run only processes the records written since the previous run.
+    Usage is divided by two every half_life hours.
+    """
+
+    def __init__(
+        self,
+        state_file,
+        half_life=24,
+        accounting_log_path="/var/spool/pbs/server_priv/accounting/",
+        lookback_days=7,
+    ):
+        self.state_file = state_file
+        self.half_life = float(half_life)
+        self.accounting_log_path = accounting_log_path
+        self.lookback_days = lookback_days
+        self.users = {}
+        self.projects = {}
+        self.last_update = None
+        self.log_file = None
+        self.log_offset = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.state_file, "r") as state:
+                _state = json.load(state)
+            self.users = _state["users"]
+            self.projects = _state["projects"]
+            self.last_update = _state["last_update"]
+            self.log_file = _state["log_file"]
+            self.log_offset = _state["log_offset"]
+        except FileNotFoundError:
+            logger.info(
+                f"{self.state_file} does not exist, usage will be computed from the last {self.lookback_days} days of accounting logs"
+            )
+        except Exception as err:
+            logger.error(
+                f"Unable to read {self.state_file} due to {err}, usage history will be re-computed"
+            )
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        _tmp_file = f"{self.state_file}.tmp"
+        with open(_tmp_file, "w") as state:
+            json.dump(
+                {
+                    "users": self.users,
+                    "projects": self.projects,
+                    "last_update": self.last_update,
+                    "log_file": self.log_file,
+                    "log_offset": self.log_offset,
+                },
+                state,
+            )
+        # Atomic update as one dispatcher runs per queue type
+        os.replace(_tmp_file, self.state_file)
+
+    def decay_factor(self, seconds):
+        return 0.5 ** (max(seconds, 0) / 3600 / self.half_life)
+
+    def get_user_usage(self, user):
+        return self.users.get(user, 0)
+
+    def get_project_usage(self, project):
+        return self.projects.get(str(project), 0)
+
+    def update(self, now=None):
+        """
+        Decay the existing usage, add the jobs completed since the last update and save the new state
+        """
+        now = int(now or datetime.now().timestamp())
+        if self.last_update is not None:
+            _factor = self.decay_factor(now - self.last_update)
+            self.users = {k: v * _factor for k, v in self.users.items()}
+            self.projects = {k: v * _factor for k, v in self.projects.items()}
+
+        for record in self.read_ended_jobs():
+            _core_hours = record["core_hours"] * self.decay_factor(now - record["end"])
+            self.users[record["user"]] = self.users.get(record["user"], 0) + _core_hours
+            self.projects[record["project"]] = (
+                self.projects.get(record["project"], 0) + _core_hours
+            )
+
+        # Forget negligible usage to keep the state file compact
+        self.users = {k: v for k, v in self.users.items() if v >= 0.01}
+        self.projects = {k: v for k, v in self.projects.items() if v >= 0.01}
+        self.last_update = now
+        self.save()
+
+    def read_ended_jobs(self):
+        """
+        Return user, project, end time and core-hours of all jobs ended since the last position saved in the state file
+        """
+        today = datetime.now()
+        if self.log_file is None:
+            first_day = today - timedelta(days=self.lookback_days)
+            log_offset = 0
+        else:
+            first_day = datetime.strptime(self.log_file, "%Y%m%d")
+            log_offset = self.log_offset
+
+        ended_jobs = []
+        day = first_day
+        while day.date() <= today.date():
+            log_file = day.strftime("%Y%m%d")
+            try:
+                with open(
+                    os.path.join(self.accounting_log_path, log_file), "rb"
+                ) as accounting_log:
+                    accounting_log.seek(log_offset)
+                    content = accounting_log.read()
+            except FileNotFoundError:
+                content = b""
+
+            # Only process complete lines, a partial line will be read again during the next update
+            content = content[: content.rfind(b"\n") + 1]
+            for line in content.decode("utf-8", errors="replace").splitlines():
+                data = line.split(";", 3)
+                if data.__len__() != 4 or data[1] != "E":
+                    continue
+                try:
+                    ended_jobs.append(parse_ended_job(data[3]))
+                except Exception as err:
+                    logger.debug(f"Unable to parse accounting record {line}: {err}")
+
+            self.log_file = log_file
+            self.log_offset = log_offset + len(content)
+            log_offset = 0
+            day += timedelta(days=1)
+
+        return ended_jobs
+
+
+def parse_ended_job(message):
+    """
+    Extract user, project, end time and core-hours from the message of an accounting E record
+    """
+    attributes = dict(re.findall(r"(\S+?)=(\S+)", message))
+    ncpus = int(
+        attributes.get("resources_used.ncpus", attributes.get("Resource_List.ncpus", 0))
+    )
+    hours, minutes, seconds = attributes.get("resources_used.walltime", "0:0:0").split(
+        ":"
+    )
+    return {
+        "user": attributes["user"],
+        "project": attributes.get("project", "_pbs_project_default"),
+        "end": int(attributes["end"]),
+        "core_hours": ncpus * (int(hours) + int(minutes) / 60 + int(seconds) / 3600),
+    }
+
+
+def fair_share_job_id_order(sorted_queued_job, user_fair_share, running_job_malus):
+    """
+    Generate the job order to provision based on fair share score.
+    The user with the highest score is picked first (ties go to the user listed first in user_fair_share),
+    its oldest queued job is selected and running_job_malus is applied to its score.
+
+    example:
+    sorted_queued_job = [
+        {'get_job_id': 1, 'get_job_owner': 'mcrozes'},
+        {'get_job_id': 2, 'get_job_owner': 'mcrozes'},
+        {'get_job_id': 3, 'get_job_owner': 'mcrozes'},
+        {'get_job_id': 4, 'get_job_owner': 'test'},
+        {'get_job_id': 5, 'get_job_owner': 'test'},
+    ]
+    user_fair_share = {'mcrozes': 100,
+                       'test': 50}
+    running_job_malus = -60
+
+    Result:
+    [1, 4, 2, 5, 3]
+    """
+    # FIFO of queued jobs per user, sorted_queued_job is already sorted by order in queue
+    user_jobs = {}
+    for job in sorted_queued_job:
+        user_jobs.setdefault(job["get_job_owner"], deque()).append(job["get_job_id"])
+
+    # heapq is a min heap, use the negative score. Position in user_fair_share is used as tie-breaker
+    users_heap = [
+        (-score, position, user)
+        for position, (user, score) in enumerate(user_fair_share.items())
+        if user in user_jobs.keys()
+    ]
+    heapq.heapify(users_heap)
+
+    job_ids_to_start = []
+    while users_heap:
+        negative_score, position, next_user = heapq.heappop(users_heap)
+        job_ids_to_start.append(user_jobs[next_user].popleft())
+        if user_jobs[next_user]:
+            heapq.heappush(
+                users_heap, (negative_score - running_job_malus, position, next_user)
+            )
+
+    logger.info(f"jobs id re-order based on fairshare: {job_ids_to_start}")
+    return job_ids_to_start
@@ -0,0 +1,200 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+FlexLM license availability used by the dispatcher to validate the *_lic* resources requested by the queued jobs.
+"""
+
+import json
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("soca_logger")
+
+
+class LicenseAvailability:
+    """
+    Run the license commands of licenses_mapping.yml (e.g: license_check.py) and return the number of available licenses.
+    - licenses requested by all the jobs of a cycle are probed at once, each distinct command runs only once and in parallel
+    - results are cached for cache_ttl seconds, so the jobs evaluated during the same cycle don't query the license server again
+    - licenses promised to the jobs provisioned during the current cycle are kept in a ledger and subtracted from
+    the available licenses until new_cycle() is called, as they are not checked out until the capacity is running
+    A command which fails or does not return an integer is logged and its license is not returned.
+    A license can also be mapped to {"command": "license_check.py ... --json", "feature": "ACOUSTICS"}: all the licenses
+    sharing the same command are then retrieved with a single lmstat call and read from its JSON output.
+
+    example:
+        license_service = get_license_availability()
+        license_service.set_commands({"comsol_lic_acoustic": "/apps/tools/scripts/license_check.py -s licenses.soca.dev -p 27718 -f ACOUSTICS"})
+        license_service.get_available(["comsol_lic_acoustic"]) -> {"comsol_lic_acoustic": 10}
+        license_service.promise("comsol_lic_acoustic", 4)
+        license_service.get_available(["comsol_lic_acoustic"]) -> {"comsol_lic_acoustic": 6}
+    """
+
+    def __init__(self, cache_ttl=5, max_workers=8, probe_timeout=60):
+        self.cache_ttl = cache_ttl
+        self.probe_timeout = probe_timeout
+        self.commands = {}
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="license-probe"
+        )
+        self._lock = threading.Lock()
+        # command -> (timestamp, available licenses)
+        self._cache = {}
+        # license -> licenses promised during the current cycle
+        self._promised = {}
+
+    def set_commands(self, commands):
+        """
+        Update the PBS resource -> license command mapping (licenses_mapping.yml can be reloaded by the daemon)
+        """
+        with self._lock:
+            if commands != self.commands:
+                self.commands = dict(commands)
+                self._cache = {}
+
+    def new_cycle(self):
+        """
+        Start a new dispatcher cycle: forget the licenses promised during the previous one
+        """
+        with self._lock:
+            self._promised = {}
+
+    def promise(self, license_name, count):
+        """
+        Book count licenses for a job provisioned during the current cycle
+        """
+        with self._lock:
+            self._promised[license_name] = self._promised.get(license_name, 0) + int(
+                count
+            )
+
+    def release(self, license_name, count):
+        """
+        Return count licenses promised during the current cycle, e.g: when the capacity of the job could not be provisioned
+        """
+        with self._lock:
+            self._promised[license_name] = max(
+                self._promised.get(license_name, 0) - int(count), 0
+            )
+
+    @staticmethod
+    def _command(entry):
+        # licenses_mapping.yml value, either a command printing the available licenses or {"command", "feature"}
+        if isinstance(entry, dict):
+            return entry.get("command"), entry.get("feature")
+        return entry, None
+
+    def _probe(self, command):
+        try:
+            _process = subprocess.run(
+                command.split(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                timeout=self.probe_timeout,
+            )
+        except Exception as err:
+            logger.error(f"Unable to run license command {command} due to {err}")
+            return None
+        if _process.returncode != 0:
+            logger.error(
+                f"License command {command} returned with error (code {_process.returncode}): {_process.stdout} {_process.stderr}"
+            )
+            return None
+        try:
+            return int(_process.stdout.strip())
+        except ValueError:
+            pass
+        try:
+            _features = json.loads(_process.stdout)
+        except ValueError:
+            _features = None
+        if not isinstance(_features, dict):
+            logger.error(
+                f"License command {command} did not return a number or a JSON map of features: {_process.stdout}"
+            )
+            return None
+        return _features
+
+    def get_available(self, licenses):
+        """
+        Return {license: available licenses minus the licenses promised during this cycle} for the licenses
+        configured in licenses_mapping.yml
+        """
+        with self._lock:
+            _commands = {
+                _license: self._command(self.commands[_license])
+                for _license in set(licenses)
+                if _license in self.commands
+            }
+            _now = time.time()
+            _to_probe = {
+                _command
+                for _command, _ in _commands.values()
+                if _command not in self._cache
+                or _now - self._cache[_command][0] >= self.cache_ttl
+            }
+
+        if _to_probe:
+            _futures = {
+                _command: self._pool.submit(self._probe, _command)
+                for _command in _to_probe
+            }
+            _probed_at = time.time()
+            for _command, _future in _futures.items():
+                _available = _future.result()
+                with self._lock:
+                    if _available is None:
+                        self._cache.pop(_command, None)
+                    else:
+                        self._cache[_command] = (_probed_at, _available)
+
+        _output = {}
+        with self._lock:
+            for _license, (_command, _feature) in _commands.items():
+                if _command not in self._cache:
+                    continue
+                _available = self._cache[_command][1]
+                if isinstance(_available, dict):
+                    _available = _available.get(_feature, {}).get("available")
+                    if _available is None:
+                        logger.error(
+                            f"Feature {_feature} of {_license} not returned by {_command}"
+                        )
+                        continue
+                elif _feature is not None:
+                    logger.error(
+                        f"{_license} requires feature {_feature} but {_command} did not return JSON"
+                    )
+                    continue
+                _output[_license] = max(
+                    int(_available) - self._promised.get(_license, 0), 0
+                )
+        return _output
+
+
+_license_availability = None
+
+
+def get_license_availability(**kwargs):
+    """
+    Return the license availability service of the current process, kwargs are only used when it is created
+    """
+    global _license_availability
+    if _license_availability is None:
+        _license_availability = LicenseAvailability(**kwargs)
+    return _license_availability
@@ -14,10 +14,62 @@
 ######################################################################################################################
 
 import argparse
+import json
 import subprocess
 import re
 import sys
 
+# Path to your lmutil binary
+LMSTAT_PATH = "PATH_TO_LMUTIL"
+
+# e.g: Users of VCSRuntime_Net:  (Total of 10 licenses issued;  Total of 4 licenses in use)
+REGEX_USERS_OF = re.compile(
+    r"^\s*Users of (?P<feature>[^:\s]+):\s*\(Total of\s+(?P<issued>\d+)\s+licenses? issued;\s*Total of\s+(?P<in_use>\d+)\s+licenses? in use\)",
+    re.MULTILINE,
+)
+
+
+def parse_lmstat(lmstat):
+    """
+    Parse the "Users of" lines of a lmstat -a output and return {feature: {"issued": X, "in_use": Y}}.
+    Uncounted or errored features are ignored. Counts of a feature served by several vendor daemons are added.
+    """
+    features = {}
+    for match in REGEX_USERS_OF.finditer(lmstat):
+        feature = features.setdefault(
+            match.group("feature"), {"issued": 0, "in_use": 0}
+        )
+        feature["issued"] += int(match.group("issued"))
+        feature["in_use"] += int(match.group("in_use"))
+    return features
+
+
+def get_available_licenses(features, reserved=None):
+    """
+    Add the number of available licenses to each feature, minus the reserved pool of the feature if any
+    """
+    reserved = reserved or {}
+    for feature_name, feature in features.items():
+        feature["available"] = (
+            feature["issued"] - feature["in_use"] - int(reserved.get(feature_name, 0))
+        )
+    return features
+
+
+def parse_reserved(values):
+    """
+    Convert a list of FEATURE=COUNT to {FEATURE: COUNT}
+    """
+    reserved = {}
+    for value in values or []:
+        feature_name, _, count = value.rpartition("=")
+        if not feature_name or not count.isdigit():
+            print(f"Invalid reserved pool {value}, must be FEATURE=COUNT")
+            sys.exit(1)
+        reserved[feature_name] = int(count)
+    return reserved
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -25,7 +77,10 @@ if __name__ == "__main__":
     )
     parser.add_argument("-p", "--port", nargs="?", required=True, help="FlexLM Port")
     parser.add_argument(
-        "-f", "--feature", nargs="?", required=True, help="FlexLM Feature"
+        "-f",
+        "--feature",
+        action="append",
+        help="FlexLM Feature. Can be specified multiple times with --json, all features are returned if not set",
     )
     parser.add_argument(
         "-m",
@@ -33,48 +88,67 @@ if __name__ == "__main__":
         nargs="?",
         help="Prevent HPC to consume all license by keeping a reserved pool for local usage",
     )
+    parser.add_argument(
+        "-j",
+        "--json",
+        action="store_const",
+        const=True,
+        default=False,
+        help="Run lmstat once and print {feature: {issued, in_use, available}} as JSON",
+    )
+    parser.add_argument(
+        "-r",
+        "--reserved",
+        action="append",
+        help="Reserved pool for a given feature as FEATURE=COUNT, used with --json. Can be specified multiple times",
+    )
 
     arg = parser.parse_args()
-    lmstat_path = "PATH_TO_LMUTIL"
-    if lmstat_path == "PATH_TO_LMUTIL":
-        print("Please specify a path to your lmutil binary (edit line 32 of this file")
+    if LMSTAT_PATH == "PATH_TO_LMUTIL":
+        print(
+            "Please specify a path to your lmutil binary (edit LMSTAT_PATH on top of this file)"
+        )
         sys.exit(1)
+
+    if not arg.json and (not arg.feature or len(arg.feature) != 1):
+        print("Please specify a single feature with -f, or use --json")
+        sys.exit(1)
+
     lmstat_cmd = [
-        lmstat_path,
+        LMSTAT_PATH,
         "lmstat",
         "-a",
         "-c",
         str(arg.port) + "@" + str(arg.server),
     ]
-    grep_cmd = ["grep", "Users of " + str(arg.feature)]
-
-    process_lmstat = subprocess.Popen(lmstat_cmd, stdout=subprocess.PIPE)
-    process_grep = subprocess.Popen(
-        grep_cmd, stdin=process_lmstat.stdout, stdout=subprocess.PIPE
-    )
-    process_lmstat.stdout.close()
-    lmstat = (process_grep.communicate()[0]).decode("utf-8")
-    regex_license_in_use = r".*Total of(.*)licenses? in use.*"
-    regex_license_issued = r".*Total of(.*)licenses? issued;.*"
-
     try:
-        license_in_use = (
-            re.search(regex_license_in_use, lmstat, re.MULTILINE)
-            .group(1)
-            .rstrip()
-            .lstrip()
-        )
-        license_total = (
-            re.search(regex_license_issued, lmstat, re.MULTILINE)
-            .group(1)
-            .rstrip()
-            .lstrip()
-        )
+        lmstat = subprocess.run(
+            lmstat_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        ).stdout
     except Exception as e:
-        print(f"Error: {e}")
-        print("You probably specified license server/port/feature which does not exist")
+        print(f"Error: Unable to run {lmstat_cmd}: {e}")
         sys.exit(1)
-    if arg.minus is not None:
-        license_total = int(license_total) - int(arg.minus)
 
-    print(int(license_total) - int(license_in_use))
+    features = parse_lmstat(lmstat)
+
+    if arg.json:
+        reserved = parse_reserved(arg.reserved)
+        if arg.feature:
+            missing_features = [f for f in arg.feature if f not in features]
+            if missing_features:
+                print(
+                    f"Error: Feature(s) {missing_features} not found on {arg.port}@{arg.server}"
+                )
+                sys.exit(1)
+            features = {f: features[f] for f in arg.feature}
+        print(json.dumps(get_available_licenses(features, reserved)))
+    else:
+        feature_name = arg.feature[0]
+        if feature_name not in features:
+            print(f"Error: Feature {feature_name} not found")
+            print(
+                "You probably specified license server/port/feature which does not exist"
+            )
+            sys.exit(1)
+        reserved = {feature_name: arg.minus} if arg.minus is not None else {}
+        print(get_available_licenses(features, reserved)[feature_name]["available"])
@@ -0,0 +1,226 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Sources of EC2 Instance State-change Notifications consumed by nodes_manager.py --events.
+"""
+
+import abc
+import json
+import logging
+import os
+import select
+import socket
+import time
+from urllib.parse import urlparse
+
+from utils.aws.boto3_wrapper import get_boto
+
+logger = logging.getLogger("soca_logger")
+
+
+def parse_state_change_event(event):
+    """
+    Return (instance_id, state) of an EC2 Instance State-change Notification, or None if event is not a state change.
+    Accept the EventBridge event, its "detail" only, or a JSON string of either.
+    e.g: {"detail-type": "EC2 Instance State-change Notification", "detail": {"instance-id": "i-0123", "state": "running"}}
+    """
+    if isinstance(event, (str, bytes)):
+        try:
+            event = json.loads(event)
+        except ValueError:
+            logger.warning(f"Ignoring invalid state change event {event}")
+            return None
+    if not isinstance(event, dict):
+        return None
+    _detail = event.get("detail", event)
+    if not isinstance(_detail, dict):
+        return None
+    if _detail.get("instance-id") and _detail.get("state"):
+        return _detail["instance-id"], _detail["state"]
+    return None
+
+
+class NodeEventSource(abc.ABC):
+    """
+    Base class of the event sources. poll() returns the (instance_id, state) received within timeout seconds,
+    ack() is called once these events have been processed, nack() if they could not be processed.
+    """
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        pass
+
+    def ack(self):
+        pass
+
+    def nack(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileEventSource(NodeEventSource):
+    """
+    Tail a file where each line is a JSON state change event (local stand-in for tests and development).
+    Only lines appended after the source is created are read.
+
+    example:
+        echo '{"detail": {"instance-id": "i-0123", "state": "running"}}' >> /tmp/soca_node_events
+    """
+
+    def __init__(self, path, poll_interval=1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._inode, self._offset = self._stat()
+
+    def _stat(self):
+        try:
+            _stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None, 0
+        return _stat.st_ino, _stat.st_size
+
+    def poll(self, timeout):
+        _deadline = time.time() + timeout
+        while True:
+            _events = self._read()
+            if _events or time.time() >= _deadline:
+                return _events
+            time.sleep(min(self.poll_interval, max(_deadline - time.time(), 0)))
+
+    def _read(self):
+        _inode, _size = self._stat()
+        if _inode != self._inode or _size < self._offset:
+            # File was rotated or truncated
+            self._inode, self._offset = _inode, 0
+        try:
+            with open(self.path, "r") as _file:
+                _file.seek(self._offset)
+                _lines = _file.readlines()
+                # Keep a partially written line for the next poll
+                if _lines and not _lines[-1].endswith("\n"):
+                    _lines.pop()
+                self._offset += sum(len(_line.encode("utf-8")) for _line in _lines)
+        except FileNotFoundError:
+            return []
+        return [
+            _event
+            for _event in (
+                parse_state_change_event(_line) for _line in _lines if _line.strip()
+            )
+            if _event is not None
+        ]
+
+
+class UnixSocketEventSource(NodeEventSource):
+    """
+    Receive JSON state change events as datagrams on a unix socket (local stand-in for tests and development).
+
+    example:
+        echo '{"detail": {"instance-id": "i-0123", "state": "running"}}' | socat - UNIX-SENDTO:/tmp/soca_node_events.sock
+    """
+
+    def __init__(self, path, max_batch=100):
+        self.path = path
+        self.max_batch = max_batch
+        if os.path.exists(path):
+            os.remove(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        self._socket.setblocking(False)
+
+    def poll(self, timeout):
+        _events = []
+        _readable, _, _ = select.select([self._socket], [], [], timeout)
+        while _readable and len(_events) < self.max_batch:
+            try:
+                _event = parse_state_change_event(self._socket.recv(65536))
+            except BlockingIOError:
+                break
+            if _event is not None:
+                _events.append(_event)
+        return _events
+
+    def close(self):
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SQSEventSource(NodeEventSource):
+    """
+    Receive the state change events delivered to an SQS queue by an EventBridge rule
+    (source aws.ec2, detail-type EC2 Instance State-change Notification). Messages are deleted once acknowledged,
+    messages which are not acknowledged are delivered again by SQS once their visibility timeout expires.
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self._sqs_client = get_boto(service_name="sqs").message
+        self._receipt_handles = []
+
+    def poll(self, timeout):
+        _events = []
+        _response = self._sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=max(0, min(int(timeout), 20)),
+        )
+        for _message in _response.get("Messages", []):
+            self._receipt_handles.append(_message["ReceiptHandle"])
+            _event = parse_state_change_event(_message.get("Body", ""))
+            if _event is not None:
+                _events.append(_event)
+        return _events
+
+    def ack(self):
+        # DeleteMessageBatch accepts up to 10 messages
+        while self._receipt_handles:
+            _batch = self._receipt_handles[:10]
+            self._receipt_handles = self._receipt_handles[10:]
+            _response = self._sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(_index), "ReceiptHandle": _handle}
+                    for _index, _handle in enumerate(_batch)
+                ],
+            )
+            for _failed in _response.get("Failed", []):
+                logger.warning(f"Unable to delete SQS message: {_failed}")
+
+    def nack(self):
+        # Keep the messages in the queue, the next ack() must not delete them
+        self._receipt_handles = []
+
+
+def get_event_source(uri):
+    """
+    Return the event source for uri:
+    - file:///path/to/events.jsonl
+    - unix:///path/to/events.sock
+    - https://sqs.<region>.amazonaws.com/<account>/<queue> (or sqs://<queue url without scheme>)
+    """
+    _parsed = urlparse(uri)
+    if _parsed.scheme == "file":
+        return FileEventSource(_parsed.path)
+    if _parsed.scheme == "unix":
+        return UnixSocketEventSource(_parsed.path)
+    if _parsed.scheme == "sqs":
+        return SQSEventSource(f"https://{uri[len('sqs://'):]}")
+    if _parsed.scheme == "https" and _parsed.netloc.startswith("sqs."):
+        return SQSEventSource(uri)
+    raise ValueError(
+        f"Unsupported event source {uri}, use file://, unix:// or an SQS queue URL"
+    )
@@ -11,9 +11,12 @@
 #  and limitations under the License.                                                                                #
 ######################################################################################################################
 
+import argparse
 import os
+import socket
 import subprocess
 import sys
+import time
 
 import logging
 
@@ -26,6 +29,9 @@ from datetime import datetime, timezone, timedelta
 from utils.aws.boto3_wrapper import get_boto
 from utils.aws.ssm_parameter_store import SocaConfig
 from utils.logger import SocaLogger
+from utils.pbs_nodes_snapshot import get_pbs_nodes_snapshot
+from pbs_batch import PBSBatchExecutor
+from node_events import get_event_source
 import pathlib
 import json
 
@@ -47,24 +53,29 @@ def run_command(cmd: list, cmd_type: str):
         return ""
 
 
-def get_all_compute_instances(cluster_id: str):
+def get_all_compute_instances(cluster_id: str, instance_ids: list = None):
+    """
+    Return the running compute nodes of the cluster grouped by job id, limited to instance_ids when specified
+    """
     job_stack = {}
     # ATTENTION /!\
     # CHANGING THIS FILTER COULD POSSIBLY BRING DOWN OTHER EC2 INSTANCES IN YOUR AWS ACCOUNT
     ec2_paginator = ec2_client.get_paginator("describe_instances")
-    ec2_iterator = ec2_paginator.paginate(
-        Filters=[
-            {
-                "Name": "instance-state-name",
-                "Values": [
-                    "running",
-                ],
-            },
-            {"Name": "tag:soca:NodeType", "Values": ["compute_node"]},
-            {"Name": "tag:soca:KeepForever", "Values": ["true", "false"]},
-            {"Name": "tag:soca:ClusterId", "Values": [cluster_id]},
-        ],
-    )
+    ec2_filters = [
+        {
+            "Name": "instance-state-name",
+            "Values": [
+                "running",
+            ],
+        },
+        {"Name": "tag:soca:NodeType", "Values": ["compute_node"]},
+        {"Name": "tag:soca:KeepForever", "Values": ["true", "false"]},
+        {"Name": "tag:soca:ClusterId", "Values": [cluster_id]},
+    ]
+    if instance_ids:
+        # Filter rather than InstanceIds, a single instance which no longer exists would fail the whole call
+        ec2_filters.append({"Name": "instance-id", "Values": instance_ids})
+    ec2_iterator = ec2_paginator.paginate(Filters=ec2_filters)
 
     for page in ec2_iterator:
         for reservation in page.get("Reservations"):
@@ -179,51 +190,32 @@ def get_scheduler_jobs_in_queue() -> list:
 
 
 def get_scheduler_all_nodes() -> dict:
-    pbsnodes_args = " -q -a -F json"
     pbs_hosts = []
     pbs_hosts_down = []
-    pbs_hosts_free = {}
     pbs_hosts_offline = []
 
-    try:
-        pbsnodes_output = run_command(
-            cmd=(sbins["pbsnodes"] + pbsnodes_args).split(), cmd_type="check_output"
+    # Node states drive the host replacement/offline decisions, always query pbsnodes and share the result
+    nodes_snapshot = get_pbs_nodes_snapshot(pbsnodes_bin=sbins["pbsnodes"])
+    if nodes_snapshot.refresh(force=True) is False:
+        logger.error(
+            f"Unable to get_scheduler_all_nodes because of {nodes_snapshot.error}"
         )
-        logger.debug(f"Got back nodes: {pbsnodes_output=}")
-        if "nodes" in pbsnodes_output.keys():
-            for hostname, data in pbsnodes_output.get("nodes").items():
-                if "jobs" not in data.keys():
 
-                    if "job-exclusive" not in str(data["state"]):
-                        if "down" in str(data["state"]):
-                            pbs_hosts_down.append(hostname)
+    for hostname, data in nodes_snapshot.get_nodes().items():
+        if "jobs" not in data.keys():
+            if "job-exclusive" not in str(data["state"]):
+                if "down" in str(data["state"]):
+                    pbs_hosts_down.append(hostname)
 
-                    if (
-                        str(data["state"]) == "free"
-                        and data["pcpus"] == data["resources_available"]["ncpus"]
-                    ):
-                        if "last_used_time" in data.keys():
-                            pbs_hosts_free[hostname] = data["last_used_time"]
-                        else:
-                            # Automatically remove capacity after 15 mins if no job ran on it
-                            pbs_hosts_free[hostname] = (
-                                data["last_state_change_time"] + 900
-                            )
-
-                    if str(data["state"]) == "offline":
-                        pbs_hosts_offline.append(hostname)
+            if str(data["state"]) == "offline":
+                pbs_hosts_offline.append(hostname)
 
-                pbs_hosts.append(hostname)
-    except AttributeError as _e:
-        # Case when scheduler does not have any valid host
-        pass
-    except Exception as _e:
-        logger.error(f"Unable to get_scheduler_all_nodes because of {_e}")
+        pbs_hosts.append(hostname)
 
     return {
         "pbs_hosts": pbs_hosts,
         "pbs_hosts_down": pbs_hosts_down,
-        "pbs_hosts_free": pbs_hosts_free,
+        "pbs_hosts_free": nodes_snapshot.get_idle_hosts(),
         "pbs_hosts_offline": pbs_hosts_offline,
     }
 
@@ -235,19 +227,22 @@ def delete_stack(stacks_to_delete: list):
 
 
 def delete_hosts(hosts):
+    pbs_batch = PBSBatchExecutor(qmgr_bin=sbins["qmgr"], logger=logger)
     for host in hosts:
-        cmd = [sbins["qmgr"], "-c", "delete node " + host]
-        try:
-            run_command(cmd, "call")
-        except Exception as e:
-            logger.error(f"Command failed due to {e}")
+        pbs_batch.qmgr(f"delete node {host}")
+
+    try:
+        pbs_batch.run()
+    except Exception as e:
+        logger.error(f"Command failed due to {e}")
 
 
 def add_hosts(hosts, compute_instances):
     """
     Add a host via OpenPBS / qmgr.
+    All hosts are added with a single qmgr call.
     """
-
+    pbs_batch = PBSBatchExecutor(qmgr_bin=sbins["qmgr"], logger=logger)
     for host in hosts:
         logger.debug(f"Adding host {host}")
 
@@ -263,44 +258,48 @@ def add_hosts(hosts, compute_instances):
                 host_subnet_id = v["instances"][host]["subnet_id"]
                 host_az = v["instances"][host]["availability_zone"]
 
-                cmds = [
-                    [
-                        sbins["qmgr"],
-                        "-c",
-                        f"create node {host} queue={host_queue}",
-                    ],
-                    [
-                        sbins["qmgr"],
-                        "-c",
-                        f"set node {host} resources_available.compute_node=job{host_job_id}"
-                        + f",resources_available.instance_id={host_instance_id}"
-                        + f",resources_available.asg_spotfleet_id={host_asg_spotfleet_id}"
-                        + f",resources_available.instance_type={host_instance_type}"
-                        + f",resources_available.availability_zone={host_az}"
-                        + f",resources_available.subnet_id={host_subnet_id}",
-                    ],
+                directives = [
+                    f"create node {host} queue={host_queue}",
+                    f"set node {host} resources_available.compute_node=job{host_job_id}"
+                    + f",resources_available.instance_id={host_instance_id}"
+                    + f",resources_available.asg_spotfleet_id={host_asg_spotfleet_id}"
+                    + f",resources_available.instance_type={host_instance_type}"
+                    + f",resources_available.availability_zone={host_az}"
+                    + f",resources_available.subnet_id={host_subnet_id}",
                 ]
-                for cmd in cmds:
-                    try:
-                        logger.debug(f"Trying to add node with: {cmd=}")
-                        run_command(cmd=cmd, cmd_type="call")
-                    except Exception as e:
-                        logger.info(f"Unable to run command because of {e}")
+                for directive in directives:
+                    logger.debug(f"Trying to add node with: {directive=}")
+                    pbs_batch.qmgr(directive)
+
+    try:
+        pbs_batch.run()
+    except Exception as e:
+        logger.info(f"Unable to run command because of {e}")
 
 
 def set_hosts_offline(hosts: dict):
+    pbs_batch = PBSBatchExecutor(qmgr_bin=sbins["qmgr"], logger=logger)
+    command_ids = {}
     for _host in hosts.keys():
         logger.info(
             f"Setting host {_host} offline as it has been idle for more than {hosts[_host]} minutes "
         )
-        cmd = [sbins["qmgr"], "-c", f"set node {_host} state=offline"]
-        try:
+        command_ids[_host] = pbs_batch.qmgr(f"set node {_host} state=offline")
 
-            _rc = run_command(cmd=cmd, cmd_type="call")
+    try:
+        _results = pbs_batch.run()
+    except Exception as e:
+        logger.info(f"Unable to offline hosts {list(hosts.keys())} - error {e}")
+        return
+
+    for _host, _command_id in command_ids.items():
+        _rc = _results[_command_id]["returncode"]
+        if _rc == 0:
             logger.info(f"Successfully offline host {_host}: {_rc}")
-
-        except Exception as e:
-            logger.info(f"Unable to offline host {_host} - error {e}")
+        else:
+            logger.info(
+                f"Unable to offline host {_host} - error {_results[_command_id]['output']}"
+            )
 
 
 def remove_offline_nodes_spotfleet(spotfleets):
@@ -563,25 +562,13 @@ def remove_offline_nodes(hosts):
     remove_offline_nodes_asg(asgs)
 
 
-if __name__ == "__main__":
-    _log_file_location = f"{pathlib.Path(__file__).parent}/logs/nodes_manager.log"
-    logger = SocaLogger().rotating_file_handler(file_path=_log_file_location)
-
-    ec2_client = get_boto(service_name="ec2").message
-    cloudformation_client = get_boto(service_name="cloudformation").message
-    autoscaling_client = get_boto(service_name="autoscaling").message
-
-    _pbs_bin_path: str = "/opt/pbs/bin"
-    sbins: dict = {
-        "qstat": f"{_pbs_bin_path}/qstat",
-        "qmgr": f"{_pbs_bin_path}/qmgr",
-        "pbsnodes": f"{_pbs_bin_path}/pbsnodes",
-    }
-
+def reconcile(cluster_id: str) -> dict:
+    """
+    Full reconciliation between the EC2 compute nodes of the cluster and the PBS nodes.
+    Return the compute instances and PBS hosts known after this reconciliation.
+    """
     # 1 - get all running EC2 instances
-    compute_instances = get_all_compute_instances(
-        cluster_id=SocaConfig(key="/configuration/ClusterId").get_value().get("message")
-    )
+    compute_instances = get_all_compute_instances(cluster_id=cluster_id)
     # Get all current instances private DNS
     current_ec2_compute_nodes_dns = [
         item
@@ -693,3 +680,261 @@ if __name__ == "__main__":
     if compute_nodes_to_add:
         logger.info(f"need to qmgr add: {compute_nodes_to_add}")
         add_hosts(hosts=compute_nodes_to_add, compute_instances=compute_instances)
+
+    return {
+        "compute_instances": compute_instances,
+        "pbs_hosts": (
+            set(pbs_nodes) - set(compute_hosts_to_delete) - set(legacy_host_to_delete)
+        )
+        | set(compute_nodes_to_add),
+    }
+
+
+class NodeStateMap:
+    """
+    In-memory map of the running EC2 compute nodes (desired) and of the PBS nodes (actual) used in event mode.
+    The map is loaded by each full reconcile() and updated from the EC2 state change events in between:
+    - running: the instance is described and registered in PBS if it is a compute node of the cluster
+    - shutting-down / terminated: the host is deleted from PBS
+    - stopping / stopped: the host is set offline, and put back online when the instance is running again
+    """
+
+    def __init__(self, cluster_id: str):
+        self.cluster_id = cluster_id
+        self.compute_instances = {}
+        self.instance_hosts = {}
+        self.pbs_hosts = set()
+        # Hosts set offline because their instance stopped, kept across load() as reconcile() does not track them
+        self.stopped_hosts = set()
+
+    def load(self, reconciled: dict):
+        self.compute_instances = reconciled["compute_instances"]
+        self.pbs_hosts = set(reconciled["pbs_hosts"])
+        self.instance_hosts = {
+            data["instance_id"]: host
+            for stack_data in self.compute_instances.values()
+            for host, data in stack_data["instances"].items()
+        }
+
+    def apply_events(self, events: list):
+        # Only the last state received for an instance matters
+        latest_states = {}
+        for instance_id, state in events:
+            latest_states[instance_id] = state
+
+        instances_running = [
+            instance_id
+            for instance_id, state in latest_states.items()
+            if state == "running" and instance_id not in self.instance_hosts
+        ]
+        instances_restarted = [
+            instance_id
+            for instance_id, state in latest_states.items()
+            if state == "running"
+            and self.instance_hosts.get(instance_id) in self.stopped_hosts
+        ]
+        instances_terminated = [
+            instance_id
+            for instance_id, state in latest_states.items()
+            if state in ("shutting-down", "terminated")
+            and instance_id in self.instance_hosts
+        ]
+        instances_stopped = [
+            instance_id
+            for instance_id, state in latest_states.items()
+            if state in ("stopping", "stopped") and instance_id in self.instance_hosts
+        ]
+
+        if instances_running:
+            self.register(instance_ids=instances_running)
+        if instances_restarted:
+            self.online(
+                hosts=[
+                    self.instance_hosts[instance_id]
+                    for instance_id in instances_restarted
+                ]
+            )
+        if instances_terminated:
+            self.remove(instance_ids=instances_terminated)
+        if instances_stopped:
+            self.offline(instance_ids=instances_stopped)
+
+    def _forget(self, instance_ids: list) -> list:
+        hosts = []
+        for instance_id in instance_ids:
+            host = self.instance_hosts.pop(instance_id)
+            for stack_data in self.compute_instances.values():
+                stack_data["instances"].pop(host, None)
+            hosts.append(host)
+        return hosts
+
+    def register(self, instance_ids: list):
+        # Instances which are not compute nodes of this cluster are filtered out by get_all_compute_instances
+        new_instances = get_all_compute_instances(
+            cluster_id=self.cluster_id, instance_ids=instance_ids
+        )
+        hosts_to_add = []
+        hosts_to_online = []
+        for job_id, stack_data in new_instances.items():
+            if job_id not in self.compute_instances:
+                self.compute_instances[job_id] = {**stack_data, "instances": {}}
+            for host, data in stack_data["instances"].items():
+                self.compute_instances[job_id]["instances"][host] = data
+                self.instance_hosts[data["instance_id"]] = host
+                if host not in self.pbs_hosts:
+                    hosts_to_add.append(host)
+                elif host in self.stopped_hosts:
+                    # Instance restarted after a reconcile() which no longer listed it as running
+                    hosts_to_online.append(host)
+
+        if hosts_to_add:
+            logger.info(f"need to qmgr add: {hosts_to_add}")
+            add_hosts(hosts=hosts_to_add, compute_instances=new_instances)
+            self.pbs_hosts.update(hosts_to_add)
+            self.stopped_hosts.difference_update(hosts_to_add)
+        if hosts_to_online:
+            self.online(hosts=hosts_to_online)
+
+    def remove(self, instance_ids: list):
+        hosts_to_delete = [
+            host for host in self._forget(instance_ids) if host in self.pbs_hosts
+        ]
+        if hosts_to_delete:
+            logger.info(f"Need to qmgr delete terminated hosts: {hosts_to_delete}")
+            delete_hosts(hosts=hosts_to_delete)
+            self.pbs_hosts.difference_update(hosts_to_delete)
+        self.stopped_hosts.difference_update(hosts_to_delete)
+
+    def offline(self, instance_ids: list):
+        pbs_batch = PBSBatchExecutor(qmgr_bin=sbins["qmgr"], logger=logger)
+        for instance_id in instance_ids:
+            host = self.instance_hosts[instance_id]
+            if host in self.pbs_hosts:
+                logger.info(f"Setting host {host} offline as {instance_id} is stopping")
+                pbs_batch.qmgr(f"set node {host} state=offline")
+                self.stopped_hosts.add(host)
+
+        try:
+            pbs_batch.run()
+        except Exception as e:
+            logger.info(f"Unable to offline stopped hosts - error {e}")
+
+    def online(self, hosts: list):
+        pbs_batch = PBSBatchExecutor(qmgr_bin=sbins["qmgr"], logger=logger)
+        command_ids = {}
+        for host in hosts:
+            logger.info(f"Setting host {host} back online as its instance is running")
+            command_ids[host] = pbs_batch.qmgr(f"set node {host} state=free")
+
+        try:
+            _results = pbs_batch.run()
+        except Exception as e:
+            logger.info(f"Unable to online restarted hosts - error {e}")
+            return
+
+        for host, command_id in command_ids.items():
+            if _results[command_id]["returncode"] == 0:
+                self.stopped_hosts.discard(host)
+            else:
+                # Kept in stopped_hosts, the next running event of this instance retries
+                logger.info(
+                    f"Unable to online host {host} - error {_results[command_id]['output']}"
+                )
+
+
+def run_event_loop(event_source, cluster_id: str, reconcile_interval: int = 900):
+    """
+    Register / remove PBS nodes as soon as EC2 state change events are received.
+    A full reconcile() still runs every reconcile_interval seconds to catch missed events and idle capacity.
+    Events are acknowledged only once they have been applied.
+    """
+    state_map = NodeStateMap(cluster_id=cluster_id)
+    next_reconcile = 0
+    while True:
+        if time.time() >= next_reconcile:
+            try:
+                state_map.load(reconcile(cluster_id=cluster_id))
+            except Exception as err:
+                logger.error(f"Unable to reconcile compute nodes because of {err}")
+            next_reconcile = time.time() + reconcile_interval
+
+        try:
+            events = event_source.poll(
+                timeout=max(1, min(20, next_reconcile - time.time()))
+            )
+            if events:
+                logger.info(f"Received {len(events)} EC2 state change events")
+                state_map.apply_events(events)
+            event_source.ack()
+        except Exception as err:
+            logger.error(f"Unable to process EC2 state change events because of {err}")
+            # Never acknowledge events which were not applied, the source delivers them again when it can
+            event_source.nack()
+            time.sleep(5)
+
+
+if __name__ == "__main__":
+    _log_file_location = f"{pathlib.Path(__file__).parent}/logs/nodes_manager.log"
+    logger = SocaLogger().rotating_file_handler(file_path=_log_file_location)
+
+    ec2_client = get_boto(service_name="ec2").message
+    cloudformation_client = get_boto(service_name="cloudformation").message
+    autoscaling_client = get_boto(service_name="autoscaling").message
+
+    _pbs_bin_path: str = "/opt/pbs/bin"
+    sbins: dict = {
+        "qstat": f"{_pbs_bin_path}/qstat",
+        "qmgr": f"{_pbs_bin_path}/qmgr",
+        "pbsnodes": f"{_pbs_bin_path}/pbsnodes",
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-e",
+        "--events",
+        nargs="?",
+        const="",
+        help="Keep running and consume EC2 state change events from this source: file:///path, unix:///path or an SQS queue URL. Use the NodeEventsQueueUrl queue of the cluster when no source is given. Run a single reconciliation when not set",
+    )
+    parser.add_argument(
+        "-r",
+        "--reconcile-interval",
+        type=int,
+        default=900,
+        help="Interval in seconds between two full reconciliations when --events is set",
+    )
+    arg = parser.parse_args()
+
+    _cluster_id = SocaConfig(key="/configuration/ClusterId").get_value().get("message")
+    _event_source_uri = arg.events
+    if _event_source_uri == "":
+        _node_events_queue_url = SocaConfig(
+            key="/configuration/NodeEventsQueueUrl"
+        ).get_value()
+        if _node_events_queue_url.get("success") and _node_events_queue_url.get(
+            "message"
+        ):
+            _event_source_uri = _node_events_queue_url.get("message")
+        else:
+            # Cluster deployed without the NodeEvents queue, keep the one-shot reconciliation
+            logger.warning(
+                "/configuration/NodeEventsQueueUrl is not set, running a single reconciliation"
+            )
+            _event_source_uri = None
+
+    if _event_source_uri:
+        # Started by cron every minute, the lock keeps a single event loop running
+        _lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            _lock_socket.bind(f"\0{__file__} --events")
+        except socket.error:
+            logger.info("nodes_manager.py --events is already running, exiting")
+            sys.exit(0)
+
+        run_event_loop(
+            event_source=get_event_source(_event_source_uri),
+            cluster_id=_cluster_id,
+            reconcile_interval=arg.reconcile_interval,
+        )
+    else:
+        reconcile(cluster_id=_cluster_id)
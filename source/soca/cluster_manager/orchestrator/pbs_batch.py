@@ -0,0 +1,242 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Batch PBS commands (qmgr, qalter, qdel ...) to limit the number of fork/exec against pbs_server.
+"""
+
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PBSBatchExecutor:
+    """
+    Collect PBS commands and run them at once with run():
+    - qmgr directives are written to a single qmgr stdin script (split every qmgr_batch_size directives) and run in the order they were added
+    - qalter requests sharing the same arguments are grouped in a single qalter call with all job ids
+    - qalter groups and other commands run concurrently through a pool of max_workers threads
+    If a qmgr batch fails, qmgr stops at the rejected directive (-a) and the directives it echoed (-e) tell which one failed:
+    the directives before it are successful, the failed one is retried on its own and the next ones are batched again.
+    A "create" directive rejected because the object already exists is successful.
+    If a grouped qalter fails, each job is retried one by one so each job gets its own result.
+
+    example:
+        pbs_batch = PBSBatchExecutor(qmgr_bin="/opt/pbs/bin/qmgr", logger=logger)
+        create_id = pbs_batch.qmgr("create node ip-10-0-0-1 queue=normal")
+        pbs_batch.qalter(job_id="123", args=["-l", "stack_id="])
+        results = pbs_batch.run()
+        results[create_id] = {"cmd": ["/opt/pbs/bin/qmgr", "-c", "create node ip-10-0-0-1 queue=normal"], "returncode": 0, "output": ""}
+    """
+
+    def __init__(
+        self,
+        qmgr_bin="/opt/pbs/bin/qmgr",
+        qalter_bin="/opt/pbs/bin/qalter",
+        max_workers=8,
+        qmgr_batch_size=500,
+        qalter_batch_size=500,
+        logger=None,
+    ):
+        self.qmgr_bin = qmgr_bin
+        self.qalter_bin = qalter_bin
+        self.max_workers = max_workers
+        self.qmgr_batch_size = qmgr_batch_size
+        self.qalter_batch_size = qalter_batch_size
+        self.logger = logger if logger is not None else logging.getLogger("soca_logger")
+        self._command_id = 0
+        self._qmgr_directives = []
+        self._qalter_groups = {}
+        self._commands = []
+
+    def _new_command_id(self):
+        self._command_id += 1
+        return self._command_id
+
+    def qmgr(self, directive):
+        """
+        Add a qmgr directive (e.g: "delete node ip-10-0-0-1") and return its command id
+        """
+        command_id = self._new_command_id()
+        self._qmgr_directives.append((command_id, directive))
+        return command_id
+
+    def qalter(self, job_id, args):
+        """
+        Add a qalter for job_id with args (e.g: ["-l", "stack_id="]) and return its command id
+        """
+        command_id = self._new_command_id()
+        self._qalter_groups.setdefault(tuple(args), []).append(
+            (command_id, str(job_id))
+        )
+        return command_id
+
+    def command(self, cmd):
+        """
+        Add any other command (as a list) and return its command id. Commands are independent and can run concurrently
+        """
+        command_id = self._new_command_id()
+        self._commands.append((command_id, cmd))
+        return command_id
+
+    def run(self):
+        """
+        Run all pending commands and return a dict of command id: {"cmd", "returncode", "output"}
+        """
+        results = {}
+        tasks = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            if self._qmgr_directives:
+                # qmgr directives can depend on each other (create node then set node), they are processed by a single worker
+                tasks.append(pool.submit(self._run_qmgr, self._qmgr_directives))
+
+            for args, jobs in self._qalter_groups.items():
+                for i in range(0, len(jobs), self.qalter_batch_size):
+                    tasks.append(
+                        pool.submit(
+                            self._run_qalter,
+                            list(args),
+                            jobs[i : i + self.qalter_batch_size],
+                        )
+                    )
+
+            for command_id, cmd in self._commands:
+                tasks.append(pool.submit(self._run_single, command_id, cmd))
+
+            for task in tasks:
+                results.update(task.result())
+
+        self._qmgr_directives = []
+        self._qalter_groups = {}
+        self._commands = []
+        return dict(sorted(results.items()))
+
+    def _execute(self, cmd, stdin=None):
+        try:
+            _process = subprocess.run(
+                cmd,
+                input=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+            )
+            return _process.returncode, _process.stdout
+        except Exception as err:
+            return -1, str(err)
+
+    def _run_single(self, command_id, cmd):
+        self.logger.info(f"About to run {cmd}")
+        returncode, output = self._execute(cmd)
+        if returncode != 0:
+            self.logger.error(f"{cmd} failed with return code {returncode}: {output}")
+        return {command_id: {"cmd": cmd, "returncode": returncode, "output": output}}
+
+    def _run_qmgr_single(self, command_id, directive):
+        result = self._run_single(command_id, [self.qmgr_bin, "-c", directive])
+        _result = result[command_id]
+        if (
+            _result["returncode"] != 0
+            and directive.split()[0] == "create"
+            and "already exists" in _result["output"].lower()
+        ):
+            self.logger.info(f"{directive} already applied: {_result['output']}")
+            _result["returncode"] = 0
+        return result
+
+    @staticmethod
+    def _echoed_directives(batch, output):
+        """
+        Return the number of directives of batch echoed by qmgr -e, in order
+        """
+        _echoed = 0
+        for _line in output.splitlines():
+            if _echoed < len(batch) and _line.strip() == batch[_echoed][1].strip():
+                _echoed += 1
+        return _echoed
+
+    def _run_qmgr(self, directives):
+        results = {}
+        pending = list(directives)
+        while pending:
+            batch = pending[: self.qmgr_batch_size]
+            pending = pending[self.qmgr_batch_size :]
+            script = "\n".join(directive for _, directive in batch) + "\n"
+            self.logger.info(f"About to run {len(batch)} qmgr directives:\n{script}")
+            # -a: stop at the first rejected directive, -e: echo each directive before it runs
+            returncode, output = self._execute(
+                [self.qmgr_bin, "-a", "-e"], stdin=script
+            )
+            if returncode == 0:
+                for command_id, directive in batch:
+                    results[command_id] = {
+                        "cmd": [self.qmgr_bin, "-c", directive],
+                        "returncode": 0,
+                        "output": output,
+                    }
+                continue
+
+            _echoed = self._echoed_directives(batch, output)
+            if _echoed == 0:
+                # qmgr failed before running any directive (e.g: pbs_server unreachable), retrying won't help
+                self.logger.error(
+                    f"qmgr batch failed with return code {returncode}: {output}"
+                )
+                for command_id, directive in batch:
+                    results[command_id] = {
+                        "cmd": [self.qmgr_bin, "-c", directive],
+                        "returncode": returncode,
+                        "output": output,
+                    }
+                continue
+
+            failed_id, failed_directive = batch[_echoed - 1]
+            self.logger.warning(
+                f"qmgr batch failed on {failed_directive} with return code {returncode}: {output}. "
+                f"Retrying it individually and batching the {len(batch) - _echoed} directives after it again"
+            )
+            for command_id, directive in batch[: _echoed - 1]:
+                results[command_id] = {
+                    "cmd": [self.qmgr_bin, "-c", directive],
+                    "returncode": 0,
+                    "output": output,
+                }
+            results.update(self._run_qmgr_single(failed_id, failed_directive))
+            pending = batch[_echoed:] + pending
+        return results
+
+    def _run_qalter(self, args, jobs):
+        cmd = [self.qalter_bin] + args + [job_id for _, job_id in jobs]
+        if len(jobs) == 1:
+            return self._run_single(jobs[0][0], cmd)
+
+        self.logger.info(f"About to run {cmd}")
+        returncode, output = self._execute(cmd)
+        if returncode == 0:
+            return {
+                command_id: {
+                    "cmd": [self.qalter_bin] + args + [job_id],
+                    "returncode": 0,
+                    "output": output,
+                }
+                for command_id, job_id in jobs
+            }
+
+        self.logger.warning(
+            f"Grouped qalter failed with return code {returncode}: {output}. Retrying each job individually"
+        )
+        results = {}
+        for command_id, job_id in jobs:
+            results.update(
+                self._run_single(command_id, [self.qalter_bin] + args + [job_id])
+            )
+        return results
@@ -0,0 +1,146 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Refresh the project budget snapshot read by the check_project_budget queuejob hook, so the hook never calls AWS Budgets.
+All budgets of the account are retrieved with DescribeBudgets and the spend of the projects listed in
+settings/project_cost_manager.txt is written atomically to project_budget_snapshot.json.
+
+The controller crontab runs it every 5 minutes:
+*/5 * * * * source /etc/environment; /opt/soca/$SOCA_CLUSTER_ID/python/latest/bin/python3 /opt/soca/$SOCA_CLUSTER_ID/cluster_manager/orchestrator/project_budget_snapshot.py
+It can also be kept running with --interval 300
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+from configparser import ConfigParser
+
+sys.path.append(
+    f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID', 'SOCA_CONFIGURATION_NOT_FOUND')}/cluster_manager"
+)
+
+from utils.aws.boto3_wrapper import get_boto
+from utils.logger import SocaLogger
+
+
+def get_projects(budget_config_file: str) -> list:
+    config = ConfigParser(allow_no_value=True)
+    with open(budget_config_file, "r") as _file:
+        config.read_file(_file)
+    return config.sections()
+
+
+def get_budgets(account_id: str) -> dict:
+    """
+    Return {budget_name: {"actual_spend", "budget_limit"}} for all budgets of the account
+    """
+    budgets = {}
+    budgets_paginator = budgets_client.get_paginator("describe_budgets")
+    for page in budgets_paginator.paginate(AccountId=account_id):
+        for budget in page.get("Budgets", []):
+            try:
+                budgets[budget["BudgetName"]] = {
+                    "actual_spend": float(
+                        budget["CalculatedSpend"]["ActualSpend"]["Amount"]
+                    ),
+                    "budget_limit": float(budget["BudgetLimit"]["Amount"]),
+                }
+            except (KeyError, ValueError) as err:
+                logger.warning(
+                    f"Ignoring budget {budget.get('BudgetName')} without spend or limit: {err}"
+                )
+    return budgets
+
+
+def write_snapshot(snapshot: dict, snapshot_file: str):
+    # The hook may read the file at any time, replace it atomically
+    _tmp_file = f"{snapshot_file}.{os.getpid()}.tmp"
+    with open(_tmp_file, "w") as _file:
+        json.dump(snapshot, _file)
+    os.chmod(_tmp_file, 0o644)
+    os.replace(_tmp_file, snapshot_file)
+
+
+def refresh(account_id: str, budget_config_file: str, snapshot_file: str) -> bool:
+    try:
+        projects = get_projects(budget_config_file)
+    except Exception as err:
+        logger.error(f"Unable to read {budget_config_file}: {err}")
+        return False
+
+    try:
+        budgets = get_budgets(account_id)
+    except Exception as err:
+        # Keep the previous snapshot, the hook applies its staleness policy if this keeps failing
+        logger.error(f"Unable to query AWS Budgets: {err}")
+        return False
+
+    snapshot = {"refreshed_at": time.time(), "account_id": account_id, "budgets": {}}
+    for project in projects:
+        if project in budgets:
+            snapshot["budgets"][project] = budgets[project]
+        else:
+            logger.warning(f"No AWS Budget named {project} in account {account_id}")
+
+    write_snapshot(snapshot, snapshot_file)
+    logger.info(
+        f"Budget snapshot refreshed for {len(snapshot['budgets'])}/{len(projects)} projects"
+    )
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-a",
+        "--account-id",
+        nargs="?",
+        help="AWS account owning the budgets, default to the account of the current credentials",
+    )
+    parser.add_argument(
+        "-i",
+        "--interval",
+        type=int,
+        default=0,
+        help="Keep running and refresh the snapshot every interval seconds. Run once when not set",
+    )
+    arg = parser.parse_args()
+
+    _log_file_location = (
+        f"{pathlib.Path(__file__).parent}/logs/project_budget_snapshot.log"
+    )
+    logger = SocaLogger().rotating_file_handler(file_path=_log_file_location)
+
+    budgets_client = get_boto(service_name="budgets").message
+    _account_id = (
+        arg.account_id
+        or get_boto(service_name="sts").message.get_caller_identity()["Account"]
+    )
+    _budget_config_file = (
+        f"{pathlib.Path(__file__).parent}/settings/project_cost_manager.txt"
+    )
+    _snapshot_file = f"{pathlib.Path(__file__).parent}/project_budget_snapshot.json"
+
+    while True:
+        _success = refresh(
+            account_id=_account_id,
+            budget_config_file=_budget_config_file,
+            snapshot_file=_snapshot_file,
+        )
+        if not arg.interval:
+            sys.exit(0 if _success else 1)
+        time.sleep(arg.interval)
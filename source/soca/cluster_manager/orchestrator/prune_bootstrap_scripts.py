@@ -0,0 +1,99 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+
+"""
+Delete the job specific bootstrap scripts of the compute node stacks which have been deleted. Run hourly by cron.
+"""
+
+import argparse
+import os
+import pathlib
+import sys
+
+sys.path.append(
+    f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID', 'SOCA_CONFIGURATION_NOT_FOUND')}/cluster_manager"
+)
+
+from utils.aws.boto3_wrapper import get_boto
+from utils.aws.ssm_parameter_store import SocaConfig
+from utils.logger import SocaLogger
+import cloudformation_builder
+
+# Every stack status but DELETE_COMPLETE
+ACTIVE_STACK_STATUSES = [
+    "CREATE_IN_PROGRESS",
+    "CREATE_FAILED",
+    "CREATE_COMPLETE",
+    "ROLLBACK_IN_PROGRESS",
+    "ROLLBACK_FAILED",
+    "ROLLBACK_COMPLETE",
+    "DELETE_IN_PROGRESS",
+    "DELETE_FAILED",
+    "UPDATE_IN_PROGRESS",
+    "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_COMPLETE",
+    "UPDATE_FAILED",
+    "UPDATE_ROLLBACK_IN_PROGRESS",
+    "UPDATE_ROLLBACK_FAILED",
+    "UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS",
+    "UPDATE_ROLLBACK_COMPLETE",
+    "REVIEW_IN_PROGRESS",
+    "IMPORT_IN_PROGRESS",
+    "IMPORT_COMPLETE",
+    "IMPORT_ROLLBACK_IN_PROGRESS",
+    "IMPORT_ROLLBACK_FAILED",
+    "IMPORT_ROLLBACK_COMPLETE",
+]
+
+
+def get_active_stacks(cluster_id: str) -> set:
+    _cloudformation = get_boto(service_name="cloudformation").message
+    return {
+        _stack["StackName"]
+        for _page in _cloudformation.get_paginator("list_stacks").paginate(
+            StackStatusFilter=ACTIVE_STACK_STATUSES
+        )
+        for _stack in _page["StackSummaries"]
+        if _stack["StackName"].startswith(f"{cluster_id}-")
+    }
+
+
+if __name__ == "__main__":
+    _log_file_location = (
+        f"{pathlib.Path(__file__).parent}/logs/prune_bootstrap_scripts.log"
+    )
+    logger = SocaLogger().rotating_file_handler(file_path=_log_file_location)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--min-age",
+        type=int,
+        default=86400,
+        help="Keep the scripts uploaded less than this number of seconds ago",
+    )
+    arg = parser.parse_args()
+
+    _cluster_id = SocaConfig(key="/configuration/ClusterId").get_value().get("message")
+    _bucket = SocaConfig(key="/configuration/S3Bucket").get_value().get("message")
+    _pruned = cloudformation_builder.prune_bootstrap_scripts(
+        bucket=_bucket,
+        cluster_id=_cluster_id,
+        active_stacks=get_active_stacks(_cluster_id),
+        min_age=arg.min_age,
+    )
+    if _pruned["success"] is True:
+        logger.info(_pruned["output"])
+    else:
+        logger.error(_pruned["output"])
+        sys.exit(1)
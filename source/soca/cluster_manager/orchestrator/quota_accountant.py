@@ -0,0 +1,299 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Running On-Demand vCPU accounting per EC2 service quota, used by add_nodes to decide if capacity can be launched.
+"""
+
+import logging
+import re
+import threading
+import time
+from math import ceil
+
+from utils.aws.boto3_wrapper import get_boto
+from utils.aws.ec2_instance_catalog import get_instance_catalog
+
+logger = logging.getLogger("soca_logger")
+
+# Instance states consuming the Running On-Demand quota
+RUNNING_STATES = ("pending", "running")
+
+# Quota names which don't list their instance families
+QUOTA_FAMILY_ALIASES = {"high memory": ["u"]}
+
+
+def parse_quota_families(quota_name):
+    """
+    Return the instance families covered by a Running On-Demand quota, or None if quota_name is not a Running On-Demand quota
+    e.g: "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances" -> ["a", "c", "d", "h", "i", "m", "r", "t", "z"]
+         "Running On-Demand G and VT instances" -> ["g", "vt"]
+    """
+    _match = re.search(r"running on-demand (.*) instances", quota_name.lower())
+    if not _match:
+        return None
+    _families = _match.group(1)
+    _in_parenthesis = re.search(r"\((.*)\)", _families)
+    if _in_parenthesis:
+        _families = _in_parenthesis.group(1)
+    if _families.strip() in QUOTA_FAMILY_ALIASES:
+        return QUOTA_FAMILY_ALIASES[_families.strip()]
+    return [
+        _family.strip()
+        for _family in re.split(r",|\band\b", _families)
+        if _family.strip()
+    ]
+
+
+def get_instance_family(instance_type):
+    # Leading letters of the instance type: c6gn.large -> c, inf2.xlarge -> inf, u-6tb1.metal -> u
+    _match = re.match(r"[a-z]+", instance_type.lower())
+    return _match.group(0) if _match else instance_type
+
+
+class VcpuQuotaAccountant:
+    """
+    Keep a running vCPU ledger per Running On-Demand quota bucket:
+    - limits come from Service Quotas and vCPUs in use from DescribeInstances, both refreshed by reconcile() every reconcile_interval seconds
+    - reserve() atomically checks and books the vCPUs of capacity being provisioned, so concurrent requests issued in the same
+      dispatcher cycle can't all pass the check. reconcile() subtracts the vCPUs of the instances already running for the
+      reservation (instances tagged with soca:StackId, whether launched by the stack itself, an ASG or a fleet), so a
+      partially launched stack keeps its remaining vCPUs booked. A reservation is released once all its instances are
+      running, when release() is called or after reservation_ttl seconds.
+    Once reconciled, admission checks are O(1) and don't call any AWS API.
+
+    example:
+        accountant = get_quota_accountant()
+        accountant.reserve(reservation_id="soca-cluster-job-123", instance_type="c6i.large", instance_count=10)
+        -> {"success": True, "message": "..."}
+    """
+
+    def __init__(self, reconcile_interval=300, reservation_ttl=900):
+        self.reconcile_interval = reconcile_interval
+        self.reservation_ttl = reservation_ttl
+        self._lock = threading.RLock()
+        self._reconciled_at = 0
+        # quota_code: {"quota_name", "families", "limit", "used"}
+        self._buckets = {}
+        # instance family: quota_code
+        self._family_bucket = {}
+        # reservation_id: {"quota_code", "vcpus", "expires_at"}
+        self._reservations = {}
+
+    def _load_quotas(self):
+        _servicequotas = get_boto(service_name="service-quotas").message
+        _buckets = {}
+        for _page in _servicequotas.get_paginator("list_service_quotas").paginate(
+            ServiceCode="ec2"
+        ):
+            for _quota in _page["Quotas"]:
+                _families = parse_quota_families(_quota["QuotaName"])
+                if _families:
+                    _buckets[_quota["QuotaCode"]] = {
+                        "quota_name": _quota["QuotaName"],
+                        "families": _families,
+                        "limit": _quota["Value"],
+                        "used": 0,
+                    }
+        return _buckets
+
+    def _load_running_instances(self):
+        _ec2 = get_boto(service_name="ec2").message
+        _instances = {}
+        # reservation id (SOCA stack name): [On-Demand instances, On-Demand vCPUs]
+        _stacks = {}
+        for _page in _ec2.get_paginator("describe_instances").paginate(
+            Filters=[{"Name": "instance-state-name", "Values": list(RUNNING_STATES)}]
+        ):
+            for _reservation in _page["Reservations"]:
+                for _instance in _reservation["Instances"]:
+                    # Spot instances are accounted in the Spot quotas
+                    if _instance.get("InstanceLifecycle") == "spot":
+                        continue
+                    _cpu_options = _instance.get("CpuOptions", {})
+                    _vcpus = _cpu_options.get("CoreCount", 1) * _cpu_options.get(
+                        "ThreadsPerCore", 1
+                    )
+                    _instances[_instance["InstanceId"]] = (
+                        _instance["InstanceType"],
+                        _vcpus,
+                    )
+                    # Instances launched by EC2 Fleet/Spot Fleet don't get the aws:cloudformation tags, use the SOCA ones
+                    _tags = {_t["Key"]: _t["Value"] for _t in _instance.get("Tags", [])}
+                    _stack_name = _tags.get("soca:StackId") or _tags.get(
+                        "aws:cloudformation:stack-name"
+                    )
+                    if _stack_name:
+                        _stack = _stacks.setdefault(_stack_name, [0, 0])
+                        _stack[0] += 1
+                        _stack[1] += _vcpus
+        return _instances, _stacks
+
+    def _bucket_for(self, instance_type):
+        _family = get_instance_family(instance_type)
+        if _family in self._family_bucket:
+            return self._family_bucket[_family]
+        # im4gn is part of the I family, use the longest family prefix
+        for _length in range(len(_family) - 1, 0, -1):
+            if _family[:_length] in self._family_bucket:
+                return self._family_bucket[_family[:_length]]
+        return None
+
+    def reconcile(self):
+        """
+        Rebuild the ledger from Service Quotas and DescribeInstances
+        """
+        _start = time.perf_counter()
+        _buckets = self._load_quotas()
+        _running_instances, _stacks = self._load_running_instances()
+        with self._lock:
+            self._buckets = _buckets
+            self._family_bucket = {
+                _family: _quota_code
+                for _quota_code, _bucket in _buckets.items()
+                for _family in _bucket["families"]
+            }
+            for _instance_type, _vcpus in _running_instances.values():
+                _quota_code = self._bucket_for(_instance_type)
+                if _quota_code is not None:
+                    self._buckets[_quota_code]["used"] += _vcpus
+
+            # vCPUs of the instances already launched by a reservation stack are now counted as used
+            for _reservation_id, _reservation in list(self._reservations.items()):
+                if _reservation_id not in _stacks:
+                    continue
+                _launched_instances, _launched_vcpus = _stacks[_reservation_id]
+                _reservation["vcpus"] = max(
+                    _reservation["requested_vcpus"] - _launched_vcpus, 0
+                )
+                if (
+                    _reservation["vcpus"] == 0
+                    or _launched_instances >= _reservation["instance_count"]
+                ):
+                    del self._reservations[_reservation_id]
+
+            self._reconciled_at = time.time()
+        logger.info(
+            f"Reconciled vCPU quotas in {time.perf_counter() - _start:.2f}s: "
+            + ", ".join(
+                f"{_b['quota_name']} {_b['used']}/{_b['limit']}"
+                for _b in _buckets.values()
+                if _b["used"]
+            )
+        )
+
+    def _reconcile_if_needed(self):
+        if time.time() - self._reconciled_at > self.reconcile_interval:
+            self.reconcile()
+
+    def _reserved_vcpus(self, quota_code, now):
+        return sum(
+            _r["vcpus"]
+            for _r in self._reservations.values()
+            if _r["quota_code"] == quota_code and _r["expires_at"] > now
+        )
+
+    def reserve(self, reservation_id, instance_type, instance_count):
+        """
+        Book the vCPUs required by instance_count instance_type if they fit in the quota.
+        Return {"success": True/False, "message": ...}
+        """
+        _vcpus_per_instance = get_instance_catalog().get_vcpus(instance_type)
+        if _vcpus_per_instance is None:
+            return {
+                "success": False,
+                "message": f"Unable to detect the number of vCPUs for {instance_type}",
+            }
+        _requested = _vcpus_per_instance * int(instance_count)
+
+        with self._lock:
+            self._reconcile_if_needed()
+            _quota_code = self._bucket_for(instance_type)
+            if _quota_code is None:
+                return {
+                    "success": False,
+                    "message": f"Unable to find ServiceQuota for {instance_type}",
+                }
+
+            _now = time.time()
+            # Drop expired reservations
+            self._reservations = {
+                _k: _v
+                for _k, _v in self._reservations.items()
+                if _v["expires_at"] > _now
+            }
+            _bucket = self._buckets[_quota_code]
+            _reserved = self._reserved_vcpus(_quota_code, _now)
+            if _bucket["used"] + _reserved + _requested > _bucket["limit"]:
+                return {
+                    "success": False,
+                    "message": f"Job cannot start due to AWS Service limit. Max Vcpus allowed {_bucket['limit']}. Detected running Vcpus {_bucket['used']}. Vcpus being provisioned {_reserved}. Requested Vcpus for this job {_requested}. Quota Name {_bucket['quota_name']}",
+                }
+
+            self._reservations[reservation_id] = {
+                "quota_code": _quota_code,
+                "instance_count": int(instance_count),
+                "requested_vcpus": _requested,
+                # vCPUs not launched yet, updated by reconcile()
+                "vcpus": _requested,
+                "expires_at": _now + self.reservation_ttl,
+            }
+            return {
+                "success": True,
+                "message": f"Reserved {_requested} vCPUs for {reservation_id} ({_bucket['quota_name']})",
+            }
+
+    def release(self, reservation_id):
+        """
+        Cancel a reservation, e.g. when the capacity could not be provisioned
+        """
+        with self._lock:
+            self._reservations.pop(reservation_id, None)
+
+    def get_usage(self):
+        """
+        Return the ledger per quota: {quota_name: {"limit", "used", "reserved"}}
+        """
+        with self._lock:
+            _now = time.time()
+            return {
+                _bucket["quota_name"]: {
+                    "limit": _bucket["limit"],
+                    "used": _bucket["used"],
+                    "reserved": self._reserved_vcpus(_quota_code, _now),
+                }
+                for _quota_code, _bucket in self._buckets.items()
+            }
+
+
+def instance_count_for_capacity(desired_capacity, weighted_capacity=None):
+    """
+    Number of instances launched for desired_capacity, desired_capacity is expressed in weighted capacity units when
+    weighted_capacity is set. The smallest weight is used to get the upper bound.
+    """
+    if weighted_capacity:
+        return ceil(int(desired_capacity) / max(1, min(weighted_capacity)))
+    return int(desired_capacity)
+
+
+_quota_accountant = None
+
+
+def get_quota_accountant():
+    """
+    Return the VcpuQuotaAccountant shared by the current process (the dispatcher keeps it across scheduling cycles)
+    """
+    global _quota_accountant
+    if _quota_accountant is None:
+        _quota_accountant = VcpuQuotaAccountant()
+    return _quota_accountant
@@ -0,0 +1,258 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Reserved Instance coverage model used by add_nodes when a job is submitted with force_ri=True.
+"""
+
+import copy
+import json
+import logging
+import threading
+import time
+
+from utils.aws.boto3_wrapper import get_boto
+from utils.cache import SocaCacheClient
+
+logger = logging.getLogger("soca_logger")
+
+RI_COVERAGE_CACHE_KEY = "orchestrator/ri_coverage"
+RUNNING_STATES = ("pending", "running")
+
+
+class RICoverage:
+    """
+    Keep the number of running On-Demand instances and active Reserved Instances per instance type.
+    The model is rebuilt by refresh() (one DescribeInstances sweep and one DescribeReservedInstances call for all instance types)
+    every refresh_interval seconds and persisted in the shared cache, so other processes and the next dispatcher cycles re-use it.
+    book() reserves RI coverage for capacity being provisioned. All the bookings of a job are released when refresh() detects
+    instances tagged with soca:JobId=<booking_id>, when release() is called or after booking_ttl seconds.
+    refresh(), book() and release() update the cached model in a single WATCH/MULTI transaction, so concurrent processes
+    don't overwrite each other's bookings and book() checks the coverage against the bookings of all processes.
+    Once loaded, can_fit() and book() don't call any EC2 API.
+
+    example:
+        ri_coverage = get_ri_coverage()
+        ri_coverage.book(booking_id="123", instance_type="c6i.large", instance_count=4)
+        -> {"success": True, "message": "...", "running": 10, "reserved": 20, "booked": 0}
+    """
+
+    def __init__(self, refresh_interval=300, booking_ttl=900):
+        self.refresh_interval = refresh_interval
+        self.booking_ttl = booking_ttl
+        self._lock = threading.RLock()
+        # {"refreshed_at": epoch, "running": {instance_type: count}, "reserved": {instance_type: count},
+        #  "bookings": {booking_id: {"instance_type", "count", "expires_at"}}}
+        self._model = {"refreshed_at": 0, "running": {}, "reserved": {}, "bookings": {}}
+        try:
+            self._cache_client = SocaCacheClient(is_admin=True)
+            if not self._cache_client.is_enabled().success:
+                self._cache_client = None
+        except Exception as err:
+            logger.warning(
+                f"Unable to build cache client, RI coverage won't be shared: {err}"
+            )
+            self._cache_client = None
+
+    def _load_from_cache(self):
+        if self._cache_client is None:
+            return
+        try:
+            _cached = self._cache_client.get(key=RI_COVERAGE_CACHE_KEY)
+            if _cached.success:
+                _model = json.loads(_cached.message)
+                if _model.get("refreshed_at", 0) >= self._model["refreshed_at"]:
+                    self._model = _model
+        except Exception as err:
+            logger.warning(f"Unable to load RI coverage from cache: {err}")
+
+    def _update(self, function):
+        """
+        Apply function(model) to the latest model and persist it, return the value returned by function.
+        function may be called several times if another process updates the cached model concurrently
+        """
+        if self._cache_client is not None:
+            _updated = {}
+
+            def _apply(cached):
+                _model = json.loads(cached) if cached else None
+                if (
+                    _model is None
+                    or _model.get("refreshed_at", 0) < self._model["refreshed_at"]
+                ):
+                    _model = copy.deepcopy(self._model)
+                _updated["result"] = function(_model)
+                _updated["model"] = _model
+                return json.dumps(_model)
+
+            try:
+                _q = self._cache_client.atomic_update(
+                    key=RI_COVERAGE_CACHE_KEY,
+                    function=_apply,
+                    ex=self.refresh_interval * 2,
+                )
+                if _q.success:
+                    self._model = _updated["model"]
+                    return _updated["result"]
+                logger.warning(f"Unable to save RI coverage to cache: {_q.message}")
+            except Exception as err:
+                logger.warning(f"Unable to save RI coverage to cache: {err}")
+
+        return function(self._model)
+
+    def refresh(self):
+        """
+        Rebuild running and reserved counts for all instance types
+        """
+        _start = time.perf_counter()
+        _ec2 = get_boto(service_name="ec2").message
+        _running = {}
+        _job_ids = set()
+        for _page in _ec2.get_paginator("describe_instances").paginate(
+            Filters=[{"Name": "instance-state-name", "Values": list(RUNNING_STATES)}]
+        ):
+            for _reservation in _page["Reservations"]:
+                for _instance in _reservation["Instances"]:
+                    for _tag in _instance.get("Tags", []):
+                        if _tag["Key"] == "soca:JobId":
+                            _job_ids.add(_tag["Value"])
+                    # Spot instances are not covered by RIs
+                    if _instance.get("InstanceLifecycle") == "spot":
+                        continue
+                    _running[_instance["InstanceType"]] = (
+                        _running.get(_instance["InstanceType"], 0) + 1
+                    )
+
+        _reserved = {}
+        for _reserved_instance in _ec2.describe_reserved_instances(
+            Filters=[{"Name": "state", "Values": ["active"]}]
+        )["ReservedInstances"]:
+            _reserved[_reserved_instance["InstanceType"]] = (
+                _reserved.get(_reserved_instance["InstanceType"], 0)
+                + _reserved_instance["InstanceCount"]
+            )
+
+        def _refresh(model):
+            model["running"] = _running
+            model["reserved"] = _reserved
+            # Instances of these bookings are now counted as running, a job booking several instance types uses <job_id>/<instance_type> keys
+            model["bookings"] = {
+                _key: _booking
+                for _key, _booking in model["bookings"].items()
+                if _key.split("/")[0] not in _job_ids
+            }
+            model["refreshed_at"] = time.time()
+
+        with self._lock:
+            self._update(_refresh)
+        logger.info(
+            f"Refreshed RI coverage in {time.perf_counter() - _start:.2f}s: {len(_running)} instance types running, {len(_reserved)} instance types reserved"
+        )
+
+    def _ensure_fresh(self):
+        self._load_from_cache()
+        if time.time() - self._model["refreshed_at"] > self.refresh_interval:
+            self.refresh()
+
+    @staticmethod
+    def _check(model, instance_type, instance_count):
+        _running = model["running"].get(instance_type, 0)
+        _reserved = model["reserved"].get(instance_type, 0)
+        _now = time.time()
+        _booked = sum(
+            _booking["count"]
+            for _booking in model["bookings"].values()
+            if _booking["instance_type"] == instance_type
+            and _booking["expires_at"] > _now
+        )
+        _result = {"running": _running, "reserved": _reserved, "booked": _booked}
+        if _running + _booked + int(instance_count) > _reserved:
+            _result["success"] = False
+            _result["message"] = (
+                f"Not enough RI to cover for this job. Instance type: {instance_type}, number of running instances: {_running}, number of instances being provisioned: {_booked}, number of purchased RIs: {_reserved}, capacity requested: {instance_count}. Either purchase more RI or allow usage of On Demand"
+            )
+        else:
+            _result["success"] = True
+            _result["message"] = (
+                f"{instance_count} {instance_type} can be covered by RI"
+            )
+        return _result
+
+    def can_fit(self, instance_type, instance_count):
+        """
+        Return {"success": True/False, "message", "running", "reserved", "booked"}, success is True when
+        instance_count more instance_type are covered by active RIs
+        """
+        with self._lock:
+            self._ensure_fresh()
+            return self._check(self._model, instance_type, instance_count)
+
+    def book(self, booking_id, instance_type, instance_count):
+        """
+        Same as can_fit() but also books the RI coverage when it succeeds
+        """
+
+        def _book(model):
+            _result = self._check(model, instance_type, instance_count)
+            if _result["success"] is True:
+                _now = time.time()
+                model["bookings"] = {
+                    _k: _v
+                    for _k, _v in model["bookings"].items()
+                    if _v["expires_at"] > _now
+                }
+                _booking = model["bookings"].get(booking_id)
+                # A job can book several instance types
+                _key = (
+                    booking_id
+                    if _booking is None or _booking["instance_type"] == instance_type
+                    else f"{booking_id}/{instance_type}"
+                )
+                model["bookings"][_key] = {
+                    "instance_type": instance_type,
+                    "count": int(instance_count),
+                    "expires_at": _now + self.booking_ttl,
+                }
+            return _result
+
+        with self._lock:
+            self._ensure_fresh()
+            return self._update(_book)
+
+    def release(self, booking_id):
+        """
+        Cancel all bookings of booking_id, e.g. when the capacity could not be provisioned
+        """
+
+        def _release(model):
+            model["bookings"] = {
+                _k: _v
+                for _k, _v in model["bookings"].items()
+                if _k != booking_id and not _k.startswith(f"{booking_id}/")
+            }
+
+        with self._lock:
+            self._update(_release)
+
+
+_ri_coverage = None
+
+
+def get_ri_coverage():
+    """
+    Return the RICoverage shared by the current process
+    """
+    global _ri_coverage
+    if _ri_coverage is None:
+        _ri_coverage = RICoverage()
+    return _ri_coverage
@@ -16,6 +16,7 @@ import getpass
 import json
 import subprocess
 import sys
+import time
 import yaml
 import os
 import hashlib
@@ -23,21 +24,470 @@ from datetime import datetime
 from utils.cast import SocaCastEngine
 from prettytable import PrettyTable
 
+QSTAT_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+DESKTOP_QUEUES = ["desktop"]
 
-def run_command(cmd):
-    try:
-        command = subprocess.Popen(
-            cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+
+def get_queue_parameter_values(queue_name, queue_settings_file):
+    """
+    Return the default job parameters configured in queue_mapping.yml for the queue type owning queue_name
+    """
+    queue_parameter_values = {}
+    with open(queue_settings_file, "r") as stream_resource_mapping:
+        docs = yaml.safe_load_all(stream_resource_mapping)
+        for doc in docs:
+            for items in doc.values():
+                for _type, info in items.items():
+                    if queue_name in info["queues"]:
+                        for parameter_key, parameter_value in info.items():
+                            queue_parameter_values[parameter_key] = parameter_value
+
+    return queue_parameter_values
+
+
+def get_job_id_hash(instance_type, instance_ami, ht_support, job_queue, spot_price):
+    h = hashlib.sha256()
+    if spot_price is False:
+        t = (instance_type, instance_ami, ht_support, job_queue, "false")
+    else:
+        t = (instance_type, instance_ami, ht_support, job_queue, spot_price)
+    for item in t:
+        h.update(item.encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_job_info(
+    job_id, job_data, queue_parameter_values, scaling_mode, job_order, wide=False
+):
+    """
+    Convert a raw qstat job into a socaqstat job entry
+    """
+    # Reset important parameters to queue parameters, job resources take precedence
+    instance_type = job_data["Resource_List"].get(
+        "instance_type", queue_parameter_values.get("instance_type")
+    )
+    ht_support = job_data["Resource_List"].get(
+        "ht_support", queue_parameter_values.get("ht_support")
+    )
+    instance_ami = job_data["Resource_List"].get(
+        "instance_ami", queue_parameter_values.get("instance_ami")
+    )
+    spot_price = job_data["Resource_List"].get(
+        "spot_price", queue_parameter_values.get("spot_price", False)
+    )
+    terminate_when_idle = queue_parameter_values.get("terminate_when_idle")
+    job_owner = job_data["Job_Owner"].split("@")[0]
+    job_queue = job_data["queue"]
+    job_state = job_data["job_state"]
+
+    if "exec_vnode" in job_data.keys():
+        if wide is True:
+            exec_vnode = job_data["exec_vnode"]
+        else:
+            exec_vnode = job_data["exec_vnode"].split("+")[0]
+    else:
+        exec_vnode = "-"
+
+    if job_state.lower() != "r":
+        stime = "-"
+        stime_epoch = "-"
+    else:
+        stime = job_data["stime"]
+        stime_epoch = (datetime.strptime(stime, QSTAT_TIME_FORMAT)).strftime("%s")
+
+    job_info = {"get_job_id": job_id}
+    if scaling_mode == "multiple_jobs":
+        job_info["get_job_instance_type"] = instance_type
+        job_info["get_job_ht_support"] = ht_support
+        job_info["get_job_spot_price"] = spot_price
+        job_info["get_job_id_hash"] = get_job_id_hash(
+            instance_type=instance_type,
+            instance_ami=instance_ami,
+            ht_support=ht_support,
+            job_queue=job_queue,
+            spot_price=spot_price,
         )
-        stdout, stderr = command.communicate()
-        _cast_tags = SocaCastEngine(data=stdout.decode("utf-8")).as_json()
-        if _cast_tags.get("success") is False:
-            print(f"Unable to parse qstat output due to {_cast_tags.get("message")}")
-            exit(1)
+
+    job_info.update(
+        {
+            "get_job_queue_name": job_queue,
+            "get_job_owner": job_owner,
+            "get_job_state": job_state,
+            "get_execution_hosts": exec_vnode,
+            "get_job_name": job_data["Job_Name"],
+            "get_job_nodect": job_data["Resource_List"]["nodect"],
+            "get_job_ncpus": job_data["Resource_List"]["ncpus"],
+            "get_job_start_time": stime,
+            "get_job_start_time_epoch": stime_epoch,
+            "get_job_queue_time": job_data["qtime"],
+            "get_job_queue_time_epoch": (
+                datetime.strptime(job_data["qtime"], QSTAT_TIME_FORMAT)
+            ).strftime("%s"),
+            "get_job_project": job_data["project"],
+            "get_job_submission_directory": job_data["Variable_List"][
+                "PBS_O_WORKDIR"
+            ],
+            # copy as consumers such as the dispatcher can update the resource list of a job
+            "get_job_resource_list": dict(job_data["Resource_List"]),
+            "get_job_order_in_queue": job_order,
+        }
+    )
+    if scaling_mode == "multiple_jobs":
+        job_info["get_job_terminate_when_idle"] = terminate_when_idle
+
+    return job_info
+
+
+class QstatSnapshot:
+    """
+    In-process view of all PBS jobs built from a single "qstat -f -F json" call.
+    Jobs are parsed once and indexed by queue, state, owner and (for multiple_jobs queues) job hash,
+    so a dispatcher cycle can serve every queue from the same snapshot instead of running socaqstat for each queue.
+    Call refresh() to fetch a new snapshot at the beginning of the next cycle.
+    """
+
+    def __init__(self, qstat_bin="/opt/pbs/bin/qstat", qstat_output=None):
+        self.qstat_bin = qstat_bin
+        self.refresh(qstat_output=qstat_output)
+
+    def refresh(self, qstat_output=None):
+        """
+        Run qstat once (unless qstat_output is provided) and rebuild all indexes.
+        On qstat failure the snapshot is empty and error contains the reason.
+        """
+        self.error = None
+        self.jobs = {}
+        self.jobs_by_queue = {}
+        self.jobs_by_state = {}
+        self.jobs_by_owner = {}
+        self.jobs_by_hash = {}
+        if qstat_output is None:
+            qstat_output = self.run_qstat()
+
+        self.created_at = time.time()
+        # qstat order is preserved in every index as it defines the job order in queue
+        for job, job_data in qstat_output.get("Jobs", {}).items():
+            self.index_job(job=job, job_data=job_data)
+
+    def run_qstat(self, job_ids=None):
+        """
+        Return the parsed "qstat -f -F json" output, for all jobs or only for job_ids.
+        Return an empty dict and set error if qstat output cannot be parsed.
+        """
+        try:
+            _qstat = subprocess.run(
+                [self.qstat_bin, "-f", "-F", "json"] + (job_ids or []),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if job_ids is None else subprocess.DEVNULL,
+            )
+            if job_ids and not _qstat.stdout.strip():
+                # None of the requested jobs exist anymore
+                return {}
+
+            _cast_tags = SocaCastEngine(data=_qstat.stdout.decode("utf-8")).as_json()
+            if _cast_tags.get("success") is False:
+                self.error = (
+                    f"Unable to parse qstat output due to {_cast_tags.get('message')}"
+                )
+                return {}
+            else:
+                return _cast_tags.get("message")
+        except Exception as err:
+            self.error = f"Unable to run {self.qstat_bin} due to {err}"
+            return {}
+
+    def index_job(self, job, job_data):
+        """
+        Add or update a job in all indexes. An updated job keeps its position in queue unless it moved to another queue
+        """
+        try:
+            job_queue = job_data["queue"]
+            job_state = job_data["job_state"]
+            job_owner = job_data["Job_Owner"].split("@")[0]
+        except Exception as err:
+            print(f"Unable to index {job} due to {err}")
+            return False
+
+        if job in self.jobs.keys():
+            if self.jobs[job]["queue"] != job_queue:
+                self.unindex_job(job)
+            else:
+                # state and owner indexes are not ordered, a job can move from one key to another
+                self.jobs_by_state[self.jobs[job]["job_state"].lower()].pop(job, None)
+                self.jobs_by_owner[self.jobs[job]["Job_Owner"].split("@")[0]].pop(
+                    job, None
+                )
+
+        self.jobs[job] = job_data
+        # indexes are dict used as ordered sets
+        self.jobs_by_queue.setdefault(job_queue, {})[job] = None
+        self.jobs_by_state.setdefault(job_state.lower(), {})[job] = None
+        self.jobs_by_owner.setdefault(job_owner, {})[job] = None
+        return True
+
+    def unindex_job(self, job):
+        """
+        Remove a job from all indexes
+        """
+        job_data = self.jobs.pop(job, None)
+        if job_data is None:
+            return
+
+        for index, key in (
+            (self.jobs_by_queue, job_data["queue"]),
+            (self.jobs_by_state, job_data["job_state"].lower()),
+            (self.jobs_by_owner, job_data["Job_Owner"].split("@")[0]),
+        ):
+            index.get(key, {}).pop(job, None)
+
+    def get_jobs(self, queue=None, state=None, owner=None):
+        """
+        Return the raw qstat jobs (in qstat order) matching all the specified filters
+        """
+        if queue is not None:
+            jobs = list(self.jobs_by_queue.get(queue, {}).keys())
         else:
-            return _cast_tags.get("message")
-    except subprocess.CalledProcessError as _e:
-        exit(1)
+            jobs = list(self.jobs.keys())
+
+        if state is not None:
+            _state_jobs = self.jobs_by_state.get(state.lower(), {})
+            jobs = [job for job in jobs if job in _state_jobs]
+
+        if owner is not None:
+            _owner_jobs = self.jobs_by_owner.get(owner, {})
+            jobs = [job for job in jobs if job in _owner_jobs]
+
+        return {job: self.jobs[job] for job in jobs}
+
+    def get_jobs_infos(
+        self,
+        queue=None,
+        queue_parameter_values=None,
+        user="all",
+        state=None,
+        job=None,
+        desktop=False,
+        wide=False,
+    ):
+        """
+        Return the same structure as "socaqstat.py -f json", built from the snapshot.
+        user=None keeps the CLI default and only returns jobs owned by the current user.
+        """
+        if queue_parameter_values is None:
+            queue_parameter_values = {}
+
+        scaling_mode = queue_parameter_values.get("scaling_mode", "single_job")
+        dict_output = {}
+        job_order = 0
+        if user is None:
+            owner = getpass.getuser()
+        elif user == "all":
+            owner = None
+        else:
+            owner = user
+
+        for job_name, job_data in self.get_jobs(
+            queue=queue, state=state, owner=owner
+        ).items():
+            try:
+                job_id = job_name.split(".")[0]
+                if job is not None and job != job_id:
+                    continue
+
+                if user is None and not desktop and job_data["queue"] in DESKTOP_QUEUES:
+                    # If job belongs to user, ignore only if desktop GUI and --desktop is not set
+                    continue
+
+                job_info = build_job_info(
+                    job_id=job_id,
+                    job_data=job_data,
+                    queue_parameter_values=queue_parameter_values,
+                    scaling_mode=scaling_mode,
+                    job_order=job_order + 1,
+                    wide=wide,
+                )
+                job_order += 1
+                if scaling_mode == "multiple_jobs":
+                    job_id_hash = job_info["get_job_id_hash"]
+                    self.jobs_by_hash.setdefault(job_id_hash, {})[job_id] = job_info
+                    if job_id_hash in dict_output.keys():
+                        dict_output[job_id_hash][job_id] = job_info
+                    else:
+                        dict_output[job_id_hash] = {job_id: job_info}
+                else:
+                    dict_output[job_id] = job_info
+
+            except Exception as err:
+                print(err)
+                pass
+
+        return dict_output
+
+    def get_jobs_by_hash(self, job_id_hash):
+        """
+        Return the jobs sharing the same job hash. Only populated for multiple_jobs queues already returned by get_jobs_infos
+        """
+        return self.jobs_by_hash.get(job_id_hash, {})
+
+
+class QstatJobTracker(QstatSnapshot):
+    """
+    QstatSnapshot kept up to date by tailing the PBS accounting logs instead of running a full qstat every cycle.
+    Each refresh() reads the accounting records written since the previous call and only queries qstat for the jobs
+    which changed (queued, started, altered, moved ...). Ended/deleted jobs are removed from the indexes.
+    A full qstat resync is done every resync_interval seconds, or when the accounting logs cannot be read.
+    Use invalidate() to refresh a job updated by the caller (e.g: qalter) during the next refresh().
+    """
+
+    # Accounting records which require to fetch the job again
+    UPDATE_RECORDS = ["Q", "S", "R", "T", "M", "C", "a"]
+    # Accounting records for jobs which are no longer in the queue
+    DELETE_RECORDS = ["E", "D", "A"]
+    # qstat is called with a batch of job ids to keep the command line size reasonable
+    QSTAT_BATCH_SIZE = 200
+
+    def __init__(
+        self,
+        qstat_bin="/opt/pbs/bin/qstat",
+        accounting_log_path="/var/spool/pbs/server_priv/accounting/",
+        resync_interval=300,
+    ):
+        self.accounting_log_path = accounting_log_path
+        self.resync_interval = resync_interval
+        self.last_resync = 0
+        self.pending_jobs = set()
+        # short job id (e.g: 123) -> full job id (e.g: 123.<pbs_server>)
+        self.short_job_ids = {}
+        self._log_file = None
+        self._log_offset = 0
+        super().__init__(qstat_bin=qstat_bin)
+
+    def refresh(self, qstat_output=None):
+        """
+        Apply the accounting log deltas since the last refresh, or do a full qstat resync when needed.
+        """
+        if (
+            qstat_output is not None
+            or time.time() - self.last_resync >= self.resync_interval
+        ):
+            self.resync(qstat_output=qstat_output)
+            return
+
+        records = self.read_accounting_records()
+        if records is None:
+            self.resync()
+            return
+
+        self.error = None
+        self.jobs_by_hash = {}
+        for record_type, job in records:
+            if record_type in self.DELETE_RECORDS:
+                self.pending_jobs.discard(job)
+                self.unindex_job(job)
+            elif record_type in self.UPDATE_RECORDS:
+                self.pending_jobs.add(job)
+
+        pending_jobs = sorted(self.pending_jobs)
+        for i in range(0, len(pending_jobs), self.QSTAT_BATCH_SIZE):
+            job_ids = pending_jobs[i : i + self.QSTAT_BATCH_SIZE]
+            qstat_output = self.run_qstat(job_ids=job_ids)
+            if self.error is not None:
+                self.resync()
+                return
+
+            updated_jobs = qstat_output.get("Jobs", {})
+            for job in job_ids:
+                if job in updated_jobs.keys():
+                    self.index_job(job=job, job_data=updated_jobs[job])
+                else:
+                    # job already completed
+                    self.unindex_job(job)
+
+        self.pending_jobs = set()
+        self.created_at = time.time()
+
+    def resync(self, qstat_output=None):
+        """
+        Rebuild the whole snapshot with a full qstat.
+        The accounting log position is saved first, records written during the qstat will be applied again at the next refresh().
+        """
+        self.seek_accounting_log_end()
+        self.short_job_ids = {}
+        super().refresh(qstat_output=qstat_output)
+        self.pending_jobs = set()
+        # retry a full resync during the next refresh if qstat failed
+        self.last_resync = time.time() if self.error is None else 0
+
+    def index_job(self, job, job_data):
+        if not super().index_job(job=job, job_data=job_data):
+            return False
+        self.short_job_ids[job.split(".")[0]] = job
+        return True
+
+    def unindex_job(self, job):
+        super().unindex_job(job)
+        self.short_job_ids.pop(job.split(".")[0], None)
+
+    def invalidate(self, job):
+        """
+        Flag a job to be fetched again during the next refresh().
+        job can be a short job id (e.g: 123 instead of 123.<pbs_server>) as used by the dispatcher qalter commands.
+        """
+        self.pending_jobs.add(self.short_job_ids.get(job, job))
+
+    def get_accounting_log_file(self):
+        # accounting logs are rotated daily by PBS using the server local time
+        return os.path.join(self.accounting_log_path, datetime.now().strftime("%Y%m%d"))
+
+    def seek_accounting_log_end(self):
+        self._log_file = self.get_accounting_log_file()
+        try:
+            self._log_offset = os.path.getsize(self._log_file)
+        except OSError:
+            # No accounting records yet for today
+            self._log_offset = 0
+
+    def read_accounting_records(self):
+        """
+        Return the list of (record_type, job_id) written since the last call.
+        Return None if the accounting logs cannot be tailed (missing permissions, truncated log ...)
+        """
+        log_file = self.get_accounting_log_file()
+        if self._log_file is not None and self._log_file != log_file:
+            # Day changed, finish to read the previous log first
+            log_files = [(self._log_file, self._log_offset), (log_file, 0)]
+        else:
+            log_files = [(log_file, self._log_offset)]
+
+        records = []
+        for _log_file, _log_offset in log_files:
+            try:
+                if os.path.getsize(_log_file) < _log_offset:
+                    print(f"{_log_file} has been truncated")
+                    return None
+
+                with open(_log_file, "rb") as accounting_log:
+                    accounting_log.seek(_log_offset)
+                    content = accounting_log.read()
+            except FileNotFoundError:
+                content = b""
+            except Exception as err:
+                print(f"Unable to read {_log_file} due to {err}")
+                return None
+
+            # Only process complete lines, a partial line will be read again during the next call
+            content = content[: content.rfind(b"\n") + 1]
+            for line in content.decode("utf-8", errors="replace").splitlines():
+                # <timestamp>;<record_type>;<job_id>;<message>
+                data = line.split(";", 3)
+                if data.__len__() != 4:
+                    continue
+                records.append((data[1], data[2]))
+
+            self._log_file = _log_file
+            self._log_offset = _log_offset + len(content)
+
+        return records
 
 
 if __name__ == "__main__":
@@ -64,12 +514,10 @@ if __name__ == "__main__":
     )
     parser.add_argument("-f", "--format", nargs="?", help="json format")
     arg = parser.parse_args()
-    qstat_output = run_command("/opt/pbs/bin/qstat -f -F json")
-    desktop_queue = ["desktop"]
-    job_id_order = []
-    output = []
-    dict_output = {}
-    job_order = 0
+    jobs_snapshot = QstatSnapshot()
+    if jobs_snapshot.error is not None:
+        print(jobs_snapshot.error)
+        sys.exit(1)
 
     # Retrieve Default Queue parameters
     queue_settings_file = (
@@ -77,17 +525,10 @@ if __name__ == "__main__":
         + os.environ["SOCA_CLUSTER_ID"]
         + "/cluster_manager/orchestrator/settings/queue_mapping.yml"
     )
-    queue_parameter_values = {}
     try:
-        stream_resource_mapping = open(queue_settings_file, "r")
-        docs = yaml.safe_load_all(stream_resource_mapping)
-        for doc in docs:
-            for items in doc.values():
-                for _type, info in items.items():
-                    if arg.queue in info["queues"]:
-                        for parameter_key, parameter_value in info.items():
-                            queue_parameter_values[parameter_key] = parameter_value
-            stream_resource_mapping.close()
+        queue_parameter_values = get_queue_parameter_values(
+            queue_name=arg.queue, queue_settings_file=queue_settings_file
+        )
     except Exception as err:
         print(f"Unable to read {queue_settings_file} with error: {err}")
         sys.exit(1)
@@ -134,163 +575,19 @@ if __name__ == "__main__":
             ]
         )
 
-    if "Jobs" not in qstat_output.keys():
+    if not jobs_snapshot.jobs:
         print("INFO: No jobs detected.")
         sys.exit(0)
 
-    for job, job_data in qstat_output["Jobs"].items():
-        try:
-            # Reset important parameters to queue parameters
-            if "instance_type" in queue_parameter_values.keys():
-                instance_type = queue_parameter_values["instance_type"]
-
-            if "ht_support" in queue_parameter_values.keys():
-                ht_support = queue_parameter_values["ht_support"]
-
-            if "instance_ami" in queue_parameter_values.keys():
-                instance_ami = queue_parameter_values["instance_ami"]
-
-            if "spot_price" in queue_parameter_values.keys():
-                spot_price = queue_parameter_values["spot_price"]
-            else:
-                spot_price = False
-
-            if "terminate_when_idle" in queue_parameter_values.keys():
-                terminate_when_idle = queue_parameter_values["terminate_when_idle"]
-
-            ignore = False
-            job_id = job.split(".")[0]
-            job_owner = job_data["Job_Owner"].split("@")[0]
-            job_queue = job_data["queue"]
-            job_state = job_data["job_state"]
-            if "instance_type" in job_data["Resource_List"].keys():
-                instance_type = job_data["Resource_List"]["instance_type"]
-            if "ht_support" in job_data["Resource_List"].keys():
-                ht_support = job_data["Resource_List"]["ht_support"]
-            if "spot_price" in job_data["Resource_List"].keys():
-                spot_price = job_data["Resource_List"]["spot_price"]
-            if "instance_ami" in job_data["Resource_List"].keys():
-                instance_ami = job_data["Resource_List"]["instance_ami"]
-
-            if arg.user is None:
-                if job_owner != getpass.getuser():
-                    # When arg.user is specified, ignore all jobs which don't match the requested user owner
-                    ignore = True
-                else:
-                    # If job belongs to user, ignore only if desktop GUI and --desktop is not set
-                    if arg.desktop is None:
-                        if job_queue in desktop_queue:
-                            ignore = True
-            else:
-                if arg.user == "all":
-                    pass
-                else:
-                    if job_owner != arg.user:
-                        # When arg.user is specified, ignore all jobs which don't match the requested user owner
-                        ignore = True
-
-            if arg.queue is not None:
-                if arg.queue != job_queue:
-                    ignore = True
-
-            if arg.state is not None:
-                if arg.state.lower() != job_state.lower():
-                    ignore = True
-
-            if arg.job is not None:
-                if arg.job != job_id:
-                    ignore = True
-
-            if "exec_vnode" in job_data.keys():
-                if arg.wide is True:
-                    exec_vnode = job_data["exec_vnode"]
-                else:
-                    exec_vnode = job_data["exec_vnode"].split("+")[0]
-            else:
-                exec_vnode = "-"
-
-            if job_state.lower() != "r":
-                stime = "-"
-                stime_epoch = "-"
-            else:
-                stime = job_data["stime"]
-                stime_epoch = (
-                    datetime.strptime(stime, "%a %b %d %H:%M:%S %Y")
-                ).strftime("%s")
-
-            if scaling_mode == "multiple_jobs":
-                h = hashlib.sha256()
-                if spot_price is False:
-                    t = (instance_type, instance_ami, ht_support, job_queue, "false")
-                else:
-                    t = (instance_type, instance_ami, ht_support, job_queue, spot_price)
-                for item in t:
-                    h.update(item.encode("utf-8"))
-                job_id_hash = h.hexdigest()
-
-            if ignore is False:
-                if scaling_mode == "multiple_jobs":
-                    job_id_order.append(job_id_hash)
-                    job_order += 1
-                    job_info = {
-                        "get_job_id": job_id,
-                        "get_job_instance_type": instance_type,
-                        "get_job_ht_support": ht_support,
-                        "get_job_spot_price": spot_price,
-                        "get_job_id_hash": job_id_hash,
-                        "get_job_queue_name": job_queue,
-                        "get_job_owner": job_owner,
-                        "get_job_state": job_state,
-                        "get_execution_hosts": exec_vnode,
-                        "get_job_name": job_data["Job_Name"],
-                        "get_job_nodect": job_data["Resource_List"]["nodect"],
-                        "get_job_ncpus": job_data["Resource_List"]["ncpus"],
-                        "get_job_start_time": stime,
-                        "get_job_start_time_epoch": stime_epoch,
-                        "get_job_queue_time": job_data["qtime"],
-                        "get_job_queue_time_epoch": (
-                            datetime.strptime(job_data["qtime"], "%a %b %d %H:%M:%S %Y")
-                        ).strftime("%s"),
-                        "get_job_project": job_data["project"],
-                        "get_job_submission_directory": job_data["Variable_List"][
-                            "PBS_O_WORKDIR"
-                        ],
-                        "get_job_resource_list": job_data["Resource_List"],
-                        "get_job_order_in_queue": job_order,
-                        "get_job_terminate_when_idle": terminate_when_idle,
-                    }
-                    if job_id_hash in dict_output.keys():
-                        dict_output[job_id_hash][job_id] = job_info
-                    else:
-                        dict_output[job_id_hash] = {job_id: job_info}
-                else:
-                    job_id_order.append(job_id)
-                    job_order += 1
-                    dict_output[job_id] = {
-                        "get_job_id": job_id,
-                        "get_job_queue_name": job_queue,
-                        "get_job_owner": job_owner,
-                        "get_job_state": job_state,
-                        "get_execution_hosts": exec_vnode,
-                        "get_job_name": job_data["Job_Name"],
-                        "get_job_nodect": job_data["Resource_List"]["nodect"],
-                        "get_job_ncpus": job_data["Resource_List"]["ncpus"],
-                        "get_job_start_time": stime,
-                        "get_job_start_time_epoch": stime_epoch,
-                        "get_job_queue_time": job_data["qtime"],
-                        "get_job_queue_time_epoch": (
-                            datetime.strptime(job_data["qtime"], "%a %b %d %H:%M:%S %Y")
-                        ).strftime("%s"),
-                        "get_job_project": job_data["project"],
-                        "get_job_submission_directory": job_data["Variable_List"][
-                            "PBS_O_WORKDIR"
-                        ],
-                        "get_job_resource_list": job_data["Resource_List"],
-                        "get_job_order_in_queue": job_order,
-                    }
-        except Exception as err:
-            print(err)
-            pass
+    dict_output = jobs_snapshot.get_jobs_infos(
+        queue=arg.queue,
+        queue_parameter_values=queue_parameter_values,
+        user=arg.user,
+        state=arg.state,
+        job=arg.job,
+        desktop=arg.desktop is True,
+        wide=arg.wide is True,
+    )
     if arg.format == "json":
         table_output = dict_output
         print(json.dumps(table_output))
@@ -323,7 +620,7 @@ if __name__ == "__main__":
                             ]
                         )
             else:
-                for _id in job_id_order:
+                for _id in dict_output.keys():
                     table_output.add_row(
                         [
                             dict_output[_id]["get_job_id"],
@@ -0,0 +1,196 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Asynchronous CloudFormation stack submission used by the dispatcher to provision capacity for many jobs at once.
+"""
+
+import copy
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+import add_nodes
+
+logger = logging.getLogger("soca_logger")
+
+THROTTLING_ERROR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "SlowDown",
+)
+
+
+class StackSubmissionPipeline:
+    """
+    Run add_nodes stages on dedicated worker pools:
+    - build: validate parameters, build the template, render the bootstrap scripts and run the capacity checks (add_nodes.build_stack)
+    - upload: upload the bootstrap scripts to S3 (add_nodes.upload_stack_bootstrap)
+    - submit: create the CloudFormation stack (add_nodes.submit_stack)
+    submit() returns immediately a Future resolved with the same dict as add_nodes.main().
+    When S3 or CloudFormation throttle the requests, all workers of the stage pause with an exponential backoff (shared across threads) before retrying.
+
+    example:
+        pipeline = get_submission_pipeline()
+        future = pipeline.submit(**job_parameter_values)
+        future.result()
+        -> {"success": True, "stack_name": "soca-cluster-job-123", "compute_node": "job123"}
+    """
+
+    def __init__(
+        self,
+        build_workers=4,
+        upload_workers=8,
+        submit_workers=4,
+        max_attempts=6,
+        base_backoff=1,
+        max_backoff=30,
+    ):
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._pools = {
+            "build": ThreadPoolExecutor(
+                max_workers=build_workers, thread_name_prefix="stack-build"
+            ),
+            "upload": ThreadPoolExecutor(
+                max_workers=upload_workers, thread_name_prefix="stack-upload"
+            ),
+            "submit": ThreadPoolExecutor(
+                max_workers=submit_workers, thread_name_prefix="stack-submit"
+            ),
+        }
+        self._lock = threading.Lock()
+        self._throttled_until = {"upload": 0, "submit": 0}
+        self._metrics = {
+            "submitted": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "throttled": 0,
+            "in_flight": 0,
+        }
+
+    def _api_call(self, stage):
+        """
+        Return an api_call(function, **kwargs) wrapper retrying function when AWS throttles the requests
+        """
+
+        def _call(function, **kwargs):
+            for _attempt in range(1, self.max_attempts + 1):
+                _delay = self._throttled_until[stage] - time.time()
+                if _delay > 0:
+                    time.sleep(_delay)
+                try:
+                    return function(**kwargs)
+                except ClientError as err:
+                    _code = err.response["Error"].get("Code")
+                    if (
+                        _code not in THROTTLING_ERROR_CODES
+                        or _attempt == self.max_attempts
+                    ):
+                        raise
+                    _backoff = min(
+                        self.max_backoff, self.base_backoff * 2 ** (_attempt - 1)
+                    ) * random.uniform(0.5, 1)
+                    with self._lock:
+                        self._metrics["throttled"] += 1
+                        self._throttled_until[stage] = max(
+                            self._throttled_until[stage], time.time() + _backoff
+                        )
+                    logger.warning(
+                        f"{stage} stage throttled ({_code}), retrying in {_backoff:.2f}s"
+                    )
+
+        return _call
+
+    def _run_stage(self, stage, function, future, *args, **kwargs):
+        """
+        Run function on the stage pool, return its result or resolve future with the error and return None
+        """
+        try:
+            _result = function(*args, **kwargs)
+        except Exception as err:
+            _result = add_nodes.return_message(f"{stage} stage failed: {err}")
+        if _result["success"] is False:
+            self._complete(future, _result)
+            return None
+        return _result
+
+    def _complete(self, future, result):
+        with self._lock:
+            self._metrics["in_flight"] -= 1
+            self._metrics["succeeded" if result["success"] else "failed"] += 1
+        future.set_result(result)
+
+    def _build(self, future, job_parameters):
+        _build = self._run_stage(
+            "build", add_nodes.build_stack, future, **job_parameters
+        )
+        if _build is not None:
+            self._pools["upload"].submit(self._upload, future, _build["stack"])
+
+    def _upload(self, future, stack):
+        _upload = self._run_stage(
+            "upload",
+            add_nodes.upload_stack_bootstrap,
+            future,
+            stack,
+            api_call=self._api_call("upload"),
+        )
+        if _upload is not None:
+            self._pools["submit"].submit(self._submit, future, stack)
+
+    def _submit(self, future, stack):
+        _submit = self._run_stage(
+            "submit",
+            add_nodes.submit_stack,
+            future,
+            stack,
+            api_call=self._api_call("submit"),
+        )
+        if _submit is not None:
+            self._complete(future, _submit)
+
+    def submit(self, **job_parameters):
+        """
+        Queue the provisioning of a job capacity, return a Future resolved with the add_nodes.main() result
+        """
+        _future = Future()
+        with self._lock:
+            self._metrics["submitted"] += 1
+            self._metrics["in_flight"] += 1
+        # Caller may re-use its job parameters dict for the next job
+        self._pools["build"].submit(self._build, _future, copy.deepcopy(job_parameters))
+        return _future
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+
+_submission_pipeline = None
+
+
+def get_submission_pipeline():
+    """
+    Return the StackSubmissionPipeline shared by the current process (the dispatcher keeps it across scheduling cycles)
+    """
+    global _submission_pipeline
+    if _submission_pipeline is None:
+        _submission_pipeline = StackSubmissionPipeline()
+    return _submission_pipeline
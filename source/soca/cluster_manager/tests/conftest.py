@@ -0,0 +1,26 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import os
+import sys
+
+# cluster_manager modules are imported the same way as on the controller: "from utils..." for the shared helpers and
+# sibling imports for the orchestrator scripts. The PBS hooks import cluster_hooks/hook_support.py from its directory
+_cluster_manager = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in (
+    _cluster_manager,
+    os.path.join(_cluster_manager, "orchestrator"),
+    os.path.join(os.path.dirname(_cluster_manager), "cluster_hooks"),
+):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
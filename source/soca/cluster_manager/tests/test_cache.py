@@ -0,0 +1,256 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+import redis
+
+from utils import cache
+from utils.aws import ec2_helper, ec2_pricing_index
+from utils.response import SocaResponse
+
+
+class FakeCacheClient:
+    """
+    Remote tier shared by all the "processes" of a test
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        if key in self.data:
+            return SocaResponse(success=True, message=self.data[key].encode("utf-8"))
+        return SocaResponse(success=False, message="CACHE_MISS")
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return SocaResponse(success=False, message=f"{key} already exists")
+        self.data[key] = value
+        return SocaResponse(success=True, message=f"Key {key} cached successfully")
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        return SocaResponse(success=True, message=f"Key {key} deleted successfully")
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    _remote = FakeCacheClient()
+    monkeypatch.setattr(cache, "_soca_cached_remote_client", lambda: _remote)
+    return _remote
+
+
+def metrics(namespace):
+    return cache.get_cache_metrics().message.get(namespace, {})
+
+
+def test_local_and_remote_hits(remote):
+    calls = []
+
+    @cache.soca_cached(namespace="tests/hits")
+    def lookup(name):
+        calls.append(name)
+        return {"name": name, "values": [1, 2]}
+
+    assert lookup("a") == {"name": "a", "values": [1, 2]}
+    # returned values are copies, callers can't alter the cached value
+    lookup("a")["values"].append(3)
+    assert lookup("a") == {"name": "a", "values": [1, 2]}
+    # another process only has the remote tier
+    lookup.cache_clear()
+    assert lookup("a") == {"name": "a", "values": [1, 2]}
+    assert calls == ["a"]
+    assert metrics("tests/hits") == {
+        "local_hit": 2,
+        "remote_hit": 1,
+        "negative_hit": 0,
+        "miss": 1,
+        "remote_error": 0,
+    }
+
+    lookup.invalidate("a")
+    lookup("a")
+    assert calls == ["a", "a"]
+
+
+def test_values_changed_by_json_are_only_cached_locally(remote):
+    @cache.soca_cached(namespace="tests/json")
+    def lookup(name):
+        return {"tuple": (1, 2)} if name == "tuple" else {1: name}
+
+    assert lookup("tuple") == {"tuple": (1, 2)}
+    assert lookup("int_key") == {1: "int_key"}
+    assert remote.data == {}
+    assert lookup("tuple") == {"tuple": (1, 2)}
+
+
+def test_negative_results_and_exceptions(remote):
+    calls = []
+
+    @cache.soca_cached(namespace="tests/negative")
+    def lookup(name):
+        calls.append(name)
+        if name == "error":
+            raise RuntimeError("throttled")
+        return SocaResponse(success=False, message=f"{name} not found")
+
+    for _ in range(2):
+        _result = lookup("missing")
+        assert isinstance(_result, SocaResponse)
+        assert _result.success is False
+        assert _result.message == "missing not found"
+        with pytest.raises(RuntimeError):
+            lookup("error")
+    assert calls == ["missing", "error", "error"]
+    assert metrics("tests/negative")["negative_hit"] == 1
+
+
+def test_concurrent_misses_are_computed_once(monkeypatch):
+    monkeypatch.setattr(cache, "_soca_cached_remote_client", lambda: None)
+    calls = []
+    _started = threading.Event()
+    _release = threading.Event()
+
+    @cache.soca_cached(namespace="tests/single_flight")
+    def lookup(name):
+        calls.append(name)
+        _started.set()
+        _release.wait(5)
+        return name
+
+    _results = []
+    _threads = [
+        threading.Thread(target=lambda: _results.append(lookup("a"))) for _ in range(4)
+    ]
+    _threads[0].start()
+    _started.wait(5)
+    for _thread in _threads[1:]:
+        _thread.start()
+    _release.set()
+    for _thread in _threads:
+        _thread.join()
+    assert _results == ["a"] * 4
+    assert calls == ["a"]
+
+
+def test_instance_type_price_lookups_are_shared(remote, monkeypatch):
+    calls = []
+
+    def get_products(ServiceCode, Filters):
+        calls.append(Filters)
+        return {"PriceList": []}
+
+    monkeypatch.setattr(
+        ec2_pricing_index.utils_boto3,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(
+            message=SimpleNamespace(get_products=get_products)
+        ),
+    )
+    ec2_pricing_index.get_instance_type_price.cache_clear()
+    for _ in range(3):
+        ec2_pricing_index.get_instance_type_price(
+            instance_type="c6i.large", region="us-east-1"
+        )
+        ec2_pricing_index.get_instance_type_price.cache_clear()
+    assert len(calls) == 1
+    assert metrics("ec2/instance_type_price")["remote_hit"] >= 2
+
+
+def test_instance_types_by_architecture_is_cached(remote, monkeypatch):
+    class FakeCatalog:
+        calls = 0
+
+        def list_instance_types(self, patterns):
+            FakeCatalog.calls += 1
+            return ["c6i.large", "c7g.large"]
+
+        def get_summary(self, instance_type):
+            return {"architectures": "arm64" if "g." in instance_type else "x86_64"}
+
+    monkeypatch.setattr(ec2_helper, "get_instance_catalog", FakeCatalog)
+    ec2_helper.get_instance_types_by_architecture.cache_clear()
+    for _ in range(2):
+        _result = ec2_helper.get_instance_types_by_architecture(["c6i.*", "c7g.*"])
+        assert _result.success is True
+        assert _result.message == {"x86_64": ["c6i.large"], "arm64": ["c7g.large"]}
+    assert FakeCatalog.calls == 1
+
+
+class FakeRedisPipeline:
+    """
+    WATCH/MULTI/EXEC pipeline, another client writes the values of concurrent_writes between GET and EXEC
+    """
+
+    def __init__(self, data, concurrent_writes):
+        self.data = data
+        self.concurrent_writes = concurrent_writes
+        self.executed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def watch(self, key):
+        self.watched = (key, self.data.get(key))
+        self.commands = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def multi(self):
+        if self.concurrent_writes:
+            self.data[self.watched[0]] = self.concurrent_writes.pop(0)
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    def execute(self):
+        self.executed += 1
+        _key, _value = self.watched
+        if self.data.get(_key) != _value:
+            raise redis.WatchError()
+        for _key, _value in self.commands:
+            self.data[_key] = _value
+
+
+def cache_client(pipeline):
+    _client = object.__new__(cache.SocaCacheClient)
+    _client.cache_key_prefix = "/soca/test/"
+    _client.redis = True
+    _client.ttl_long = 3600
+    _client.cache_client = SimpleNamespace(pipeline=lambda transaction: pipeline)
+    return _client
+
+
+def test_atomic_update_is_retried_on_concurrent_writes():
+    _pipeline = FakeRedisPipeline(data={}, concurrent_writes=["10", "20"])
+    _result = cache_client(_pipeline).atomic_update(
+        key="/counter", function=lambda value: str(int(value or 0) + 1)
+    )
+    assert _result.success is True
+    assert _result.message == "21"
+    assert _pipeline.data == {"/soca/test/counter": "21"}
+    assert _pipeline.executed == 3
+
+    _pipeline = FakeRedisPipeline(data={}, concurrent_writes=["10", "20"])
+    _result = cache_client(_pipeline).atomic_update(
+        key="/counter", function=lambda value: str(int(value or 0) + 1), retries=2
+    )
+    assert _result.success is False
+    assert _pipeline.data == {"/soca/test/counter": "20"}
@@ -0,0 +1,125 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import pytest
+
+import capacity_planner
+
+PRICES = {
+    "c6i.large": {"ondemand": 0.085},
+    "c6i.2xlarge": {"ondemand": 0.34},
+    "c6i.4xlarge": {"ondemand": 0.68},
+}
+
+
+class FakePricingIndex:
+    def __init__(self, prices):
+        self.prices = prices
+
+    def get_price(self, instance_type):
+        return self.prices.get(instance_type, {})
+
+
+@pytest.fixture
+def prices(monkeypatch):
+    _prices = dict(PRICES)
+    monkeypatch.setattr(
+        capacity_planner, "get_pricing_index", lambda: FakePricingIndex(_prices)
+    )
+    return _prices
+
+
+def planner(instance_types=("c6i.large", "c6i.2xlarge")):
+    _specs = {
+        "c6i.large": (2, 4096),
+        "c6i.2xlarge": (8, 16384),
+        "c6i.4xlarge": (16, 32768),
+    }
+    return capacity_planner.CapacityPlanner(
+        instance_types=list(instance_types),
+        weighted_capacity=[_specs[_i][0] for _i in instance_types],
+        memory=[_specs[_i][1] for _i in instance_types],
+    )
+
+
+def job(job_id, ncpus, nodect=1, mem=0):
+    return {"job_id": job_id, "ncpus": ncpus, "nodect": nodect, "mem": mem}
+
+
+def test_small_jobs_share_the_cheapest_instance(prices):
+    plan = planner().plan(jobs=[job("1", 2), job("2", 2), job("3", 2)])
+    # same price per vCPU, larger instances are preferred and right-sized to the jobs they host
+    assert plan["instances"] == {"c6i.2xlarge": 1}
+    assert plan["capacity"] == 8
+    assert plan["jobs"] == ["1", "2", "3"]
+    assert plan["estimated_hourly_cost"] == 0.34
+
+
+def test_single_job_is_right_sized(prices):
+    plan = planner().plan(jobs=[job("1", 2)])
+    assert plan["instances"] == {"c6i.large": 1}
+    assert plan["capacity"] == 2
+
+
+def test_cheaper_per_vcpu_instance_is_preferred(prices):
+    prices["c6i.large"] = {"ondemand": 0.05}
+    plan = planner().plan(jobs=[job("1", 2), job("2", 2)])
+    assert plan["instances"] == {"c6i.large": 2}
+    assert plan["capacity"] == 4
+
+
+def test_job_larger_than_any_instance_is_unschedulable(prices):
+    plan = planner().plan(jobs=[job("1", 16), job("2", 2)])
+    assert plan["unschedulable_jobs"] == ["1"]
+    assert plan["jobs"] == ["2"]
+    assert plan["instances"] == {"c6i.large": 1}
+
+
+def test_job_which_does_not_fit_in_memory_is_unschedulable(prices):
+    plan = planner().plan(jobs=[job("1", 2, mem=32768)])
+    assert plan["unschedulable_jobs"] == ["1"]
+    assert plan["capacity"] == 0
+
+
+def test_multi_node_job_is_split_in_chunks(prices):
+    plan = planner().plan(jobs=[job("1", 12, nodect=2)])
+    # 2 chunks of 6 vCPUs, each one needs its own c6i.2xlarge
+    assert plan["instances"] == {"c6i.2xlarge": 2}
+    assert plan["capacity"] == 16
+
+
+def test_free_nodes_are_used_first(prices):
+    plan = planner().plan(
+        jobs=[job("1", 2), job("2", 2)], free_nodes=[{"ncpus": 2, "mem": 4096}]
+    )
+    assert plan["jobs_on_free_nodes"] == ["1"]
+    assert plan["instances"] == {"c6i.large": 1}
+    assert plan["capacity"] == 2
+
+
+def test_committed_jobs_consume_free_nodes(prices):
+    plan = planner().plan(
+        jobs=[job("2", 2)],
+        free_nodes=[{"ncpus": 2, "mem": 4096}],
+        committed_jobs=[job("1", 2)],
+    )
+    assert plan["jobs_on_free_nodes"] == []
+    assert plan["instances"] == {"c6i.large": 1}
+
+
+def test_unpriced_instance_types_are_planned_by_vcpus(prices):
+    prices.pop("c6i.2xlarge")
+    plan = planner().plan(jobs=[job("1", 2), job("2", 2), job("3", 2)])
+    assert plan["estimated_hourly_cost"] is None
+    assert plan["capacity"] == 8
+    assert plan["jobs"] == ["1", "2", "3"]
@@ -0,0 +1,284 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import base64
+import datetime
+import json
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+import cloudformation_builder
+
+
+@pytest.fixture(autouse=True)
+def instance_catalog(monkeypatch):
+    # Template build only, no EC2 instance catalog lookup
+    monkeypatch.setattr(
+        cloudformation_builder, "is_ebs_optimized", lambda instance_type: True
+    )
+    monkeypatch.setattr(
+        cloudformation_builder, "is_cpu_options_supported", lambda instance_type: True
+    )
+    monkeypatch.setattr(
+        cloudformation_builder,
+        "_skeleton_cache",
+        type(cloudformation_builder._skeleton_cache)(),
+    )
+
+
+def job_params(**overrides):
+    params = {
+        "AdditionalSecurityGroupIds": [],
+        "BaseOS": "amazonlinux2023",
+        "ClusterId": "soca-test",
+        "ComputeNodeInstanceProfileArn": "arn:aws:iam::123456789012:instance-profile/soca-compute",
+        "CoreCount": 1,
+        "CustomIamInstanceProfile": False,
+        "DesiredCapacity": 4,
+        "Efa": False,
+        "FSxLustreConfiguration": {"fsx_lustre": False},
+        "ImageId": "ami-0123456789abcdef0",
+        "InstanceType": ["c6i.large"],
+        "JobId": "123",
+        "JobName": "test-job",
+        "JobOwner": "mcrozes",
+        "JobProject": "cfd",
+        "JobQueue": "normal",
+        "KeepEbs": False,
+        "KeepForever": False,
+        "MaxEfaInterfaces": 0,
+        "MetadataHttpTokens": "required",
+        "MetricCollectionAnonymous": False,
+        "Misc": "",
+        "PlacementGroup": True,
+        "Region": "us-east-1",
+        "RootSize": 10,
+        "ScratchSize": 0,
+        "SecurityGroupId": "sg-0123456789abcdef0",
+        "SolutionMetricsLambda": "arn:aws:lambda:us-east-1:123456789012:function:metrics",
+        "SpotAllocationCount": False,
+        "SpotAllocationStrategy": "capacity-optimized",
+        "SpotFleetIAMRoleArn": "arn:aws:iam::123456789012:role/spotfleet",
+        "SpotPrice": False,
+        "SSHKeyPair": "soca",
+        "StackUUID": "00000001",
+        "SubnetId": ["subnet-0123456789abcdef0", "subnet-0123456789abcdef1"],
+        "TerminateWhenIdle": 0,
+        "ThreadsPerCore": False,
+        "Version": "25.5.0",
+        "VolumeType": "gp3",
+        "VolumeTypeIops": 0,
+        "WeightedCapacity": False,
+    }
+    params.update(overrides)
+    return params
+
+
+def user_data(params):
+    return base64.b64encode(f"#!/bin/bash\necho {params['JobId']}".encode()).decode()
+
+
+def assert_skeleton_matches_full_build(params):
+    _full = cloudformation_builder.build_template(
+        params=params, user_data=user_data(params), use_skeleton=False
+    )
+    _skeleton = cloudformation_builder.build_template(
+        params=params, user_data=user_data(params)
+    )
+    assert json.loads(_skeleton) == json.loads(_full)
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {},
+        {"DesiredCapacity": 1},
+        {"DesiredCapacity": 64},
+        {"JobName": 'quote " backslash \\ tab \t'},
+        {"JobName": "unicode-é-ジョブ"},
+        {"JobName": str(cloudformation_builder.SKELETON_DESIRED_CAPACITY)},
+        {"JobOwner": "@@skeleton:JobId@@"},
+        {"TerminateWhenIdle": 3},
+        {"KeepForever": True},
+        {"SpotPrice": 0.5, "DesiredCapacity": 8},
+        {"SpotPrice": 0.5, "SpotAllocationCount": 2, "DesiredCapacity": 8},
+        {"InstanceType": ["c6i.xlarge", "c5.xlarge"], "WeightedCapacity": [4, 4]},
+        {"PlacementGroup": False},
+        {"Efa": True, "MaxEfaInterfaces": 1},
+    ],
+)
+def test_skeleton_build_matches_full_build(overrides):
+    assert_skeleton_matches_full_build(job_params(**overrides))
+
+
+def test_jobs_of_the_same_shape_share_a_skeleton():
+    for _job_id in range(1, 6):
+        assert_skeleton_matches_full_build(
+            job_params(
+                JobId=str(_job_id),
+                JobName=f"job-{_job_id}",
+                StackUUID=f"{_job_id:08d}",
+                DesiredCapacity=_job_id + 1,
+            )
+        )
+    _metrics = cloudformation_builder.get_skeleton_cache_metrics()
+    assert _metrics["size"] == 1
+
+
+def test_jobs_of_different_shapes_do_not_share_a_skeleton():
+    assert_skeleton_matches_full_build(job_params(RootSize=10))
+    assert_skeleton_matches_full_build(job_params(RootSize=20))
+    assert cloudformation_builder.get_skeleton_cache_metrics()["size"] == 2
+
+
+def test_prioritized_instance_types_use_a_prioritized_on_demand_fleet():
+    _template = json.loads(
+        cloudformation_builder.build_template(
+            params=job_params(
+                InstanceType=["c6i.2xlarge", "c6i.large"],
+                WeightedCapacity=[8, 2],
+                PrioritizedInstanceTypes=True,
+            ),
+            user_data=user_data(job_params()),
+            use_skeleton=False,
+        )
+    )
+    _fleet = [
+        _resource["Properties"]
+        for _resource in _template["Resources"].values()
+        if _resource["Type"] == "AWS::EC2::EC2Fleet"
+    ][0]
+    assert _fleet["OnDemandOptions"] == {"AllocationStrategy": "prioritized"}
+    _overrides = [
+        _override
+        for _config in _fleet["LaunchTemplateConfigs"]
+        for _override in _config["Overrides"]
+    ]
+    assert {
+        (_override["InstanceType"], _override["Priority"]) for _override in _overrides
+    } == {("c6i.2xlarge", 0.0), ("c6i.large", 1.0)}
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        # key: LastModified
+        self.objects = dict(objects or {})
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(("head_object", Key))
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append(("put_object", Key))
+        self.objects[Key] = datetime.datetime.now(datetime.timezone.utc)
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(
+            paginate=lambda Bucket, Prefix: [
+                {
+                    "Contents": [
+                        {"Key": _key, "LastModified": _last_modified}
+                        for _key, _last_modified in self.objects.items()
+                        if _key.startswith(Prefix)
+                    ]
+                }
+            ]
+        )
+
+    def delete_objects(self, Bucket, Delete):
+        self.calls.append(("delete_objects", len(Delete["Objects"])))
+        for _object in Delete["Objects"]:
+            self.objects.pop(_object["Key"])
+        return {}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    _s3 = FakeS3()
+    monkeypatch.setattr(
+        cloudformation_builder,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=_s3),
+    )
+    monkeypatch.setattr(cloudformation_builder, "_uploaded_bootstrap_scripts", set())
+    return _s3
+
+
+def bootstrap_scripts(stack_name):
+    _folder = cloudformation_builder.get_bootstrap_s3_folder("soca-test")
+    return [
+        {
+            "name": "install_required_packages.sh",
+            "bucket": "bucket",
+            "key": f"{_folder}/content/abc/install_required_packages.sh",
+            "body": "#!/bin/bash",
+            "content_addressed": True,
+        },
+        {
+            "name": "02_setup.sh",
+            "bucket": "bucket",
+            "key": f"{_folder}/{stack_name}/uuid/02_setup.sh",
+            "body": "#!/bin/bash",
+            "content_addressed": False,
+        },
+    ]
+
+
+def test_only_job_independent_scripts_are_content_addressed(s3):
+    for _job_id in ("1", "2"):
+        assert (
+            cloudformation_builder.upload_bootstrap_scripts(
+                bootstrap_scripts(f"soca-test-job-{_job_id}")
+            )["success"]
+            is True
+        )
+    _folder = cloudformation_builder.get_bootstrap_s3_folder("soca-test")
+    assert sorted(s3.calls) == [
+        ("head_object", f"{_folder}/content/abc/install_required_packages.sh"),
+        ("put_object", f"{_folder}/content/abc/install_required_packages.sh"),
+        ("put_object", f"{_folder}/soca-test-job-1/uuid/02_setup.sh"),
+        ("put_object", f"{_folder}/soca-test-job-2/uuid/02_setup.sh"),
+    ]
+
+
+def test_scripts_of_deleted_stacks_are_pruned(s3):
+    _folder = cloudformation_builder.get_bootstrap_s3_folder("soca-test")
+    _old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
+    s3.objects = {
+        f"{_folder}/content/abc/install_required_packages.sh": _old,
+        f"{_folder}/soca-test-job-1/uuid/02_setup.sh": _old,
+        f"{_folder}/soca-test-job-1/uuid/03_setup_post_reboot.sh": _old,
+        f"{_folder}/soca-test-job-2/uuid/02_setup.sh": _old,
+        # uploaded by the stack being created
+        f"{_folder}/soca-test-job-3/uuid/02_setup.sh": datetime.datetime.now(
+            datetime.timezone.utc
+        ),
+        # previous layout, not associated to a stack
+        f"{_folder}/0b6f7c5e/02_setup.sh": _old,
+    }
+    _pruned = cloudformation_builder.prune_bootstrap_scripts(
+        bucket="bucket", cluster_id="soca-test", active_stacks={"soca-test-job-2"}
+    )
+    assert _pruned["success"] is True
+    assert sorted(s3.objects) == [
+        f"{_folder}/0b6f7c5e/02_setup.sh",
+        f"{_folder}/content/abc/install_required_packages.sh",
+        f"{_folder}/soca-test-job-2/uuid/02_setup.sh",
+        f"{_folder}/soca-test-job-3/uuid/02_setup.sh",
+    ]
+    assert s3.calls == [("delete_objects", 2)]
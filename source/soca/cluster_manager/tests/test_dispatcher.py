@@ -0,0 +1,89 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import dispatcher
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    _applied = []
+    monkeypatch.setattr(dispatcher, "capacity_submission_timeout", 0.2)
+    monkeypatch.setattr(dispatcher, "pending_capacity_submissions", [])
+    monkeypatch.setattr(dispatcher, "logpush", lambda *args, **kwargs: None)
+    monkeypatch.setattr(
+        dispatcher,
+        "apply_capacity_submission",
+        lambda submission, future: _applied.append(
+            (submission["job_id"], future.result()["success"], threading.get_ident())
+        ),
+    )
+    return _applied
+
+
+def submission(job_id, success=None):
+    _future = Future()
+    if success is not None:
+        _future.set_result({"success": success})
+    return {"job_id": job_id, "future": _future}
+
+
+def test_submissions_share_a_single_deadline(applied):
+    capacity_submissions = [submission(str(_i)) for _i in range(5)]
+    capacity_submissions.append(submission("5", success=True))
+    _start = time.perf_counter()
+    dispatcher.process_capacity_submissions(capacity_submissions)
+    assert time.perf_counter() - _start < 1
+    assert capacity_submissions == []
+    assert [_a[0] for _a in applied] == ["5"]
+    assert len(dispatcher.pending_capacity_submissions) == 5
+
+
+def test_late_submissions_are_applied_by_the_next_pass(applied):
+    _late = submission("1")
+    _failed = submission("2")
+    dispatcher.process_capacity_submissions([_late, _failed])
+    assert applied == []
+
+    # results set by the StackSubmissionPipeline workers are not applied by them
+    _worker = threading.Thread(
+        target=lambda: (
+            _late["future"].set_result({"success": True}),
+            _failed["future"].set_result({"success": False}),
+        )
+    )
+    _worker.start()
+    _worker.join()
+    assert applied == []
+
+    dispatcher.process_capacity_submissions([submission("3", success=True)])
+    assert applied == [
+        ("1", True, threading.get_ident()),
+        ("2", False, threading.get_ident()),
+        ("3", True, threading.get_ident()),
+    ]
+    assert dispatcher.pending_capacity_submissions == []
+
+
+def test_pending_submissions_can_be_awaited(applied):
+    _late = submission("1")
+    dispatcher.process_capacity_submissions([_late])
+    threading.Timer(0.1, _late["future"].set_result, [{"success": True}]).start()
+    dispatcher.apply_pending_capacity_submissions(timeout=None)
+    assert [_a[0] for _a in applied] == ["1"]
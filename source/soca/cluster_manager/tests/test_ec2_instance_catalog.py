@@ -0,0 +1,164 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import fnmatch
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils.aws import ec2_instance_catalog
+
+
+def instance_type(name, vcpus, architecture="x86_64", current_generation=True):
+    return {
+        "InstanceType": name,
+        "CurrentGeneration": current_generation,
+        "BareMetal": name.endswith(".metal"),
+        "HibernationSupported": False,
+        "VCpuInfo": {"DefaultVCpus": vcpus, "DefaultCores": vcpus // 2},
+        "MemoryInfo": {"SizeInMiB": vcpus * 2048},
+        "ProcessorInfo": {"SupportedArchitectures": [architecture]},
+        "PlacementGroupInfo": {"SupportedStrategies": ["cluster"]},
+        "EbsInfo": {"EbsOptimizedSupport": "default"},
+    }
+
+
+INSTANCE_TYPES = [
+    instance_type("c6i.large", 2),
+    instance_type("c6i.metal", 128),
+    instance_type("c6g.large", 2, architecture="arm64"),
+    instance_type("c4.large", 2, current_generation=False),
+]
+
+
+class FakeEC2:
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    def get_paginator(self, operation):
+        assert operation == "describe_instance_types"
+        return self
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.fail:
+            raise RuntimeError("DescribeInstanceTypes unavailable")
+        _instance_types = INSTANCE_TYPES
+        for _filter in kwargs.get("Filters", []):
+            _instance_types = [
+                _i
+                for _i in _instance_types
+                if any(self._match(_filter["Name"], _i, _v) for _v in _filter["Values"])
+            ]
+        return [{"InstanceTypes": _instance_types}]
+
+    @staticmethod
+    def _match(name, instance, value):
+        if name == "instance-type":
+            return fnmatch.fnmatch(instance["InstanceType"], value)
+        if name == "processor-info.supported-architecture":
+            return value in instance["ProcessorInfo"]["SupportedArchitectures"]
+        if name == "current-generation":
+            return str(instance["CurrentGeneration"]).lower() == value
+        if name == "bare-metal":
+            return str(instance["BareMetal"]).lower() == value
+        raise AssertionError(f"Unexpected filter {name}")
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    _ec2 = FakeEC2()
+    monkeypatch.setattr(
+        ec2_instance_catalog.utils_boto3,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=_ec2),
+    )
+    return _ec2
+
+
+def test_catalog_is_downloaded_once_and_queried_locally(ec2, tmp_path):
+    catalog = ec2_instance_catalog.SocaEC2InstanceCatalog(
+        catalog_path=str(tmp_path / "catalog.db")
+    )
+    assert catalog.list_instance_types(patterns=["c6*"]) == [
+        "c6g.large",
+        "c6i.large",
+        "c6i.metal",
+    ]
+    assert catalog.list_instance_types(
+        architecture="x86_64", current_generation=True, bare_metal=False
+    ) == ["c6i.large"]
+    assert catalog.get_vcpus("c6i.metal") == 128
+    assert catalog.get_architecture("c6g.large") == "arm64"
+    assert len(ec2.calls) == 1
+
+
+def test_list_instance_types_falls_back_to_the_api_without_catalog(ec2, tmp_path):
+    # the catalog can't be written (e.g: cache directory can't be created)
+    (tmp_path / "not_a_directory").write_text("")
+    catalog = ec2_instance_catalog.SocaEC2InstanceCatalog(
+        catalog_path=str(tmp_path / "not_a_directory" / "catalog.db")
+    )
+    assert catalog.list_instance_types(
+        patterns=["c6*"], architecture="x86_64", bare_metal=False
+    ) == ["c6i.large"]
+    assert ec2.calls[-1]["Filters"] == [
+        {"Name": "instance-type", "Values": ["c6*"]},
+        {"Name": "processor-info.supported-architecture", "Values": ["x86_64"]},
+        {"Name": "bare-metal", "Values": ["false"]},
+    ]
+    # instance types returned by the API are not described again
+    _calls = len(ec2.calls)
+    assert catalog.get_vcpus("c6i.large") == 2
+    assert len(ec2.calls) == _calls
+
+
+def test_failed_download_is_not_retried_before_retry_interval(ec2, tmp_path):
+    ec2.fail = True
+    catalog = ec2_instance_catalog.SocaEC2InstanceCatalog(
+        catalog_path=str(tmp_path / "catalog.db"), inode_check_interval=0
+    )
+    with pytest.raises(RuntimeError):
+        # no catalog and the API fallback fails as well
+        catalog.list_instance_types(patterns=["c6*"])
+    # 1 catalog download + 1 API fallback
+    assert len(ec2.calls) == 2
+    ec2.fail = False
+    assert catalog.list_instance_types(patterns=["c6i.*"]) == [
+        "c6i.large",
+        "c6i.metal",
+    ]
+    # served by the API, the catalog download is not retried yet
+    assert len(ec2.calls) == 3
+    assert not os.path.exists(tmp_path / "catalog.db")
+
+    catalog._refresh_failed_at = time.time() - catalog.refresh_retry_interval
+    catalog.list_instance_types(patterns=["c6i.*"])
+    assert os.path.exists(tmp_path / "catalog.db")
+
+
+def test_stale_catalog_refresh_failures_are_not_retried_on_every_query(ec2, tmp_path):
+    catalog = ec2_instance_catalog.SocaEC2InstanceCatalog(
+        catalog_path=str(tmp_path / "catalog.db"), max_age=0, inode_check_interval=0
+    )
+    catalog.refresh()
+    ec2.fail = True
+    for _ in range(5):
+        assert catalog.list_instance_types(patterns=["c6i.large"]) == ["c6i.large"]
+        if catalog._refresh_thread is not None:
+            catalog._refresh_thread.join()
+    # initial download + a single failed background refresh
+    assert len(ec2.calls) == 2
@@ -0,0 +1,223 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import datetime
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils import cache
+from utils.aws import ec2_pricing_index
+
+
+def price_list(instance_type, ondemand, reserved):
+    return json.dumps(
+        {
+            "product": {"attributes": {"instanceType": instance_type}},
+            "terms": {
+                "OnDemand": {
+                    "SKU.1": {
+                        "termAttributes": {},
+                        "priceDimensions": {
+                            "SKU.1.1": {
+                                "description": f"$0.1 per On Demand Linux {instance_type} Instance Hour",
+                                "pricePerUnit": {"USD": str(ondemand)},
+                            }
+                        },
+                    }
+                },
+                "Reserved": {
+                    "SKU.2": {
+                        "termAttributes": {
+                            "OfferingClass": "standard",
+                            "LeaseContractLength": "1yr",
+                            "PurchaseOption": "No Upfront",
+                        },
+                        "priceDimensions": {
+                            "SKU.2.1": {
+                                "description": "Linux/UNIX (Amazon VPC), c6i.large reserved instance applied",
+                                "pricePerUnit": {"USD": str(reserved)},
+                            }
+                        },
+                    },
+                    "SKU.3": {
+                        "termAttributes": {
+                            "OfferingClass": "convertible",
+                            "LeaseContractLength": "3yr",
+                            "PurchaseOption": "All Upfront",
+                        },
+                        "priceDimensions": {
+                            "SKU.3.1": {
+                                "description": "Linux/UNIX (Amazon VPC)",
+                                "pricePerUnit": {"USD": "0.0001"},
+                            }
+                        },
+                    },
+                },
+            },
+        }
+    )
+
+
+PRICE_LISTS = {
+    "c6i.large": price_list("c6i.large", 0.085, 0.0536),
+    "m5.xlarge": price_list("m5.xlarge", 0.192, 0.121),
+}
+
+
+def spot_record(instance_type, availability_zone, price, minutes_ago):
+    return {
+        "InstanceType": instance_type,
+        "AvailabilityZone": availability_zone,
+        "SpotPrice": str(price),
+        "Timestamp": datetime.datetime.now(datetime.timezone.utc)
+        - datetime.timedelta(minutes=minutes_ago),
+    }
+
+
+class FakeAWS:
+    def __init__(self):
+        self.calls = []
+        self.pricing_error = None
+        self.spot_error = None
+        self.spot_history = [
+            spot_record("c6i.large", "us-east-1a", 0.040, 60),
+            spot_record("c6i.large", "us-east-1a", 0.030, 5),
+            spot_record("c6i.large", "us-east-1b", 0.035, 10),
+        ]
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(
+            paginate=lambda **kwargs: self._paginate(operation, **kwargs)
+        )
+
+    def _paginate(self, operation, **kwargs):
+        self.calls.append(operation)
+        if operation == "get_products":
+            if self.pricing_error:
+                raise self.pricing_error
+            return [{"PriceList": list(PRICE_LISTS.values())}]
+        if self.spot_error:
+            raise self.spot_error
+        return [{"SpotPriceHistory": self.spot_history}]
+
+    def get_products(self, ServiceCode, Filters):
+        self.calls.append("get_products:single")
+        _instance_type = [
+            _f["Value"] for _f in Filters if _f["Field"] == "instanceType"
+        ][0]
+        return {
+            "PriceList": (
+                [PRICE_LISTS[_instance_type]] if _instance_type in PRICE_LISTS else []
+            )
+        }
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    _aws = FakeAWS()
+    # single-type lookups are only cached in the process of the test
+    monkeypatch.setattr(cache, "_soca_cached_remote_client", lambda: None)
+    ec2_pricing_index.get_instance_type_price.cache_clear()
+    monkeypatch.setattr(
+        ec2_pricing_index.utils_boto3,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=_aws),
+    )
+    return _aws
+
+
+def pricing_index(tmp_path, **kwargs):
+    return ec2_pricing_index.SocaEC2PricingIndex(
+        index_path=str(tmp_path / "ec2_pricing_index.db"),
+        region="us-east-1",
+        inode_check_interval=0,
+        **kwargs,
+    )
+
+
+def test_prices_are_served_from_the_index(aws, tmp_path):
+    index = pricing_index(tmp_path, blocking_download=True)
+    assert index.get_price("c6i.large") == {
+        "ondemand": 0.085,
+        "reserved": 0.0536,
+        # cheapest latest price across AZs
+        "spot": 0.030,
+    }
+    assert index.get_price("m5.xlarge") == {"ondemand": 0.192, "reserved": 0.121}
+    assert index.get_price("does.notexist") == {}
+    assert aws.calls == ["get_products", "describe_spot_price_history"]
+    # another process re-uses the index written on disk
+    assert pricing_index(tmp_path).get_price("c6i.large")["ondemand"] == 0.085
+    assert len(aws.calls) == 2
+
+
+def test_first_download_does_not_block_lookups(aws, tmp_path):
+    index = pricing_index(tmp_path)
+    assert index.get_price("c6i.large") == {}
+    index._refresh_thread.join()
+    assert index.get_price("c6i.large")["ondemand"] == 0.085
+
+
+def test_api_fallback_until_the_index_is_loaded(aws, tmp_path):
+    aws.pricing_error = RuntimeError("Throttling")
+    index = pricing_index(tmp_path)
+    assert index.get_price("c6i.large", api_fallback=True) == {
+        "ondemand": 0.085,
+        "reserved": 0.0536,
+    }
+    index._refresh_thread.join()
+    assert "get_products:single" in aws.calls
+
+    aws.pricing_error = None
+    index.refresh()
+    _calls = len(aws.calls)
+    assert index.get_price("c6i.large", api_fallback=True)["spot"] == 0.030
+    assert len(aws.calls) == _calls
+
+
+def test_spot_history_failure_is_not_fatal(aws, tmp_path):
+    aws.spot_error = RuntimeError("AccessDenied")
+    index = pricing_index(tmp_path)
+    assert index.refresh().get("success") is True
+    assert index.get_price("c6i.large") == {"ondemand": 0.085, "reserved": 0.0536}
+
+
+def test_failed_refresh_is_not_retried_before_retry_interval(aws, tmp_path):
+    aws.pricing_error = RuntimeError("Throttling")
+    index = pricing_index(tmp_path)
+    for _ in range(5):
+        assert index.get_price("c6i.large") == {}
+        index._refresh_thread.join()
+    assert aws.calls == ["get_products"]
+
+    aws.pricing_error = None
+    index._refresh_failed_at = time.time() - index.refresh_retry_interval
+    index.get_price("c6i.large")
+    index._refresh_thread.join()
+    assert index.get_price("c6i.large")["ondemand"] == 0.085
+
+
+def test_index_of_another_region_is_refreshed(aws, tmp_path):
+    pricing_index(tmp_path, blocking_download=True).get_price("c6i.large")
+    index = ec2_pricing_index.SocaEC2PricingIndex(
+        index_path=str(tmp_path / "ec2_pricing_index.db"),
+        region="eu-west-1",
+        inode_check_interval=0,
+    )
+    assert index._is_stale() is True
+    index.refresh()
+    assert aws.calls.count("get_products") == 2
+    assert index._is_stale() is False
@@ -0,0 +1,178 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import time
+
+import pytest
+
+import fair_share
+
+
+def queued_job(job_id, owner, nodect=1, queued_seconds=0, resources=None):
+    return {
+        "get_job_id": job_id,
+        "get_job_owner": owner,
+        "get_job_project": "_pbs_project_default",
+        "get_job_nodect": nodect,
+        "get_job_queue_time_epoch": int(time.time()) - queued_seconds,
+        "get_job_resource_list": resources or {},
+    }
+
+
+def running_job(owner, ncpus=2, started_seconds_ago=3600):
+    return {
+        "get_job_owner": owner,
+        "get_job_ncpus": ncpus,
+        "get_job_start_time_epoch": int(time.time()) - started_seconds_ago,
+    }
+
+
+class FakeUsage:
+    def __init__(self, users=None, projects=None):
+        self.users = users or {}
+        self.projects = projects or {}
+
+    def get_user_usage(self, user):
+        return self.users.get(user, 0)
+
+    def get_project_usage(self, project):
+        return self.projects.get(project, 0)
+
+
+def test_job_id_order_alternates_users_by_score():
+    jobs = [
+        queued_job(1, "mcrozes"),
+        queued_job(2, "mcrozes"),
+        queued_job(3, "mcrozes"),
+        queued_job(4, "test"),
+        queued_job(5, "test"),
+    ]
+    assert fair_share.fair_share_job_id_order(
+        jobs, {"mcrozes": 100, "test": 50}, running_job_malus=-60
+    ) == [1, 4, 2, 5, 3]
+
+
+def test_job_id_order_ties_go_to_first_user():
+    jobs = [queued_job(1, "b"), queued_job(2, "a")]
+    assert fair_share.fair_share_job_id_order(
+        jobs, {"a": 100, "b": 100}, running_job_malus=-60
+    ) == [2, 1]
+
+
+def test_job_id_order_keeps_queue_order_per_user():
+    jobs = [queued_job(job_id, "a") for job_id in (7, 3, 9)]
+    assert fair_share.fair_share_job_id_order(
+        jobs, {"a": 100}, running_job_malus=-60
+    ) == [7, 3, 9]
+
+
+def test_score_applies_running_job_malus_and_drops_users_without_queued_jobs():
+    scores = fair_share.fair_share_score(
+        queued_jobs=[queued_job(1, "a"), queued_job(2, "b")],
+        running_jobs=[running_job("a"), running_job("a"), running_job("c")],
+        start_score=100,
+        running_job_malus=-60,
+    )
+    # linear formula: +1 per queued job
+    assert scores == {"a": 100 - 120 + 1, "b": 101}
+
+
+def test_score_queued_job_being_provisioned_counts_as_running():
+    scores = fair_share.fair_share_score(
+        queued_jobs=[queued_job(1, "a", resources={"stack_id": "soca-job-1"})],
+        running_jobs=[],
+        start_score=100,
+        running_job_malus=-60,
+    )
+    assert scores == {"a": 40}
+
+
+def test_score_required_resource_formula_counts_nodes_and_licenses():
+    scores = fair_share.fair_share_score(
+        queued_jobs=[
+            queued_job(1, "a", nodect=4, resources={"comsol_lic_acoustic": "2"})
+        ],
+        running_jobs=[],
+        start_score=100,
+        running_job_malus=-60,
+        formula="required_resource",
+        formula_parameters={"c1": 2},
+    )
+    assert scores == {"a": 100 + 2 * (4 + 2)}
+
+
+@pytest.mark.parametrize(
+    "formula, formula_parameters",
+    [
+        ("does_not_exist", {"c1": 2}),
+        ("required_resource", {"c3": 2}),
+        ("required_resource", {"c1": "two"}),
+        ("required_resource", ["c1"]),
+    ],
+)
+def test_score_invalid_formula_settings_fall_back_to_defaults(
+    formula, formula_parameters
+):
+    scores = fair_share.fair_share_score(
+        queued_jobs=[queued_job(1, "a", nodect=4)],
+        running_jobs=[],
+        start_score=100,
+        running_job_malus=-60,
+        formula=formula,
+        formula_parameters=formula_parameters,
+    )
+    # "does_not_exist" falls back to linear (+1), invalid parameters to c1=1 (+4 nodes)
+    assert scores == {"a": 101 if formula == "does_not_exist" else 104}
+
+
+def test_score_removes_decayed_usage():
+    scores = fair_share.fair_share_score(
+        queued_jobs=[queued_job(1, "a"), queued_job(2, "b")],
+        running_jobs=[],
+        start_score=100,
+        running_job_malus=-60,
+        usage=FakeUsage(users={"a": 10}),
+        usage_weight=2,
+    )
+    assert scores == {"a": 101 - 20, "b": 101}
+
+
+def test_parse_ended_job():
+    record = fair_share.parse_ended_job(
+        "user=mcrozes group=mcrozes project=cfd end=1700000000 "
+        "Resource_List.ncpus=4 resources_used.ncpus=8 resources_used.walltime=01:30:00"
+    )
+    assert record == {
+        "user": "mcrozes",
+        "project": "cfd",
+        "end": 1700000000,
+        "core_hours": 12.0,
+    }
+
+
+def test_queue_time_formula_ignores_jobs_queued_in_the_future():
+    # clock skew between the PBS server and the dispatcher host
+    assert fair_share.queue_time_bonus(required_resource=4, queued_seconds=-30) == 0
+    scores = fair_share.fair_share_score(
+        queued_jobs=[queued_job(1, "a", queued_seconds=-30), queued_job(2, "b")],
+        running_jobs=[],
+        start_score=100,
+        running_job_malus=-60,
+        formula="queue_time",
+    )
+    assert scores == {"a": 100, "b": 100}
+    assert fair_share.fair_share_job_id_order(
+        [queued_job(1, "a", queued_seconds=-30), queued_job(2, "b")],
+        scores,
+        running_job_malus=-60,
+    ) == [1, 2]
@@ -0,0 +1,168 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import hook_support
+
+QUEUE_MAPPING = """
+queue_type:
+  compute:
+    queues: ["normal", "high"]
+    allowed_users: []
+    excluded_users: []
+  test:
+    queues: "test, debug"
+    allowed_users: []
+    excluded_users: []
+  other:
+    queues: "other"
+"""
+
+
+@pytest.fixture
+def soca_home(tmp_path):
+    _settings = tmp_path / "cluster_manager" / "orchestrator" / "settings"
+    _settings.mkdir(parents=True)
+    (tmp_path / "cluster_hooks").mkdir()
+    (_settings / "queue_mapping.yml").write_text(QUEUE_MAPPING)
+    (_settings / "licenses_mapping.yml").write_text("{}\n")
+    (_settings / "project_cost_manager.txt").write_text("[project_a]\nuser1\n")
+    (tmp_path / "environment").write_text(
+        "export SOCA_CLUSTER_ID=soca-test\nAWS_DEFAULT_REGION=us-east-1\n"
+    )
+    return tmp_path
+
+
+def hook_cache(soca_home, **kwargs):
+    return hook_support.QueueJobHookCache(
+        soca_home=str(soca_home),
+        environment_file=str(soca_home / "environment"),
+        **kwargs,
+    ).refresh()
+
+
+def touch(path, delta=10):
+    _mtime = os.stat(path).st_mtime + delta
+    os.utime(path, (_mtime, _mtime))
+
+
+def test_queue_settings_are_indexed_by_queue_name(soca_home):
+    _hook_cache = hook_cache(soca_home)
+    assert _hook_cache.get_environment() == {
+        "SOCA_CLUSTER_ID": "soca-test",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+    assert [_v["queues"] for _v in _hook_cache.get_queue_settings("high")] == [
+        ["normal", "high"]
+    ]
+    assert _hook_cache.get_queue_settings("unknown") == []
+    assert _hook_cache.get_project_budgets() == {"project_a": ["user1"]}
+
+
+def test_only_invalid_entries_naming_the_queue_are_returned(soca_home):
+    _hook_cache = hook_cache(soca_home)
+    assert _hook_cache.get_invalid_queue_settings("normal") == []
+    assert [_v["queues"] for _v in _hook_cache.get_invalid_queue_settings("debug")] == [
+        "test, debug"
+    ]
+    assert [_v["queues"] for _v in _hook_cache.get_invalid_queue_settings("other")] == [
+        "other"
+    ]
+
+
+def test_modified_source_file_is_parsed_again(soca_home):
+    _hook_cache = hook_cache(soca_home)
+    _queue_mapping = (
+        soca_home / "cluster_manager/orchestrator/settings/queue_mapping.yml"
+    )
+
+    _queue_mapping.write_text("queue_type: [")
+    touch(_queue_mapping)
+    with pytest.raises(hook_support.HookSupportError):
+        _hook_cache.refresh().get_queue_settings("normal")
+
+    _queue_mapping.write_text(QUEUE_MAPPING)
+    touch(_queue_mapping, delta=20)
+    assert len(_hook_cache.refresh().get_queue_settings("normal")) == 1
+
+
+@pytest.mark.skipif(
+    os.getuid() != 0, reason="the snapshot file is only read when owned by root"
+)
+def test_snapshot_file_is_reused(soca_home, monkeypatch):
+    hook_cache(soca_home)
+    assert (soca_home / "cluster_hooks" / hook_support.SNAPSHOT_FILE_NAME).exists()
+
+    monkeypatch.setattr(
+        hook_support,
+        "compile_queue_mapping",
+        lambda queue_mapping: pytest.fail("queue_mapping.yml parsed again"),
+    )
+    _hook_cache = hook_cache(soca_home)
+    assert len(_hook_cache.get_queue_settings("normal")) == 1
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    _directory = {"members": ["user1"], "available": True, "searches": 0, "now": 1000}
+
+    def _search_group_members(self, group_dn):
+        _directory["searches"] += 1
+        if not _directory["available"]:
+            raise Exception("SSM is not available")
+        return list(_directory["members"])
+
+    monkeypatch.setattr(
+        hook_support.QueueJobHookCache, "_search_group_members", _search_group_members
+    )
+    monkeypatch.setattr(
+        hook_support, "time", SimpleNamespace(time=lambda: _directory["now"])
+    )
+    return _directory
+
+
+def test_group_members_are_cached(soca_home, directory):
+    _hook_cache = hook_cache(soca_home, group_members_ttl=300)
+    assert _hook_cache.get_group_members("cn=group") == ["user1"]
+    directory["members"] = ["user2"]
+    directory["now"] += 299
+    assert _hook_cache.get_group_members("cn=group") == ["user1"]
+    directory["now"] += 1
+    assert _hook_cache.get_group_members("cn=group") == ["user2"]
+    assert directory["searches"] == 2
+
+
+def test_stale_group_members_are_used_until_max_stale_age(soca_home, directory):
+    _hook_cache = hook_cache(
+        soca_home, group_members_ttl=300, group_members_max_stale_age=3600
+    )
+    assert _hook_cache.get_group_members("cn=group") == ["user1"]
+
+    directory["available"] = False
+    directory["now"] += 3599
+    assert _hook_cache.get_group_members("cn=group") == ["user1"]
+
+    # Fail closed once the last known membership is too old
+    directory["now"] += 1
+    with pytest.raises(hook_support.HookSupportError):
+        _hook_cache.get_group_members("cn=group")
+
+
+def test_unknown_group_fails_closed(soca_home, directory):
+    directory["available"] = False
+    with pytest.raises(hook_support.HookSupportError):
+        hook_cache(soca_home).get_group_members("cn=group")
@@ -0,0 +1,145 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import pytest
+
+import license_availability
+import license_check
+
+LMSTAT = """
+lmutil - Copyright (c) 1989-2019 Flexera. All Rights Reserved.
+Flexible License Manager status on Thu 1/1/2026 10:00
+
+License server status: 27718@licenses.soca.dev
+    licenses.soca.dev: license server UP (MASTER) v11.16.4
+
+Vendor daemon status (on licenses.soca.dev):
+
+  LMCOMSOL: UP v11.16.4
+Feature usage info:
+
+Users of ACOUSTICS:  (Total of 10 licenses issued;  Total of 4 licenses in use)
+
+  "ACOUSTICS" v5.6, vendor: LMCOMSOL, expiry: permanent(no expiration date)
+  floating license
+
+    mcrozes ip-10-0-0-1 /dev/tty (v5.6) (licenses.soca.dev/27718 101), start Thu 1/1 9:00, 4 licenses
+
+Users of COMSOL:  (Total of 1 license issued;  Total of 0 licenses in use)
+Users of UNCOUNTED:  (Uncounted, node-locked)
+Users of BROKEN:  (Error: 1 licenses, unsupported by licensed server)
+
+  LMOTHER: UP v11.16.4
+Users of ACOUSTICS:  (Total of 5 licenses issued;  Total of 1 license in use)
+"""
+
+
+def test_parse_lmstat():
+    assert license_check.parse_lmstat(LMSTAT) == {
+        # served by two vendor daemons
+        "ACOUSTICS": {"issued": 15, "in_use": 5},
+        "COMSOL": {"issued": 1, "in_use": 0},
+    }
+
+
+def test_parse_lmstat_without_features():
+    assert license_check.parse_lmstat("lmgrd is not running") == {}
+
+
+def test_get_available_licenses_removes_reserved_pool():
+    features = license_check.get_available_licenses(
+        license_check.parse_lmstat(LMSTAT), reserved={"ACOUSTICS": 3, "OTHER": 2}
+    )
+    assert features["ACOUSTICS"]["available"] == 7
+    assert features["COMSOL"]["available"] == 1
+
+
+def test_parse_reserved():
+    assert license_check.parse_reserved(["ACOUSTICS=3", "A=B=2"]) == {
+        "ACOUSTICS": 3,
+        "A=B": 2,
+    }
+    assert license_check.parse_reserved(None) == {}
+
+
+@pytest.mark.parametrize("value", ["ACOUSTICS", "ACOUSTICS=", "=3", "ACOUSTICS=-1"])
+def test_parse_reserved_rejects_invalid_values(value):
+    with pytest.raises(SystemExit):
+        license_check.parse_reserved([value])
+
+
+@pytest.fixture
+def license_service(monkeypatch):
+    _outputs = {
+        "count_acoustics": 10,
+        "lmstat --json": {
+            "ACOUSTICS": {"issued": 15, "in_use": 5, "available": 10},
+            "COMSOL": {"issued": 1, "in_use": 0, "available": 1},
+        },
+        "broken": None,
+    }
+    _service = license_availability.LicenseAvailability(max_workers=1)
+    _probes = []
+
+    def probe(command):
+        _probes.append(command)
+        return _outputs[command]
+
+    monkeypatch.setattr(_service, "_probe", probe)
+    _service.probes = _probes
+    yield _service
+    _service._pool.shutdown()
+
+
+def test_license_availability_reads_features_of_a_shared_command(license_service):
+    license_service.set_commands(
+        {
+            "comsol_lic_acoustic": {"command": "lmstat --json", "feature": "ACOUSTICS"},
+            "comsol_lic_comsol": {"command": "lmstat --json", "feature": "COMSOL"},
+            "comsol_lic_missing": {"command": "lmstat --json", "feature": "MISSING"},
+            "other_lic": "broken",
+        }
+    )
+    assert license_service.get_available(
+        [
+            "comsol_lic_acoustic",
+            "comsol_lic_comsol",
+            "comsol_lic_missing",
+            "other_lic",
+            "not_configured_lic",
+        ]
+    ) == {"comsol_lic_acoustic": 10, "comsol_lic_comsol": 1}
+    assert sorted(license_service.probes) == ["broken", "lmstat --json"]
+
+
+def test_license_availability_subtracts_promised_licenses(license_service):
+    license_service.set_commands({"comsol_lic_acoustic": "count_acoustics"})
+    license_service.promise("comsol_lic_acoustic", 4)
+    license_service.promise("comsol_lic_acoustic", 4)
+    assert license_service.get_available(["comsol_lic_acoustic"]) == {
+        "comsol_lic_acoustic": 2
+    }
+    license_service.release("comsol_lic_acoustic", 4)
+    assert license_service.get_available(["comsol_lic_acoustic"]) == {
+        "comsol_lic_acoustic": 6
+    }
+    license_service.promise("comsol_lic_acoustic", 20)
+    assert license_service.get_available(["comsol_lic_acoustic"]) == {
+        "comsol_lic_acoustic": 0
+    }
+    license_service.new_cycle()
+    assert license_service.get_available(["comsol_lic_acoustic"]) == {
+        "comsol_lic_acoustic": 10
+    }
+    # results are cached for cache_ttl seconds
+    assert license_service.probes == ["count_acoustics"]
@@ -0,0 +1,278 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import json
+import logging
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+
+import node_events
+import nodes_manager
+
+
+def state_change(instance_id, state):
+    return json.dumps(
+        {
+            "detail-type": "EC2 Instance State-change Notification",
+            "detail": {"instance-id": instance_id, "state": state},
+        }
+    )
+
+
+def test_parse_state_change_event():
+    assert node_events.parse_state_change_event(state_change("i-1", "running")) == (
+        "i-1",
+        "running",
+    )
+    assert node_events.parse_state_change_event(
+        {"instance-id": "i-1", "state": "stopped"}
+    ) == ("i-1", "stopped")
+    assert node_events.parse_state_change_event("not json") is None
+    assert node_events.parse_state_change_event({"detail": {"foo": "bar"}}) is None
+
+
+def test_file_source_only_reads_appended_lines(tmp_path):
+    path = tmp_path / "events.jsonl"
+    path.write_text(state_change("i-old", "running") + "\n")
+    source = node_events.FileEventSource(str(path), poll_interval=0.01)
+    assert source.poll(timeout=0) == []
+
+    with open(path, "a") as _file:
+        _file.write(state_change("i-1", "running") + "\n")
+        _file.write("not json\n")
+        _file.write(state_change("i-2", "stopped") + "\n")
+    assert source.poll(timeout=0) == [("i-1", "running"), ("i-2", "stopped")]
+    assert source.poll(timeout=0) == []
+
+
+def test_file_source_keeps_partial_lines(tmp_path):
+    path = tmp_path / "events.jsonl"
+    source = node_events.FileEventSource(str(path), poll_interval=0.01)
+    assert source.poll(timeout=0) == []
+
+    _line = state_change("i-1", "running")
+    path.write_text(_line[:10])
+    assert source.poll(timeout=0) == []
+    with open(path, "a") as _file:
+        _file.write(_line[10:] + "\n")
+    assert source.poll(timeout=0) == [("i-1", "running")]
+
+
+def test_file_source_rereads_truncated_file(tmp_path):
+    path = tmp_path / "events.jsonl"
+    path.write_text(state_change("i-10", "running") + "\n")
+    source = node_events.FileEventSource(str(path), poll_interval=0.01)
+
+    path.write_text(state_change("i-2", "stopped") + "\n")
+    assert source.poll(timeout=0) == [("i-2", "stopped")]
+
+
+def test_file_source_reads_rotated_file(tmp_path):
+    path = tmp_path / "events.jsonl"
+    path.write_text(state_change("i-1", "running") + "\n")
+    source = node_events.FileEventSource(str(path), poll_interval=0.01)
+
+    _rotated = tmp_path / "events.jsonl.new"
+    _rotated.write_text(state_change("i-2", "terminated") + "\n")
+    os.replace(_rotated, path)
+    assert source.poll(timeout=0) == [("i-2", "terminated")]
+
+
+def test_unix_socket_source(tmp_path):
+    path = str(tmp_path / "events.sock")
+    source = node_events.UnixSocketEventSource(path, max_batch=2)
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        assert source.poll(timeout=0) == []
+        for _instance_id in ("i-1", "i-2", "i-3"):
+            sender.sendto(state_change(_instance_id, "running").encode(), path)
+        sender.sendto(b"not json", path)
+        # max_batch limits the events returned by a single poll
+        assert source.poll(timeout=1) == [("i-1", "running"), ("i-2", "running")]
+        assert source.poll(timeout=1) == [("i-3", "running")]
+        assert source.poll(timeout=0) == []
+    finally:
+        sender.close()
+        source.close()
+
+
+def test_get_event_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        node_events,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=None),
+    )
+    assert isinstance(
+        node_events.get_event_source(f"file://{tmp_path}/events.jsonl"),
+        node_events.FileEventSource,
+    )
+    _sqs = node_events.get_event_source(
+        "sqs://sqs.us-east-1.amazonaws.com/123456789012/soca-test-NodeEvents"
+    )
+    assert isinstance(_sqs, node_events.SQSEventSource)
+    assert (
+        _sqs.queue_url
+        == "https://sqs.us-east-1.amazonaws.com/123456789012/soca-test-NodeEvents"
+    )
+    with pytest.raises(ValueError):
+        node_events.get_event_source("http://example.com/events")
+
+
+class FakePBSBatchExecutor:
+    directives = []
+    failing = set()
+
+    def __init__(self, qmgr_bin, logger):
+        self._commands = {}
+
+    def qmgr(self, directive):
+        _command_id = len(self._commands)
+        self._commands[_command_id] = directive
+        FakePBSBatchExecutor.directives.append(directive)
+        return _command_id
+
+    def run(self):
+        return {
+            _command_id: {
+                "returncode": (
+                    1 if directive.split()[2] in FakePBSBatchExecutor.failing else 0
+                ),
+                "output": "",
+            }
+            for _command_id, directive in self._commands.items()
+        }
+
+
+def compute_instances(*instances):
+    return {
+        "42": {
+            "instance_type": "c6i.large",
+            "instances": {
+                host: {"instance_id": instance_id} for instance_id, host in instances
+            },
+        }
+    }
+
+
+@pytest.fixture
+def pbs(monkeypatch):
+    _pbs = {"added": [], "deleted": [], "ec2": {}}
+    FakePBSBatchExecutor.directives = []
+    FakePBSBatchExecutor.failing = set()
+    monkeypatch.setattr(
+        nodes_manager, "logger", logging.getLogger("soca_logger"), raising=False
+    )
+    monkeypatch.setattr(nodes_manager, "sbins", {"qmgr": "qmgr"}, raising=False)
+    monkeypatch.setattr(nodes_manager, "PBSBatchExecutor", FakePBSBatchExecutor)
+    monkeypatch.setattr(
+        nodes_manager,
+        "add_hosts",
+        lambda hosts, compute_instances: _pbs["added"].extend(hosts),
+    )
+    monkeypatch.setattr(
+        nodes_manager, "delete_hosts", lambda hosts: _pbs["deleted"].extend(hosts)
+    )
+    monkeypatch.setattr(
+        nodes_manager,
+        "get_all_compute_instances",
+        lambda cluster_id, instance_ids: compute_instances(
+            *[
+                (_instance_id, _pbs["ec2"][_instance_id])
+                for _instance_id in instance_ids
+                if _instance_id in _pbs["ec2"]
+            ]
+        ),
+    )
+    return _pbs
+
+
+def state_map():
+    _state_map = nodes_manager.NodeStateMap(cluster_id="soca-test")
+    _state_map.load(
+        {
+            "compute_instances": compute_instances(("i-1", "ip-10-0-0-1")),
+            "pbs_hosts": ["ip-10-0-0-1"],
+        }
+    )
+    return _state_map
+
+
+def test_running_compute_node_is_registered(pbs):
+    pbs["ec2"]["i-2"] = "ip-10-0-0-2"
+    _state_map = state_map()
+    # i-3 is not a compute node of the cluster
+    _state_map.apply_events(
+        [("i-2", "pending"), ("i-2", "running"), ("i-3", "running")]
+    )
+    assert pbs["added"] == ["ip-10-0-0-2"]
+    assert _state_map.instance_hosts == {"i-1": "ip-10-0-0-1", "i-2": "ip-10-0-0-2"}
+    assert _state_map.pbs_hosts == {"ip-10-0-0-1", "ip-10-0-0-2"}
+
+    # Duplicated events are ignored
+    _state_map.apply_events([("i-2", "running")])
+    assert pbs["added"] == ["ip-10-0-0-2"]
+
+
+def test_terminated_compute_node_is_deleted(pbs):
+    _state_map = state_map()
+    _state_map.apply_events([("i-1", "shutting-down"), ("i-9", "terminated")])
+    assert pbs["deleted"] == ["ip-10-0-0-1"]
+    assert _state_map.instance_hosts == {}
+    assert _state_map.pbs_hosts == set()
+    assert _state_map.compute_instances["42"]["instances"] == {}
+
+
+def test_stopped_compute_node_is_set_offline_then_online(pbs):
+    _state_map = state_map()
+    _state_map.apply_events([("i-1", "stopping")])
+    assert FakePBSBatchExecutor.directives == ["set node ip-10-0-0-1 state=offline"]
+    assert _state_map.stopped_hosts == {"ip-10-0-0-1"}
+
+    # stopped_hosts is kept across load()
+    _state_map.load(
+        {
+            "compute_instances": compute_instances(("i-1", "ip-10-0-0-1")),
+            "pbs_hosts": ["ip-10-0-0-1"],
+        }
+    )
+    _state_map.apply_events([("i-1", "running")])
+    assert FakePBSBatchExecutor.directives[-1] == "set node ip-10-0-0-1 state=free"
+    assert _state_map.stopped_hosts == set()
+    assert pbs["added"] == []
+
+
+def test_host_stays_stopped_when_online_fails(pbs):
+    _state_map = state_map()
+    _state_map.apply_events([("i-1", "stopped")])
+    FakePBSBatchExecutor.failing = {"ip-10-0-0-1"}
+    _state_map.apply_events([("i-1", "running")])
+    assert _state_map.stopped_hosts == {"ip-10-0-0-1"}
+
+    FakePBSBatchExecutor.failing = set()
+    _state_map.apply_events([("i-1", "running")])
+    assert _state_map.stopped_hosts == set()
+
+
+def test_restarted_node_missing_from_reconcile_is_put_back_online(pbs):
+    pbs["ec2"]["i-1"] = "ip-10-0-0-1"
+    _state_map = state_map()
+    _state_map.apply_events([("i-1", "stopped")])
+    # reconcile() no longer lists the stopped instance, its host is still a PBS node
+    _state_map.load({"compute_instances": {}, "pbs_hosts": ["ip-10-0-0-1"]})
+    _state_map.apply_events([("i-1", "running")])
+    assert pbs["added"] == []
+    assert FakePBSBatchExecutor.directives[-1] == "set node ip-10-0-0-1 state=free"
+    assert _state_map.stopped_hosts == set()
@@ -0,0 +1,163 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import pytest
+
+from pbs_batch import PBSBatchExecutor
+
+
+class FakePBS:
+    """
+    Minimal qmgr / qalter: "create node" fails if the node exists, "set node" fails if it does not,
+    qalter fails for the jobs listed in unknown_jobs
+    """
+
+    def __init__(self, nodes=None, unknown_jobs=None, server_down=False):
+        self.nodes = set(nodes or [])
+        self.unknown_jobs = set(unknown_jobs or [])
+        self.server_down = server_down
+        self.calls = []
+
+    def _directive(self, directive):
+        _action, _, _node = directive.split()[:3]
+        if _action == "create":
+            if _node in self.nodes:
+                return f"qmgr obj={_node} svr=default: Node name already exists"
+            self.nodes.add(_node)
+        elif _node not in self.nodes:
+            return f"qmgr obj={_node} svr=default: Unknown node"
+        return None
+
+    def execute(self, cmd, stdin=None):
+        self.calls.append((cmd, stdin))
+        if cmd[0] == "qalter":
+            _unknown = [_job for _job in cmd if _job in self.unknown_jobs]
+            if _unknown:
+                return 1, f"qalter: Unknown Job Id {_unknown[0]}"
+            return 0, ""
+        if self.server_down:
+            return 1, "qmgr: cannot connect to server (errno=111)"
+        if "-c" in cmd:
+            _error = self._directive(cmd[-1])
+            return (2, _error) if _error else (0, "")
+        _output = []
+        for _line in stdin.splitlines():
+            _output.append(_line)
+            _error = self._directive(_line)
+            if _error:
+                # -a: abort on the first rejected directive
+                return 2, "\n".join(_output + [_error])
+        return 0, "\n".join(_output)
+
+
+@pytest.fixture
+def pbs(monkeypatch):
+    _pbs = FakePBS()
+    monkeypatch.setattr(
+        PBSBatchExecutor,
+        "_execute",
+        lambda self, cmd, stdin=None: _pbs.execute(cmd, stdin),
+    )
+    return _pbs
+
+
+def executor(**kwargs):
+    return PBSBatchExecutor(qmgr_bin="qmgr", qalter_bin="qalter", **kwargs)
+
+
+def add_nodes(pbs_batch, nodes):
+    command_ids = {}
+    for _node in nodes:
+        command_ids[_node] = (
+            pbs_batch.qmgr(f"create node {_node} queue=normal"),
+            pbs_batch.qmgr(f"set node {_node} resources_available.compute_node=job1"),
+        )
+    return command_ids
+
+
+def test_qmgr_directives_run_in_a_single_call(pbs):
+    pbs_batch = executor()
+    command_ids = add_nodes(pbs_batch, ["ip-1", "ip-2", "ip-3"])
+    results = pbs_batch.run()
+    assert len(pbs.calls) == 1
+    assert all(
+        results[_id]["returncode"] == 0 for _ids in command_ids.values() for _id in _ids
+    )
+    assert pbs.nodes == {"ip-1", "ip-2", "ip-3"}
+
+
+def test_qmgr_batch_resumes_after_the_failed_directive(pbs):
+    pbs.nodes.add("ip-2")
+    pbs_batch = executor()
+    command_ids = add_nodes(pbs_batch, ["ip-1", "ip-2", "ip-3"])
+    results = pbs_batch.run()
+    # batch aborted on "create node ip-2", retried alone, then the remaining directives in a single call
+    assert [_cmd for _cmd, _ in pbs.calls] == [
+        ["qmgr", "-a", "-e"],
+        ["qmgr", "-c", "create node ip-2 queue=normal"],
+        ["qmgr", "-a", "-e"],
+    ]
+    assert pbs.calls[2][1].splitlines()[0] == (
+        "set node ip-2 resources_available.compute_node=job1"
+    )
+    # "already exists" is not an error
+    assert all(
+        results[_id]["returncode"] == 0 for _ids in command_ids.values() for _id in _ids
+    )
+    assert pbs.nodes == {"ip-1", "ip-2", "ip-3"}
+
+
+def test_qmgr_failed_directive_gets_its_own_result(pbs):
+    pbs_batch = executor()
+    _set_id = pbs_batch.qmgr("set node ip-9 state=offline")
+    _create_id = pbs_batch.qmgr("create node ip-1 queue=normal")
+    results = pbs_batch.run()
+    assert results[_set_id]["returncode"] != 0
+    assert "Unknown node" in results[_set_id]["output"]
+    assert results[_create_id]["returncode"] == 0
+    assert len(pbs.calls) == 3
+
+
+def test_qmgr_is_not_retried_when_no_directive_ran(pbs):
+    pbs.server_down = True
+    pbs_batch = executor()
+    command_ids = add_nodes(pbs_batch, ["ip-1", "ip-2"])
+    results = pbs_batch.run()
+    assert len(pbs.calls) == 1
+    assert all(
+        results[_id]["returncode"] == 1 for _ids in command_ids.values() for _id in _ids
+    )
+
+
+def test_qmgr_batch_size(pbs):
+    pbs_batch = executor(qmgr_batch_size=2)
+    add_nodes(pbs_batch, ["ip-1", "ip-2", "ip-3"])
+    pbs_batch.run()
+    assert len(pbs.calls) == 3
+
+
+def test_qalter_groups_jobs_and_retries_them_one_by_one(pbs):
+    pbs.unknown_jobs.add("2")
+    pbs_batch = executor()
+    command_ids = {
+        _job: pbs_batch.qalter(job_id=_job, args=["-l", "stack_id="])
+        for _job in ("1", "2", "3")
+    }
+    _select_id = pbs_batch.qalter(job_id="1", args=["-l", "select=1:ncpus=2"])
+    results = pbs_batch.run()
+    assert results[command_ids["1"]]["returncode"] == 0
+    assert results[command_ids["2"]]["returncode"] == 1
+    assert results[command_ids["3"]]["returncode"] == 0
+    assert results[_select_id]["cmd"] == ["qalter", "-l", "select=1:ncpus=2", "1"]
+    # 1 grouped stack_id qalter + 3 retries + 1 select qalter
+    assert len(pbs.calls) == 5
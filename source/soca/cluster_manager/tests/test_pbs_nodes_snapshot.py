@@ -0,0 +1,168 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import time
+
+import pytest
+
+from utils.pbs_nodes_snapshot import SocaPBSNodesSnapshot, parse_pbs_size
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("4gb", 4096),
+        ("512mb", 512),
+        ("1024kb", 1),
+        ("1tb", 1024 * 1024),
+        ("1048576", 1),
+        (1048576, 1),
+        ("1048576b", 1),
+        (" 2GB ", 2048),
+        ("1.5gb", 1536),
+        (0, 0),
+    ],
+)
+def test_parse_pbs_size(value, expected):
+    assert parse_pbs_size(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "gb", "4 pb", "-1gb", None])
+def test_parse_pbs_size_rejects_invalid_sizes(value):
+    with pytest.raises(ValueError):
+        parse_pbs_size(value)
+
+
+def pbs_node(
+    compute_node,
+    state="free",
+    instance_type="c6i.large",
+    availability_zone="us-east-1a",
+    ncpus=2,
+    mem="4gb",
+    assigned_ncpus=0,
+    assigned_mem="0kb",
+    state_changed_seconds_ago=3600,
+    **kwargs,
+):
+    node = {
+        "state": state,
+        "pcpus": ncpus,
+        "last_state_change_time": int(time.time()) - state_changed_seconds_ago,
+        "resources_available": {
+            "compute_node": compute_node,
+            "instance_type": instance_type,
+            "availability_zone": availability_zone,
+            "ncpus": ncpus,
+            "mem": mem,
+        },
+        "resources_assigned": {"ncpus": assigned_ncpus, "mem": assigned_mem},
+    }
+    node.update(kwargs)
+    return node
+
+
+@pytest.fixture
+def snapshot():
+    _snapshot = SocaPBSNodesSnapshot(shared=False)
+    _snapshot.refresh(
+        pbsnodes_output={
+            "nodes": {
+                "ip-1": pbs_node("job1"),
+                "ip-2": pbs_node(
+                    "job1", assigned_ncpus=1, assigned_mem="1gb", jobs=["1.pbs"]
+                ),
+                "ip-3": pbs_node(
+                    "job2",
+                    state="down,offline",
+                    instance_type="c6i.2xlarge",
+                    availability_zone="us-east-1b",
+                ),
+                "ip-4": pbs_node("job2", state_changed_seconds_ago=10),
+                "ip-5": pbs_node("job3", state="job-busy", assigned_ncpus=2),
+            }
+        }
+    )
+    return _snapshot
+
+
+def test_get_nodes_by_index(snapshot):
+    assert list(snapshot.get_nodes(compute_node="job1")) == ["ip-1", "ip-2"]
+    assert list(snapshot.get_nodes(state="offline")) == ["ip-3"]
+    assert list(snapshot.get_nodes(state="down")) == ["ip-3"]
+    assert list(snapshot.get_nodes(instance_type="c6i.2xlarge")) == ["ip-3"]
+    assert list(snapshot.get_nodes(availability_zone="us-east-1b")) == ["ip-3"]
+    assert list(snapshot.get_nodes(compute_node="job2", state="free")) == ["ip-4"]
+    assert snapshot.get_nodes(compute_node="does-not-exist") == {}
+    assert len(snapshot.get_nodes()) == 5
+
+
+def test_index_node_moves_the_node_to_its_new_state(snapshot):
+    snapshot.index_node("ip-1", pbs_node("job1", state="offline"))
+    assert "ip-1" not in snapshot.get_nodes(state="free")
+    assert "ip-1" in snapshot.get_nodes(state="offline")
+    snapshot.unindex_node("ip-1")
+    assert "ip-1" not in snapshot.get_nodes(compute_node="job1")
+    assert "ip-1" not in snapshot.get_nodes()
+
+
+def test_get_free_capacity_ignores_recent_and_busy_nodes(snapshot):
+    assert snapshot.get_free_capacity("job1") == [
+        {"hostname": "ip-1", "ncpus": 2, "mem": 4096},
+        {"hostname": "ip-2", "ncpus": 1, "mem": 3072},
+    ]
+    assert snapshot.get_free_cpus("job1") == 3
+    # ip-4 changed state 10 seconds ago
+    assert snapshot.get_free_cpus("job2") == 0
+    assert snapshot.get_free_cpus("job2", min_age=0) == 2
+    assert snapshot.get_free_cpus("job3") == 0
+
+
+def test_get_idle_hosts(snapshot):
+    _idle_hosts = snapshot.get_idle_hosts()
+    assert sorted(_idle_hosts) == ["ip-1", "ip-4"]
+    assert _idle_hosts["ip-1"] == snapshot.nodes["ip-1"]["last_state_change_time"] + 900
+
+
+def test_refresh_keeps_recent_snapshot_unless_forced(snapshot, monkeypatch):
+    _calls = []
+
+    def run_pbsnodes(hostnames=None):
+        _calls.append(hostnames)
+        return {"nodes": {"ip-9": pbs_node("job9")}}
+
+    monkeypatch.setattr(snapshot, "run_pbsnodes", run_pbsnodes)
+    assert snapshot.refresh() is True
+    assert _calls == []
+    assert snapshot.refresh(force=True) is True
+    assert _calls == [None]
+    assert list(snapshot.get_nodes()) == ["ip-9"]
+
+
+def test_refresh_hostnames_only_updates_these_nodes(snapshot, monkeypatch):
+    monkeypatch.setattr(
+        snapshot,
+        "run_pbsnodes",
+        lambda hostnames=None: {"nodes": {"ip-1": pbs_node("job1", state="offline")}},
+    )
+    assert snapshot.refresh(hostnames=["ip-1", "ip-2"]) is True
+    # ip-2 no longer exists in PBS
+    assert list(snapshot.get_nodes(compute_node="job1")) == ["ip-1"]
+    assert list(snapshot.get_nodes(state="offline")) == ["ip-3", "ip-1"]
+    assert "ip-5" in snapshot.get_nodes()
+
+
+def test_refresh_keeps_previous_snapshot_when_pbsnodes_fails(snapshot, monkeypatch):
+    monkeypatch.setattr(snapshot, "run_pbsnodes", lambda hostnames=None: None)
+    assert snapshot.refresh(force=True) is False
+    assert len(snapshot.get_nodes()) == 5
@@ -0,0 +1,270 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+import json
+import logging
+import os
+import runpy
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import hook_support
+import project_budget_snapshot
+
+HOOK_FILE = os.path.join(
+    os.path.dirname(hook_support.__file__), "queuejob", "check_project_budget.py"
+)
+
+
+class FakeBudgetsClient:
+    def __init__(self, budgets=None, error=None):
+        self.budgets = budgets or []
+        self.error = error
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "describe_budgets"
+        return self
+
+    def paginate(self, AccountId):
+        if self.error is not None:
+            raise self.error
+        return [{"Budgets": self.budgets[:1]}, {"Budgets": self.budgets[1:]}]
+
+
+def budget(name, actual_spend, budget_limit):
+    return {
+        "BudgetName": name,
+        "BudgetLimit": {"Amount": str(budget_limit), "Unit": "USD"},
+        "CalculatedSpend": {
+            "ActualSpend": {"Amount": str(actual_spend), "Unit": "USD"}
+        },
+    }
+
+
+@pytest.fixture
+def soca_home(tmp_path):
+    _settings = tmp_path / "cluster_manager" / "orchestrator" / "settings"
+    _settings.mkdir(parents=True)
+    (tmp_path / "cluster_hooks").mkdir()
+    (_settings / "queue_mapping.yml").write_text("{}\n")
+    (_settings / "licenses_mapping.yml").write_text("{}\n")
+    (_settings / "project_cost_manager.txt").write_text(
+        "[project_a]\nuser1\n\n[project_b]\nuser1\n"
+    )
+    (tmp_path / "environment").write_text("SOCA_CLUSTER_ID=soca-test\n")
+    return tmp_path
+
+
+@pytest.fixture
+def refresher(monkeypatch, soca_home):
+    monkeypatch.setattr(
+        project_budget_snapshot,
+        "logger",
+        logging.getLogger("soca_logger"),
+        raising=False,
+    )
+
+    def _refresh(budgets_client):
+        monkeypatch.setattr(
+            project_budget_snapshot, "budgets_client", budgets_client, raising=False
+        )
+        return project_budget_snapshot.refresh(
+            account_id="123456789012",
+            budget_config_file=str(
+                soca_home
+                / "cluster_manager/orchestrator/settings/project_cost_manager.txt"
+            ),
+            snapshot_file=str(
+                soca_home / "cluster_manager/orchestrator/project_budget_snapshot.json"
+            ),
+        )
+
+    return _refresh
+
+
+def read_snapshot(soca_home):
+    with open(
+        soca_home / "cluster_manager/orchestrator/project_budget_snapshot.json"
+    ) as _file:
+        return json.load(_file)
+
+
+def test_refresh_writes_the_budgets_of_the_projects(soca_home, refresher):
+    assert refresher(
+        FakeBudgetsClient(
+            budgets=[
+                budget("project_a", 10, 100),
+                budget("other", 1, 2),
+                {"BudgetName": "project_b"},
+            ]
+        )
+    )
+    _snapshot = read_snapshot(soca_home)
+    assert _snapshot["account_id"] == "123456789012"
+    assert time.time() - _snapshot["refreshed_at"] < 60
+    # project_b has no spend / limit, other is not a project of the cluster
+    assert _snapshot["budgets"] == {
+        "project_a": {"actual_spend": 10.0, "budget_limit": 100.0}
+    }
+    assert not [
+        _file
+        for _file in os.listdir(soca_home / "cluster_manager/orchestrator")
+        if _file.endswith(".tmp")
+    ]
+
+
+def test_refresh_keeps_the_previous_snapshot_when_budgets_fail(soca_home, refresher):
+    assert refresher(FakeBudgetsClient(budgets=[budget("project_a", 10, 100)]))
+    _previous = read_snapshot(soca_home)
+    assert not refresher(FakeBudgetsClient(error=Exception("throttled")))
+    assert read_snapshot(soca_home) == _previous
+
+
+def test_refresh_fails_without_project_configuration(soca_home, refresher):
+    os.remove(
+        soca_home / "cluster_manager/orchestrator/settings/project_cost_manager.txt"
+    )
+    assert not refresher(FakeBudgetsClient(budgets=[budget("project_a", 10, 100)]))
+    assert not (
+        soca_home / "cluster_manager/orchestrator/project_budget_snapshot.json"
+    ).exists()
+
+
+class HookAccepted(SystemExit):
+    pass
+
+
+class HookRejected(SystemExit):
+    pass
+
+
+class FakeEvent:
+    def __init__(self, requestor, project):
+        self.requestor = requestor
+        self.job = SimpleNamespace(queue="normal", project=project)
+
+    def accept(self):
+        raise HookAccepted()
+
+    def reject(self, message):
+        raise HookRejected(message)
+
+
+@pytest.fixture
+def run_hook(monkeypatch, soca_home):
+    _hook_cache = hook_support.QueueJobHookCache(
+        soca_home=str(soca_home), environment_file=str(soca_home / "environment")
+    )
+    monkeypatch.setattr(
+        hook_support, "get_hook_cache", lambda soca_home: _hook_cache.refresh()
+    )
+
+    def _run_hook(project="project_a", requestor="user1"):
+        monkeypatch.setitem(
+            sys.modules,
+            "pbs",
+            SimpleNamespace(
+                event=lambda: FakeEvent(requestor=requestor, project=project),
+                logmsg=lambda level, message: None,
+                LOG_DEBUG=0,
+            ),
+        )
+        with pytest.raises(SystemExit) as _result:
+            runpy.run_path(HOOK_FILE)
+        return _result.value
+
+    return _run_hook
+
+
+def write_budget_snapshot(soca_home, refreshed_at, budgets):
+    project_budget_snapshot.write_snapshot(
+        {
+            "refreshed_at": refreshed_at,
+            "account_id": "123456789012",
+            "budgets": budgets,
+        },
+        str(soca_home / "cluster_manager/orchestrator/project_budget_snapshot.json"),
+    )
+
+
+def test_hook_accepts_job_within_budget(soca_home, run_hook):
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time(),
+        budgets={"project_a": {"actual_spend": 10.0, "budget_limit": 100.0}},
+    )
+    assert isinstance(run_hook(), HookAccepted)
+
+
+def test_hook_rejects_job_over_budget(soca_home, run_hook):
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time(),
+        budgets={"project_a": {"actual_spend": 101.0, "budget_limit": 100.0}},
+    )
+    _result = run_hook()
+    assert isinstance(_result, HookRejected)
+    assert "exceed allocated threshold" in str(_result)
+
+
+def test_hook_rejects_job_without_budget_snapshot(soca_home, run_hook):
+    _result = run_hook()
+    assert isinstance(_result, HookRejected)
+    assert "project_budget_snapshot.json is not available" in str(_result)
+
+
+def test_hook_rejects_job_with_stale_budget_snapshot(soca_home, run_hook):
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time() - 3600,
+        budgets={"project_a": {"actual_spend": 10.0, "budget_limit": 100.0}},
+    )
+    _result = run_hook()
+    assert isinstance(_result, HookRejected)
+    assert "has not been refreshed for more than 1800 seconds" in str(_result)
+
+
+def test_hook_rejects_project_missing_from_budget_snapshot(soca_home, run_hook):
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time(),
+        budgets={"project_a": {"actual_spend": 10.0, "budget_limit": 100.0}},
+    )
+    _result = run_hook(project="project_b")
+    assert isinstance(_result, HookRejected)
+    assert "no AWS Budget found for project_b" in str(_result)
+
+
+def test_hook_reads_the_refreshed_budget_snapshot(soca_home, run_hook):
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time() - 3600,
+        budgets={"project_a": {"actual_spend": 10.0, "budget_limit": 100.0}},
+    )
+    assert isinstance(run_hook(), HookRejected)
+
+    write_budget_snapshot(
+        soca_home,
+        refreshed_at=time.time(),
+        budgets={"project_a": {"actual_spend": 10.0, "budget_limit": 100.0}},
+    )
+    # Make sure the replaced file does not share the mtime of the previous one
+    _snapshot_file = (
+        soca_home / "cluster_manager/orchestrator/project_budget_snapshot.json"
+    )
+    _mtime = os.stat(_snapshot_file).st_mtime + 10
+    os.utime(_snapshot_file, (_mtime, _mtime))
+    assert isinstance(run_hook(), HookAccepted)
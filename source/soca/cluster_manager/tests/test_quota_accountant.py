@@ -0,0 +1,171 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+
+from types import SimpleNamespace
+
+import pytest
+
+import quota_accountant
+
+VCPUS = {"c6i.large": 2, "c6i.2xlarge": 8, "g5.xlarge": 4}
+
+
+class FakeAWS:
+    def __init__(self):
+        self.quotas = [
+            {
+                "QuotaCode": "L-1216C47A",
+                "QuotaName": "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances",
+                "Value": 32.0,
+            },
+            {
+                "QuotaCode": "L-DB2E81BA",
+                "QuotaName": "Running On-Demand G and VT instances",
+                "Value": 8.0,
+            },
+            {"QuotaCode": "L-0263D0A3", "QuotaName": "EC2-VPC Elastic IPs", "Value": 5},
+        ]
+        self.instances = []
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(paginate=lambda **kwargs: self._paginate(operation))
+
+    def _paginate(self, operation):
+        self.calls.append(operation)
+        if operation == "list_service_quotas":
+            return [{"Quotas": self.quotas}]
+        return [{"Reservations": [{"Instances": self.instances}]}]
+
+    def launch(self, instance_type, count=1, tags=None, spot=False):
+        for _ in range(count):
+            _instance = {
+                "InstanceId": f"i-{len(self.instances):017d}",
+                "InstanceType": instance_type,
+                "CpuOptions": {
+                    "CoreCount": VCPUS[instance_type] // 2,
+                    "ThreadsPerCore": 2,
+                },
+                "Tags": [{"Key": _k, "Value": _v} for _k, _v in (tags or {}).items()],
+            }
+            if spot:
+                _instance["InstanceLifecycle"] = "spot"
+            self.instances.append(_instance)
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    _aws = FakeAWS()
+    monkeypatch.setattr(
+        quota_accountant,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=_aws),
+    )
+    monkeypatch.setattr(
+        quota_accountant,
+        "get_instance_catalog",
+        lambda: SimpleNamespace(get_vcpus=VCPUS.get),
+    )
+    return _aws
+
+
+def usage(accountant, quota="Standard"):
+    return [
+        _usage
+        for _quota_name, _usage in accountant.get_usage().items()
+        if quota in _quota_name
+    ][0]
+
+
+@pytest.mark.parametrize(
+    "quota_name, families",
+    [
+        (
+            "Running On-Demand Standard (A, C, D, H, I, M, R, T, Z) instances",
+            ["a", "c", "d", "h", "i", "m", "r", "t", "z"],
+        ),
+        ("Running On-Demand G and VT instances", ["g", "vt"]),
+        ("Running On-Demand High Memory instances", ["u"]),
+        ("All Standard Spot Instance Requests", None),
+    ],
+)
+def test_parse_quota_families(quota_name, families):
+    assert quota_accountant.parse_quota_families(quota_name) == families
+
+
+def test_reservations_are_checked_against_the_quota(aws):
+    aws.launch("c6i.2xlarge", count=2)
+    aws.launch("c6i.2xlarge", count=4, spot=True)
+    accountant = quota_accountant.VcpuQuotaAccountant()
+
+    assert accountant.reserve("job-1", "c6i.large", 4)["success"] is True
+    assert usage(accountant) == {"limit": 32.0, "used": 16, "reserved": 8}
+    # 16 used + 8 reserved + 10 requested > 32
+    assert accountant.reserve("job-2", "c6i.large", 5)["success"] is False
+    assert accountant.reserve("job-3", "g5.xlarge", 2)["success"] is True
+    assert accountant.reserve("job-4", "g5.xlarge", 1)["success"] is False
+
+    accountant.release("job-1")
+    assert accountant.reserve("job-2", "c6i.large", 5)["success"] is True
+    # a single reconciliation for all admission checks
+    assert aws.calls == ["list_service_quotas", "describe_instances"]
+
+
+def test_unknown_instance_types_are_rejected(aws):
+    accountant = quota_accountant.VcpuQuotaAccountant()
+    assert accountant.reserve("job-1", "c7.unknown", 1)["success"] is False
+    assert accountant.reserve("job-2", "p5.48xlarge", 1)["success"] is False
+
+
+@pytest.mark.parametrize(
+    "tags",
+    [
+        # instances launched by EC2 Fleet / Spot Fleet only have the tags of the launch template
+        {"soca:StackId": "soca-cluster-job-1"},
+        {"aws:cloudformation:stack-name": "soca-cluster-job-1"},
+    ],
+)
+def test_launched_instances_are_not_counted_twice(aws, tags):
+    accountant = quota_accountant.VcpuQuotaAccountant()
+    assert accountant.reserve("soca-cluster-job-1", "c6i.large", 4)["success"] is True
+
+    aws.launch("c6i.large", count=3, tags=tags)
+    accountant.reconcile()
+    # the last instance is still being provisioned
+    assert usage(accountant) == {"limit": 32.0, "used": 6, "reserved": 2}
+
+    aws.launch("c6i.large", count=1, tags=tags)
+    accountant.reconcile()
+    assert usage(accountant) == {"limit": 32.0, "used": 8, "reserved": 0}
+
+
+def test_expired_reservations_are_released(aws, monkeypatch):
+    accountant = quota_accountant.VcpuQuotaAccountant(reservation_ttl=60)
+    assert accountant.reserve("job-1", "c6i.2xlarge", 4)["success"] is True
+    assert accountant.reserve("job-2", "c6i.large", 1)["success"] is False
+
+    _now = quota_accountant.time.time() + 61
+    monkeypatch.setattr(
+        quota_accountant,
+        "time",
+        SimpleNamespace(
+            time=lambda: _now, perf_counter=quota_accountant.time.perf_counter
+        ),
+    )
+    assert accountant.reserve("job-2", "c6i.large", 1)["success"] is True
+
+
+def test_instance_count_for_capacity():
+    assert quota_accountant.instance_count_for_capacity(3) == 3
+    assert quota_accountant.instance_count_for_capacity(10, [2, 4, 8]) == 5
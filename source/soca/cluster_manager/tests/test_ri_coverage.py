@@ -0,0 +1,149 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+
+from types import SimpleNamespace
+
+import pytest
+
+import ri_coverage
+from utils.response import SocaResponse
+
+
+class FakeCacheClient:
+    """
+    Cache shared by the RICoverage of several processes
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def is_enabled(self):
+        return SocaResponse(success=True, message="Cache enabled")
+
+    def get(self, key):
+        if key in self.data:
+            return SocaResponse(success=True, message=self.data[key])
+        return SocaResponse(success=False, message="CACHE_MISS")
+
+    def atomic_update(self, key, function, ex=None):
+        self.data[key] = function(self.data.get(key))
+        return SocaResponse(success=True, message=self.data[key])
+
+
+class FakeEC2:
+    def __init__(self):
+        self.instances = []
+        self.reserved_instances = [
+            {"InstanceType": "c6i.large", "InstanceCount": 4},
+            {"InstanceType": "c6i.large", "InstanceCount": 2},
+            {"InstanceType": "m6i.large", "InstanceCount": 2},
+        ]
+        self.calls = 0
+
+    def get_paginator(self, operation):
+        self.calls += 1
+        return SimpleNamespace(
+            paginate=lambda **kwargs: [
+                {"Reservations": [{"Instances": self.instances}]}
+            ]
+        )
+
+    def describe_reserved_instances(self, Filters):
+        return {"ReservedInstances": self.reserved_instances}
+
+    def launch(self, instance_type, job_id, spot=False):
+        _instance = {
+            "InstanceType": instance_type,
+            "Tags": [{"Key": "soca:JobId", "Value": job_id}],
+        }
+        if spot:
+            _instance["InstanceLifecycle"] = "spot"
+        self.instances.append(_instance)
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    _ec2 = FakeEC2()
+    monkeypatch.setattr(
+        ri_coverage,
+        "get_boto",
+        lambda service_name, **kwargs: SimpleNamespace(message=_ec2),
+    )
+    return _ec2
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    _cache = FakeCacheClient()
+    monkeypatch.setattr(ri_coverage, "SocaCacheClient", lambda is_admin: _cache)
+    return _cache
+
+
+def test_bookings_are_checked_against_running_instances(ec2, cache):
+    ec2.launch("c6i.large", "1")
+    ec2.launch("c6i.large", "2", spot=True)
+    coverage = ri_coverage.RICoverage()
+    assert coverage.book("3", "c6i.large", 3)["success"] is True
+    _result = coverage.book("4", "c6i.large", 3)
+    assert _result["success"] is False
+    assert (_result["running"], _result["booked"], _result["reserved"]) == (1, 3, 6)
+    assert coverage.book("4", "c6i.large", 2)["success"] is True
+    assert coverage.can_fit("m6i.large", 3)["success"] is False
+    # a single refresh for all the checks
+    assert ec2.calls == 1
+
+
+def test_bookings_of_other_processes_are_not_overwritten(ec2, cache):
+    dispatcher_1 = ri_coverage.RICoverage()
+    dispatcher_2 = ri_coverage.RICoverage()
+    assert dispatcher_1.book("1", "c6i.large", 4)["success"] is True
+    assert dispatcher_2.book("2", "c6i.large", 4)["success"] is False
+    assert dispatcher_2.book("2", "c6i.large", 2)["success"] is True
+    assert dispatcher_1.can_fit("c6i.large", 1)["booked"] == 6
+
+    dispatcher_1.release("1")
+    assert dispatcher_2.can_fit("c6i.large", 4)["success"] is True
+
+
+def test_refresh_releases_all_the_bookings_of_a_job(ec2, cache):
+    coverage = ri_coverage.RICoverage()
+    assert coverage.book("1", "c6i.large", 2)["success"] is True
+    assert coverage.book("1", "m6i.large", 2)["success"] is True
+    assert coverage.book("2", "c6i.large", 2)["success"] is True
+    assert sorted(coverage._model["bookings"]) == ["1", "1/m6i.large", "2"]
+
+    ec2.launch("c6i.large", "1")
+    ec2.launch("c6i.large", "1")
+    ec2.launch("m6i.large", "1")
+    ec2.launch("m6i.large", "1")
+    coverage.refresh()
+    assert sorted(coverage._model["bookings"]) == ["2"]
+    assert coverage.can_fit("c6i.large", 2)["success"] is True
+    assert coverage.can_fit("m6i.large", 1)["success"] is False
+
+
+def test_release_without_cache(ec2, monkeypatch):
+    monkeypatch.setattr(
+        ri_coverage,
+        "SocaCacheClient",
+        lambda is_admin: SimpleNamespace(
+            is_enabled=lambda: SocaResponse(success=False, message="disabled")
+        ),
+    )
+    coverage = ri_coverage.RICoverage()
+    assert coverage.book("1", "c6i.large", 6)["success"] is True
+    assert coverage.book("1", "m6i.large", 1)["success"] is True
+    assert coverage.can_fit("c6i.large", 1)["success"] is False
+    coverage.release("1")
+    assert coverage._model["bookings"] == {}
@@ -0,0 +1,172 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Compare the per job CloudFormation template build time and memory of orchestrator/cloudformation_builder.py:
+- legacy: troposphere template built for every job and serialized to YAML (previous implementation)
+- full: troposphere template built for every job and serialized to JSON (build_template(use_skeleton=False))
+- skeleton: template built once per job shape, job specific values patched into the serialized skeleton (build_template())
+EC2 instance catalog lookups are replaced by constants so only the template build is measured.
+
+Usage: python3 cloudformation_template_build.py --jobs 1000 --shapes 1 10
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../orchestrator")
+)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../.."))
+import cloudformation_builder
+
+cloudformation_builder.is_ebs_optimized = lambda instance_type: True
+cloudformation_builder.is_cpu_options_supported = lambda instance_type: True
+
+INSTANCE_TYPES = [["c6i.large"], ["c6i.xlarge", "c5.xlarge"], ["m6i.2xlarge"]]
+
+
+def generate_job(job_index, shape_index):
+    return {
+        "AdditionalSecurityGroupIds": [],
+        "BaseOS": "amazonlinux2023",
+        "ClusterId": "soca-benchmark",
+        "ComputeNodeInstanceProfileArn": "arn:aws:iam::123456789012:instance-profile/soca-compute",
+        "CoreCount": 1,
+        "CustomIamInstanceProfile": False,
+        "DesiredCapacity": random.randint(2, 64),
+        "Efa": False,
+        "FSxLustreConfiguration": {"fsx_lustre": False},
+        "ImageId": "ami-0123456789abcdef0",
+        "InstanceType": INSTANCE_TYPES[shape_index % len(INSTANCE_TYPES)],
+        "JobId": str(job_index),
+        "JobName": f"benchmark-job-{job_index}",
+        "JobOwner": f"user{random.randint(1, 50)}",
+        "JobProject": "benchmark",
+        "JobQueue": f"queue{shape_index}",
+        "KeepEbs": False,
+        "KeepForever": False,
+        "MaxEfaInterfaces": 0,
+        "MetadataHttpTokens": "required",
+        "MetricCollectionAnonymous": True,
+        "Misc": "",
+        "PlacementGroup": True,
+        "Region": "us-east-1",
+        "RootSize": 10 + shape_index,
+        "ScratchSize": 0,
+        "SecurityGroupId": "sg-0123456789abcdef0",
+        "SolutionMetricsLambda": "arn:aws:lambda:us-east-1:123456789012:function:metrics",
+        "SpotAllocationCount": False,
+        "SpotAllocationStrategy": "capacity-optimized",
+        "SpotFleetIAMRoleArn": "arn:aws:iam::123456789012:role/spotfleet",
+        "SpotPrice": False,
+        "SSHKeyPair": "soca",
+        "StackUUID": f"{job_index:08d}",
+        "SubnetId": ["subnet-0123456789abcdef0", "subnet-0123456789abcdef1"],
+        "TerminateWhenIdle": 0,
+        "ThreadsPerCore": False,
+        "Version": "25.5.0",
+        "VolumeType": "gp3",
+        "VolumeTypeIops": 0,
+        "WeightedCapacity": False,
+    }
+
+
+def legacy_build(params, user_data):
+    # Previous implementation, template serialized to YAML
+    return (
+        cloudformation_builder._build_template(params=params, user_data=user_data)
+        .to_yaml()
+        .replace("_soca_", "soca:")
+    )
+
+
+def full_build(params, user_data):
+    return cloudformation_builder.build_template(
+        params=params, user_data=user_data, use_skeleton=False
+    )
+
+
+def skeleton_build(params, user_data):
+    return cloudformation_builder.build_template(params=params, user_data=user_data)
+
+
+def measure(function, jobs, memory_jobs=20):
+    # Time and memory are measured separately as tracemalloc slows down the build
+    start = time.perf_counter()
+    for params, user_data in jobs:
+        function(params, user_data)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for params, user_data in jobs[:memory_jobs]:
+        function(params, user_data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / len(jobs) * 1000, peak / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=500, help="Number of jobs")
+    parser.add_argument(
+        "--shapes",
+        nargs="+",
+        type=int,
+        default=[1, 10, 100],
+        help="Number of distinct job shapes",
+    )
+    parser.add_argument(
+        "--skip-legacy",
+        action="store_const",
+        const=True,
+        default=False,
+        help="Do not benchmark the YAML implementation",
+    )
+    arg = parser.parse_args()
+
+    random.seed(42)
+    print(
+        f"{'Shapes':>8} {'Implementation':>15} {'ms/job':>10} {'Peak memory (KiB)':>18}"
+    )
+    for shapes_count in arg.shapes:
+        jobs = []
+        for job_index in range(arg.jobs):
+            user_data = base64.b64encode(os.urandom(6000)).decode("utf-8")
+            jobs.append(
+                (
+                    generate_job(job_index, random.randint(0, shapes_count - 1)),
+                    user_data,
+                )
+            )
+
+        # Skeleton templates must be identical to the templates built for each job
+        for params, user_data in jobs[:20]:
+            if json.loads(full_build(params, user_data)) != json.loads(
+                skeleton_build(params, user_data)
+            ):
+                print(f"WARNING: skeleton template differs for job {params['JobId']}")
+
+        implementations = [("full", full_build), ("skeleton", skeleton_build)]
+        if not arg.skip_legacy:
+            implementations.insert(0, ("legacy", legacy_build))
+        for name, function in implementations:
+            cloudformation_builder._skeleton_cache.clear()
+            per_job_ms, peak_kib = measure(function, jobs)
+            print(f"{shapes_count:>8} {name:>15} {per_job_ms:>10.3f} {peak_kib:>18.1f}")
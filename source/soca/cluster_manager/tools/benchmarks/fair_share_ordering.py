@@ -0,0 +1,142 @@
+######################################################################################################################
+#  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.                                                #
+#                                                                                                                    #
+#  Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file except in compliance    #
+#  with the License. A copy of the License is located at                                                             #
+#                                                                                                                    #
+#      http://www.apache.org/licenses/LICENSE-2.0                                                                    #
+#                                                                                                                    #
+#  or in the 'license' file accompanying this file. This file is distributed on an 'AS IS' BASIS, WITHOUT WARRANTIES #
+#  OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions    #
+#  and limitations under the License.                                                                                #
+######################################################################################################################
+
+"""
+Compare the previous fair share job ordering (full re-sort of all users and full scan of the queue for every job)
+with the heap based implementation of orchestrator/fair_share.py on synthetic queues.
+
+Usage: python3 fair_share_ordering.py --jobs 1000 5000 10000 --users 50
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../orchestrator")
+)
+import fair_share
+
+FAIR_SHARE_START_SCORE = 100
+FAIR_SHARE_RUNNING_JOB_MALUS = -60
+
+
+def legacy_fair_share_job_id_order(sorted_queued_job, user_fair_share):
+    # Previous dispatcher.py implementation, logging removed
+    job_ids_to_start = []
+    order = 0
+    while order <= sorted_queued_job.__len__():
+        sorted_user_fair_share = sorted(
+            user_fair_share.items(), key=lambda kv: kv[1], reverse=True
+        )
+        next_user = sorted_user_fair_share[0][0]
+        next_user_jobs = [
+            i["get_job_id"]
+            for i in sorted_queued_job
+            if i["get_job_owner"] == next_user
+        ]
+        for job_id in next_user_jobs:
+            if job_id in job_ids_to_start:
+                if next_user_jobs.__len__() == 1:
+                    # User don't have any more queued jobs
+                    del user_fair_share[next_user]
+            else:
+                job_ids_to_start.append(job_id)
+                user_fair_share[next_user] = (
+                    user_fair_share[next_user] + FAIR_SHARE_RUNNING_JOB_MALUS
+                )
+                break
+
+        order += 1
+
+    return job_ids_to_start
+
+
+def generate_queue(jobs_count, users_count):
+    now = int(time.time())
+    queued_jobs = []
+    for job_order in range(1, jobs_count + 1):
+        queued_jobs.append(
+            {
+                "get_job_id": str(job_order),
+                "get_job_owner": f"user{random.randint(1, users_count)}",
+                "get_job_order_in_queue": job_order,
+                "get_job_queue_time_epoch": str(now - random.randint(0, 86400)),
+                "get_job_nodect": random.randint(1, 8),
+                "get_job_resource_list": {},
+            }
+        )
+    return queued_jobs
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--jobs",
+        nargs="+",
+        type=int,
+        default=[100, 1000, 5000, 10000],
+        help="Number of queued jobs to benchmark",
+    )
+    parser.add_argument("--users", type=int, default=50, help="Number of users")
+    parser.add_argument(
+        "--skip-legacy",
+        action="store_const",
+        const=True,
+        default=False,
+        help="Only benchmark the current implementation",
+    )
+    arg = parser.parse_args()
+
+    # Silence per job logs
+    logging.getLogger("tcpserver").setLevel(logging.CRITICAL)
+    random.seed(42)
+    print(f"{'Jobs':>8} {'Score (s)':>10} {'Order (s)':>10} {'Legacy order (s)':>17}")
+    for jobs_count in arg.jobs:
+        queued_jobs = generate_queue(jobs_count=jobs_count, users_count=arg.users)
+        user_fair_share, score_time = timed(
+            fair_share.fair_share_score,
+            queued_jobs,
+            [],
+            start_score=FAIR_SHARE_START_SCORE,
+            running_job_malus=FAIR_SHARE_RUNNING_JOB_MALUS,
+        )
+        job_order, order_time = timed(
+            fair_share.fair_share_job_id_order,
+            queued_jobs,
+            dict(user_fair_share),
+            running_job_malus=FAIR_SHARE_RUNNING_JOB_MALUS,
+        )
+        if arg.skip_legacy:
+            legacy_time = "-"
+        else:
+            legacy_job_order, legacy_time = timed(
+                legacy_fair_share_job_id_order, queued_jobs, dict(user_fair_share)
+            )
+            # Legacy implementation stops early once a user with more than one job runs out of jobs
+            if job_order[: len(legacy_job_order)] != legacy_job_order:
+                print(f"WARNING: job order differs for {jobs_count} jobs")
+            legacy_time = f"{legacy_time:.4f}"
+
+        print(
+            f"{jobs_count:>8} {score_time:>10.4f} {order_time:>10.4f} {legacy_time:>17}"
+        )
@@ -4,16 +4,61 @@
 import boto3
 import botocore
 import logging
+import os
+import threading
 from typing import Optional
 from utils.error import SocaError
 from utils.response import SocaResponse
 
 logger = logging.getLogger("soca_logger")
 
+# boto3 clients are thread-safe and expensive to build, they are created once per process and re-used by all callers
+BOTO3_MAX_POOL_CONNECTIONS = 50
+BOTO3_RETRIES = {"max_attempts": 10, "mode": "adaptive"}
+
+_boto3_lock = threading.Lock()
+_boto3_clients = {}
+_boto3_session = {}
+_boto3_metrics = {"clients_created": {}, "api_calls": {}}
+
+
+def _get_process_session() -> boto3.Session:
+    # boto3.Session is not thread-safe and connection pools must not be shared across fork, use one Session per process
+    with _boto3_lock:
+        if _boto3_session.get("pid") != os.getpid():
+            _boto3_session["session"] = boto3.Session()
+            _boto3_session["pid"] = os.getpid()
+            _boto3_clients.clear()
+        return _boto3_session["session"]
+
+
+def _count_api_call(service_name: str, **kwargs):
+    with _boto3_lock:
+        _boto3_metrics["api_calls"][service_name] = (
+            _boto3_metrics["api_calls"].get(service_name, 0) + 1
+        )
+
+
+def get_boto_metrics() -> SocaResponse:
+    """
+    Return the number of boto3 clients/resources created and API calls issued per service by the current process
+    """
+    with _boto3_lock:
+        return SocaResponse(
+            success=True,
+            message={
+                "clients_created": dict(_boto3_metrics["clients_created"]),
+                "api_calls": dict(_boto3_metrics["api_calls"]),
+                "pooled_clients": len(_boto3_clients),
+            },
+        )
+
 
 def get_boto_session_credentials():
     try:
-        return SocaResponse(success=True, message=boto3.Session().get_credentials())
+        return SocaResponse(
+            success=True, message=_get_process_session().get_credentials()
+        )
     except Exception as err:
         return SocaError.AWS_API_ERROR(
             service_name="boto3",
@@ -23,7 +68,7 @@ def get_boto_session_credentials():
 
 def get_boto_session_region():
     try:
-        return SocaResponse(success=True, message=boto3.Session().region_name)
+        return SocaResponse(success=True, message=_get_process_session().region_name)
     except Exception as err:
         return SocaError.AWS_API_ERROR(
             service_name="boto3",
@@ -38,15 +83,31 @@ def get_boto(
     resource: Optional[bool] = False,
     endpoint_url: Optional[str] = None,
 ) -> boto3.session:
+    """
+    Return a boto3 client (or resource) for service_name.
+    Clients are pooled per process and keyed by service, region, endpoint and config, the same client is returned to all callers.
+    Resources are not thread-safe, a new one is created for each call.
+    """
+    _session = _get_process_session()
+    if not region_name:
+        region_name = _session.region_name
+
+    _pool_key = (service_name, region_name, endpoint_url, bool(extra_config))
+    if not resource:
+        _client = _boto3_clients.get(_pool_key)
+        if _client is not None:
+            return SocaResponse(success=True, message=_client)
+
     if extra_config:
-        _extra_parameters = {"user_agent_extra": "AwsSolution/SO0072/25.5.0"}
+        _extra_parameters = {
+            "user_agent_extra": "AwsSolution/SO0072/25.5.0",
+            "max_pool_connections": BOTO3_MAX_POOL_CONNECTIONS,
+            "retries": BOTO3_RETRIES,
+        }
         _config = botocore.config.Config(**_extra_parameters)
     else:
         _config = None
 
-    if not region_name:
-        region_name = boto3.Session().region_name
-
     _boto3_params = {
         "service_name": service_name,
         "region_name": region_name,
@@ -57,10 +118,31 @@ def get_boto(
     logger.debug(f"Building boto3 {service_name} with params {_boto3_params}")
 
     try:
-        if not resource:
-            return SocaResponse(success=True, message=boto3.client(**_boto3_params))
-        else:
-            return SocaResponse(success=True, message=boto3.resource(**_boto3_params))
+        with _boto3_lock:
+            if not resource:
+                # Another thread may have created the client while we were waiting for the lock
+                _client = _boto3_clients.get(_pool_key)
+                if _client is None:
+                    _client = _session.client(**_boto3_params)
+                    _client.meta.events.register(
+                        "before-call",
+                        lambda **kwargs: _count_api_call(service_name, **kwargs),
+                    )
+                    _boto3_clients[_pool_key] = _client
+                    _boto3_metrics["clients_created"][service_name] = (
+                        _boto3_metrics["clients_created"].get(service_name, 0) + 1
+                    )
+                return SocaResponse(success=True, message=_client)
+            else:
+                _resource = _session.resource(**_boto3_params)
+                _boto3_metrics["clients_created"][service_name] = (
+                    _boto3_metrics["clients_created"].get(service_name, 0) + 1
+                )
+        _resource.meta.client.meta.events.register(
+            "before-call",
+            lambda **kwargs: _count_api_call(service_name, **kwargs),
+        )
+        return SocaResponse(success=True, message=_resource)
     except Exception as err:
         return SocaError.AWS_API_ERROR(
             service_name="boto3",
@@ -3,23 +3,25 @@
 
 import logging
 from utils.aws.ssm_parameter_store import SocaConfig
-import utils.aws.boto3_wrapper as utils_boto3
 from botocore.exceptions import ClientError
 from utils.error import SocaError
 from utils.response import SocaResponse
 from utils.cast import SocaCastEngine
+from utils.aws.ec2_instance_catalog import get_instance_catalog
+from utils.cache import soca_cached
 import boto3
 import botocore
 
-client_ec2 = utils_boto3.get_boto(service_name="ec2").message
 logger = logging.getLogger("soca_logger")
 
 
+@soca_cached(namespace="ec2/instance_types_by_architecture", ttl=3600)
 def get_instance_types_by_architecture(instance_type_pattern: list) -> dict:
     """
     This function take a list of EC2 pattern such as c5.large, c6i.* and generate the relevant list of associated instance type
     grouped by architecture:
     {"x86_64": ["instance1", ...], "arm64": [...]}
+    Results are cached, DescribeInstanceTypes is only called when the EC2 instance catalog is not available
     """
     logger.info(
         f"Building all supported EC2 instance type based on {instance_type_pattern}"
@@ -37,22 +39,15 @@ def get_instance_types_by_architecture(instance_type_pattern: list) -> dict:
     _matching_instances = {"x86_64": [], "arm64": []}
 
     try:
-        paginator = client_ec2.get_paginator("describe_instance_types")
-        for page in paginator.paginate(
-            MaxResults=100,
-            Filters=[
-                {
-                    "Name": "instance-type",
-                    "Values": sorted(set(instance_type_pattern)),
-                },
-            ],
+        _catalog = get_instance_catalog()
+        for _instance_type in _catalog.list_instance_types(
+            patterns=sorted(set(instance_type_pattern))
         ):
-            for instance_type in page["InstanceTypes"]:
-                _instance_type = instance_type["InstanceType"]
-                _instance_arch = instance_type["ProcessorInfo"][
-                    "SupportedArchitectures"
-                ][0]
-                _matching_instances[_instance_arch].append(_instance_type)
+            _instance_arch = _catalog.get_summary(_instance_type)["architectures"]
+            if "arm64" in _instance_arch.split(","):
+                _matching_instances["arm64"].append(_instance_type)
+            elif "x86_64" in _instance_arch.split(","):
+                _matching_instances["x86_64"].append(_instance_type)
 
     except botocore.exceptions.ClientError as e:
         return SocaResponse(
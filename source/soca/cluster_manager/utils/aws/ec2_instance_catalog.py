@@ -0,0 +1,491 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional
+from botocore.exceptions import ClientError
+import utils.aws.boto3_wrapper as utils_boto3
+from utils.error import SocaError
+from utils.response import SocaResponse
+
+logger = logging.getLogger("soca_logger")
+
+EC2_INSTANCE_CATALOG_PATH = os.environ.get(
+    "SOCA_EC2_INSTANCE_CATALOG",
+    f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_manager/cache/ec2_instance_catalog.db",
+)
+
+# Columns extracted from DescribeInstanceTypes and indexed on disk, the full API response is kept in "data"
+_CATALOG_SCHEMA = """
+CREATE TABLE instance_types (
+    instance_type TEXT PRIMARY KEY,
+    vcpus INTEGER,
+    cores INTEGER,
+    threads_per_core INTEGER,
+    memory_mib INTEGER,
+    architectures TEXT,
+    placement_group_strategies TEXT,
+    hibernation_supported INTEGER,
+    ebs_optimized_support TEXT,
+    current_generation INTEGER,
+    bare_metal INTEGER,
+    data TEXT
+);
+CREATE INDEX instance_types_current_generation ON instance_types (current_generation, bare_metal);
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_CATALOG_COLUMNS = (
+    "instance_type",
+    "vcpus",
+    "cores",
+    "threads_per_core",
+    "memory_mib",
+    "architectures",
+    "placement_group_strategies",
+    "hibernation_supported",
+    "ebs_optimized_support",
+    "current_generation",
+    "bare_metal",
+)
+
+
+def _summarize_instance_type(instance_type: dict) -> dict:
+    _vcpu_info = instance_type.get("VCpuInfo", {})
+    return {
+        "instance_type": instance_type.get("InstanceType"),
+        "vcpus": _vcpu_info.get("DefaultVCpus"),
+        "cores": _vcpu_info.get("DefaultCores"),
+        "threads_per_core": _vcpu_info.get("DefaultThreadsPerCore"),
+        "memory_mib": instance_type.get("MemoryInfo", {}).get("SizeInMiB"),
+        "architectures": ",".join(
+            instance_type.get("ProcessorInfo", {}).get("SupportedArchitectures", [])
+        ),
+        "placement_group_strategies": ",".join(
+            instance_type.get("PlacementGroupInfo", {}).get("SupportedStrategies", [])
+        ),
+        "hibernation_supported": int(instance_type.get("HibernationSupported", False)),
+        "ebs_optimized_support": instance_type.get("EbsInfo", {}).get(
+            "EbsOptimizedSupport", "unsupported"
+        ),
+        "current_generation": int(instance_type.get("CurrentGeneration", False)),
+        "bare_metal": int(instance_type.get("BareMetal", False)),
+    }
+
+
+class SocaEC2InstanceCatalog:
+    """
+    Local catalog of all EC2 instance types available in the region.
+    The output of DescribeInstanceTypes is downloaded once and persisted as a sqlite database shared by all processes
+    of the controller (orchestrator scripts and web interface). Queries are served from the local file.
+    The catalog is refreshed in a background thread when older than max_age seconds and atomically replaced on disk.
+    Instance types not found in the catalog (e.g: released since the last refresh) are queried via the API and kept in memory.
+    When the catalog can't be created, queries are served by the API. A failed refresh is not retried before
+    refresh_retry_interval seconds.
+
+    example:
+        catalog = get_instance_catalog()
+        catalog.get_vcpus("c6i.large") -> 2
+        catalog.list_instance_types(patterns=["c6i.*"], architecture="x86_64", current_generation=True)
+        catalog.describe(["c6i.large", "m5.xlarge"]) -> SocaResponse(message={"c6i.large": <DescribeInstanceTypes output>, ...})
+    """
+
+    def __init__(
+        self,
+        catalog_path: Optional[str] = EC2_INSTANCE_CATALOG_PATH,
+        max_age: Optional[int] = 86400,
+        inode_check_interval: Optional[int] = 5,
+        refresh_retry_interval: Optional[int] = 300,
+    ):
+        self.catalog_path = catalog_path
+        self.max_age = max_age
+        self.inode_check_interval = inode_check_interval
+        self.refresh_retry_interval = refresh_retry_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_failed_at = 0
+        self._refreshed_at = None
+        self._api_fallback = {}
+
+    def _download(self) -> list:
+        _ec2_client = utils_boto3.get_boto(service_name="ec2").message
+        _instance_types = []
+        _paginator = _ec2_client.get_paginator("describe_instance_types")
+        for _page in _paginator.paginate(MaxResults=100):
+            _instance_types.extend(_page.get("InstanceTypes", []))
+        return _instance_types
+
+    def _write(self, instance_types: list) -> None:
+        _catalog_dir = os.path.dirname(self.catalog_path)
+        os.makedirs(_catalog_dir, exist_ok=True)
+        _fd, _tmp_path = tempfile.mkstemp(
+            dir=_catalog_dir, prefix=".ec2_instance_catalog.", suffix=".tmp"
+        )
+        os.close(_fd)
+        try:
+            _connection = sqlite3.connect(_tmp_path)
+            try:
+                _connection.executescript(_CATALOG_SCHEMA)
+                _rows = []
+                for _instance_type in instance_types:
+                    _summary = _summarize_instance_type(_instance_type)
+                    _rows.append(
+                        tuple(_summary[_column] for _column in _CATALOG_COLUMNS)
+                        + (json.dumps(_instance_type, default=str),)
+                    )
+                _connection.executemany(
+                    f"INSERT OR REPLACE INTO instance_types VALUES ({','.join(['?'] * (len(_CATALOG_COLUMNS) + 1))})",
+                    _rows,
+                )
+                _connection.execute(
+                    "INSERT INTO metadata VALUES ('refreshed_at', ?)",
+                    (str(time.time()),),
+                )
+                _connection.commit()
+            finally:
+                _connection.close()
+            os.chmod(_tmp_path, 0o644)
+            # Readers keep using the previous file until they reopen it
+            os.replace(_tmp_path, self.catalog_path)
+        finally:
+            if os.path.exists(_tmp_path):
+                os.remove(_tmp_path)
+
+    def refresh(self, blocking: Optional[bool] = True) -> SocaResponse:
+        """
+        Download the catalog and replace the local file. Only one process refreshes the catalog at a time,
+        with blocking=False the refresh is skipped if another process is already refreshing it.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.catalog_path), exist_ok=True)
+            with open(f"{self.catalog_path}.lock", "w") as _lock_file:
+                try:
+                    fcntl.flock(
+                        _lock_file,
+                        fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB,
+                    )
+                except BlockingIOError:
+                    return SocaResponse(
+                        success=True,
+                        message="EC2 instance catalog is already being refreshed by another process",
+                    )
+
+                # Another process may have refreshed the catalog while we were waiting for the lock
+                if not self._is_stale():
+                    return SocaResponse(
+                        success=True, message="EC2 instance catalog is up to date"
+                    )
+
+                _start = time.perf_counter()
+                _instance_types = self._download()
+                self._write(_instance_types)
+                logger.info(
+                    f"Refreshed EC2 instance catalog with {len(_instance_types)} instance types in {time.perf_counter() - _start:.2f}s"
+                )
+                return SocaResponse(
+                    success=True,
+                    message=f"EC2 instance catalog refreshed with {len(_instance_types)} instance types",
+                )
+        except Exception as err:
+            self._refresh_failed_at = time.time()
+            return SocaError.AWS_API_ERROR(
+                service_name="ec2",
+                helper=f"Unable to refresh EC2 instance catalog {self.catalog_path} due to {err}",
+            )
+
+    def _can_retry_refresh(self) -> bool:
+        return time.time() - self._refresh_failed_at >= self.refresh_retry_interval
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            if not self._can_retry_refresh():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self.refresh, kwargs={"blocking": False}, daemon=True
+            )
+            self._refresh_thread.start()
+
+    def _get_refreshed_at(self) -> [float, None]:
+        try:
+            _connection = sqlite3.connect(f"file:{self.catalog_path}?mode=ro", uri=True)
+            try:
+                _row = _connection.execute(
+                    "SELECT value FROM metadata WHERE key = 'refreshed_at'"
+                ).fetchone()
+            finally:
+                _connection.close()
+            return float(_row[0]) if _row else None
+        except sqlite3.Error:
+            return None
+
+    def _is_stale(self) -> bool:
+        _refreshed_at = self._get_refreshed_at()
+        return _refreshed_at is None or time.time() - _refreshed_at > self.max_age
+
+    def _connection(self) -> [sqlite3.Connection, None]:
+        # sqlite connections can't be shared across threads, each thread keeps its own read-only connection
+        # and re-opens it when the catalog file has been replaced by a refresh
+        _now = time.time()
+        _local = self._local
+        if (
+            getattr(_local, "connection", None) is not None
+            and _now - _local.inode_checked_at < self.inode_check_interval
+        ):
+            return _local.connection
+
+        try:
+            _inode = os.stat(self.catalog_path).st_ino
+        except OSError:
+            if not self._can_retry_refresh():
+                return None
+            logger.info(
+                f"EC2 instance catalog {self.catalog_path} not found, downloading it"
+            )
+            _refresh = self.refresh(blocking=True)
+            if _refresh.get("success") is False:
+                logger.error(_refresh.get("message"))
+                return None
+            _inode = os.stat(self.catalog_path).st_ino
+
+        if getattr(_local, "connection", None) is None or _local.inode != _inode:
+            if getattr(_local, "connection", None) is not None:
+                _local.connection.close()
+            _local.connection = sqlite3.connect(
+                f"file:{self.catalog_path}?mode=ro", uri=True
+            )
+            _local.connection.row_factory = sqlite3.Row
+            _local.inode = _inode
+            _row = _local.connection.execute(
+                "SELECT value FROM metadata WHERE key = 'refreshed_at'"
+            ).fetchone()
+            self._refreshed_at = float(_row[0]) if _row else 0
+
+        _local.inode_checked_at = _now
+        if _now - self._refreshed_at > self.max_age:
+            self._refresh_in_background()
+        return _local.connection
+
+    def _describe_from_api(self, instance_types: list) -> dict:
+        # Fallback for instance types not (yet) in the catalog, results (including invalid instance types) are kept in memory
+        _missing = [_i for _i in instance_types if _i not in self._api_fallback]
+        if _missing:
+            _ec2_client = utils_boto3.get_boto(service_name="ec2").message
+            try:
+                _found = {
+                    _i["InstanceType"]: _i
+                    for _i in _ec2_client.describe_instance_types(
+                        InstanceTypes=_missing
+                    ).get("InstanceTypes", [])
+                }
+            except ClientError as err:
+                if err.response["Error"].get("Code") != "InvalidInstanceType":
+                    raise err
+                # At least one instance type is invalid, query them one by one
+                _found = {}
+                for _instance_type in _missing:
+                    try:
+                        for _i in _ec2_client.describe_instance_types(
+                            InstanceTypes=[_instance_type]
+                        ).get("InstanceTypes", []):
+                            _found[_i["InstanceType"]] = _i
+                    except ClientError as err:
+                        if err.response["Error"].get("Code") != "InvalidInstanceType":
+                            raise err
+            with self._lock:
+                for _instance_type in _missing:
+                    self._api_fallback[_instance_type] = _found.get(_instance_type)
+
+        return {
+            _i: self._api_fallback[_i]
+            for _i in instance_types
+            if self._api_fallback.get(_i) is not None
+        }
+
+    def _list_from_api(
+        self,
+        patterns: Optional[list] = None,
+        architecture: Optional[str] = None,
+        current_generation: Optional[bool] = None,
+        bare_metal: Optional[bool] = None,
+        hibernation_supported: Optional[bool] = None,
+    ) -> list:
+        # Fallback of list_instance_types when there is no catalog, the instance types returned are kept in memory
+        _filters = []
+        for _name, _value in (
+            ("instance-type", patterns),
+            ("processor-info.supported-architecture", architecture),
+            ("current-generation", current_generation),
+            ("bare-metal", bare_metal),
+            ("hibernation-supported", hibernation_supported),
+        ):
+            if _value is None or _value == []:
+                continue
+            if isinstance(_value, bool):
+                _value = str(_value).lower()
+            _filters.append(
+                {
+                    "Name": _name,
+                    "Values": list(_value) if isinstance(_value, list) else [_value],
+                }
+            )
+
+        _ec2_client = utils_boto3.get_boto(service_name="ec2").message
+        _instance_types = {}
+        _paginator = _ec2_client.get_paginator("describe_instance_types")
+        for _page in _paginator.paginate(MaxResults=100, Filters=_filters):
+            for _instance_type in _page.get("InstanceTypes", []):
+                _instance_types[_instance_type["InstanceType"]] = _instance_type
+        with self._lock:
+            self._api_fallback.update(_instance_types)
+        return sorted(_instance_types)
+
+    def _query(self, columns: str, instance_types: list) -> dict:
+        _result = {}
+        _connection = self._connection()
+        if _connection is not None:
+            for _row in _connection.execute(
+                f"SELECT {columns} FROM instance_types WHERE instance_type IN ({','.join(['?'] * len(instance_types))})",
+                instance_types,
+            ):
+                _result[_row["instance_type"]] = _row
+        return _result
+
+    def describe(self, instance_types: list) -> SocaResponse:
+        """
+        Return the DescribeInstanceTypes output of each instance type as a dict, invalid instance types are not returned.
+        Unlike the API, the order of instance_types is preserved
+        """
+        try:
+            _rows = self._query("instance_type, data", instance_types)
+            _found = {_i: json.loads(_r["data"]) for _i, _r in _rows.items()}
+            _missing = [_i for _i in instance_types if _i not in _found]
+            if _missing:
+                _found.update(self._describe_from_api(_missing))
+            return SocaResponse(
+                success=True,
+                message={_i: _found[_i] for _i in instance_types if _i in _found},
+            )
+        except Exception as err:
+            return SocaError.AWS_API_ERROR(
+                service_name="ec2",
+                helper=f"Unable to describe instance types {instance_types} due to {err}",
+            )
+
+    def get_summary(self, instance_type: str) -> [dict, None]:
+        """
+        Return the indexed attributes of instance_type (vcpus, cores, memory_mib ...) or None if the instance type does not exist
+        """
+        _rows = self._query(",".join(_CATALOG_COLUMNS), [instance_type])
+        if instance_type in _rows:
+            return dict(_rows[instance_type])
+        _instance = self._describe_from_api([instance_type]).get(instance_type)
+        return _summarize_instance_type(_instance) if _instance else None
+
+    def get_vcpus(self, instance_type: str) -> [int, None]:
+        _summary = self.get_summary(instance_type)
+        return _summary["vcpus"] if _summary else None
+
+    def get_cores(self, instance_type: str) -> [int, None]:
+        _summary = self.get_summary(instance_type)
+        return _summary["cores"] if _summary else None
+
+    def get_memory_mib(self, instance_type: str) -> [int, None]:
+        _summary = self.get_summary(instance_type)
+        return _summary["memory_mib"] if _summary else None
+
+    def get_architecture(self, instance_type: str) -> [str, None]:
+        # First supported architecture returned by DescribeInstanceTypes
+        _summary = self.get_summary(instance_type)
+        return _summary["architectures"].split(",")[0] if _summary else None
+
+    def supports_placement_group(
+        self, instance_type: str, placement_group_type: Optional[str] = "cluster"
+    ) -> bool:
+        _summary = self.get_summary(instance_type)
+        return bool(
+            _summary
+            and placement_group_type
+            in _summary["placement_group_strategies"].split(",")
+        )
+
+    def supports_hibernation(self, instance_type: str) -> bool:
+        _summary = self.get_summary(instance_type)
+        return bool(_summary and _summary["hibernation_supported"])
+
+    def is_ebs_optimized(self, instance_type: str) -> bool:
+        _summary = self.get_summary(instance_type)
+        return bool(
+            _summary
+            and _summary["ebs_optimized_support"].lower() in {"default", "supported"}
+        )
+
+    def list_instance_types(
+        self,
+        patterns: Optional[list] = None,
+        architecture: Optional[str] = None,
+        current_generation: Optional[bool] = None,
+        bare_metal: Optional[bool] = None,
+        hibernation_supported: Optional[bool] = None,
+    ) -> list:
+        """
+        Return the sorted list of instance types matching all filters.
+        patterns accept the same wildcards as the EC2 instance-type filter (e.g: c6i.*, *.metal)
+        """
+        _conditions = []
+        _values = []
+        if patterns:
+            _conditions.append(
+                "(" + " OR ".join(["instance_type GLOB ?"] * len(patterns)) + ")"
+            )
+            _values.extend(patterns)
+        if architecture is not None:
+            _conditions.append("(',' || architectures || ',') LIKE ?")
+            _values.append(f"%,{architecture},%")
+        for _column, _value in (
+            ("current_generation", current_generation),
+            ("bare_metal", bare_metal),
+            ("hibernation_supported", hibernation_supported),
+        ):
+            if _value is not None:
+                _conditions.append(f"{_column} = ?")
+                _values.append(int(_value))
+
+        _connection = self._connection()
+        if _connection is None:
+            return self._list_from_api(
+                patterns=patterns,
+                architecture=architecture,
+                current_generation=current_generation,
+                bare_metal=bare_metal,
+                hibernation_supported=hibernation_supported,
+            )
+        return [
+            _row["instance_type"]
+            for _row in _connection.execute(
+                f"SELECT instance_type FROM instance_types {'WHERE ' + ' AND '.join(_conditions) if _conditions else ''} ORDER BY instance_type",
+                _values,
+            )
+        ]
+
+
+_instance_catalog = {}
+
+
+def get_instance_catalog() -> SocaEC2InstanceCatalog:
+    """
+    Return the EC2 instance catalog of the current process
+    """
+    if _instance_catalog.get("pid") != os.getpid():
+        _instance_catalog["catalog"] = SocaEC2InstanceCatalog()
+        _instance_catalog["pid"] = os.getpid()
+    return _instance_catalog["catalog"]
@@ -0,0 +1,454 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import datetime
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional
+import utils.aws.boto3_wrapper as utils_boto3
+from utils.aws.ssm_parameter_store import SocaConfig
+from utils.cache import soca_cached
+from utils.error import SocaError
+from utils.response import SocaResponse
+
+logger = logging.getLogger("soca_logger")
+
+EC2_PRICING_INDEX_PATH = os.environ.get(
+    "SOCA_EC2_PRICING_INDEX",
+    f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_manager/cache/ec2_pricing_index.db",
+)
+
+# Pricing API is only available in a handful of regions, but returns the prices of all regions
+PRICING_API_REGION = "us-east-1"
+
+# Spot price history window loaded in the index
+SPOT_HISTORY_DAYS = 1
+
+PRICING_MODELS = ("ondemand", "reserved", "spot")
+
+# GetProducts filters of the Linux, shared tenancy, no pre-installed software price lists
+_PRICE_LIST_FILTERS = (
+    ("operatingSystem", "Linux"),
+    ("tenancy", "Shared"),
+    ("preInstalledSw", "NA"),
+    ("capacitystatus", "Used"),
+    ("licenseModel", "No License required"),
+)
+
+_INDEX_SCHEMA = """
+CREATE TABLE prices (
+    instance_type TEXT PRIMARY KEY,
+    ondemand REAL,
+    reserved REAL,
+    spot_min REAL,
+    spot_avg REAL,
+    spot_latest REAL
+);
+CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_PRICES_COLUMNS = (
+    "instance_type",
+    "ondemand",
+    "reserved",
+    "spot_min",
+    "spot_avg",
+    "spot_latest",
+)
+
+
+def _parse_price_list(price_list: dict) -> [tuple, None]:
+    """
+    Return (instance_type, ondemand, reserved) hourly prices of a GetProducts PriceList entry.
+    reserved is the standard 1yr No Upfront hourly rate
+    """
+    _instance_type = (
+        price_list.get("product", {}).get("attributes", {}).get("instanceType")
+    )
+    if not _instance_type:
+        return None
+    _ondemand = None
+    _reserved = None
+    for _term_type, _term_data in price_list.get("terms", {}).items():
+        for _sku_data in _term_data.values():
+            _term_attributes = _sku_data.get("termAttributes", {})
+            if _term_type != "OnDemand" and not (
+                _term_attributes.get("OfferingClass") == "standard"
+                and _term_attributes.get("LeaseContractLength") == "1yr"
+                and _term_attributes.get("PurchaseOption") == "No Upfront"
+            ):
+                continue
+            for _price_dimension in _sku_data.get("priceDimensions", {}).values():
+                _description = _price_dimension.get("description", "").lower()
+                _price = float(_price_dimension["pricePerUnit"]["USD"])
+                if (
+                    _term_type == "OnDemand"
+                    and f"on demand linux {_instance_type} instance hour"
+                    in _description
+                ):
+                    _ondemand = _price
+                elif (
+                    _term_type != "OnDemand"
+                    and "linux/unix (amazon vpc)" in _description
+                ):
+                    _reserved = _price
+    return _instance_type, _ondemand, _reserved
+
+
+@soca_cached(namespace="ec2/instance_type_price", ttl=86400)
+def get_instance_type_price(instance_type: str, region: str) -> dict:
+    """
+    Return the hourly ondemand and reserved (1yr No Upfront) Linux prices of a single instance type with GetProducts.
+    Results are shared by all processes of the cluster through the cache until the pricing index is loaded
+    """
+    _pricing_client = utils_boto3.get_boto(
+        service_name="pricing", region_name=PRICING_API_REGION
+    ).message
+    _response = _pricing_client.get_products(
+        ServiceCode="AmazonEC2",
+        Filters=[
+            {"Type": "TERM_MATCH", "Field": _field, "Value": _value}
+            for _field, _value in (
+                ("instanceType", instance_type),
+                ("regionCode", region),
+            )
+            + _PRICE_LIST_FILTERS
+        ],
+    )
+    _price = {}
+    for _price_list in _response.get("PriceList", []):
+        _parsed = _parse_price_list(json.loads(_price_list))
+        if _parsed is None or _parsed[0] != instance_type:
+            continue
+        for _model, _value in zip(("ondemand", "reserved"), _parsed[1:]):
+            if _value is not None:
+                _price[_model] = _value
+    return _price
+
+
+class SocaEC2PricingIndex:
+    """
+    Local index of the Linux EC2 prices (On-Demand, 1yr No Upfront Reserved and Spot) of the cluster region.
+    The price list of the region is bulk-loaded with a single paginated GetProducts sweep and the Spot price history
+    of the last SPOT_HISTORY_DAYS with DescribeSpotPriceHistory. Prices and Spot summaries are persisted as a sqlite database
+    shared by all processes of the controller, refreshed in a background thread when older than max_age seconds and atomically replaced on disk.
+    The prices table is loaded in memory, lookups do not issue any API call nor parse any PriceList document.
+    When the index does not exist yet, it is downloaded in a background thread and lookups return no price until it is written,
+    unless blocking_download is set (batch jobs) or the lookup asks for api_fallback (single instance type GetProducts).
+    A failed refresh is not retried before refresh_retry_interval seconds.
+
+    example:
+        index = get_pricing_index()
+        index.get_price("c6i.large") -> {"ondemand": 0.085, "reserved": 0.0536, "spot": 0.0301}
+    """
+
+    def __init__(
+        self,
+        index_path: Optional[str] = EC2_PRICING_INDEX_PATH,
+        region: Optional[str] = None,
+        max_age: Optional[int] = 21600,
+        inode_check_interval: Optional[int] = 5,
+        refresh_retry_interval: Optional[int] = 300,
+        blocking_download: Optional[bool] = False,
+    ):
+        self.index_path = index_path
+        self.region = region
+        self.max_age = max_age
+        self.inode_check_interval = inode_check_interval
+        self.refresh_retry_interval = refresh_retry_interval
+        self.blocking_download = blocking_download
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_failed_at = 0
+        self._refreshed_at = None
+        self._inode = None
+        self._inode_checked_at = 0
+        self._prices = {}
+
+    def _get_region(self) -> str:
+        if self.region is None:
+            self.region = SocaConfig(key="/configuration/Region").get_value().message
+        return self.region
+
+    def _download_prices(self) -> dict:
+        _pricing_client = utils_boto3.get_boto(
+            service_name="pricing", region_name=PRICING_API_REGION
+        ).message
+        _prices = {}
+        _paginator = _pricing_client.get_paginator("get_products")
+        for _page in _paginator.paginate(
+            ServiceCode="AmazonEC2",
+            Filters=[
+                {"Type": "TERM_MATCH", "Field": _field, "Value": _value}
+                for _field, _value in (("regionCode", self._get_region()),)
+                + _PRICE_LIST_FILTERS
+            ],
+            PaginationConfig={"PageSize": 100},
+        ):
+            for _price_list in _page.get("PriceList", []):
+                _parsed = _parse_price_list(json.loads(_price_list))
+                if _parsed is not None:
+                    _prices[_parsed[0]] = _parsed[1:]
+        return _prices
+
+    def _download_spot_history(self) -> list:
+        _ec2_client = utils_boto3.get_boto(
+            service_name="ec2", region_name=self._get_region()
+        ).message
+        _history = []
+        _paginator = _ec2_client.get_paginator("describe_spot_price_history")
+        for _page in _paginator.paginate(
+            ProductDescriptions=["Linux/UNIX"],
+            StartTime=datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(days=SPOT_HISTORY_DAYS),
+            PaginationConfig={"PageSize": 1000},
+        ):
+            for _record in _page.get("SpotPriceHistory", []):
+                _history.append(
+                    (
+                        _record["InstanceType"],
+                        _record["AvailabilityZone"],
+                        float(_record["SpotPrice"]),
+                        _record["Timestamp"].timestamp(),
+                    )
+                )
+        return _history
+
+    def _write(self, prices: dict, spot_history: list) -> None:
+        # Spot summary per instance type: min/avg over the window and cheapest current price across AZs
+        _spot = {}
+        _latest = {}
+        for _instance_type, _az, _price, _timestamp in spot_history:
+            _summary = _spot.setdefault(_instance_type, [_price, 0.0, 0])
+            _summary[0] = min(_summary[0], _price)
+            _summary[1] += _price
+            _summary[2] += 1
+            if _timestamp >= _latest.get((_instance_type, _az), (0, None))[0]:
+                _latest[(_instance_type, _az)] = (_timestamp, _price)
+        _spot_latest = {}
+        for (_instance_type, _az), (_timestamp, _price) in _latest.items():
+            _spot_latest[_instance_type] = min(
+                _price, _spot_latest.get(_instance_type, _price)
+            )
+
+        _rows = []
+        for _instance_type in sorted(set(prices) | set(_spot)):
+            _ondemand, _reserved = prices.get(_instance_type, (None, None))
+            _spot_summary = _spot.get(_instance_type)
+            _rows.append(
+                (
+                    _instance_type,
+                    _ondemand,
+                    _reserved,
+                    _spot_summary[0] if _spot_summary else None,
+                    _spot_summary[1] / _spot_summary[2] if _spot_summary else None,
+                    _spot_latest.get(_instance_type),
+                )
+            )
+
+        _index_dir = os.path.dirname(self.index_path)
+        os.makedirs(_index_dir, exist_ok=True)
+        _fd, _tmp_path = tempfile.mkstemp(
+            dir=_index_dir, prefix=".ec2_pricing_index.", suffix=".tmp"
+        )
+        os.close(_fd)
+        try:
+            _connection = sqlite3.connect(_tmp_path)
+            try:
+                _connection.executescript(_INDEX_SCHEMA)
+                _connection.executemany(
+                    f"INSERT INTO prices VALUES ({','.join(['?'] * len(_PRICES_COLUMNS))})",
+                    _rows,
+                )
+                _connection.executemany(
+                    "INSERT INTO metadata VALUES (?, ?)",
+                    (("refreshed_at", str(time.time())), ("region", self.region)),
+                )
+                _connection.commit()
+            finally:
+                _connection.close()
+            os.chmod(_tmp_path, 0o644)
+            # Readers keep using the previous file until they reopen it
+            os.replace(_tmp_path, self.index_path)
+        finally:
+            if os.path.exists(_tmp_path):
+                os.remove(_tmp_path)
+
+    def refresh(self, blocking: Optional[bool] = True) -> SocaResponse:
+        """
+        Download the price list and the Spot price history and replace the local file. Only one process refreshes the index at a time,
+        with blocking=False the refresh is skipped if another process is already refreshing it.
+        """
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(f"{self.index_path}.lock", "w") as _lock_file:
+                try:
+                    fcntl.flock(
+                        _lock_file,
+                        fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB,
+                    )
+                except BlockingIOError:
+                    return SocaResponse(
+                        success=True,
+                        message="EC2 pricing index is already being refreshed by another process",
+                    )
+
+                # Another process may have refreshed the index while we were waiting for the lock
+                if not self._is_stale():
+                    return SocaResponse(
+                        success=True, message="EC2 pricing index is up to date"
+                    )
+
+                _start = time.perf_counter()
+                _prices = self._download_prices()
+                try:
+                    _spot_history = self._download_spot_history()
+                except Exception as err:
+                    # On-Demand and Reserved prices are still indexed, Spot prices are retried at the next refresh
+                    logger.warning(
+                        f"Unable to download Spot price history, EC2 pricing index is written without Spot prices: {err}"
+                    )
+                    _spot_history = []
+                self._write(_prices, _spot_history)
+                logger.info(
+                    f"Refreshed EC2 pricing index for {self.region} with {len(_prices)} instance types and {len(_spot_history)} Spot prices in {time.perf_counter() - _start:.2f}s"
+                )
+                return SocaResponse(
+                    success=True,
+                    message=f"EC2 pricing index refreshed with {len(_prices)} instance types",
+                )
+        except Exception as err:
+            self._refresh_failed_at = time.time()
+            return SocaError.AWS_API_ERROR(
+                service_name="pricing",
+                helper=f"Unable to refresh EC2 pricing index {self.index_path} due to {err}",
+            )
+
+    def _can_retry_refresh(self) -> bool:
+        return time.time() - self._refresh_failed_at >= self.refresh_retry_interval
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            if not self._can_retry_refresh():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self.refresh, kwargs={"blocking": False}, daemon=True
+            )
+            self._refresh_thread.start()
+
+    def _read_metadata(self, connection: sqlite3.Connection) -> dict:
+        return {
+            _key: _value
+            for _key, _value in connection.execute("SELECT key, value FROM metadata")
+        }
+
+    def _is_stale(self) -> bool:
+        try:
+            _connection = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+            try:
+                _metadata = self._read_metadata(_connection)
+            finally:
+                _connection.close()
+        except sqlite3.Error:
+            return True
+        # Index built for another region (e.g: file copied from another cluster) is never valid
+        if _metadata.get("region") != self._get_region():
+            return True
+        return time.time() - float(_metadata.get("refreshed_at", 0)) > self.max_age
+
+    def _load(self) -> dict:
+        # Prices are kept in memory and reloaded when the index file has been replaced by a refresh
+        _now = time.time()
+        if self._inode is not None and _now - self._inode_checked_at < (
+            self.inode_check_interval
+        ):
+            return self._prices
+
+        try:
+            _inode = os.stat(self.index_path).st_ino
+        except FileNotFoundError:
+            if not self.blocking_download:
+                self._refresh_in_background()
+                return self._prices
+            if not self._can_retry_refresh():
+                return self._prices
+            logger.info(
+                f"EC2 pricing index {self.index_path} not found, downloading it"
+            )
+            _refresh = self.refresh(blocking=True)
+            if _refresh.get("success") is False:
+                logger.error(_refresh.get("message"))
+                return self._prices
+            _inode = os.stat(self.index_path).st_ino
+
+        if _inode != self._inode:
+            _connection = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True)
+            try:
+                _prices = {
+                    _row[0]: {
+                        "ondemand": _row[1],
+                        "reserved": _row[2],
+                        "spot": _row[5],
+                        "spot_min": _row[3],
+                        "spot_avg": _row[4],
+                    }
+                    for _row in _connection.execute(
+                        f"SELECT {','.join(_PRICES_COLUMNS)} FROM prices"
+                    )
+                }
+                _metadata = self._read_metadata(_connection)
+            finally:
+                _connection.close()
+            with self._lock:
+                self._prices = _prices
+                self._inode = _inode
+                self._refreshed_at = float(_metadata.get("refreshed_at", 0))
+                if _metadata.get("region") != self._get_region():
+                    self._refreshed_at = 0
+
+        self._inode_checked_at = _now
+        if _now - self._refreshed_at > self.max_age:
+            self._refresh_in_background()
+        return self._prices
+
+    def get_price(
+        self, instance_type: str, api_fallback: Optional[bool] = False
+    ) -> dict:
+        """
+        Return the hourly ondemand, reserved (1yr No Upfront) and spot (cheapest current price across AZs) prices of instance_type.
+        Prices not available for the instance type are not returned, an empty dict is returned for unknown instance types.
+        With api_fallback, the ondemand and reserved prices of instance_type are queried via the Pricing API until the index is loaded.
+        """
+        _prices = self._load()
+        if not _prices and api_fallback:
+            # The first region-wide sweep takes minutes, don't make interactive callers wait for it
+            return get_instance_type_price(
+                instance_type=instance_type, region=self._get_region()
+            )
+        _price = _prices.get(instance_type, {})
+        return {
+            _model: _price[_model]
+            for _model in PRICING_MODELS
+            if _price.get(_model) is not None
+        }
+
+
+_pricing_index = {}
+
+
+def get_pricing_index(**kwargs) -> SocaEC2PricingIndex:
+    """
+    Return the EC2 pricing index of the current process, kwargs are only used when it is created
+    """
+    if _pricing_index.get("pid") != os.getpid():
+        _pricing_index["index"] = SocaEC2PricingIndex(**kwargs)
+        _pricing_index["pid"] = os.getpid()
+    return _pricing_index["index"]
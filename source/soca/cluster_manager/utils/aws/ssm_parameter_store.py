@@ -3,6 +3,8 @@
 
 import os
 import logging
+import threading
+import time
 from typing import Type, Optional, Any
 import utils.aws.boto3_wrapper as utils_boto3
 from utils.cache import SocaCacheClient
@@ -13,6 +15,9 @@ from utils.config_checks import SocaConfigKeyVerifier
 
 logger = logging.getLogger("soca_logger")
 
+# Cache key updated every time a parameter is changed with SocaConfig.set_value, used to refresh SocaConfigSnapshot
+CONFIG_SNAPSHOT_VERSION_KEY = "/system/config_snapshot_version"
+
 
 class SocaConfig:
     def __init__(
@@ -103,6 +108,7 @@ class SocaConfig:
                         f"default is set but ignored as SSM key ({self._full_parameter_name}) is path and will always return a dict"
                     )
 
+                _to_cache = {}
                 for _page in _response_paginator:
                     parameters = _page["Parameters"]
                     if not parameters:
@@ -115,20 +121,7 @@ class SocaConfig:
                             return SocaResponse(success=False, message={})
 
                     for _entry in parameters:
-                        if cache_result is True:
-                            if (
-                                self.cache_admin is True
-                                and _cache_enabled.success is True
-                            ):
-                                logger.debug(f"Caching {_entry['Name']} ...  ")
-                                self._cache_client.set(
-                                    key=_entry["Name"], value=_entry["Value"]
-                                )
-                            else:
-                                logger.debug(
-                                    "cache_result is True but cache_admin is False or cache is not enabled, data won't be cached"
-                                )
-
+                        _to_cache[_entry["Name"]] = _entry["Value"]
                         _output[
                             (
                                 _entry["Name"]
@@ -139,6 +132,16 @@ class SocaConfig:
                             )
                         ] = _entry["Value"]
 
+                if cache_result is True:
+                    if self.cache_admin is True and _cache_enabled.success is True:
+                        # Cache the entire hierarchy in a single round-trip
+                        logger.debug(f"Caching {len(_to_cache)} keys ...  ")
+                        self._cache_client.mset(mapping=_to_cache)
+                    else:
+                        logger.debug(
+                            "cache_result is True but cache_admin is False or cache is not enabled, data won't be cached"
+                        )
+
                 return SocaResponse(success=True, message=_output)
             else:
                 _response = self._ssm_client.get_parameter(
@@ -256,6 +259,14 @@ class SocaConfig:
                     Overwrite=True,
                 )
                 if _update_key.get("ResponseMetadata").get("HTTPStatusCode") == 200:
+                    if (
+                        self.cache_admin is True
+                        and self._cache_client.is_enabled().success is True
+                    ):
+                        # Notify all SocaConfigSnapshot that the configuration has changed
+                        self._cache_client.set(
+                            key=CONFIG_SNAPSHOT_VERSION_KEY, value=str(time.time())
+                        )
                     return SocaResponse(success=True, message="Key update successfully")
                 else:
                     return SocaError.AWS_API_ERROR(
@@ -271,3 +282,100 @@ class SocaConfig:
                 service_name="ssm_parameterstore",
                 helper=f"Unknown error while trying to retrieve parameter {self._full_parameter_name} due to {e}",
             )
+
+
+class SocaConfigSnapshot:
+    """
+    In-process snapshot of the entire /soca/<cluster_id>/ configuration tree, shared by all threads of the process.
+    The tree is loaded once (paginated get_parameters_by_path) and all reads are served from memory.
+    The snapshot is reloaded when it is older than ttl seconds, or when the version key stored in cache
+    (updated by SocaConfig.set_value) has changed. The version key is checked at most every version_check_interval seconds.
+
+    example:
+        SocaConfigSnapshot.get_snapshot() -> same output as SocaConfig(key="/").get_value(return_as=dict)
+        SocaConfigSnapshot.get_value(key="/configuration/Region")
+    """
+
+    ttl = 300
+    version_check_interval = 15
+    _lock = threading.Lock()
+    _parameters = None
+    _version = None
+    _loaded_at = 0
+    _version_checked_at = 0
+
+    @classmethod
+    def _get_version(cls) -> [str, None]:
+        _cache_client = SocaCacheClient(is_admin=False)
+        if _cache_client.is_enabled().success:
+            _version = _cache_client.get(key=CONFIG_SNAPSHOT_VERSION_KEY)
+            if _version.success:
+                return _version.message
+        return None
+
+    @classmethod
+    def get_snapshot(cls, force_refresh: Optional[bool] = False) -> SocaResponse:
+        with cls._lock:
+            _now = time.time()
+            if (
+                force_refresh is False
+                and cls._parameters is not None
+                and _now - cls._loaded_at < cls.ttl
+            ):
+                if _now - cls._version_checked_at < cls.version_check_interval:
+                    return SocaResponse(success=True, message=dict(cls._parameters))
+
+                cls._version_checked_at = _now
+                if cls._get_version() == cls._version:
+                    return SocaResponse(success=True, message=dict(cls._parameters))
+                logger.info("Configuration version has changed, reloading snapshot")
+
+            # Read the version first, a change made while the tree is loading will trigger a new reload
+            _version = cls._get_version()
+            _tree = SocaConfig(key="/").get_value(return_as=dict)
+            if _tree.get("success") is False or not _tree.get("message"):
+                if cls._parameters is not None:
+                    logger.warning(
+                        f"Unable to reload configuration snapshot, keeping previous snapshot: {_tree.get('message')}"
+                    )
+                    return SocaResponse(success=True, message=dict(cls._parameters))
+                return SocaError.AWS_API_ERROR(
+                    service_name="ssm_parameterstore",
+                    helper=f"Unable to load configuration snapshot: {_tree.get('message')}",
+                )
+
+            logger.debug(f"Loaded configuration snapshot, version {_version}")
+            cls._parameters = _tree.get("message")
+            cls._version = _version
+            cls._loaded_at = _now
+            cls._version_checked_at = _now
+            return SocaResponse(success=True, message=dict(cls._parameters))
+
+    @classmethod
+    def get_value(
+        cls,
+        key: str,
+        return_as: Optional[Type] = str,
+        default: Optional[Any] = None,
+    ) -> SocaResponse:
+        _key = key if key.startswith("/") else f"/{key}"
+        _snapshot = cls.get_snapshot()
+        if _snapshot.get("success") is False:
+            return _snapshot
+
+        if _key not in _snapshot.get("message").keys():
+            if default is not None:
+                return SocaResponse(success=True, message=default)
+            return SocaError.AWS_API_ERROR(
+                service_name="ssm_parameterstore",
+                helper=f"{_key} not found in configuration snapshot",
+            )
+
+        _result = SocaCastEngine(_snapshot.get("message")[_key]).cast_as(
+            expected_type=return_as
+        )
+        if not _result.success:
+            return SocaError.CAST_ERROR(
+                helper=f"Value retrieved from configuration snapshot but could not cast {_snapshot.get('message')[_key]} as {return_as}"
+            )
+        return SocaResponse(success=True, message=_result.message)
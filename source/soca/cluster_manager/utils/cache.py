@@ -1,7 +1,13 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
+import copy
+import functools
+import hashlib
+import json
 import logging
+import threading
+import time
 import redis
 from utils.aws.secrets_manager import SocaSecret
 import utils.aws.boto3_wrapper as utils_boto3
@@ -90,7 +96,7 @@ class SocaCacheClient:
         except Exception as err:
             return SocaError.CACHE_ERROR(helper=f"Unable to scan cache due to {err}")
 
-    def set(self, key, value, ex=None):
+    def set(self, key, value, ex=None, nx=False):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Cache Set {key=} -> {value=}")
         try:
@@ -98,7 +104,8 @@ class SocaCacheClient:
                 if not ex:
                     ex = self.ttl_long
 
-                _q = self.cache_client.set(f"{self.key_fqdn(key)}", value, ex=ex)
+                # nx=True only set the key if it does not already exist
+                _q = self.cache_client.set(f"{self.key_fqdn(key)}", value, ex=ex, nx=nx)
                 if _q:
                     return SocaResponse(
                         success=True, message=f"Key {key} cached successfully"
@@ -116,17 +123,17 @@ class SocaCacheClient:
             logger.debug(f"Cache Delete {key=}")
         try:
             if self.redis:
-                if self.exists(self.key_fqdn(key)).success:
-                    _q = self.cache_client.delete(f"{self.key_fqdn(key)}")
-                    if _q == 1:
-                        return SocaResponse(
-                            success=True, message=f"Key {key} deleted successfully"
-                        )
-                    else:
-                        return SocaResponse(
-                            success=False,
-                            message=f"Unable to delete {key}. Redis Response: {_q}",
-                        )
+                # DEL returns the number of keys removed, no need for a prior EXISTS round-trip
+                _q = self.cache_client.delete(f"{self.key_fqdn(key)}")
+                if _q == 1:
+                    return SocaResponse(
+                        success=True, message=f"Key {key} deleted successfully"
+                    )
+                else:
+                    return SocaResponse(
+                        success=False,
+                        message=f"Unable to delete {key}. Key does not exist in cache",
+                    )
         except Exception as err:
             return SocaError.CACHE_ERROR(helper=f"Unable to delete {key} due to {err}")
 
@@ -136,16 +143,130 @@ class SocaCacheClient:
 
         try:
             if self.redis:
-                if self.exists(self.key_fqdn(key)).success:
-                    return SocaResponse(
-                        success=True, message=self.cache_client.get(self.key_fqdn(key))
-                    )
+                # GET returns None when the key does not exist, no need for a prior EXISTS round-trip
+                _value = self.cache_client.get(self.key_fqdn(key))
+                if _value is not None:
+                    return SocaResponse(success=True, message=_value)
                 else:
                     logger.info(f"Key {key} does not exist in cache")
                     return SocaResponse(success=False, message="CACHE_MISS")
         except Exception as err:
             return SocaError.CACHE_ERROR(helper=f"Unable to get {key} due to {err}")
 
+    def mget(self, keys: list):
+        """
+        Retrieve multiple keys in a single round-trip.
+        Return a dict of key: value for the keys found in cache, missing keys are not included
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Cache MGet {keys=}")
+        try:
+            if self.redis:
+                if not keys:
+                    return SocaResponse(success=True, message={})
+                _values = self.cache_client.mget([self.key_fqdn(_k) for _k in keys])
+                return SocaResponse(
+                    success=True,
+                    message={_k: _v for _k, _v in zip(keys, _values) if _v is not None},
+                )
+        except Exception as err:
+            return SocaError.CACHE_ERROR(helper=f"Unable to mget {keys} due to {err}")
+
+    def mset(self, mapping: dict, ex=None):
+        """
+        Cache multiple key: value in a single round-trip.
+        MSET does not support expiration, so keys are set through a non-transactional pipeline to keep a TTL on each key
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Cache MSet {mapping=}")
+        try:
+            if self.redis:
+                if not mapping:
+                    return SocaResponse(success=True, message="No key to cache")
+                if not ex:
+                    ex = self.ttl_long
+
+                _pipeline = self.cache_client.pipeline(transaction=False)
+                for _k, _v in mapping.items():
+                    _pipeline.set(self.key_fqdn(_k), _v, ex=ex)
+                _q = _pipeline.execute()
+                if all(_q):
+                    return SocaResponse(
+                        success=True,
+                        message=f"{len(mapping)} keys cached successfully",
+                    )
+                else:
+                    return SocaResponse(
+                        success=False,
+                        message=f"Unable to cache all keys. Redis Response: {_q}",
+                    )
+        except Exception as err:
+            return SocaError.CACHE_ERROR(
+                helper=f"Unable to mset {list(mapping.keys())} due to {err}"
+            )
+
+    def pipeline(self, operations: list, transaction: Optional[bool] = False):
+        """
+        Run multiple commands in a single round-trip. Set transaction=True to run them atomically (MULTI/EXEC).
+        operations is a list of tuple (command, key, *args) with an optional dict of keyword arguments as last element.
+        Return the list of results in the same order as operations
+
+        example:
+            pipeline(operations=[("set", "/key1", "value", {"ex": 60}), ("get", "/key2"), ("delete", "/key3")])
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Cache Pipeline {operations=} {transaction=}")
+        try:
+            if self.redis:
+                _pipeline = self.cache_client.pipeline(transaction=transaction)
+                for _operation in operations:
+                    _command, _key, *_args = _operation
+                    _kwargs = (
+                        _args.pop() if _args and isinstance(_args[-1], dict) else {}
+                    )
+                    getattr(_pipeline, _command)(self.key_fqdn(_key), *_args, **_kwargs)
+                return SocaResponse(success=True, message=_pipeline.execute())
+        except Exception as err:
+            return SocaError.CACHE_ERROR(
+                helper=f"Unable to run pipeline {operations} due to {err}"
+            )
+
+    def atomic_update(self, key, function, ex=None, retries: Optional[int] = 10):
+        """
+        Read-modify-write a single key atomically (WATCH/MULTI/EXEC).
+        function receives the current value (None if key does not exist) and returns the new value. function is called again
+        with the latest value when key is modified by another client before the update is committed, up to retries times.
+        Return the new value
+
+        example:
+            atomic_update(key="/counter", function=lambda value: str(int(value or 0) + 1))
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Cache Atomic Update {key=}")
+        try:
+            if self.redis:
+                if not ex:
+                    ex = self.ttl_long
+
+                _key = self.key_fqdn(key)
+                with self.cache_client.pipeline(transaction=True) as _pipeline:
+                    for _ in range(retries):
+                        try:
+                            _pipeline.watch(_key)
+                            _value = function(_pipeline.get(_key))
+                            _pipeline.multi()
+                            _pipeline.set(_key, _value, ex=ex)
+                            _pipeline.execute()
+                            return SocaResponse(success=True, message=_value)
+                        except redis.WatchError:
+                            logger.debug(f"{key} modified concurrently, retrying")
+                return SocaResponse(
+                    success=False,
+                    message=f"Unable to update {key}, key modified concurrently {retries} times",
+                )
+        except Exception as err:
+            return SocaError.CACHE_ERROR(helper=f"Unable to update {key} due to {err}")
+
     def lrange(self, key, start, end):
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Cache lrange {key=}:  {start}-{end}")
@@ -252,3 +373,280 @@ def get_cache_config(is_admin: bool = False) -> dict:
         _cache_client = None
 
     return {"cache_client": _cache_client, "cache_info": _cache_info}
+
+
+# Two-tier cache used by @soca_cached: bounded in-process tier in front of the shared Redis/Valkey tier
+_soca_cached_lock = threading.Lock()
+_soca_cached_metrics = {}
+_soca_cached_inflight = {}
+_soca_cached_remote = {}
+
+
+def _soca_cached_count(namespace: str, metric: str) -> None:
+    with _soca_cached_lock:
+        _namespace_metrics = _soca_cached_metrics.setdefault(
+            namespace,
+            {
+                "local_hit": 0,
+                "remote_hit": 0,
+                "negative_hit": 0,
+                "miss": 0,
+                "remote_error": 0,
+            },
+        )
+        _namespace_metrics[metric] += 1
+
+
+def get_cache_metrics() -> SocaResponse:
+    """
+    Return hit/miss counters per @soca_cached namespace for the current process
+    """
+    with _soca_cached_lock:
+        return SocaResponse(
+            success=True,
+            message={
+                _namespace: dict(_metrics)
+                for _namespace, _metrics in _soca_cached_metrics.items()
+            },
+        )
+
+
+def _soca_cached_remote_client():
+    # Built once per process, None if the cache is not enabled or cannot be reached
+    _pid = os.getpid()
+    if _soca_cached_remote.get("pid") != _pid:
+        try:
+            _client = SocaCacheClient(is_admin=True)
+            if not _client.is_enabled().success:
+                _client = None
+        except Exception as err:
+            logger.warning(
+                f"Unable to build cache client, @soca_cached will only use the local tier: {err}"
+            )
+            _client = None
+        _soca_cached_remote.update({"pid": _pid, "client": _client})
+    return _soca_cached_remote.get("client")
+
+
+def _soca_cached_serialize(value, negative: bool):
+    if isinstance(value, SocaResponse):
+        _payload = {
+            "type": "SocaResponse",
+            "success": value.success,
+            "message": value.message,
+            "status_code": value.status_code,
+        }
+    else:
+        _payload = {"type": "value", "value": value}
+    _payload["negative"] = negative
+    _data = json.dumps(_payload)
+    # Tuples, sets or non-str dict keys do not survive the JSON round-trip, keep them in the local tier only
+    if json.loads(_data) != _payload:
+        raise ValueError("value is not preserved by a JSON round-trip")
+    return _data
+
+
+def _soca_cached_deserialize(data):
+    _payload = json.loads(data)
+    if _payload.get("type") == "SocaResponse":
+        _value = SocaResponse(
+            success=_payload.get("success"),
+            message=_payload.get("message"),
+            status_code=_payload.get("status_code"),
+        )
+    else:
+        _value = _payload.get("value")
+    return _value, _payload.get("negative", False)
+
+
+def _soca_cached_is_negative(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, SocaResponse):
+        return value.success is False
+    return False
+
+
+def soca_cached(
+    namespace: str,
+    ttl: Optional[int] = 3600,
+    local_ttl: Optional[int] = 60,
+    local_maxsize: Optional[int] = 1024,
+    negative_ttl: Optional[int] = 30,
+    remote: Optional[bool] = True,
+    lock_timeout: Optional[int] = 30,
+):
+    """
+    Cache-aside decorator backed by a two-tier cache:
+    - a bounded in-process TTL tier (local_maxsize entries kept at most local_ttl seconds), shared by all threads of the process
+    - the shared Redis/Valkey tier (ttl seconds), shared by all processes and hosts of the cluster. Skipped if remote is False or if cache is not enabled
+
+    The cache key is built from namespace and the function arguments, namespace must be unique per function.
+    Negative results (None or SocaResponse with success=False) are cached for negative_ttl seconds (0 to disable) to avoid hammering a failing backend.
+    Exceptions are never cached.
+    Concurrent misses on the same key are collapsed (single-flight): within a process through a lock, across processes through a
+    lock key in Redis. Waiters poll the remote tier for up to lock_timeout seconds before computing the value themselves.
+    Values cached in the remote tier must be returned unchanged by a JSON round-trip (no tuple, set or non-str dict key),
+    otherwise they are only cached in the local tier.
+
+    example:
+        @soca_cached(namespace="ec2/instance_arch", ttl=86400)
+        def get_arch_for_instance_type(instancetype: str) -> str:
+
+        get_arch_for_instance_type.invalidate("m5.large")
+    """
+
+    def decorator(function):
+        _local = TTLCache(maxsize=local_maxsize, ttl=max(local_ttl, negative_ttl, 1))
+        _local_lock = threading.Lock()
+
+        def build_key(args, kwargs) -> str:
+            _arguments = json.dumps([args, kwargs], sort_keys=True, default=str)
+            return f"soca_cached/{namespace}/{hashlib.sha256(_arguments.encode('utf-8')).hexdigest()}"
+
+        def get_local(key):
+            with _local_lock:
+                _entry = _local.get(key)
+            if _entry is None:
+                return None
+            _expires_at, _value, _negative = _entry
+            if _expires_at < time.time():
+                return None
+            return _entry
+
+        def set_local(key, value, negative: bool):
+            _expires_at = time.time() + (
+                min(local_ttl, negative_ttl) if negative else local_ttl
+            )
+            with _local_lock:
+                _local[key] = (_expires_at, value, negative)
+
+        def get_remote(client, key):
+            try:
+                _q = client.get(key=key)
+                if _q.success:
+                    return _soca_cached_deserialize(_q.message)
+            except Exception as err:
+                _soca_cached_count(namespace, "remote_error")
+                logger.warning(f"Unable to read {key} from cache: {err}")
+            return None
+
+        def set_remote(client, key, value, negative: bool):
+            try:
+                _q = client.set(
+                    key=key,
+                    value=_soca_cached_serialize(value, negative),
+                    ex=negative_ttl if negative else ttl,
+                )
+                if not _q or _q.success is False:
+                    _soca_cached_count(namespace, "remote_error")
+            except (TypeError, ValueError) as err:
+                logger.debug(
+                    f"{key} cannot be stored as JSON, not caching remotely: {err}"
+                )
+            except Exception as err:
+                _soca_cached_count(namespace, "remote_error")
+                logger.warning(f"Unable to write {key} to cache: {err}")
+
+        def lookup(key, client):
+            _entry = get_local(key)
+            if _entry is not None:
+                _soca_cached_count(
+                    namespace, "negative_hit" if _entry[2] else "local_hit"
+                )
+                return True, _entry[1]
+
+            if client is not None:
+                _remote = get_remote(client, key)
+                if _remote is not None:
+                    _value, _negative = _remote
+                    _soca_cached_count(
+                        namespace, "negative_hit" if _negative else "remote_hit"
+                    )
+                    set_local(key, _value, _negative)
+                    return True, _value
+
+            return False, None
+
+        def compute(key, client, args, kwargs):
+            _value = function(*args, **kwargs)
+            _negative = _soca_cached_is_negative(_value)
+            if _negative and negative_ttl <= 0:
+                return _value
+            set_local(key, _value, _negative)
+            if client is not None:
+                set_remote(client, key, _value, _negative)
+            return _value
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            _key = build_key(args, kwargs)
+            _client = _soca_cached_remote_client() if remote else None
+
+            _found, _value = lookup(_key, _client)
+            if _found:
+                return copy.deepcopy(_value)
+
+            # Single-flight within the process, only one thread computes a given key
+            with _soca_cached_lock:
+                _key_lock = _soca_cached_inflight.setdefault(_key, threading.Lock())
+
+            with _key_lock:
+                try:
+                    # Another thread may have populated the cache while we were waiting
+                    _entry = get_local(_key)
+                    if _entry is not None:
+                        _soca_cached_count(
+                            namespace, "negative_hit" if _entry[2] else "local_hit"
+                        )
+                        return copy.deepcopy(_entry[1])
+
+                    _soca_cached_count(namespace, "miss")
+                    if _client is None:
+                        return copy.deepcopy(compute(_key, None, args, kwargs))
+
+                    # Single-flight across processes, only the owner of the lock key computes the value
+                    _lock_key = f"{_key}/lock"
+                    _acquired = _client.set(
+                        key=_lock_key, value=str(os.getpid()), ex=lock_timeout, nx=True
+                    )
+                    if _acquired and _acquired.success:
+                        try:
+                            return copy.deepcopy(compute(_key, _client, args, kwargs))
+                        finally:
+                            _client.delete(key=_lock_key)
+
+                    _deadline = time.time() + lock_timeout
+                    while time.time() < _deadline:
+                        time.sleep(0.1)
+                        _remote = get_remote(_client, _key)
+                        if _remote is not None:
+                            set_local(_key, _remote[0], _remote[1])
+                            return copy.deepcopy(_remote[0])
+
+                    logger.warning(
+                        f"Timeout waiting for {_key} to be computed by another process, computing it locally"
+                    )
+                    return copy.deepcopy(compute(_key, _client, args, kwargs))
+                finally:
+                    with _soca_cached_lock:
+                        _soca_cached_inflight.pop(_key, None)
+
+        def invalidate(*args, **kwargs):
+            _key = build_key(args, kwargs)
+            with _local_lock:
+                _local.pop(_key, None)
+            _client = _soca_cached_remote_client() if remote else None
+            if _client is not None:
+                _client.delete(key=_key)
+
+        def cache_clear():
+            # Only clear the local tier, remote entries expire after ttl
+            with _local_lock:
+                _local.clear()
+
+        wrapper.invalidate = invalidate
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
@@ -1,20 +1,160 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    meta,
+    nodes,
+    select_autoescape,
+)
 from utils.cast import SocaCastEngine
 from utils.error import SocaError
 from utils.response import SocaResponse
 from utils.aws.boto3_wrapper import get_boto
+import hashlib
+import json
 import logging
 import os
 import sys
 import pathlib
+import threading
+from collections import OrderedDict
 from types import SimpleNamespace
 
 
 logger = logging.getLogger("soca_logger")
 
+# Compiled templates are shared by all SocaJinja2Generator of the process and persisted across processes with the bytecode cache
+JINJA2_BYTECODE_CACHE_PATH = os.environ.get(
+    "SOCA_JINJA2_BYTECODE_CACHE",
+    f"/opt/soca/{os.environ.get('SOCA_CLUSTER_ID')}/cluster_manager/cache/jinja2",
+)
+RENDER_CACHE_MAXSIZE = 256
+
+_jinja2_lock = threading.Lock()
+_jinja2_environments = {}
+# (template_dirs, template_name): {"files": {path: mtime}, "hash": str, "keys": set or None}
+_template_fingerprints = {}
+_render_cache = OrderedDict()
+_render_cache_metrics = {"hit": 0, "miss": 0}
+
+
+def _get_jinja2_environment(template_dirs: tuple) -> Environment:
+    with _jinja2_lock:
+        _env = _jinja2_environments.get(template_dirs)
+        if _env is None:
+            try:
+                pathlib.Path(JINJA2_BYTECODE_CACHE_PATH).mkdir(
+                    parents=True, exist_ok=True
+                )
+                _bytecode_cache = FileSystemBytecodeCache(JINJA2_BYTECODE_CACHE_PATH)
+            except Exception as err:
+                logger.warning(
+                    f"Unable to use {JINJA2_BYTECODE_CACHE_PATH} as Jinja2 bytecode cache: {err}"
+                )
+                _bytecode_cache = None
+            _env = Environment(
+                loader=FileSystemLoader(list(template_dirs)),
+                extensions=["jinja2.ext.do"],
+                autoescape=select_autoescape(
+                    enabled_extensions=("j2", "jinja2"),
+                    default_for_string=True,
+                    default=True,
+                ),
+                bytecode_cache=_bytecode_cache,
+            )
+            _jinja2_environments[template_dirs] = _env
+        return _env
+
+
+def _context_keys(ast) -> [set, None]:
+    """
+    Return the keys read by the template with context.get("<key>") or context["<key>"], None if context is used any other way
+    """
+    _keys = set()
+    _static_lookups = 0
+    for _node in ast.find_all((nodes.Call, nodes.Getitem)):
+        if isinstance(_node, nodes.Call):
+            _target = _node.node
+            if (
+                isinstance(_target, nodes.Getattr)
+                and isinstance(_target.node, nodes.Name)
+                and _target.node.name == "context"
+                and _target.attr == "get"
+                and _node.args
+                and isinstance(_node.args[0], nodes.Const)
+            ):
+                _keys.add(_node.args[0].value)
+                _static_lookups += 1
+        elif (
+            isinstance(_node.node, nodes.Name)
+            and _node.node.name == "context"
+            and isinstance(_node.arg, nodes.Const)
+        ):
+            _keys.add(_node.arg.value)
+            _static_lookups += 1
+
+    _context_usages = sum(
+        1
+        for _node in ast.find_all(nodes.Name)
+        if _node.name == "context" and _node.ctx == "load"
+    )
+    return _keys if _context_usages == _static_lookups else None
+
+
+def _get_template_fingerprint(env: Environment, template_name: str) -> dict:
+    """
+    Return the hash of a template and all templates it includes/imports, and the context keys they read.
+    keys is None when the context keys can't be determined statically (dynamic include or context usage)
+    """
+    _cache_key = (tuple(env.loader.searchpath), template_name)
+    with _jinja2_lock:
+        _cached = _template_fingerprints.get(_cache_key)
+    if _cached is not None and all(
+        os.path.exists(_path) and os.path.getmtime(_path) == _mtime
+        for _path, _mtime in _cached["files"].items()
+    ):
+        return _cached
+
+    _files = {}
+    _keys = set()
+    _hash = hashlib.sha256()
+    _to_visit = [template_name]
+    _visited = set()
+    while _to_visit:
+        _name = _to_visit.pop()
+        if _name in _visited:
+            continue
+        _visited.add(_name)
+        _source, _path, _ = env.loader.get_source(env, _name)
+        _files[_path] = os.path.getmtime(_path)
+        _hash.update(_name.encode())
+        _hash.update(_source.encode())
+        _ast = env.parse(_source)
+        for _referenced in meta.find_referenced_templates(_ast):
+            if _referenced is None:
+                _keys = None
+            else:
+                _to_visit.append(_referenced)
+        if _keys is not None:
+            _template_keys = _context_keys(_ast)
+            _keys = None if _template_keys is None else _keys | _template_keys
+
+    _fingerprint = {"files": _files, "hash": _hash.hexdigest(), "keys": _keys}
+    with _jinja2_lock:
+        _template_fingerprints[_cache_key] = _fingerprint
+    return _fingerprint
+
+
+def get_render_cache_metrics() -> SocaResponse:
+    with _jinja2_lock:
+        return SocaResponse(
+            success=True,
+            message={**_render_cache_metrics, "size": len(_render_cache)},
+        )
+
 
 class SocaJinja2Generator:
     def __init__(self, get_template: str, variables: dict, template_dirs: list):
@@ -32,18 +172,29 @@ class SocaJinja2Generator:
             )
 
         logger.debug(f"Jinja2 template dir: {self._template_dirs}")
-        _jinja2_env = Environment(
-            loader=FileSystemLoader(self._template_dirs),
-            extensions=["jinja2.ext.do"],
-            autoescape=select_autoescape(
-                enabled_extensions=("j2", "jinja2"),
-                default_for_string=True,
-                default=True,
-            ),
-        )
-        return _jinja2_env
+        return _get_jinja2_environment(tuple(self._template_dirs))
 
-    def to_stdout(self, autocast_values: bool = False):
+    def _render_cache_key(self, j2_env: Environment) -> [str, None]:
+        # Template hash + the variables read by the template, None if the variables read can't be determined
+        _fingerprint = _get_template_fingerprint(j2_env, self._get_template)
+        if _fingerprint["keys"] is None:
+            return None
+        _variables = {
+            _key: self._variables.get(_key, "__undefined__")
+            for _key in sorted(_fingerprint["keys"])
+        }
+        return hashlib.sha256(
+            (
+                _fingerprint["hash"]
+                + json.dumps(_variables, sort_keys=True, default=str)
+            ).encode()
+        ).hexdigest()
+
+    def to_stdout(self, autocast_values: bool = False, use_cache: bool = False):
+        """
+        Render the template. When use_cache is True, templates rendered with the same template files and the same
+        values for the variables they read are served from an in-process cache
+        """
         try:
             _j2_env = self.build_jinja2_environment()
             if autocast_values:
@@ -53,10 +204,26 @@ class SocaJinja2Generator:
                 else:
                     return SocaError.JINJA_GENERATOR_ERROR(helper=_autocast.message)
 
+            _cache_key = self._render_cache_key(_j2_env) if use_cache else None
+            if _cache_key is not None:
+                with _jinja2_lock:
+                    _rendered_template = _render_cache.get(_cache_key)
+                    if _rendered_template is not None:
+                        _render_cache.move_to_end(_cache_key)
+                        _render_cache_metrics["hit"] += 1
+                        return SocaResponse(success=True, message=_rendered_template)
+                    _render_cache_metrics["miss"] += 1
+
             _rendered_template = _j2_env.get_template(self._get_template).render(
                 context=self._variables,
                 ns=SimpleNamespace(template_already_included=[]),
             )
+
+            if _cache_key is not None:
+                with _jinja2_lock:
+                    _render_cache[_cache_key] = _rendered_template
+                    while len(_render_cache) > RENDER_CACHE_MAXSIZE:
+                        _render_cache.popitem(last=False)
             return SocaResponse(success=True, message=_rendered_template)
         except Exception as err:
             exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -0,0 +1,334 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import re
+import subprocess
+import threading
+import time
+from typing import Optional
+from utils.cache import SocaCacheClient
+
+logger = logging.getLogger("soca_logger")
+
+PBS_NODES_SNAPSHOT_CACHE_KEY = "orchestrator/pbs_nodes_snapshot"
+
+_PBS_SIZE_UNITS = {
+    "b": 1 / 1024 / 1024,
+    "kb": 1 / 1024,
+    "mb": 1,
+    "gb": 1024,
+    "tb": 1024 * 1024,
+}
+
+
+def parse_pbs_size(value) -> float:
+    """
+    Convert a PBS size (e.g: 4gb, 512mb, 1024kb, 1048576) to MiB, PBS defaults to bytes when there is no unit
+    """
+    _match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?b?)\s*$", str(value).lower())
+    if not _match:
+        raise ValueError(f"Invalid PBS size {value}")
+    return float(_match.group(1)) * _PBS_SIZE_UNITS[_match.group(2) or "b"]
+
+
+class SocaPBSNodesSnapshot:
+    """
+    In-process view of all PBS nodes built from a single "pbsnodes -a -F json" call.
+    Nodes are indexed by compute_node, state, instance type and availability zone so free capacity and idle hosts
+    are answered from memory. A snapshot is shared with the other controller processes (dispatcher, nodes_manager, analytics)
+    through the cache, refresh() re-uses a snapshot taken by another process less than max_age seconds ago.
+    refresh(hostnames=[...]) only queries the given nodes (e.g: nodes added or set offline during the cycle).
+
+    example:
+        snapshot = get_pbs_nodes_snapshot()
+        snapshot.refresh()
+        snapshot.get_free_cpus("job123") -> 16
+        snapshot.get_nodes(state="free", instance_type="c6i.large") -> {"ip-10-0-0-1": <pbsnodes output>, ...}
+    """
+
+    def __init__(
+        self,
+        pbsnodes_bin: Optional[str] = "/opt/pbs/bin/pbsnodes",
+        max_age: Optional[int] = 30,
+        shared: Optional[bool] = True,
+    ):
+        self.pbsnodes_bin = pbsnodes_bin
+        self.max_age = max_age
+        self.shared = shared
+        self.error = None
+        self.timestamp = None
+        self.created_at = 0
+        self._lock = threading.RLock()
+        self._cache_client = None
+        self.nodes = {}
+        self.nodes_by_compute_node = {}
+        self.nodes_by_state = {}
+        self.nodes_by_instance_type = {}
+        self.nodes_by_availability_zone = {}
+
+    def _get_cache_client(self) -> [SocaCacheClient, None]:
+        if not self.shared:
+            return None
+        if self._cache_client is None:
+            try:
+                self._cache_client = SocaCacheClient(is_admin=True)
+            except Exception as err:
+                logger.warning(f"Unable to share pbsnodes snapshot: {err}")
+                self.shared = False
+                return None
+        return self._cache_client
+
+    def run_pbsnodes(self, hostnames: Optional[list] = None) -> [dict, None]:
+        """
+        Return the parsed pbsnodes output for all nodes or only for hostnames, or None and set error on failure
+        """
+        _cmd = [self.pbsnodes_bin, "-F", "json"]
+        _cmd += ["-v"] + hostnames if hostnames else ["-a"]
+        try:
+            _pbsnodes = subprocess.run(
+                _cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            )
+        except Exception as err:
+            self.error = f"Unable to run {self.pbsnodes_bin} due to {err}"
+            return None
+
+        # pbsnodes exits with rc==1 when the server has no node list or when a requested node does not exist anymore
+        if not _pbsnodes.stdout.strip():
+            if (
+                _pbsnodes.returncode == 0
+                or hostnames
+                or ("server has no node list" in _pbsnodes.stderr.lower())
+            ):
+                return {"nodes": {}}
+            self.error = f"Unable to run {self.pbsnodes_bin}: {_pbsnodes.stderr}"
+            return None
+        try:
+            return json.loads(_pbsnodes.stdout)
+        except ValueError as err:
+            self.error = f"Unable to parse pbsnodes output due to {err}"
+            return None
+
+    def refresh(
+        self,
+        pbsnodes_output: Optional[dict] = None,
+        hostnames: Optional[list] = None,
+        force: Optional[bool] = False,
+    ) -> bool:
+        """
+        Rebuild all indexes. Unless force is set, the current snapshot (or a snapshot shared by another process)
+        is kept when it is less than max_age seconds old. With hostnames, only these nodes are queried and updated.
+        Return False and keep the previous snapshot if pbsnodes fails.
+        """
+        with self._lock:
+            if hostnames:
+                _output = self.run_pbsnodes(hostnames=hostnames)
+                if _output is None:
+                    return False
+                for _hostname in hostnames:
+                    self.unindex_node(_hostname)
+                for _hostname, _data in _output.get("nodes", {}).items():
+                    self.index_node(_hostname, _data)
+                self._publish()
+                return True
+
+            _publish = False
+            if pbsnodes_output is None:
+                if not force and time.time() - self.created_at < self.max_age:
+                    return True
+                if not force:
+                    pbsnodes_output = self._load_shared()
+                if pbsnodes_output is None:
+                    pbsnodes_output = self.run_pbsnodes()
+                    if pbsnodes_output is None:
+                        logger.error(self.error)
+                        return False
+                    pbsnodes_output.setdefault("timestamp", time.time())
+                    _publish = True
+
+            self._build(pbsnodes_output)
+            if _publish:
+                self._publish()
+            return True
+
+    def _build(self, pbsnodes_output: dict) -> None:
+        self.error = None
+        self.nodes = {}
+        self.nodes_by_compute_node = {}
+        self.nodes_by_state = {}
+        self.nodes_by_instance_type = {}
+        self.nodes_by_availability_zone = {}
+        self.timestamp = pbsnodes_output.get("timestamp", time.time())
+        self.created_at = self.timestamp
+        for _hostname, _data in pbsnodes_output.get("nodes", {}).items():
+            self.index_node(_hostname, _data)
+
+    def _load_shared(self) -> [dict, None]:
+        _cache_client = self._get_cache_client()
+        if _cache_client is None:
+            return None
+        _cached = _cache_client.get(PBS_NODES_SNAPSHOT_CACHE_KEY)
+        if _cached.get("success") is False or not _cached.get("message"):
+            return None
+        try:
+            _pbsnodes_output = json.loads(_cached.get("message"))
+        except ValueError:
+            return None
+        if time.time() - _pbsnodes_output.get("timestamp", 0) >= self.max_age:
+            return None
+        return _pbsnodes_output
+
+    def _publish(self) -> None:
+        _cache_client = self._get_cache_client()
+        if _cache_client is None:
+            return
+        _set = _cache_client.set(
+            key=PBS_NODES_SNAPSHOT_CACHE_KEY,
+            value=json.dumps({"timestamp": self.timestamp, "nodes": self.nodes}),
+            ex=max(int(self.max_age), 1),
+        )
+        if _set.get("success") is False:
+            logger.warning(f"Unable to share pbsnodes snapshot: {_set.get('message')}")
+
+    def index_node(self, hostname: str, data: dict) -> None:
+        """
+        Add or update a node in all indexes
+        """
+        self.unindex_node(hostname)
+        self.nodes[hostname] = data
+        for _index, _key in self._index_keys(data):
+            _index.setdefault(_key, {})[hostname] = None
+
+    def unindex_node(self, hostname: str) -> None:
+        """
+        Remove a node from all indexes
+        """
+        _data = self.nodes.pop(hostname, None)
+        if _data is None:
+            return
+        for _index, _key in self._index_keys(_data):
+            _index.get(_key, {}).pop(hostname, None)
+
+    def _index_keys(self, data: dict) -> list:
+        _resources = data.get("resources_available", {})
+        # A node can have several states at once (e.g: "down,offline")
+        _keys = [
+            (self.nodes_by_state, _state.strip())
+            for _state in str(data.get("state", "")).split(",")
+        ]
+        for _index, _resource in (
+            (self.nodes_by_compute_node, "compute_node"),
+            (self.nodes_by_instance_type, "instance_type"),
+            (self.nodes_by_availability_zone, "availability_zone"),
+        ):
+            if _resources.get(_resource) is not None:
+                _keys.append((_index, _resources[_resource]))
+        return _keys
+
+    def get_nodes(
+        self,
+        compute_node: Optional[str] = None,
+        state: Optional[str] = None,
+        instance_type: Optional[str] = None,
+        availability_zone: Optional[str] = None,
+    ) -> dict:
+        """
+        Return the pbsnodes data of the nodes matching all the specified filters
+        """
+        with self._lock:
+            _hostnames = None
+            for _index, _key in (
+                (self.nodes_by_compute_node, compute_node),
+                (self.nodes_by_state, state),
+                (self.nodes_by_instance_type, instance_type),
+                (self.nodes_by_availability_zone, availability_zone),
+            ):
+                if _key is None:
+                    continue
+                _matching = _index.get(_key, {})
+                _hostnames = (
+                    list(_matching)
+                    if _hostnames is None
+                    else [_h for _h in _hostnames if _h in _matching]
+                )
+            if _hostnames is None:
+                _hostnames = list(self.nodes)
+            return {_hostname: self.nodes[_hostname] for _hostname in _hostnames}
+
+    def get_free_capacity(self, compute_node: str, min_age: Optional[int] = 60) -> list:
+        """
+        Return the free capacity of the free nodes of compute_node as a list of {"hostname", "ncpus", "mem" (MiB)}.
+        Nodes which changed state less than min_age seconds ago are ignored.
+        """
+        _free_capacity = []
+        _now = time.time()
+        for _hostname, _data in self.get_nodes(
+            compute_node=compute_node, state="free"
+        ).items():
+            if str(_data.get("state")) != "free" or _now <= (
+                _data.get("last_state_change_time", 0) + min_age
+            ):
+                continue
+            _available = _data.get("resources_available", {})
+            _assigned = _data.get("resources_assigned", {})
+            _free_cpus = int(_available.get("ncpus", 0)) - int(
+                _assigned.get("ncpus", 0)
+            )
+            _free_mem = parse_pbs_size(_available.get("mem", 0)) - parse_pbs_size(
+                _assigned.get("mem", 0)
+            )
+            if _free_cpus > 0:
+                _free_capacity.append(
+                    {
+                        "hostname": _hostname,
+                        "ncpus": _free_cpus,
+                        "mem": max(_free_mem, 0),
+                    }
+                )
+        return _free_capacity
+
+    def get_free_cpus(self, compute_node: str, min_age: Optional[int] = 60) -> int:
+        """
+        Return the number of free cpus on the free nodes of compute_node
+        """
+        return sum(
+            _node["ncpus"] for _node in self.get_free_capacity(compute_node, min_age)
+        )
+
+    def get_idle_hosts(self) -> dict:
+        """
+        Return the free hosts without any job as {hostname: idle_since}.
+        idle_since is the last time a job ran on the host, or 15 minutes after its last state change if no job ever ran on it.
+        """
+        _idle_hosts = {}
+        for _hostname, _data in self.get_nodes(state="free").items():
+            if (
+                "jobs" in _data
+                or str(_data.get("state")) != "free"
+                or _data.get("pcpus")
+                != _data.get("resources_available", {}).get("ncpus")
+            ):
+                continue
+            if "last_used_time" in _data:
+                _idle_hosts[_hostname] = _data["last_used_time"]
+            else:
+                # Automatically remove capacity after 15 mins if no job ran on it
+                _idle_hosts[_hostname] = _data.get("last_state_change_time", 0) + 900
+        return _idle_hosts
+
+
+_pbs_nodes_snapshot = {}
+
+
+def get_pbs_nodes_snapshot(
+    pbsnodes_bin: Optional[str] = "/opt/pbs/bin/pbsnodes",
+) -> SocaPBSNodesSnapshot:
+    """
+    Return the pbsnodes snapshot of the current process
+    """
+    if _pbs_nodes_snapshot.get(pbsnodes_bin) is None:
+        _pbs_nodes_snapshot[pbsnodes_bin] = SocaPBSNodesSnapshot(
+            pbsnodes_bin=pbsnodes_bin
+        )
+    return _pbs_nodes_snapshot[pbsnodes_bin]
@@ -18,6 +18,7 @@ from datetime import datetime, timezone
 
 import json
 from utils.aws.ssm_parameter_store import SocaConfig
+from utils.aws.ec2_instance_catalog import get_instance_catalog
 from decorators import private_api
 from flask import request
 import re
@@ -455,14 +456,13 @@ class CreateVirtualDesktop(Resource):
 
             if args["hibernate"]:
                 try:
-                    check_hibernation_support = client_ec2.describe_instance_types(
-                        InstanceTypes=[instance_type],
-                        Filters=[{"Name": "hibernation-supported", "Values": ["true"]}],
+                    check_hibernation_support = (
+                        get_instance_catalog().supports_hibernation(instance_type)
                     )
                     logger.debug(
                         f"Checking instance {instance_type} for Hibernation support: {check_hibernation_support}"
                     )
-                    if len(check_hibernation_support.get("InstanceTypes", {})) == 0:
+                    if check_hibernation_support is False:
                         if config.Config.DCV_FORCE_INSTANCE_HIBERNATE_SUPPORT is True:
                             return SocaError.VIRTUAL_DESKTOP_LAUNCH_ERROR(
                                 session_number=args["session_name"],
@@ -19,7 +19,7 @@ import os
 import sys
 from models import db, VirtualDesktopSessions, SoftwareStacks, VirtualDesktopProfiles
 import utils.aws.boto3_wrapper as utils_boto3
-from utils.aws.ssm_parameter_store import SocaConfig
+from utils.aws.ssm_parameter_store import SocaConfigSnapshot
 from utils.error import SocaError
 from utils.response import SocaResponse
 
@@ -72,7 +72,7 @@ class ListAllVirtualDesktops(Resource):
         user_sessions = {}
         logger.info("Getting Session information for all session")
 
-        _get_soca_parameters = SocaConfig(key="/").get_value(return_as=dict)
+        _get_soca_parameters = SocaConfigSnapshot.get_snapshot()
         if _get_soca_parameters.get("success") is False:
             return SocaError.GENERIC_ERROR(
                 helper=f"Unable to retrieve SOCA Parameters: {_get_soca_parameters.get('message')}"
@@ -13,76 +13,17 @@
 
 from flask_restful import Resource, reqparse
 import logging
-import ast
 import re
 import math
-import utils.aws.boto3_wrapper as utils_boto3
 from utils.response import SocaResponse
-from utils.aws.ssm_parameter_store import SocaConfig
+from utils.aws.ec2_pricing_index import get_pricing_index
 
 logger = logging.getLogger("soca_logger")
 
 
 def get_compute_pricing(instance_type: str) -> dict:
-    _pricing = {}
-    client_pricing = utils_boto3.get_boto(
-        service_name="pricing", region_name="us-east-1"
-    ).message
-
-    region = SocaConfig(key="/configuration/Region").get_value().message
-
-    response = client_pricing.get_products(
-        ServiceCode="AmazonEC2",
-        Filters=[
-            {
-                "Type": "TERM_MATCH",
-                "Field": "instanceType",
-                "Value": instance_type,
-            },
-            {
-                "Type": "TERM_MATCH",
-                "Field": "regionCode",
-                "Value": region,
-            },
-            {
-                "Type": "TERM_MATCH",
-                "Field": "operatingSystem",
-                "Value": "Linux",
-            },
-            {
-                "Type": "TERM_MATCH",
-                "Field": "tenancy",
-                "Value": "Shared",
-            },
-        ],
-    )
-    logger.debug(f"Retrieving pricing information for {instance_type}: {response}")
-    for data in response["PriceList"]:
-        _price_list = ast.literal_eval(data)
-        for term_type, term_data in _price_list["terms"].items():
-            for sku, sku_data in term_data.items():
-                for rate_code, price_dimension in sku_data["priceDimensions"].items():
-                    description = price_dimension["description"].lower()
-                    price = float(price_dimension["pricePerUnit"]["USD"])
-
-                    # On-Demand Pricing
-                    if (
-                        term_type == "OnDemand"
-                        and f"on demand linux {instance_type} instance hour"
-                        in description.lower()
-                    ):
-                        _pricing["ondemand"] = price
-
-                    # Reserved Pricing (1 year, no upfront)
-                    elif (
-                        term_type != "OnDemand"
-                        and sku_data["termAttributes"]["OfferingClass"] == "standard"
-                        and sku_data["termAttributes"]["LeaseContractLength"] == "1yr"
-                        and sku_data["termAttributes"]["PurchaseOption"] == "No Upfront"
-                        and "linux/unix (amazon vpc)" in description.lower()
-                    ):
-                        _pricing["reserved"] = price
-    return _pricing
+    # Served from the in-memory pricing index of the cluster region, no Pricing API call per request once it is downloaded
+    return get_pricing_index().get_price(instance_type, api_fallback=True)
 
 
 class AwsPrice(Resource):
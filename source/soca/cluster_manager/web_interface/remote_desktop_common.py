@@ -15,6 +15,7 @@ import time
 import logging
 from utils.aws.ssm_parameter_store import SocaConfig
 import utils.aws.boto3_wrapper as utils_boto3
+from utils.aws.ec2_instance_catalog import get_instance_catalog
 from utils.cache import SocaCacheClient
 from models import SoftwareStacks, VirtualDesktopSessions
 import random
@@ -196,30 +197,15 @@ def _generate_allowed_instances_list_aws_api() -> list:
         f"Cluster configuration allowed DCV list: {_config_allowed_list}  BareMetal: {_config_allow_metal}, PreviousGeneration: {_config_allow_prevgen}"
     )
 
-    _filters: list = []
-
-    if not _config_allow_prevgen:
-        _filters.append({"Name": "current-generation", "Values": ["true"]})
-
-    if not _config_allow_metal:
-        _filters.append({"Name": "bare-metal", "Values": ["false"]})
-
-    # Add our instance types from config
-    _filters.append({"Name": "instance-type", "Values": _config_allowed_list})
-
     _start = time.perf_counter_ns()
-    _ec2_paginator = client_ec2.get_paginator("describe_instance_types")
-    _ec2_iterator = _ec2_paginator.paginate(Filters=_filters)
-
-    _page_count: int = 0
-    for _page in _ec2_iterator:
-        _page_count += 1
-        _instance_list: list = _page.get("InstanceTypes", [])
-        for _instance in _instance_list:
-            _allowed_list.append(_instance.get("InstanceType", "unknown-instance-name"))
+    _allowed_list = get_instance_catalog().list_instance_types(
+        patterns=_config_allowed_list,
+        current_generation=None if _config_allow_prevgen else True,
+        bare_metal=None if _config_allow_metal else False,
+    )
     _duration_ms = (time.perf_counter_ns() - _start) / 1_000_000
     logger.info(
-        f"Refreshed instances list of {len(_allowed_list)} instances from AWS in {_duration_ms} ms ({_page_count} API pages)"
+        f"Refreshed instances list of {len(_allowed_list)} instances from the EC2 instance catalog in {_duration_ms} ms"
     )
     # TODO - Should these be sorted for the end-user?
     # For example - display the more recent / newer instance families first in the list
@@ -265,17 +251,8 @@ def get_arch_for_instance_type(instancetype: str) -> str:
     """
     logger.debug(f"Retrieving architecture for instance type: {instancetype}")
     _found_arch = None
-    _resp = client_ec2.describe_instance_types(InstanceTypes=[instancetype])
-    _instance_info = _resp.get("InstanceTypes", {})
-    for _i in _instance_info:
-        _instance_name = _i.get("InstanceType", None)
-        # This shouldn't happen with an exact-match search
-        if _instance_name != instancetype:
-            continue
-
-        _proc_info = _i.get("ProcessorInfo", {})
-        if _proc_info:
-            _arch = sorted(_proc_info.get("SupportedArchitectures", []))
-            _found_arch = _arch[0]
+    _summary = get_instance_catalog().get_summary(instancetype)
+    if _summary and _summary.get("architectures"):
+        _found_arch = sorted(_summary.get("architectures").split(","))[0]
 
     return _found_arch
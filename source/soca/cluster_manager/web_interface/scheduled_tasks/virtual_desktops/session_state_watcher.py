@@ -5,7 +5,7 @@ import logging
 from extensions import db
 from models import VirtualDesktopSessions
 import utils.aws.boto3_wrapper as utils_boto3
-from utils.aws.ssm_parameter_store import SocaConfig
+from utils.aws.ssm_parameter_store import SocaConfigSnapshot
 from utils.http_client import SocaHttpClient
 from utils.response import SocaResponse
 from botocore.exceptions import ClientError
@@ -46,7 +46,7 @@ def process_chunk(
     try:
         logger.info(f"Processing chunk {sessions}")
 
-        _get_soca_parameters = SocaConfig(key="/").get_value(return_as=dict)
+        _get_soca_parameters = SocaConfigSnapshot.get_snapshot()
         if _get_soca_parameters.get("success") is False:
             logger.critical(
                 f"Unable to retrieve SOCA Parameters: {_get_soca_parameters.get('message')}"